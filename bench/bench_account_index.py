@@ -0,0 +1,343 @@
+"""
+採用担当アカウントの索引（src/account_index.py）と、以前の全件走査の比較
+
+疑似 Firestore（bench/fake_firestore.py）の accounts/{uid}/jobbox_accounts と engage_accounts に
+--accounts 件ずつ入れ、通知のアカウント名（とアカウントID）での検索を次の2通りで行う。
+
+    scan    以前の watch_mail と同じ。コレクションを pageSize=100 で全件読み、全件を正規化して
+            先頭から比べる（求人ボックスは一覧を5分キャッシュしていたので、一覧の読み込みと走査を分けて測る）
+    index   AccountIndex.find（watcher.firestore の一覧・batchGet を使う）
+
+確認すること（違えば不一致として数える）:
+    - すべての検索で scan と index が同じアカウントを返す（同名の重複・全角/空白違い・アカウントID違い・
+      account_name のないドキュメント・見つからない名前を含む）
+    - 追加・変更・削除のあとの refresh が、account_name だけの一覧（ページ数分）と媒体ごとに1回の batchGet で
+      終わり、generation が増え、その後の検索結果も scan と一致する
+    - 変更がなければ refresh で generation が変わらず、batchGet も呼ばれない
+    - 管理していないアカウント名の通知が続くとき、見つからなかった結果を覚えていれば（ACCOUNT_NEGATIVE_TTL）
+      2回目以降は Firestore を読まない。アカウントが追加されて generation が変わると忘れて見つかるようになり、
+      期限が切れると確認し直す（覚えない場合は見つからないたびに一覧を読み直す）
+
+使い方:
+    python bench/bench_account_index.py [--accounts 3000] [--lookups 500] [--changes 30] [--latency-ms 5]
+                                        [--unknown 5] [--repeats 4]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import unicodedata
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from fake_firestore import FakeFirestore  # noqa: E402
+
+UID = 'bench-uid'
+PROJECT = 'bench-accounts'
+
+
+def _legacy_norm(s):
+    """以前の _norm と同じ"""
+    if not s:
+        return ''
+    t = unicodedata.normalize('NFKC', s)
+    t = re.sub(r"\s+", '', t)
+    return t.lower()
+
+
+def _legacy_list(session, fs, collection, keys):
+    """以前の _get_jobbox_accounts / _get_engage_accounts と同じ読み込み（pageSize=100 の全件）"""
+    url = f'http://{fs.host}/v1/projects/{PROJECT}/databases/(default)/documents/accounts/{UID}/{collection}'
+    accounts, token = [], None
+    while True:
+        params = {'pageSize': 100}
+        if token:
+            params['pageToken'] = token
+        data = session.get(url, params=params, timeout=30).json()
+        for d in data.get('documents', []):
+            flds = d.get('fields', {})
+            account = {k: flds.get(k, {}).get('stringValue') for k in keys}
+            if account.get('account_name'):
+                accounts.append(account)
+        token = data.get('nextPageToken')
+        if not token:
+            return accounts
+
+
+def _legacy_find(accounts, name, account_id=''):
+    """以前の _resolve_jobbox_account / _resolve_engage_account の走査"""
+    parsed_norm = _legacy_norm(name.strip())
+    account_id = account_id.strip()
+    for ra in accounts:
+        ra_norm = _legacy_norm(ra.get('account_name') or '')
+        if not (ra_norm and ra_norm == parsed_norm):
+            continue
+        if account_id:
+            if (ra.get('account_id') or '').strip() == account_id:
+                return ra
+        else:
+            return ra
+    return None
+
+
+def _seed(fs, n, rnd):
+    base = f'accounts/{UID}'
+    for i in range(n):
+        name = f'株式会社サンプル{i // 3}'  # 3件ずつ同じ会社名（アカウントIDで区別する）
+        doc = {'account_name': name, 'account_id': f'A{i:06d}', 'jobbox_id': f'user{i}@example.com',
+               'jobbox_password': f'pw{i}', 'memo': 'x' * 200}
+        if i % 50 == 0:
+            doc['account_name'] = ''  # account_name のないドキュメントは対象外
+        fs.put(f'{base}/jobbox_accounts/{fs.new_id()}', doc)
+        fs.put(f'{base}/engage_accounts/{fs.new_id()}', {
+            'account_name': f'有限会社　テスト {i}' if i % 7 else f'ｴﾝｹﾞｰｼﾞ商事{i // 2}',
+            'engage_id': f'eng{i}', 'engage_password': f'epw{i}', 'memo': 'y' * 200})
+
+
+def _queries(n, lookups, rnd):
+    out = []
+    for _ in range(lookups):
+        i = rnd.randrange(n)
+        kind = rnd.random()
+        if kind < 0.4:
+            out.append(('jobbox', f'株式会社 サンプル{i // 3}', f'A{i:06d}'))     # 空白違い + ID 一致
+        elif kind < 0.55:
+            out.append(('jobbox', f'株式会社サンプル{i // 3}', ''))              # 名前だけ（重複の先頭）
+        elif kind < 0.65:
+            out.append(('jobbox', f'株式会社サンプル{i // 3}', f'B{i:06d}'))     # ID 違い
+        elif kind < 0.9:
+            out.append(('engage', f'有限会社 テスト {i}' if i % 7 else f'エンゲージ商事{i // 2}', ''))
+        else:
+            out.append((rnd.choice(['jobbox', 'engage']), f'未登録の会社{i}', ''))
+    return out
+
+
+def _compare(index, legacy, queries):
+    bad = 0
+    for platform, name, account_id in queries:
+        want = _legacy_find(legacy[platform], name, account_id)
+        got = index.find(UID, platform, name, account_id)
+        if want != got:
+            bad += 1
+    return bad
+
+
+def _requests(fs):
+    return {k: fs.counters.get(k, 0) for k in ('get', 'post:batchGet')}
+
+
+def _negative_checks(fs, args, rnd, sink):
+    """管理していないアカウント名の通知が続くとき。(結果の行, 不一致数) を返す"""
+    from account_index import AccountIndex
+    from watcher.firestore import batch_get_documents, list_account_documents
+
+    mismatches = 0
+    rows = []
+    unknown = [(rnd.choice(['jobbox', 'engage']), f'管理外の会社{n}', '') for n in range(args.unknown)]
+    indexes = {}
+    # miss_refresh=0 は見つからないたびに確認し直す（以前の、通知ごとに一覧を読む動作に相当）
+    for label, negative_ttl in (('未登録の名前（覚えない）', 0), ('未登録の名前（覚える）', 60)):
+        index = indexes[negative_ttl] = AccountIndex(list_account_documents, batch_get_documents, ttl=3600,
+                                                     miss_refresh=0, negative_ttl=negative_ttl, name=label)
+        with contextlib.redirect_stdout(sink):
+            index.refresh(UID)
+            before = sum(_requests(fs).values())
+            t0 = time.perf_counter()
+            found = [index.find(UID, p, name, aid) for _ in range(args.repeats) for p, name, aid in unknown]
+        elapsed = (time.perf_counter() - t0) * 1000 / len(found)
+        req = sum(_requests(fs).values()) - before
+        rows.append((label, elapsed, req))
+        if any(found):
+            print(f'{label}: 未登録の名前でアカウントが返りました')
+            mismatches += 1
+    # 覚える場合は最初の1回ずつだけ確認し直す（媒体ごとの account_name だけの一覧）
+    pages = 2 * -(-(args.accounts + args.changes) // 300)
+    if rows[-1][2] > args.unknown * pages:
+        print(f'見つからなかった結果を覚えても {rows[-1][2]} 回読みました（上限 {args.unknown * pages}）')
+        mismatches += 1
+
+    # 未登録だった名前のアカウントを追加すると、generation が変わって覚えていた結果が消える
+    index = indexes[60]
+    platform, name, _ = unknown[0]
+    coll = 'jobbox_accounts' if platform == 'jobbox' else 'engage_accounts'
+    fs.put(f'accounts/{UID}/{coll}/{fs.new_id()}', {
+        'account_name': name, 'jobbox_id': 'added', 'jobbox_password': 'pw', 'engage_id': 'added',
+        'engage_password': 'pw'})
+    gen = index.generation(UID)
+    with contextlib.redirect_stdout(sink):
+        index.refresh(UID)
+    remembered = index.stats()['uids'][0]['negative']
+    got = index.find(UID, platform, name)
+    if index.generation(UID) == gen or remembered or not got or got.get('account_name') != name:
+        print(f'アカウント追加後: generation {gen} → {index.generation(UID)} / 覚えていた結果 {remembered} 件 / '
+              f'見つかったか {bool(got)}')
+        mismatches += 1
+
+    # 期限が切れたら確認し直す
+    index = AccountIndex(list_account_documents, batch_get_documents, ttl=3600, miss_refresh=0,
+                         negative_ttl=0.2, name='bench-expire')
+    with contextlib.redirect_stdout(sink):
+        index.refresh(UID)
+        platform, name, _ = unknown[-1]
+        index.find(UID, platform, name)
+        before = sum(_requests(fs).values())
+        index.find(UID, platform, name)
+        cached = sum(_requests(fs).values()) - before
+        time.sleep(0.3)
+        index.find(UID, platform, name)
+        expired = sum(_requests(fs).values()) - before - cached
+    if cached or not expired:
+        print(f'期限の確認: 期限内の再検索で {cached} 回 / 期限切れ後に {expired} 回読みました')
+        mismatches += 1
+    return rows, mismatches
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--accounts', type=int, default=3000, help='媒体ごとのアカウント数')
+    ap.add_argument('--lookups', type=int, default=500)
+    ap.add_argument('--changes', type=int, default=30, help='追加・変更・削除それぞれの件数')
+    ap.add_argument('--latency-ms', type=float, default=5.0, help='疑似 Firestore の応答の遅れ')
+    ap.add_argument('--unknown', type=int, default=5, help='管理していないアカウント名の数')
+    ap.add_argument('--repeats', type=int, default=4, help='管理していないアカウント名ごとの通知数')
+    ap.add_argument('--seed', type=int, default=7)
+    args = ap.parse_args()
+
+    import requests
+
+    rnd = random.Random(args.seed)
+    fs = FakeFirestore(project=PROJECT, seed=args.seed).start()
+    _seed(fs, args.accounts, rnd)
+    fs.latency_ms = args.latency_ms
+
+    tmp = tempfile.mkdtemp(prefix='bench_accounts_')
+    with open(os.path.join(tmp, 'service-account'), 'w', encoding='utf-8') as f:
+        json.dump({'project_id': PROJECT}, f)
+    os.chdir(tmp)
+    os.environ['FIRESTORE_EMULATOR_HOST'] = fs.host
+
+    from account_index import ACCOUNT_COLLECTIONS, AccountIndex
+    from watcher.firestore import batch_get_documents, list_account_documents
+
+    session = requests.Session()
+    queries = _queries(args.accounts, args.lookups, rnd)
+    mismatches = 0
+    rows = []
+
+    # --- 以前の全件走査 ---
+    t0 = time.perf_counter()
+    legacy = {p: _legacy_list(session, fs, coll, keys) for p, (coll, keys) in ACCOUNT_COLLECTIONS.items()}
+    list_sec = (time.perf_counter() - t0) / 2
+    t0 = time.perf_counter()
+    for platform, name, account_id in queries:
+        _legacy_find(legacy[platform], name, account_id)
+    scan_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    rows.append(('scan（一覧の読み込み 1回）', list_sec * 1000, '-'))
+    rows.append(('scan（キャッシュ済みの走査）', scan_ms, '-'))
+    rows.append(('scan（engage: 毎回読み込み）', list_sec * 1000 + scan_ms, '-'))
+
+    # --- 索引 ---
+    index = AccountIndex(list_account_documents, batch_get_documents, ttl=3600, miss_refresh=3600,
+                         negative_ttl=60, name='bench')
+    sink = io.StringIO()
+    before = _requests(fs)
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(sink):
+        index.refresh(UID)
+    load_ms = (time.perf_counter() - t0) * 1000
+    load_req = sum(_requests(fs).values()) - sum(before.values())
+    rows.append(('index（初回の読み込み）', load_ms, load_req))
+
+    before = _requests(fs)
+    bad = _compare(index, legacy, queries)
+    # _compare は scan も含むので、find だけを別に測る
+    t0 = time.perf_counter()
+    for platform, name, account_id in queries:
+        index.find(UID, platform, name, account_id)
+    find_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    find_req = sum(_requests(fs).values()) - sum(before.values())
+    rows.append(('index.find', find_ms, find_req))
+    if bad:
+        print(f'初回の読み込み後: scan と結果が違う検索 {bad} 件')
+    mismatches += bad
+    if find_req:
+        print(f'索引の検索で Firestore に {find_req} 回問い合わせました（0 回のはず）')
+        mismatches += 1
+
+    # --- 変更なしの refresh ---
+    gen = index.generation(UID)
+    before = _requests(fs)
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(sink):
+        index.refresh(UID)
+    idle_ms = (time.perf_counter() - t0) * 1000
+    delta = {k: v - before[k] for k, v in _requests(fs).items()}
+    rows.append(('refresh（変更なし）', idle_ms, sum(delta.values())))
+    if index.generation(UID) != gen or delta['post:batchGet']:
+        print(f'変更なしの refresh で generation {gen} → {index.generation(UID)} / batchGet {delta["post:batchGet"]} 回')
+        mismatches += 1
+
+    # --- 追加・変更・削除のあとの refresh ---
+    base = f'accounts/{UID}'
+    for p, (coll, _keys) in ACCOUNT_COLLECTIONS.items():
+        ids = sorted(fs.collections[f'{base}/{coll}'])
+        for doc_id in rnd.sample(ids, args.changes * 2)[:args.changes]:
+            fs.delete(f'{base}/{coll}/{doc_id}')
+        ids = sorted(fs.collections[f'{base}/{coll}'])
+        for n, doc_id in enumerate(rnd.sample(ids, args.changes)):
+            doc = fs.get(f'{base}/{coll}/{doc_id}')
+            if n % 2:
+                doc['account_name'] = f'株式会社サンプル{rnd.randrange(args.accounts // 3)}'
+            doc[f'{p}_password' if p == 'jobbox' else 'engage_password'] = 'changed'
+            fs.put(f'{base}/{coll}/{doc_id}', doc)
+        for n in range(args.changes):
+            fs.put(f'{base}/{coll}/{fs.new_id()}', {
+                'account_name': f'新規の会社{n}', 'account_id': f'N{n:04d}', 'jobbox_id': f'new{n}',
+                'jobbox_password': 'pw', 'engage_id': f'new{n}', 'engage_password': 'pw'})
+            queries.append((p, f'新規の会社{n}', f'N{n:04d}' if p == 'jobbox' else ''))
+    legacy = {p: _legacy_list(session, fs, coll, keys) for p, (coll, keys) in ACCOUNT_COLLECTIONS.items()}
+
+    before = _requests(fs)
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(sink):
+        index.refresh(UID)
+    change_ms = (time.perf_counter() - t0) * 1000
+    delta = {k: v - before[k] for k, v in _requests(fs).items()}
+    rows.append((f'refresh（{args.changes}件ずつ追加・変更・削除）', change_ms, sum(delta.values())))
+    pages = 2 * -(-(args.accounts + args.changes) // 300)
+    if index.generation(UID) == gen or delta['post:batchGet'] != 2 or delta['get'] > pages:
+        print(f'変更後の refresh: generation {gen} → {index.generation(UID)} / 一覧 {delta["get"]} 回 '
+              f'(上限 {pages}) / batchGet {delta["post:batchGet"]} 回')
+        mismatches += 1
+    bad = _compare(index, legacy, queries)
+    if bad:
+        print(f'変更の反映後: scan と結果が違う検索 {bad} 件')
+    mismatches += bad
+
+    negative_rows, bad = _negative_checks(fs, args, rnd, sink)
+    rows.extend(negative_rows)
+    mismatches += bad
+
+    fs.stop()
+    print(f'アカウント {args.accounts} 件 × 2媒体 / 検索 {len(queries)} 回 / 応答の遅れ {args.latency_ms:g}ms')
+    print(f"{'処理':<36} {'ms/回':>9} {'要求':>5}")
+    for label, ms, req in rows:
+        print(f'{label:<36} {ms:>9.3f} {req:>5}')
+    stats = index.stats()
+    print(f"hits {stats['hits']} / misses {stats['misses']} (覚えていた結果 {stats['negative_hits']}) / "
+          f"generation {index.generation(UID)}")
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
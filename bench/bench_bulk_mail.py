@@ -0,0 +1,181 @@
+"""
+予約メールの一括送信（bulk_mail）の計測（疑似 SMTP サーバー・疑似 mail_settings を使用）
+
+同じ時刻に期限になったメールタスクを
+    legacy:  タスクごとに mail_settings を読み、テンプレートを展開して send_mail_once（接続の再利用なし）
+    bulk:    送信元ごとに設定を1回だけ読み、render_many で先に展開して少数の SMTP セッションで流す
+で送り、送信件数/秒・メッセージごとの p50 / p95・接続数・設定の読込回数を比べる。
+両方で同じ件名・本文が届いていることも確認する。
+タスク ID のないタスクを混ぜたときに、一括送信の結果が他のタスクの結果を上書きせず、
+ID のあるタスクだけが1件ずつ結果に入ることも確認する（DRY_RUN_MAIL で送信はしない）。
+
+使い方:
+    python bench/bench_bulk_mail.py [--tasks 300] [--senders 2] [--sessions 2] [--settings-latency-ms 80]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from email import message_from_bytes, policy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['EMAIL_SMTP_SSL'] = 'false'
+os.environ['EMAIL_SMTP_HOST'] = '127.0.0.1'
+# 同じタスクを2回（legacy / bulk）送るため、outbox の二重送信防止は使わない
+os.environ['OUTBOX'] = 'false'
+
+import bulk_mail  # noqa: E402
+import smtp_pool  # noqa: E402
+from email_watcher import apply_template_tokens, send_mail_once  # noqa: E402
+from fake_smtp_server import FakeSmtpServer  # noqa: E402
+
+PASSWORD = 'app-pass'
+
+SUBJECT = '【{{company}}】{{applicant_name}} 様 面接日程のご案内'
+BODIES = [
+    '{{applicant_name}} 様\n\nこの度は「{{job_title}}」にご応募いただきありがとうございます。\n'
+    '{{company}} 採用担当です。面接日程についてご連絡いたします。\n',
+    '<p>{{applicant_name}} 様</p><p>{{company}} の「{{job_title}}」へのご応募ありがとうございます。</p>',
+]
+
+
+class _Settings:
+    """疑似 mail_settings（Firestore の読込遅延を再現し、読込回数を数える）"""
+
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.reads = 0
+
+    def __call__(self, uid):
+        self.reads += 1
+        time.sleep(self.latency_ms / 1000.0)
+        return {'email': f'{uid}@example.com', 'appPass': PASSWORD}
+
+
+def _tasks(n, senders):
+    tasks = []
+    for i in range(n):
+        tasks.append({
+            'id': f'task{i:05d}',
+            'uid': f'uid{i % senders}',
+            'taskType': 'mail',
+            'to': f'applicant{i}@example.com',
+            'subject': SUBJECT,
+            'template': BODIES[i % len(BODIES)],
+            'applicantDetail': {'applicant_name': f'応募者{i}', 'company': f'株式会社テスト{i % 7}',
+                                'title': f'倉庫スタッフ<{i % 5}>'},
+        })
+    return tasks
+
+
+def _legacy(tasks, settings):
+    latencies = []
+    ok = 0
+    t0 = time.perf_counter()
+    for task in tasks:
+        t1 = time.perf_counter()
+        cfg = settings(task['uid'])
+        subject = apply_template_tokens(task['subject'], task['applicantDetail'])
+        body = apply_template_tokens(task['template'], task['applicantDetail'])
+        if send_mail_once(cfg['email'], cfg['appPass'], task['to'], subject, body)[0]:
+            ok += 1
+        latencies.append((time.perf_counter() - t1) * 1000)
+    return ok, time.perf_counter() - t0, sorted(latencies)
+
+
+def _bulk(tasks, settings, sessions):
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = bulk_mail.send_mail_tasks_bulk(tasks, settings, prefer_reply=False, sessions=sessions)
+    elapsed = time.perf_counter() - t0
+    ok = sum(1 for success, _ in results.values() if success)
+    return ok, elapsed, bulk_mail.bulk_mail_stats()
+
+
+def _missing_id_check(settings):
+    """タスク ID のないタスクを混ぜて一括送信する。不一致の数を返す"""
+    tasks = _tasks(6, 2)
+    for t in tasks[:2]:
+        t['id'] = None
+    tasks[2].pop('id')
+    os.environ['DRY_RUN_MAIL'] = 'true'
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = bulk_mail.send_mail_tasks_bulk(tasks, settings, prefer_reply=False)
+    finally:
+        del os.environ['DRY_RUN_MAIL']
+    expected = {t['id'] for t in tasks[3:]}
+    ok = set(results) == expected and all(success for success, _ in results.values())
+    print(f'タスク ID なし 3件 + あり 3件 → 結果 {len(results)}件（ID なしは一括送信しない）: {"OK" if ok else "NG"}')
+    return 0 if ok else 1
+
+
+def _received(srv):
+    """届いたメッセージを (宛先, 件名, 本文) の集合にする"""
+    out = set()
+    for raw in srv.raw_messages:
+        msg = message_from_bytes(raw, policy=policy.default)
+        part = msg.get_body(preferencelist=('html', 'plain'))
+        out.add((str(msg['To']), str(msg['Subject']), part.get_content().strip()))
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description='予約メールの一括送信の計測')
+    ap.add_argument('--tasks', type=int, default=300)
+    ap.add_argument('--senders', type=int, default=2)
+    ap.add_argument('--sessions', type=int, default=2)
+    ap.add_argument('--settings-latency-ms', type=float, default=80.0, help='mail_settings 読込1回の遅延')
+    ap.add_argument('--connect-latency-ms', type=float, default=60.0)
+    ap.add_argument('--auth-latency-ms', type=float, default=40.0)
+    ap.add_argument('--message-latency-ms', type=float, default=2.0)
+    args = ap.parse_args()
+
+    tasks = _tasks(args.tasks, args.senders)
+    print(f'tasks: {args.tasks} / senders: {args.senders} / sessions: {args.sessions} / '
+          f'settings {args.settings_latency_ms}ms / connect {args.connect_latency_ms}ms + auth {args.auth_latency_ms}ms')
+    print(f"{'mode':<10} {'msg/s':>8} {'p50':>9} {'p95':>9} {'sent':>6} {'received':>8} {'connections':>11} {'settings':>8}")
+
+    received = {}
+    for mode in ('legacy', 'bulk'):
+        os.environ['SMTP_POOL'] = 'false' if mode == 'legacy' else 'true'
+        smtp_pool._pool = None
+        srv = FakeSmtpServer(connect_latency_ms=args.connect_latency_ms, auth_latency_ms=args.auth_latency_ms,
+                             message_latency_ms=args.message_latency_ms, password=PASSWORD, keep_raw=True).start()
+        os.environ['EMAIL_SMTP_PORT'] = str(srv.port)
+        settings = _Settings(args.settings_latency_ms)
+        try:
+            if mode == 'legacy':
+                ok, elapsed, lat = _legacy(tasks, settings)
+                p50, p95 = lat[len(lat) // 2], lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+            else:
+                ok, elapsed, reports = _bulk(tasks, settings, args.sessions)
+                p50 = max(r['p50_ms'] for r in reports)
+                p95 = max(r['p95_ms'] for r in reports)
+        finally:
+            if smtp_pool._pool is not None:
+                smtp_pool._pool.close_all()
+            srv.stop()
+        received[mode] = _received(srv)
+        print(f"{mode:<10} {len(tasks) / elapsed:>8.1f} {p50:>7.1f}ms {p95:>7.1f}ms {ok:>6} "
+              f"{srv.counters.get('messages', 0):>8} {srv.counters.get('connections', 0):>11} {settings.reads:>8}")
+        if mode == 'bulk':
+            for r in reports:
+                print(f"{'':<10} {r['sender']}: {r['sent']}通 {r['msg_per_s']}通/s 展開・組立 {r['render_ms']}ms")
+
+    mismatches = len(received['legacy'] ^ received['bulk'])
+    if len(received['bulk']) != len(tasks):
+        mismatches += abs(len(tasks) - len(received['bulk']))
+    mismatches += _missing_id_check(_Settings(0))
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+予約タスクの分散送信（dispatch_policy）のシミュレーション
+
+同じ時刻（09:00）に期限になったタスク（SMS + メールの応募を含む）を、5 秒ごとのチェックで
+仮想時計を進めながら select に渡し、
+
+    - 1回のチェックで送るタスク数の最大値・1秒あたりの最大送信数
+    - 予定時刻からの遅延（p50 / p95 / 最大）と SCHEDULE_MAX_LATENESS を超えていないか
+    - priority の逆転がないか、同じ応募の SMS とメールが同じチェックで送られているか
+    - 入力順を変えても・作り直しても送信時刻が同じか（ジッターが決まった値か）
+
+を確認する。無効（従来どおり）の場合と比べる。
+
+使い方:
+    python bench/bench_dispatch_policy.py [--applicants 600] [--window 300] [--rate ""] [--max-lateness 600]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from dispatch_policy import SpreadPolicy  # noqa: E402
+from rate_limit import parse_rate  # noqa: E402
+
+START_MS = 1_760_000_400_000  # 分の境目（ちょうど HH:MM:00）
+TICK_S = 5.0  # watch_mail の予約タスクのチェック間隔
+DISPATCHER_TICK_S = 60.0  # scheduled_dispatcher のチェック間隔
+
+
+def _tasks(applicants, seed=7):
+    rnd = random.Random(seed)
+    tasks = []
+    for i in range(applicants):
+        prio = rnd.choice((0, 0, 0, 1, 2))
+        types = ('sms', 'mail') if i % 3 == 0 else (rnd.choice(('sms', 'mail')),)
+        for tt in types:
+            tasks.append({'id': f'{tt}{i:05d}', 'uid': 'uid0', 'taskType': tt, 'ouboNo': f'OB{i:06d}',
+                          'nextRun': START_MS, 'priority': prio})
+    return tasks
+
+
+def _simulate(policy, tasks, tick_s=TICK_S, use_hint=False):
+    """仮想時計でチェックを繰り返し、タスク ID → 送信時刻（ms）を返す"""
+    pending = list(tasks)
+    sent = {}
+    ticks = []
+    now = START_MS
+    with contextlib.redirect_stdout(io.StringIO()):
+        while pending:
+            ready = policy.select(pending, now)
+            ids = {t['id'] for t in ready}
+            for t in ready:
+                sent[t['id']] = now
+            ticks.append(len(ready))
+            pending = [t for t in pending if t['id'] not in ids]
+            step = policy.wait_hint(tick_s) if use_hint else tick_s
+            now += int(step * 1000)
+    return sent, ticks
+
+
+def _report(name, tasks, sent, ticks, max_lateness, tick_s=TICK_S):
+    late = sorted((sent[t['id']] - t['nextRun']) / 1000.0 for t in tasks)
+    per_sec = Counter(ms // 1000 for ms in sent.values())
+    by_id = {t['id']: t for t in tasks}
+    # priority の逆転（高い priority の応募が低い priority より後に送られた組）
+    first_by_prio = {}
+    last_by_prio = {}
+    for tid, ms in sent.items():
+        p = by_id[tid]['priority']
+        first_by_prio[p] = min(first_by_prio.get(p, ms), ms)
+        last_by_prio[p] = max(last_by_prio.get(p, ms), ms)
+    inversions = sum(1 for p in last_by_prio for q in first_by_prio if p < q and last_by_prio[p] > first_by_prio[q])
+    # 同じ応募の SMS とメールが別々のチェックで送られた数
+    by_unit = {}
+    for t in tasks:
+        by_unit.setdefault(t['ouboNo'], set()).add(sent[t['id']])
+    split_units = sum(1 for v in by_unit.values() if len(v) > 1)
+    over = sum(1 for x in late if x > max_lateness + tick_s)
+    print(f"{name:<26} {len(ticks):>6} {max(ticks):>9} {max(per_sec.values()):>7} "
+          f"{late[len(late) // 2]:>7.1f}s {late[int(len(late) * 0.95)]:>7.1f}s {late[-1]:>7.1f}s "
+          f"{inversions:>5} {split_units:>5} {over:>5}")
+    return inversions + split_units + over
+
+
+def main():
+    ap = argparse.ArgumentParser(description='予約タスクの分散送信のシミュレーション')
+    ap.add_argument('--applicants', type=int, default=600)
+    ap.add_argument('--window', type=float, default=300.0)
+    ap.add_argument('--rate', default='', help='SCHEDULE_SPREAD_RATE と同じ形式（例: 2/s）')
+    ap.add_argument('--max-lateness', type=float, default=600.0)
+    ap.add_argument('--min-cohort', type=int, default=10)
+    args = ap.parse_args()
+
+    tasks = _tasks(args.applicants)
+    print(f'applicants: {args.applicants} / tasks: {len(tasks)} / window: {args.window}s / '
+          f'rate: {args.rate or "-"} / max lateness: {args.max_lateness}s')
+    print(f"{'mode':<26} {'checks':>6} {'max/check':>9} {'max/s':>7} {'p50':>8} {'p95':>8} {'max':>8} "
+          f"{'inv':>5} {'split':>5} {'late':>5}")
+
+    mismatches = 0
+    off = SpreadPolicy()
+    sent, ticks = _simulate(off, tasks)
+    _report('disabled (legacy)', tasks, sent, ticks, args.max_lateness)
+
+    def make():
+        return SpreadPolicy(window_s=args.window, rate=parse_rate(args.rate), min_cohort=args.min_cohort,
+                            max_lateness_s=args.max_lateness)
+
+    sent2, ticks2 = _simulate(make(), tasks)
+    mismatches += _report('spread (watcher 5s)', tasks, sent2, ticks2, args.max_lateness)
+    sent1, ticks1 = _simulate(make(), tasks, DISPATCHER_TICK_S, use_hint=True)
+    mismatches += _report('spread (dispatcher)', tasks, sent1, ticks1, args.max_lateness, DISPATCHER_TICK_S)
+
+    # 入力順を変えて作り直しても同じ送信時刻になるか
+    shuffled = list(tasks)
+    random.Random(99).shuffle(shuffled)
+    sent3, _ = _simulate(make(), shuffled)
+    differ = sum(1 for k in sent2 if sent2[k] != sent3.get(k))
+    print(f'入力順を変えた場合に送信時刻が変わったタスク: {differ}')
+    mismatches += differ
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
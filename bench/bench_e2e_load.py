@@ -0,0 +1,353 @@
+"""
+端から端までの負荷試験（IMAP → 解析 → Firestore → 管理画面 → SMS / メール → 時刻送信）
+
+本番の外部サービスの代わりにローカルの疑似サーバーを起動し、watch_mail と scheduled_task_worker を
+そのまま動かす。
+    - IMAP:       bench/fake_imap_server.py（求人ボックス用・エンゲージ用の2つのメールボックス）
+    - Firestore:  bench/fake_firestore.py（FIRESTORE_EMULATOR_HOST で向ける）
+    - SMS:        bench/fake_sms_publisher.py（api_settings の baseUrl）
+    - メール:     bench/fake_smtp_server.py（EMAIL_SMTP_HOST / EMAIL_SMTP_SSL=false）
+    - 管理画面:   bench/fake_portal.py（静的な応募者詳細ページ。ブラウザの代わり）
+
+--rate 通/分 の間隔で「新着応募のお知らせ」（求人ボックス）と「【要対応】新着応募のお知らせ」（エンゲージ）を
+合計 --notifications 通配信し、応募者ごとに通知の配信から SMS / メールが疑似サーバーに届くまでの時間を測る。
+男性の応募者（--delayed-ratio の割合）は予約送信（delayed）のセグメントに入り、scheduled_tasks 経由で送る。
+予約の待ち時間は短縮する（疑似 Firestore に書かれた時点で nextRun を現在時刻にする）ため、
+時刻送信の行は「通知 → タスク登録 → scheduled_task_worker が拾って送信」までの時間になる。
+
+結果: 経路ごとの件数・p50 / p95 / p99 / 最大と、処理量（送信完了した通知数 / 分）。
+全員に1回ずつ届いたか（重複・未着なし）を確認する。watch_mail のログは一時ディレクトリの watcher.log に出す。
+
+--rpa-fail-ratio の割合の通知は、最初の1回だけ管理画面が 503 を返す（ログイン・詳細の取得の失敗の代わり）。
+その通知が処理済み通知の台帳に failed として残り、人が未読に戻すと処理し直されて届くことも確認する。
+
+使い方:
+    python bench/bench_e2e_load.py [--notifications 60] [--rate 120] [--engage-ratio 0.3] [--delayed-ratio 0.2]
+        [--portal-latency-ms 300] [--firestore-latency-ms 20] [--imap-latency-ms 10] [--sms-latency-ms 30]
+        [--rpa-fail-ratio 0.1]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from fake_firestore import FakeFirestore  # noqa: E402
+from fake_imap_server import FakeImapServer  # noqa: E402
+from fake_portal import PortalServer, install  # noqa: E402
+from fake_sms_publisher import FakeSmsPublisher  # noqa: E402
+from fake_smtp_server import FakeSmtpServer  # noqa: E402
+
+UID = 'bench-uid'
+PROJECT = 'bench-e2e'
+JOBBOX_USER = 'jobbox-inbox@example.com'
+ENGAGE_USER = 'engage-inbox@example.com'
+ACCOUNTS = 12
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def _segment(title, priority, genders, sms_mode):
+    return {
+        'title': title, 'enabled': True, 'priority': priority,
+        'conditions': {
+            'nameTypes': {'kanji': True, 'katakana': True, 'hiragana': True, 'alpha': True},
+            'genders': genders,
+            'ageRanges': {'maleMin': 15, 'maleMax': 99, 'femaleMin': 15, 'femaleMax': 99},
+        },
+        'actions': {
+            'sms': {'enabled': True, 'text': '{{applicant_name}}様 ご応募ありがとうございます（{{job_title}}）',
+                    'sendMode': sms_mode, 'delayMinutes': 1},
+            'mail': {'enabled': True, 'subject': 'ご応募ありがとうございます',
+                     'body': '{{applicant_name}}様\n{{job_title}}へのご応募ありがとうございます。', 'sendMode': 'immediate'},
+        },
+    }
+
+
+def _seed(fs, sms_url):
+    base = f'accounts/{UID}'
+    fs.put(f'{base}/api_settings/settings', {'provider': 'sms_publisher', 'baseUrl': sms_url,
+                                             'apiId': 'bench', 'apiPass': 'bench'})
+    fs.put(f'{base}/mail_settings/settings', {'email': JOBBOX_USER, 'appPass': 'bench-app-pass'})
+    fs.put(f'{base}/engage_mail_settings/settings', {'email': ENGAGE_USER, 'appPass': 'bench-app-pass'})
+    for coll in ('target_segments', 'engage_target_segments'):
+        fs.put(f'{base}/{coll}/seg-delayed', _segment('男性（予約）', 1, {'male': True, 'female': False}, 'delayed'))
+        fs.put(f'{base}/{coll}/seg-immediate', _segment('全員（即時）', 2, {'male': False, 'female': True}, 'immediate'))
+    for k in range(ACCOUNTS):
+        fs.put(f'{base}/jobbox_accounts/acc{k:03d}', {
+            'account_name': f'株式会社ベンチ物流{k}', 'account_id': f'1000-{k:04d}',
+            'jobbox_id': f'jobbox{k}@example.com', 'jobbox_password': 'pw'})
+        fs.put(f'{base}/engage_accounts/acc{k:03d}', {
+            'account_name': f'株式会社エンゲージベンチ{k}', 'engage_id': f'engage{k}@example.com',
+            'engage_password': 'pw'})
+
+
+def _applicant(i, male):
+    return {
+        'name': f'{"山田 太郎" if male else "佐藤 花子"}{i}', 'gender': '男性' if male else '女性',
+        'birth': '1995年4月1日', 'tel': f'090{i:08d}', 'email': f'applicant{i}@example.com',
+        'addr': '東京都千代田区', 'school': 'ベンチ大学',
+    }
+
+
+def _jobbox_mail(i, k):
+    msg = EmailMessage()
+    msg['Subject'] = '【求人ボックス】新着応募のお知らせ'
+    msg['From'] = 'noreply@kyujinbox.example'
+    msg['To'] = JOBBOX_USER
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid(f'jobbox{i}')
+    msg.set_content(
+        '採用担当者様\n\n求人ボックス 採用ボードに新着応募がありました。\n\n'
+        f'【アカウント名】株式会社ベンチ物流{k}\n【アカウントID】1000-{k:04d}\n'
+        f'【求人タイトル】倉庫内ピッキング{i % 7}\n【応募No.】B{i:07d}\n【掲載企業名】株式会社ベンチ物流{k}\n\n'
+        '応募者の情報は採用ボードからご確認ください。\nhttps://secure.kyujinbox.com/login\n')
+    return msg.as_bytes()
+
+
+def _engage_mail(i, k):
+    msg = EmailMessage()
+    msg['Subject'] = '【要対応】新着応募のお知らせ'
+    msg['From'] = 'system@en-gage.net'
+    msg['To'] = ENGAGE_USER
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid(f'engage{i}')
+    msg.set_content(
+        f'株式会社エンゲージベンチ{k}\n採用 担当様\n\nエンゲージ事務局です。\n貴社の採用ページより応募がありました。\n\n'
+        f'【 応募職種 】\n介護スタッフ{i % 5}\n\n【 応募内容の閲覧用URL 】\n'
+        f'https://en-gage.net/company/manage/message/?apply_id=BENCH{i:07d}\n')
+    return msg.as_bytes()
+
+
+def _ledger_outcomes(path, message_ids):
+    """処理済み通知の台帳に記録された Message-ID ごとの結果"""
+    from message_ledger import message_id_key
+
+    conn = sqlite3.connect(path)
+    try:
+        out = {}
+        for mid in message_ids:
+            row = conn.execute('SELECT outcome FROM messages WHERE key = ?', (message_id_key(mid),)).fetchone()
+            out[mid] = row[0] if row else None
+        return out
+    finally:
+        conn.close()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--notifications', type=int, default=60)
+    ap.add_argument('--rate', type=float, default=120.0, help='通知の配信間隔（通/分）')
+    ap.add_argument('--engage-ratio', type=float, default=0.3)
+    ap.add_argument('--delayed-ratio', type=float, default=0.2, help='予約送信（scheduled_tasks 経由）になる応募者の割合')
+    ap.add_argument('--poll', type=int, default=1, help='watch_mail の監視間隔（秒）')
+    ap.add_argument('--portal-latency-ms', type=float, default=300.0, help='ブラウザ操作の代わりの待ち時間')
+    ap.add_argument('--firestore-latency-ms', type=float, default=20.0)
+    ap.add_argument('--imap-latency-ms', type=float, default=10.0)
+    ap.add_argument('--sms-latency-ms', type=float, default=30.0)
+    ap.add_argument('--smtp-latency-ms', type=float, default=20.0)
+    ap.add_argument('--timeout', type=float, default=120.0, help='最後の配信から送信完了を待つ秒数')
+    ap.add_argument('--rpa-fail-ratio', type=float, default=0.1, help='最初の1回は管理画面の取得に失敗する通知の割合')
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_e2e_')
+    imap = FakeImapServer(latency_ms=args.imap_latency_ms).start()
+    fs = FakeFirestore(latency_ms=args.firestore_latency_ms, project=PROJECT).start()
+    sms = FakeSmsPublisher(latency_ms=args.sms_latency_ms).start()
+    smtp = FakeSmtpServer(message_latency_ms=args.smtp_latency_ms).start()
+    portal = PortalServer(latency_ms=args.portal_latency_ms).start()
+    _seed(fs, sms.base_url)
+
+    # watch_mail は cwd の service-account を最初に探す。疑似 Firestore ではトークンを取らないので project_id だけでよい
+    with open(os.path.join(tmp, 'service-account'), 'w', encoding='utf-8') as f:
+        json.dump({'project_id': PROJECT}, f)
+    os.chdir(tmp)
+    os.environ.update({
+        'FIRESTORE_EMULATOR_HOST': fs.host,
+        'EMAIL_IMAP_SSL': 'false', 'EMAIL_IMAP_PORT': str(imap.port),
+        'EMAIL_SMTP_HOST': '127.0.0.1', 'EMAIL_SMTP_PORT': str(smtp.port), 'EMAIL_SMTP_SSL': 'false',
+        'OUTBOX_DB': os.path.join(tmp, 'outbox.db'),
+        'MESSAGE_LEDGER_DB': os.path.join(tmp, 'message_ledger.db'),
+        'RPA_MAX_UNREAD_SCAN': str(max(50, args.notifications)),
+    })
+    os.environ.setdefault('RPA_MAX_BROWSERS', '8')
+
+    delivered = {}   # i -> 配信時刻
+    due = {}         # i -> 予約タスクの実行予定時刻（短縮後）
+    arrivals = {'sms': {}, 'mail': {}}
+    dup = {'sms': 0, 'mail': 0}
+    lock = threading.Lock()
+
+    def on_sms(number, text):
+        now = time.time()
+        i = int(re.sub(r'\D', '', number)[-8:])
+        with lock:
+            if i in arrivals['sms']:
+                dup['sms'] += 1
+            else:
+                arrivals['sms'][i] = now
+
+    def on_mail(mail_from, rcpts):
+        now = time.time()
+        for r in rcpts:
+            m = re.search(r'applicant(\d+)@', r)
+            if m:
+                i = int(m.group(1))
+                with lock:
+                    if i in arrivals['mail']:
+                        dup['mail'] += 1
+                    else:
+                        arrivals['mail'][i] = now
+
+    def on_write(path, doc):
+        # 予約送信の待ち時間を短縮: 登録されたタスクをすぐ実行対象にする（保存済みのフィールドを直接書き換える）
+        if '/scheduled_tasks/' in path and doc['fields'].get('status', {}).get('stringValue') == 'pending':
+            fields = doc['fields']
+            if 'createdAt' in fields and fields.get('nextRun', {}).get('integerValue') != fields['createdAt'].get('integerValue'):
+                fields['nextRun'] = {'integerValue': fields['createdAt']['integerValue']}
+                tel = fields.get('to', {}).get('stringValue', '')
+                if tel:
+                    with lock:
+                        due[int(re.sub(r'\D', '', tel)[-8:])] = time.time()
+
+    sms.on_message = on_sms
+    smtp.on_message = on_mail
+    fs.on_write = on_write
+
+    log_path = os.path.join(tmp, 'watcher.log')
+    log = open(log_path, 'w', encoding='utf-8')
+    with contextlib.redirect_stdout(log):
+        install(portal)
+        import email_watcher
+        stop = threading.Event()
+        threading.Thread(target=email_watcher.scheduled_task_worker, args=(UID, stop), daemon=True).start()
+        for user, label, category in ((JOBBOX_USER, 'Jobbox', 'jobbox'), (ENGAGE_USER, 'Engage', 'engage')):
+            threading.Thread(target=email_watcher.watch_mail,
+                             args=('127.0.0.1', user, 'bench-app-pass', UID, 'INBOX', args.poll, label, category),
+                             daemon=True).start()
+
+        interval = 60.0 / args.rate if args.rate > 0 else 0.0
+        kinds = {}
+        engage_every = round(1 / args.engage_ratio) if args.engage_ratio > 0 else 0
+        delayed_every = round(1 / args.delayed_ratio) if args.delayed_ratio > 0 else 0
+        fail_every = round(1 / args.rpa_fail_ratio) if args.rpa_fail_ratio > 0 else 0
+        failing = {}  # i -> (メールボックス, シーケンス番号, Message-ID)
+        t_start = time.time()
+        for i in range(args.notifications):
+            engage = bool(engage_every) and i % engage_every == engage_every - 1
+            male = bool(delayed_every) and i % delayed_every == 0
+            k = i % ACCOUNTS
+            detail = _applicant(i, male)
+            if engage:
+                portal.add_applicant('engage', f'BENCH{i:07d}', detail)
+                raw, user = _engage_mail(i, k), ENGAGE_USER
+            else:
+                portal.add_applicant('jobbox', f'B{i:07d}', dict(detail, oubo_no=f'B{i:07d}', kyujin=f'倉庫内ピッキング{i % 7}'))
+                raw, user = _jobbox_mail(i, k), JOBBOX_USER
+            kinds[i] = ('engage' if engage else 'jobbox', 'delayed' if male else 'immediate')
+            fail = bool(fail_every) and i % fail_every == fail_every // 2
+            if fail:
+                portal.fail_next(*(('engage', f'BENCH{i:07d}') if engage else ('jobbox', f'B{i:07d}')))
+            with lock:
+                delivered[i] = time.time()
+            num = imap.deliver(user, raw)
+            if fail:
+                failing[i] = (user, num, message_from_bytes(raw)['Message-ID'])
+            next_at = t_start + (i + 1) * interval
+            time.sleep(max(0.0, next_at - time.time()))
+        t_fed = time.time()
+
+        deadline = t_fed + args.timeout
+        from watcher.ingest import get_watch_pipeline
+        failed_recorded = 0
+        if failing:
+            # 失敗しなかった通知が届き、パイプラインが空になったら、失敗した通知の台帳の記録を見て未読に戻す
+            expected = args.notifications - len(failing)
+            while time.time() < deadline:
+                with lock:
+                    if len(arrivals['sms']) >= expected and len(arrivals['mail']) >= expected:
+                        break
+                time.sleep(0.2)
+            get_watch_pipeline().wait_idle(max(0.0, deadline - time.time()) + 5)
+            outcomes = _ledger_outcomes(os.environ['MESSAGE_LEDGER_DB'], [v[2] for v in failing.values()])
+            failed_recorded = sum(1 for v in outcomes.values() if v == 'failed')
+            with lock:
+                sent_early = sum(1 for i in failing if i in arrivals['sms'] or i in arrivals['mail'])
+            for user, num, _mid in failing.values():
+                imap.mark_unseen(user, num)
+        while time.time() < deadline:
+            with lock:
+                done_sms = len(arrivals['sms'])
+                done_mail = len(arrivals['mail'])
+            if done_sms >= args.notifications and done_mail >= args.notifications:
+                break
+            time.sleep(0.2)
+        # 履歴の書き込みは送信の後に record 段階で行われるので、パイプラインが空になるまで待つ
+        get_watch_pipeline().wait_idle(max(0.0, deadline - time.time()) + 5)
+        stop.set()
+        t_end = time.time()
+    log.close()
+
+    rows = {}
+    for i, (platform, route) in kinds.items():
+        if i in arrivals['sms']:
+            rows.setdefault(f'SMS {platform} {route}', []).append(arrivals['sms'][i] - delivered[i])
+        if i in arrivals['mail']:
+            rows.setdefault(f'mail {platform}', []).append(arrivals['mail'][i] - delivered[i])
+    completed = [i for i in kinds if i in arrivals['sms'] and i in arrivals['mail']]
+    last = max([max(arrivals['sms'].get(i, 0), arrivals['mail'].get(i, 0)) for i in completed] or [t_end])
+    span = max(last - t_start, 1e-9)
+
+    print(f'通知 {args.notifications} 通を {args.rate:g} 通/分で配信（エンゲージ {sum(1 for v in kinds.values() if v[0] == "engage")} / '
+          f'予約送信 {sum(1 for v in kinds.values() if v[1] == "delayed")}）')
+    print(f"{'route':<26} {'n':>4} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'max s':>7}")
+    for name in sorted(rows):
+        v = rows[name]
+        print(f'{name:<26} {len(v):>4} {_percentile(v, 50):>7.2f} {_percentile(v, 95):>7.2f} '
+              f'{_percentile(v, 99):>7.2f} {max(v):>7.2f}')
+    if due:
+        pickup = [arrivals['sms'][i] - due[i] for i in due if i in arrivals['sms']]
+        print(f"{'(task due -> SMS)':<26} {len(pickup):>4} {_percentile(pickup, 50):>7.2f} {_percentile(pickup, 95):>7.2f} "
+              f'{_percentile(pickup, 99):>7.2f} {max(pickup or [0]):>7.2f}')
+    print(f'処理量: {len(completed)} 通 / {span:.1f}s = {len(completed) / span * 60:.1f} 通/分（配信 {args.rate:g} 通/分）')
+    print(f"Firestore 要求 {fs.counters.get('requests', 0)} / IMAP 接続 {imap.counters.get('connections', 0)} / "
+          f"SMTP 接続 {smtp.counters.get('connections', 0)} / 管理画面 {portal.counters.get('jobbox_pages', 0) + portal.counters.get('engage_pages', 0)} ページ / "
+          f"メモ保存 {len(portal.memos)}")
+    missing_sms = args.notifications - len(arrivals['sms'])
+    missing_mail = args.notifications - len(arrivals['mail'])
+    if missing_sms or missing_mail or dup['sms'] or dup['mail']:
+        print(f"  未着 SMS {missing_sms} / メール {missing_mail}、重複 SMS {dup['sms']} / メール {dup['mail']}")
+    if failing:
+        print(f'RPA 失敗 {len(failing)} 通: 台帳に failed {failed_recorded} 通 / 失敗時に送信 {sent_early} 通 → '
+              f'未読に戻して処理し直し（届いたかは上の未着で確認）')
+    print(f'ログ: {log_path}')
+    mismatches = missing_sms + missing_mail + dup['sms'] + dup['mail']
+    if failing:
+        mismatches += (len(failing) - failed_recorded) + sent_early
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+エンゲージ応募者情報抽出のベンチマーク
+
+保存済みのプロフィールページ（bench/fixtures/engage/*.html）に対して
+EngageLogin._extract_applicant_detail をブラウザなしで実行し、
+ラベル索引版と従来の全走査版の抽出時間と結果の一致を確認する。
+
+使い方:
+    python bench/bench_engage_detail.py [--repeat 20]
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from bs4 import BeautifulSoup  # noqa: E402
+from engage_login import EngageLogin  # noqa: E402
+
+FIXTURE_DIR = os.path.join(ROOT, 'bench', 'fixtures', 'engage')
+
+
+class _LegacyLookup:
+    """索引導入前の get_text_bs4（フィールドごとにページ全体を走査する）"""
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    @property
+    def strings(self):
+        return list(self.soup.stripped_strings)
+
+    def lookup(self, keywords):
+        soup = self.soup
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        regexes = [re.compile(kw) for kw in keywords]
+        skip_words = ['求人を選択', '選択してください', 'IDで検索', 'プロフィール', 'メッセージ']
+        for dt in soup.find_all('dt'):
+            if any(r.search(dt.get_text(' ', strip=True)) for r in regexes):
+                dd = dt.find_next_sibling('dd')
+                if dd:
+                    txt = dd.get_text(' ', strip=True)
+                    if txt and len(txt) < 200 and not any(s in txt for s in skip_words):
+                        return txt
+        for th in soup.find_all('th'):
+            if any(r.search(th.get_text(' ', strip=True)) for r in regexes):
+                td = th.find_next_sibling('td')
+                if td:
+                    txt = td.get_text(' ', strip=True)
+                    if txt and len(txt) < 200 and not any(s in txt for s in skip_words):
+                        return txt
+        for label in soup.find_all(['label', 'div'], class_=re.compile(r'label', re.I)):
+            if any(r.search(label.get_text(' ', strip=True)) for r in regexes):
+                parent = label.parent
+                if parent:
+                    data_elem = parent.find(['div', 'span'], class_=re.compile(r'data', re.I))
+                    if data_elem:
+                        txt = data_elem.get_text(' ', strip=True)
+                        if txt and len(txt) < 200 and not any(s in txt for s in skip_words):
+                            return txt
+        for tag in soup.find_all(['div', 'span', 'p']):
+            full_text = tag.get_text(' ', strip=True)
+            if any(r.search(full_text) for r in regexes):
+                parts = re.split(r'[：:]', full_text, maxsplit=1)
+                if len(parts) == 2 and len(parts[1].strip()) < 100:
+                    txt = parts[1].strip()
+                    if not any(s in txt for s in ['求人を選択', '選択してください', 'IDで検索']):
+                        return txt
+        return None
+
+
+class _LegacyEngage(EngageLogin):
+    def _parse_page(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        return soup, _LegacyLookup(soup)
+
+    def _extract_name_from_header(self, soup, index=None):
+        # ヘッダーのセレクタもセレクタごとに soup.select で走査する
+        return super()._extract_name_from_header(soup)
+
+
+def _new(cls):
+    obj = cls.__new__(cls)
+    obj.driver = None
+    return obj
+
+
+def _extract(engage, html):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return engage._extract_applicant_detail(html)
+
+
+def _time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='エンゲージ応募者情報抽出のベンチマーク')
+    ap.add_argument('--repeat', type=int, default=20)
+    args = ap.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html')))
+    if not paths:
+        print('fixture がありません:', FIXTURE_DIR)
+        return 1
+
+    mismatches = 0
+    print(f"{'page':<36} {'legacy(ms)':>10} {'index(ms)':>10} {'speedup':>8}  result")
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        legacy = _extract(_new(_LegacyEngage), html)
+        indexed = _extract(_new(EngageLogin), html)
+        same = legacy == indexed
+        if not same:
+            mismatches += 1
+        # 毎回新しいインスタンスで計測（ページ解析のキャッシュを効かせない）
+        t_legacy = _time(lambda: _extract(_new(_LegacyEngage), html), args.repeat)
+        t_index = _time(lambda: _extract(_new(EngageLogin), html), args.repeat)
+        print(f"{os.path.basename(path):<36} {t_legacy:>10.2f} {t_index:>10.2f} {t_legacy / t_index:>7.2f}x  {'OK' if same else 'MISMATCH'}")
+        if not same:
+            print('  legacy:', legacy)
+            print('  index :', indexed)
+
+    print('結果不一致:', mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
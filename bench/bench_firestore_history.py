@@ -0,0 +1,303 @@
+"""
+10 万件規模の sms_history / scheduled_tasks に対する Firestore 処理の計測（bench/fake_firestore.py）
+
+疑似 Firestore（メモリ上・HTTP）に accounts/{uid}/sms_history を --history 件、
+accounts/{uid}/scheduled_tasks を --tasks 件入れておき、次を計測・確認する。
+
+1. 疑似サーバー側の基本操作
+   - コレクション一覧のページ送り（pageSize=300）で全件を1回ずつ取れること
+   - write_sms_history の統合判定で使う4種類の runQuery（oubo_no+tel / oubo_no+email / tel+email /
+     email のみ、いずれも sentAt の時間窓 + sentAt 降順 + limit 1）を parent=accounts/{uid} で実行し、
+     結果が Python で全件を調べた答えと一致すること
+   - batchGet（存在しない ID を混ぜる）/ commit（updateMask・delete・前提条件違反で全体が取り消されること）
+2. アプリの処理（FIRESTORE_EMULATOR_HOST で疑似サーバーへ向ける）
+   - write_sms_history: 1回あたりの時間と、既存履歴へ統合された件数 / 新規作成の件数
+     （統合の検索は parent が documents 直下・allDescendants なしのため、本物の Firestore と同じく
+     accounts/{uid}/sms_history は検索対象にならない。現状の動作として 統合 0 件 を確認する）
+   - get_pending_scheduled_tasks: 期限の来た pending だけが返ること（コレクション全件を1回の GET で読む）
+   - update_scheduled_task_status: completed は削除、failed は status / errorMsg の更新になること
+
+使い方:
+    python bench/bench_firestore_history.py [--history 100000] [--tasks 100000] [--queries 200] [--writes 200]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from fake_firestore import FakeFirestore, encode_value  # noqa: E402
+
+UID = 'bench-uid'
+PROJECT = 'bench-history'
+RECENT = 300
+SHORT = 120
+
+
+def _ff(field_path, op, value, value_type='stringValue'):
+    """write_sms_history と同じ形の fieldFilter"""
+    return {'fieldFilter': {'field': {'fieldPath': field_path}, 'op': op, 'value': {value_type: str(value)}}}
+
+
+def _strategies(row, now_ts):
+    """write_sms_history の統合判定と同じ4種類の条件 [(名前, filters, 時間窓)]"""
+    return [
+        ('oubo+tel', [_ff('oubo_no', 'EQUAL', row['oubo_no']), _ff('tel', 'EQUAL', row['tel'])], RECENT),
+        ('oubo+email', [_ff('oubo_no', 'EQUAL', row['oubo_no']), _ff('email', 'EQUAL', row['email'])], RECENT),
+        ('tel+email', [_ff('tel', 'EQUAL', row['tel']), _ff('email', 'EQUAL', row['email'])], RECENT),
+        ('email', [_ff('email', 'EQUAL', row['email'])], SHORT),
+    ]
+
+
+def _expected(rows, filters, since):
+    """全件を調べた答え（条件に合う中で sentAt が最大のもの。なければ None）"""
+    want = {f['fieldFilter']['field']['fieldPath']: f['fieldFilter']['value']['stringValue'] for f in filters}
+    best = None
+    for r in rows:
+        if r['sentAt'] > since and all(r[k] == v for k, v in want.items()):
+            if best is None or r['sentAt'] > best['sentAt']:
+                best = r
+    return best
+
+
+def _seed(fs, n_history, n_tasks, due_ratio, rnd, now_ts):
+    base = f'accounts/{UID}'
+    rows = []
+    for i in range(n_history):
+        # 1割は時間窓（5分）に入る最近の送信、残りは過去30日に散らす
+        age = rnd.randint(1, RECENT - 1) if i % 10 == 0 else rnd.randint(RECENT + 1, 30 * 86400)
+        row = {'oubo_no': str(7000000 + i // 2), 'tel': f'090{rnd.randint(0, 40000):08d}',
+               'email': f'user{rnd.randint(0, 30000)}@example.com', 'sentAt': now_ts - age,
+               'status': '送信済（S）', 'sms_status': 'sent', 'name': f'応募者{i}', 'job_title': 'ホールスタッフ'}
+        doc_id = fs.new_id()
+        row['id'] = doc_id
+        fs.put(f'{base}/sms_history/{doc_id}', {k: v for k, v in row.items() if k != 'id'})
+        rows.append(row)
+
+    now_ms = now_ts * 1000
+    due = set()
+    for i in range(n_tasks):
+        is_due = rnd.random() < due_ratio
+        status = 'pending' if rnd.random() < 0.95 else 'failed'
+        # 期限の来たものは 2分以内の遅れにしておく（遅延の警告表示を出さない）
+        next_run = now_ms - rnd.randint(1000, 100000) if is_due else now_ms + rnd.randint(3600, 30 * 86400) * 1000
+        doc_id = fs.new_id()
+        fs.put(f'{base}/scheduled_tasks/{doc_id}', {
+            'uid': UID, 'taskType': 'sms', 'status': status, 'sendMode': 'delayed', 'delayMinutes': 30,
+            'nextRun': next_run, 'createdAt': now_ms - 1800000, 'to': f'090{i % 100000000:08d}',
+            'template': '{name}様 ご応募ありがとうございます', 'applicantDetail': {'name': f'応募者{i}'},
+            'segmentId': 'seg-delayed', 'ouboNo': str(8000000 + i)})
+        if is_due and status == 'pending':
+            due.add(doc_id)
+    return rows, due
+
+
+def _post(session, url, body):
+    r = session.post(url, json=body, timeout=60)
+    r.raise_for_status()
+    return r.json()
+
+
+def _stub_checks(fs, session, rows, args, rnd, now_ts):
+    """疑似サーバーの一覧・runQuery・batchGet・commit の計測と確認。(結果の行, 不一致数) を返す"""
+    mismatches = 0
+    docs_url = f'http://{fs.host}/v1/projects/{PROJECT}/databases/(default)/documents'
+    coll_url = f'{docs_url}/accounts/{UID}/sms_history'
+    out = []
+
+    # --- 一覧のページ送り ---
+    t0 = time.perf_counter()
+    seen, token, pages = [], None, 0
+    while True:
+        params = {'pageSize': 300}
+        if token:
+            params['pageToken'] = token
+        r = session.get(coll_url, params=params, timeout=60)
+        data = r.json()
+        seen.extend(d['name'].rsplit('/', 1)[-1] for d in data.get('documents', []))
+        pages += 1
+        token = data.get('nextPageToken')
+        if not token:
+            break
+    elapsed = time.perf_counter() - t0
+    ok = seen == sorted({row['id'] for row in rows})
+    mismatches += 0 if ok else 1
+    out.append(('list pageSize=300', pages, elapsed, ok))
+
+    # --- 統合判定の runQuery（初回は索引を作る分を含むので別に出す） ---
+    targets = [rnd.choice(rows) for _ in range(args.queries)]
+    for label, pick in (('runQuery 初回', targets[:1]), ('runQuery', targets)):
+        answers = []
+        t0 = time.perf_counter()
+        for row in pick:
+            for _name, filters, window in _strategies(row, now_ts):
+                since = now_ts - window
+                where = filters + [_ff('sentAt', 'GREATER_THAN', since, value_type='integerValue')]
+                body = {'structuredQuery': {'from': [{'collectionId': 'sms_history'}], 'limit': 1,
+                                            'where': {'compositeFilter': {'op': 'AND', 'filters': where}},
+                                            'orderBy': [{'field': {'fieldPath': 'sentAt'}, 'direction': 'DESC'}]}}
+                got = [x['document'] for x in _post(session, f'{docs_url}/accounts/{UID}:runQuery', body)
+                       if x.get('document')]
+                answers.append((filters, since, got))
+        elapsed = time.perf_counter() - t0
+        bad = 0
+        for filters, since, got in answers:
+            want = _expected(rows, filters, since)
+            got_at = int(got[0]['fields']['sentAt']['integerValue']) if got else None
+            # sentAt が同じものが複数あるときはどれを返しても正しい
+            if (want is None) != (got_at is None) or (want and got_at != want['sentAt']):
+                bad += 1
+        mismatches += bad
+        out.append((label, len(answers), elapsed, bad == 0))
+    hits = sum(1 for _f, _s, got in answers if got)
+    print(f'統合判定の runQuery: {len(answers)} 回中 {hits} 回で既存履歴が見つかった')
+
+    # --- batchGet ---
+    names = [fs.doc_name(f"accounts/{UID}/sms_history/{row['id']}") for row in rnd.sample(rows, 90)]
+    names += [fs.doc_name(f'accounts/{UID}/sms_history/missing{i:02d}') for i in range(10)]
+    t0 = time.perf_counter()
+    res = _post(session, f'{docs_url}:batchGet', {'documents': names})
+    elapsed = time.perf_counter() - t0
+    ok = ([x.get('found', {}).get('name') or x.get('missing') for x in res] == names
+          and sum(1 for x in res if 'missing' in x) == 10)
+    mismatches += 0 if ok else 1
+    out.append(('batchGet 100', 1, elapsed, ok))
+
+    # --- commit（更新 + 削除、前提条件違反なら何も書かない） ---
+    picked = rnd.sample(rows, 500)
+    writes = []
+    for row in picked[:400]:
+        writes.append({'update': {'name': fs.doc_name(f"accounts/{UID}/sms_history/{row['id']}"),
+                                  'fields': {'mail_status': encode_value('sent')}},
+                       'updateMask': {'fieldPaths': ['mail_status']}, 'currentDocument': {'exists': True}})
+    for row in picked[400:]:
+        writes.append({'delete': fs.doc_name(f"accounts/{UID}/sms_history/{row['id']}")})
+    broken = writes + [{'update': {'name': fs.doc_name(f'accounts/{UID}/sms_history/missing-doc'), 'fields': {}},
+                        'currentDocument': {'exists': True}}]
+    r = session.post(f'{docs_url}:commit', json={'writes': broken}, timeout=60)
+    rejected = r.status_code == 404 and fs.get(f"accounts/{UID}/sms_history/{picked[0]['id']}").get('mail_status') is None
+    t0 = time.perf_counter()
+    res = _post(session, f'{docs_url}:commit', {'writes': writes})
+    elapsed = time.perf_counter() - t0
+    after = [fs.get(f"accounts/{UID}/sms_history/{row['id']}") for row in picked]
+    ok = (rejected and len(res.get('writeResults', [])) == 500
+          and all(d is not None and d.get('mail_status') == 'sent' and d.get('name') for d in after[:400])
+          and all(d is None for d in after[400:]))
+    mismatches += 0 if ok else 1
+    out.append(('commit 500', 1, elapsed, ok))
+    deleted = {row['id'] for row in picked[400:]}
+    rows[:] = [row for row in rows if row['id'] not in deleted]
+    return out, mismatches
+
+
+def _app_checks(fs, rows, due, args, rnd, now_ts):
+    """email_watcher の write_sms_history / get_pending_scheduled_tasks / update_scheduled_task_status"""
+    import email_watcher as ew
+
+    mismatches = 0
+    out = []
+    before = len(fs.collections.get(f'accounts/{UID}/sms_history', {}))
+    requests_before = fs.counters.get('requests', 0)
+    sink = io.StringIO()
+    results = []
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(sink):
+        for row in rnd.sample(rows, args.writes):
+            # 既存の最近の送信と同じ応募者へのメール送信（統合されれば mail_status が付く）
+            results.append(ew.write_sms_history(UID, {
+                'oubo_no': row['oubo_no'], 'tel': row['tel'], 'email': row['email'],
+                'status': '送信済（M）', 'mail_status': 'sent', 'sentAt': int(time.time())}))
+    elapsed = time.perf_counter() - t0
+    created = len(fs.collections.get(f'accounts/{UID}/sms_history', {})) - before
+    merged = sink.getvalue().count('Merged sms_history')
+    per_call = (fs.counters.get('requests', 0) - requests_before) / max(args.writes, 1)
+    ok = all(results) and created + merged == args.writes
+    mismatches += 0 if ok else 1
+    out.append(('write_sms_history', args.writes, elapsed, ok))
+    print(f'write_sms_history: 統合 {merged} 件 / 新規作成 {created} 件 / Firestore 要求 {per_call:.1f} 回/件')
+
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(sink):
+        tasks = ew.get_pending_scheduled_tasks(UID)
+    elapsed = time.perf_counter() - t0
+    ok = {t['id'] for t in tasks} == due
+    mismatches += 0 if ok else 1
+    out.append(('get_pending_scheduled_tasks', 1, elapsed, ok))
+    print(f'get_pending_scheduled_tasks: {args.tasks} 件中 {len(tasks)} 件（全件を1回の GET で読む）')
+
+    done = sorted(due)
+    completed, failed = done[::2], done[1::2]
+    t0 = time.perf_counter()
+    ok = True
+    for task_id in completed:
+        ok = ew.update_scheduled_task_status(UID, task_id, 'completed') and ok
+    for task_id in failed:
+        ok = ew.update_scheduled_task_status(UID, task_id, 'failed', 'bench error') and ok
+    elapsed = time.perf_counter() - t0
+    base = f'accounts/{UID}/scheduled_tasks'
+    ok = (ok and all(fs.get(f'{base}/{i}') is None for i in completed)
+          and all((fs.get(f'{base}/{i}') or {}).get('status') == 'failed'
+                  and fs.get(f'{base}/{i}').get('errorMsg') == 'bench error'
+                  and fs.get(f'{base}/{i}').get('template') for i in failed))
+    with contextlib.redirect_stdout(sink):
+        ok = ok and ew.get_pending_scheduled_tasks(UID) == []
+    mismatches += 0 if ok else 1
+    out.append(('update_task_status', len(done), elapsed, ok))
+    return out, mismatches
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--history', type=int, default=100000)
+    ap.add_argument('--tasks', type=int, default=100000)
+    ap.add_argument('--due-ratio', type=float, default=0.002, help='期限の来ているタスクの割合')
+    ap.add_argument('--queries', type=int, default=200, help='統合判定の runQuery を試す応募者数（4種類ずつ）')
+    ap.add_argument('--writes', type=int, default=200)
+    ap.add_argument('--seed', type=int, default=7)
+    args = ap.parse_args()
+
+    import requests
+
+    rnd = random.Random(args.seed)
+    fs = FakeFirestore(project=PROJECT, seed=args.seed).start()
+    now_ts = int(time.time())
+    t0 = time.perf_counter()
+    rows, due = _seed(fs, args.history, args.tasks, args.due_ratio, rnd, now_ts)
+    print(f'準備: sms_history {args.history} 件 / scheduled_tasks {args.tasks} 件（期限到来 {len(due)} 件）'
+          f' {time.perf_counter() - t0:.1f}s')
+
+    # watch_mail と同じく cwd の service-account を使う。疑似 Firestore ではトークンを取らないので project_id だけでよい
+    tmp = tempfile.mkdtemp(prefix='bench_fs_history_')
+    with open(os.path.join(tmp, 'service-account'), 'w', encoding='utf-8') as f:
+        json.dump({'project_id': PROJECT}, f)
+    os.chdir(tmp)
+    os.environ['FIRESTORE_EMULATOR_HOST'] = fs.host
+    os.environ.pop('OUTBOX_ASYNC_HISTORY', None)
+
+    session = requests.Session()
+    stub_rows, stub_bad = _stub_checks(fs, session, rows, args, rnd, now_ts)
+    app_rows, app_bad = _app_checks(fs, rows, due, args, rnd, now_ts)
+
+    print()
+    print(f"{'operation':<28} {'n':>7} {'total s':>9} {'ms/op':>8}  ok")
+    for name, n, elapsed, ok in stub_rows + app_rows:
+        per = elapsed / n * 1000 if n else 0.0
+        print(f'{name:<28} {n:>7} {elapsed:>9.3f} {per:>8.2f}  {ok}')
+    print(f"Firestore 要求 {fs.counters.get('requests', 0)}")
+    fs.stop()
+    mismatches = stub_bad + app_bad
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+処理済み通知メールの台帳（src/message_ledger.py）の確認と計測
+
+1. 参照の速さ: 記録済み N 件に対して、メモリ（LRU）に載っている場合・SQLite だけの場合の1回あたりの参照時間
+2. 重複の再生: N 通の通知を処理したあと
+    - 人が Gmail で未読に戻した（Message-ID が同じ）通知 --reopen 通
+    - 転送などで Message-ID だけ変わった通知 --forward 通
+    - 新しい通知（Date が違う、同じ求人への別の応募） --fresh 通
+   がもう一度 UNSEEN に現れたとして、watch_mail と同じ順（ヘッダー → 台帳 → 本文 → 解析 → 台帳 → RPA）で
+   処理したときの本文取得数と RPA 起動数を、台帳なし（従来）と比べる。台帳はプロセスを起動し直した想定で
+   開き直す（SQLite から読む）。
+
+使い方:
+    python bench/bench_message_ledger.py [--messages 500] [--reopen 120] [--forward 40] [--fresh 60]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from message_ledger import DONE, MessageLedger, content_key, message_id_key  # noqa: E402
+
+
+def _notification(i, date_offset=0):
+    account = f'株式会社サンプル{i % 37}'
+    return {
+        'message_id': f'<{i:08d}.{date_offset}.notify@jobbox.example>',
+        'date': time.strftime('%a, %d %b %Y %H:%M:%S +0900', time.localtime(1760000000 + i * 60 + date_offset)),
+        'parsed': {'account_name': account, 'account_id': f'id{i % 37}', 'job_title': f'倉庫スタッフ{i % 11}',
+                   'url': 'https://secure.xn--pckua2a7gp15o89zb.com/'},
+    }
+
+
+def _process(messages, ledger):
+    """watch_mail の判定順を再現する。戻り値: (本文取得数, RPA 起動数)"""
+    body_fetches = rpa_runs = 0
+    for m in messages:
+        mid_key = message_id_key(m['message_id'])
+        if ledger is not None and mid_key and ledger.lookup(mid_key):
+            continue
+        body_fetches += 1
+        ckey = content_key('jobbox', m['parsed'], m['date'])
+        if ledger is not None:
+            hit = ledger.lookup(ckey)
+            if hit:
+                ledger.record([mid_key], hit['outcome'], 'jobbox', m['parsed']['account_name'])
+                continue
+            ledger.record([mid_key, ckey], 'dispatched', 'jobbox', m['parsed']['account_name'])
+            ledger.set_outcome([mid_key, ckey], DONE)  # RPA が終わったら（watcher.ingest._finish_notification）
+        rpa_runs += 1
+    return body_fetches, rpa_runs
+
+
+def _lookup_cost(n, memory_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = MessageLedger(os.path.join(tmp, 'ledger.db'), memory_size=memory_size)
+        keys = [message_id_key(f'<{i}@bench>') for i in range(n)]
+        ledger.record(keys)
+        t0 = time.perf_counter()
+        hits = sum(1 for k in keys if ledger.lookup(k))
+        per_hit = (time.perf_counter() - t0) / n * 1e6
+        t0 = time.perf_counter()
+        misses = sum(1 for i in range(n) if not ledger.lookup(message_id_key(f'<miss{i}@bench>')))
+        per_miss = (time.perf_counter() - t0) / n * 1e6
+        ledger.close()
+    return per_hit, per_miss, hits + misses
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--messages', type=int, default=500)
+    ap.add_argument('--reopen', type=int, default=120)
+    ap.add_argument('--forward', type=int, default=40)
+    ap.add_argument('--fresh', type=int, default=60)
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+    rnd = random.Random(args.seed)
+    mismatches = 0
+
+    print(f"{'tier':<16} {'hit µs':>8} {'miss µs':>8}")
+    for name, memory_size in (('memory (LRU)', args.messages * 2), ('SQLite only', 0)):
+        per_hit, per_miss, ok = _lookup_cost(args.messages * 4, memory_size)
+        print(f'{name:<16} {per_hit:>8.1f} {per_miss:>8.1f}')
+        mismatches += abs(ok - args.messages * 8)
+    print()
+
+    first = [_notification(i) for i in range(args.messages)]
+    reopened = rnd.sample(first, min(args.reopen, len(first)))
+    forwarded = [dict(m, message_id=f'<fwd{k}.{m["message_id"][1:]}') for k, m in
+                 enumerate(rnd.sample(first, min(args.forward, len(first))))]
+    fresh = [_notification(i, date_offset=7) for i in rnd.sample(range(args.messages), min(args.fresh, args.messages))]
+    replay = reopened + forwarded + fresh
+    rnd.shuffle(replay)
+    expected_rpa = args.messages + len(fresh)
+
+    print(f'通知 {args.messages} 通を処理後、未読に戻った {len(reopened)} / 転送 {len(forwarded)} / 新着 {len(fresh)} 通を再処理')
+    print(f"{'mode':<22} {'body fetch':>10} {'RPA runs':>9} {'duplicate RPA':>14}")
+    b1, r1 = _process(first, None)
+    b2, r2 = _process(replay, None)
+    print(f"{'MESSAGE_LEDGER=false':<22} {b1 + b2:>10} {r1 + r2:>9} {r1 + r2 - expected_rpa:>14}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        ledger = MessageLedger(path)
+        b1, r1 = _process(first, ledger)
+        ledger.close()
+        ledger = MessageLedger(path)  # 再起動した想定（メモリは空、SQLite から読む）
+        b2, r2 = _process(replay, ledger)
+        stats = ledger.stats()
+        ledger.close()
+    print(f"{'ledger':<22} {b1 + b2:>10} {r1 + r2:>9} {r1 + r2 - expected_rpa:>14}")
+    print(f"ledger counters: {stats['counters']}  outcomes: {stats['outcomes']}")
+    mismatches += abs(r1 + r2 - expected_rpa)
+    mismatches += abs(b1 + b2 - (args.messages + len(forwarded) + len(fresh)))
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
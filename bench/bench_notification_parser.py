@@ -0,0 +1,268 @@
+"""
+応募通知メール解析のマイクロベンチマーク
+
+bench/fixtures/eml/*.eml に対して、件名判定 → MIME 本文抽出 → 本文解析 を
+通知パーサー（notification_parser）と導入前の実装の両方で実行し、
+結果の一致と1通あたりの処理時間を比較する。
+
+使い方:
+    python bench/bench_notification_parser.py [--repeat 2000]
+"""
+
+import argparse
+import email
+import glob
+import os
+import re
+import sys
+import time
+import unicodedata
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import notification_parser as np_  # noqa: E402
+
+EML_DIR = os.path.join(ROOT, 'bench', 'fixtures', 'eml')
+JOBBOX_LOGIN_URL = np_.JOBBOX_LOGIN_URL
+
+
+# ---------- 導入前の実装（email_watcher から移植、比較用） ----------
+def _legacy_parse_jobbox_body(body):
+    # 提取所需字段
+    account_name = ''
+    account_id = ''
+    job_title = ''
+    # url = ''  # 不再从邮件中提取URL，改用固定值
+    
+    # 支持多种邮件格式：既有【アカウント名】也有普通的 'アカウント名:'
+    m = re.search(r'【?アカウント名】?[:：\s]*\s*(.+)', body)
+    if m:
+        account_name = m.group(1).strip()
+    # アカウントID: 严格匹配 4位数字-4位数字 格式
+    m = re.search(r'【?アカウントID】?[:：\s]*\s*(\d{4}-\d{4})', body)
+    if m:
+        account_id = m.group(1).strip()
+    m = re.search(r'【?求人タイトル】?[:：\s]*\s*(.+)', body)
+    if m:
+        job_title = m.group(1).strip()
+    
+    # 提取応募No.（支持多种格式）
+    oubo_no = ''
+    m = re.search(r'【?応募No.?】?[:：\s]*([A-Za-z0-9\-]+)', body)
+    if not m:
+        m = re.search(r'応募No.?[:：\s]*([A-Za-z0-9\-]+)', body)
+    if m:
+        oubo_no = m.group(1).strip()
+    
+    # 提取掲載企業名 / 企業名 / 掲載会社 等表示发布企业名的字段
+    employer_name = ''
+    m = re.search(r'【?(?:掲載企業名|企業名|掲載会社)】?[:：\s]*\s*(.+)', body)
+    if m:
+        employer_name = m.group(1).strip()
+    
+    return {
+        'account_name': account_name,
+        'account_id': account_id,
+        'job_title': job_title,
+        'url': JOBBOX_LOGIN_URL,  # 使用固定URL
+        'oubo_no': oubo_no,
+        'employer_name': employer_name
+    }
+
+
+def _legacy_parse_engage_body(body):
+    """parse_engage_body（エンジン導入前）"""
+    result = {
+        'account_name': '',
+        'job_title': '',
+        'url': '',
+        'employer_name': ''
+    }
+    
+    # 提取アカウント名（在"エンゲージ事務局です"之前的公司名）
+    # 方法1: 查找"エンゲージ事務局です"之前的非空行，且包含"株式会社"或"会社"等关键词
+    lines = body.split('\n')
+    engage_idx = -1
+    for i, line in enumerate(lines):
+        if 'エンゲージ事務局です' in line:
+            engage_idx = i
+            break
+    
+    if engage_idx > 0:
+        # 向上查找最近的包含公司名特征的行
+        for i in range(engage_idx - 1, -1, -1):
+            line = lines[i].strip()
+            # 跳过空行和邮件头信息
+            if not line or line.startswith('To:') or line.startswith('From:') or line.startswith('Date:') or line.startswith('Subject:') or line.startswith('----------') or line.startswith('<') or '@' in line:
+                continue
+            # 如果包含"様"，跳过（这是收件人姓名）
+            if '様' in line:
+                continue
+            # 如果包含公司特征词，或者是第一个非特殊字符的行
+            if any(kw in line for kw in ['株式会社', '会社', '有限会社', '合同会社', '本社', '支社', '事業所']):
+                result['account_name'] = line
+                result['employer_name'] = line
+                break
+            # 如果这是一个普通文本行（非邮件头），也可能是公司名
+            elif len(line) > 2 and not line.startswith('-') and not line.startswith('='):
+                result['account_name'] = line
+                result['employer_name'] = line
+                break
+    
+    # 方法2: 如果上面没找到，尝试用正则表达式匹配公司名模式
+    if not result['account_name']:
+        # 在整个邮件中搜索公司名模式（在"エンゲージ事務局です"之前）
+        engage_pos = body.find('エンゲージ事務局です')
+        if engage_pos > 0:
+            before_engage = body[:engage_pos]
+            # 查找包含"株式会社"等的行
+            m = re.search(r'((?:株式会社|有限会社|合同会社|合資会社)[^\n]+?)(?:\n|$)', before_engage)
+            if m:
+                result['account_name'] = m.group(1).strip()
+                result['employer_name'] = result['account_name']
+    
+    # 提取【 応募職種 】（可能有多种格式）
+    # 格式1: 【 応募職種 】
+    m = re.search(r'【\s*応募職種\s*】\s*\n\s*(.+?)(?:\n|$)', body, re.MULTILINE)
+    if m:
+        result['job_title'] = m.group(1).strip()
+    else:
+        # 格式2: 【応募職種】（无空格）
+        m = re.search(r'【応募職種】\s*\n\s*(.+?)(?:\n|$)', body, re.MULTILINE)
+        if m:
+            result['job_title'] = m.group(1).strip()
+    
+    # 提取【 応募内容の閲覧用URL 】（可能有多种格式）
+    # 格式1: 【 応募内容の閲覧用URL 】
+    m = re.search(r'【\s*応募内容の閲覧用URL\s*】\s*\n\s*(https?://[^\s]+)', body, re.MULTILINE)
+    if m:
+        result['url'] = m.group(1).strip()
+    else:
+        # 格式2: 【応募内容の閲覧用URL】（无空格）
+        m = re.search(r'【応募内容の閲覧用URL】\s*\n\s*(https?://[^\s]+)', body, re.MULTILINE)
+        if m:
+            result['url'] = m.group(1).strip()
+        else:
+            # 格式3: 直接查找en-gage.net的URL
+            m = re.search(r'(https://en-gage\.net/company/manage/message/\?apply_id=[A-Za-z0-9=]+)', body)
+            if m:
+                result['url'] = m.group(1).strip()
+    
+    if result['url']:
+        # 从URL中提取apply_id作为oubo_no
+        apply_id_match = re.search(r'apply_id=([A-Za-z0-9=]+)', result['url'])
+        if apply_id_match:
+            result['oubo_no'] = apply_id_match.group(1)
+    
+    return result
+
+
+def _legacy_decode_subject(raw):
+    if not raw:
+        return ''
+    subject = ''
+    for part, enc in email.header.decode_header(raw):
+        if isinstance(part, bytes):
+            try:
+                subject += part.decode(enc or 'utf-8')
+            except Exception:
+                subject += part.decode('utf-8', errors='ignore')
+        else:
+            subject += part
+    return subject
+
+
+def _legacy_extract_body(full_bytes):
+    msg = email.message_from_bytes(full_bytes)
+    body = ''
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_type() == 'text/plain':
+                payload = part.get_payload(decode=True)
+                if isinstance(payload, (bytes, bytearray)):
+                    try:
+                        body = payload.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+                    except Exception:
+                        body = payload.decode('utf-8', errors='ignore')
+                elif isinstance(payload, str):
+                    body = payload
+                break
+    else:
+        payload = msg.get_payload(decode=True)
+        if isinstance(payload, (bytes, bytearray)):
+            body = payload.decode(msg.get_content_charset() or 'utf-8', errors='ignore')
+        elif isinstance(payload, str):
+            body = payload
+    return body
+
+
+def _legacy_process(raw):
+    hdr = email.message_from_bytes(raw)
+    subject_raw = _legacy_decode_subject(hdr.get('Subject') or '')
+    subject = unicodedata.normalize('NFKC', subject_raw) if subject_raw else ''
+    has_engage_marker = '要対応' in subject_raw or '要対応' in subject
+    if '新着応募のお知らせ' in subject and not has_engage_marker:
+        return 'jobbox', _legacy_parse_jobbox_body(_legacy_extract_body(raw))
+    if has_engage_marker and '新着応募' in subject:
+        return 'engage', _legacy_parse_engage_body(_legacy_extract_body(raw))
+    return '', None
+
+
+def _process(raw):
+    hdr = email.message_from_bytes(raw)
+    fmt = np_.detect_format(_legacy_decode_subject(hdr.get('Subject') or ''))
+    if fmt is None:
+        return '', None
+    return fmt.platform, fmt.parse_body(np_.extract_text_body(raw))
+
+
+def _median_us(fn, arg, repeat):
+    samples = []
+    for _ in range(5):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            fn(arg)
+        samples.append((time.perf_counter() - t0) / repeat * 1e6)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='応募通知メール解析のマイクロベンチマーク')
+    ap.add_argument('--repeat', type=int, default=2000)
+    args = ap.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(EML_DIR, '*.eml')))
+    mismatches = 0
+    print(f"{'eml':<36} {'platform':<8} {'body legacy':>11} {'body new':>9} {'full legacy':>11} {'full new':>9}  result")
+    for path in paths:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        legacy = _legacy_process(raw)
+        current = _process(raw)
+        same = legacy == current
+        if not same:
+            mismatches += 1
+        platform = current[0]
+        if platform:
+            body = np_.extract_text_body(raw)
+            legacy_parse = _legacy_parse_jobbox_body if platform == 'jobbox' else _legacy_parse_engage_body
+            new_parse = np_.get_format(platform).parse_body
+            t_body_legacy = _median_us(legacy_parse, body, args.repeat)
+            t_body_new = _median_us(new_parse, body, args.repeat)
+        else:
+            t_body_legacy = t_body_new = 0.0
+        t_full_legacy = _median_us(_legacy_process, raw, max(1, args.repeat // 10))
+        t_full_new = _median_us(_process, raw, max(1, args.repeat // 10))
+        print(f"{os.path.basename(path):<36} {platform or '-':<8} {t_body_legacy:>9.1f}us {t_body_new:>7.1f}us "
+              f"{t_full_legacy:>9.1f}us {t_full_new:>7.1f}us  {'OK' if same else 'MISMATCH'}")
+        if not same:
+            print('  legacy :', legacy)
+            print('  current:', current)
+    print('結果不一致:', mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+送信 outbox（SQLite / WAL）の確認とオーバーヘッド計測
+
+1. 1件あたりのオーバーヘッド: guarded_send（送信前後の記録）を何もしない送信関数で N 回呼んだ時間
+2. 再起動の確認: 子プロセスが疑似 SMS PUBLISHER にタスクを順に送り、k 件目の送信直後
+   （結果を記録する前）に強制終了する。同じタスク一覧で子プロセスを起動し直して、
+    - 同じ番号に2回以上届いていないこと（送信済のキーは送らない）
+    - 送信中に落ちた1件は既定では送り直さず interrupted になること
+    - 非同期の履歴（OUTBOX_ASYNC_HISTORY）が再起動後に全件書かれること
+   を確認する。OUTBOX=false（従来）の場合の二重送信数と比べる。
+3. 書き込み中に落ちた履歴: 落ちてすぐ（stale_after より前に）起動し直しても、時間がたてば書き込みスレッドが
+   queued に戻して書くこと
+4. 応募No のない送信: 同じ送信先・同じテンプレートでも、別の通知（ref）からの送信は止めず、
+   同じ通知の送り直しだけを止めること。ref もなければ記録せずに毎回送ること
+
+使い方:
+    python bench/bench_outbox.py [--tasks 200] [--crash-at 120] [--overhead 2000]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _child(args):
+    """子プロセス: タスクを順に送り、crash_at 件目の送信直後に落ちる"""
+    import requests
+
+    import outbox
+
+    history_path = os.environ['BENCH_HISTORY']
+
+    def write_history(uid, doc):
+        with open(history_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+        return True
+
+    outbox.resume_history(write_history)
+    session = requests.Session()
+    for i in range(args.tasks):
+        number = f'0901{i:07d}'
+
+        def send():
+            r = session.post(args.url + '/send', data={'mobilenumber': number, 'smstext': 'test'}, timeout=5)
+            if i == args.crash_at:
+                os._exit(3)  # プロバイダには届いたが、結果を記録する前に落ちる
+            return (200 <= r.status_code < 300, {'status_code': r.status_code})
+
+        ok, info = outbox.guarded_send('uid0', f'OB{i:06d}', 'sms', 'scheduled:seg1', number, send)
+        if not outbox.is_duplicate(info):  # 送信済で送らなかった場合は履歴を書かない（前回書いている）
+            rec = {'oubo_no': f'OB{i:06d}', 'tel': number, 'status': '送信済（S）' if ok else '送信失敗（S）'}
+            if outbox.history_async_enabled():
+                outbox.enqueue_history('uid0', rec, write_history)
+            else:
+                write_history('uid0', rec)
+    ob = outbox.get_outbox()
+    if ob is not None and ob._writer is not None:
+        ob._writer.flush(10)
+    return 0
+
+
+def _run_children(url, tasks, crash_at, env):
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', '--url', url, '--tasks', str(tasks)]
+    first = subprocess.run(cmd + ['--crash-at', str(crash_at)], env=env)
+    second = subprocess.run(cmd + ['--crash-at', '-1'], env=env)
+    return first.returncode, second.returncode
+
+
+def _scenario(name, tasks, crash_at, extra_env):
+    from fake_sms_publisher import FakeSmsPublisher
+
+    srv = FakeSmsPublisher().start()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({'OUTBOX_DB': os.path.join(tmp, 'outbox.db'), 'BENCH_HISTORY': os.path.join(tmp, 'history.jsonl'),
+                    'PYTHONPATH': os.path.join(ROOT, 'src')})
+        env.update(extra_env)
+        t0 = time.perf_counter()
+        rc1, rc2 = _run_children(srv.base_url, tasks, crash_at, env)
+        elapsed = time.perf_counter() - t0
+        srv.stop()
+        per_number = Counter(n for n, _ in srv.messages)
+        duplicates = sum(c - 1 for c in per_number.values() if c > 1)
+        history = []
+        if os.path.exists(env['BENCH_HISTORY']):
+            with open(env['BENCH_HISTORY'], encoding='utf-8') as f:
+                history = [json.loads(line) for line in f if line.strip()]
+        history_ounos = Counter(h['oubo_no'] for h in history)
+        state = {}
+        if extra_env.get('OUTBOX', 'true') != 'false':
+            import outbox
+            ob = outbox.Outbox(env['OUTBOX_DB'])
+            state = ob.stats()['sends']
+            ob.close()
+    print(f"{name:<28} {rc1:>4} {rc2:>4} {len(per_number):>9} {duplicates:>5} {sum(history_ounos.values()):>8} "
+          f"{state.get('sending', 0):>11} {elapsed:>6.2f}s")
+    # 履歴は行数で数える（送信済で送らなかったタスクの履歴をもう一度書くと tasks を超える）
+    return len(per_number), duplicates, sum(history_ounos.values())
+
+
+def _overhead(n):
+    import outbox
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ob = outbox.Outbox(os.path.join(tmp, 'outbox.db'))
+        t0 = time.perf_counter()
+        for i in range(n):
+            ob.run(outbox.make_key('uid0', f'OB{i}', 'sms', 'seg'), lambda: (True, {'status_code': 200}))
+        per_send = (time.perf_counter() - t0) / n * 1e6
+        t0 = time.perf_counter()
+        dup = sum(1 for i in range(n) if ob.run(outbox.make_key('uid0', f'OB{i}', 'sms', 'seg'),
+                                                lambda: (True, {}))[1].get('outbox') == 'duplicate')
+        per_dup = (time.perf_counter() - t0) / n * 1e6
+        ob.close()
+    return per_send, per_dup, dup
+
+
+def _stale_history_check():
+    """書き込み中のまま残った履歴が、起動後に書き込まれるか。不一致の数を返す"""
+    import outbox
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'outbox.db')
+        ob = outbox.Outbox(path)
+        ob.enqueue_history('u1', {'oubo_no': 'OB1'})
+        ob.claim_history()  # writing にしたところで落ちた
+        ob.close()
+        ob = outbox.Outbox(path)  # すぐ起動し直す（この時点ではまだ戻さない）
+        ob.stale_after = 0.3
+        written = []
+        writer = ob.start_history_writer(lambda uid, doc: written.append(doc['oubo_no']) or True)
+        writer.flush(2.0)
+        before = len(written)
+        time.sleep(0.4)
+        writer.flush(5.0)
+        history = ob.stats()['history']
+        ob.close()
+    print(f"書き込み中に落ちた履歴: 起動直後 {before} 件 → {ob.stale_after:g} 秒後 {len(written)} 件（history: {history}）")
+    return 0 if before == 0 and written == ['OB1'] and history.get('written') == 1 else 1
+
+
+def _no_oubo_checks():
+    """応募No のない送信の冪等キー。不一致の数を返す"""
+    import outbox
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['OUTBOX_DB'] = os.path.join(tmp, 'outbox.db')
+        calls = []
+
+        def send():
+            calls.append(1)
+            return (True, {'status_code': 200})
+
+        results = []
+        # 同じ応募者の再応募（別の通知）→ 2回とも送る / 同じ通知の送り直し → 送らない
+        with outbox.notification_scope('sha:notification-1'):
+            results.append(outbox.guarded_send('u1', '', 'sms', 'seg1', '+8190', send))
+        with outbox.notification_scope('sha:notification-2'):
+            results.append(outbox.guarded_send('u1', '', 'sms', 'seg1', '+8190', send))
+        with outbox.notification_scope('sha:notification-2'):
+            results.append(outbox.guarded_send('u1', '', 'sms', 'seg1', '+8190', send))
+        by_notification = len(calls)
+        # 予約送信はタスク ID（通知の文脈より優先）
+        with outbox.notification_scope('sha:notification-2'):
+            outbox.guarded_send('u1', '', 'sms', 'scheduled:seg1', '+8190', send, ref='task-1')
+            outbox.guarded_send('u1', '', 'sms', 'scheduled:seg1', '+8190', send, ref='task-2')
+            outbox.guarded_send('u1', '', 'sms', 'scheduled:seg1', '+8190', send, ref='task-2')
+        by_task = len(calls) - by_notification
+        # ref がなければ記録しない（送信先だけで重複と判定しない）
+        outbox.guarded_send('u1', '', 'sms', 'seg1', '+8190', send)
+        outbox.guarded_send('u1', '', 'sms', 'seg1', '+8190', send)
+        unguarded = len(calls) - by_notification - by_task
+        counters = outbox.get_outbox().stats()['counters']
+        outbox.get_outbox().close()
+        outbox._outbox = None
+        del os.environ['OUTBOX_DB']
+    dup_reported = results[2][1].get('outbox') == 'duplicate'
+    print(f'応募No なし: 別の通知 2件 → 送信 {by_notification}（同じ通知の送り直しは重複と判定: {dup_reported}）/ '
+          f"別のタスク 2件 → 送信 {by_task} / ref なし 2回 → 送信 {unguarded}（記録なし {counters['unguarded']}）")
+    ok = by_notification == 2 and dup_reported and by_task == 2 and unguarded == 2 and counters['unguarded'] == 2
+    return 0 if ok else 1
+
+
+def main():
+    ap = argparse.ArgumentParser(description='送信 outbox の確認とオーバーヘッド計測')
+    ap.add_argument('--tasks', type=int, default=200)
+    ap.add_argument('--crash-at', type=int, default=120)
+    ap.add_argument('--overhead', type=int, default=2000)
+    ap.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    ap.add_argument('--url', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        return _child(args)
+
+    per_send, per_dup, dup = _overhead(args.overhead)
+    print(f'outbox オーバーヘッド: 送信記録 {per_send:.0f}µs/件、送信済の判定 {per_dup:.0f}µs/件（{dup}/{args.overhead} 件を重複と判定）')
+    mismatches = _stale_history_check()
+    mismatches += _no_oubo_checks()
+    print()
+    print(f'tasks: {args.tasks} / 1回目は {args.crash_at} 件目の送信直後に強制終了 → 同じタスクで再起動')
+    print(f"{'mode':<28} {'rc1':>4} {'rc2':>4} {'delivered':>9} {'dup':>5} {'history':>8} {'interrupted':>11} {'time':>7}")
+    _scenario('OUTBOX=false (legacy)', args.tasks, args.crash_at, {'OUTBOX': 'false'})
+    delivered, duplicates, history = _scenario('outbox', args.tasks, args.crash_at, {})
+    # 送信中に落ちた1件は送り直さず、再起動後に interrupted（送信失敗扱い）として履歴に残る
+    mismatches += duplicates + abs(delivered - args.tasks) + abs(history - args.tasks)
+    delivered, duplicates, history = _scenario('outbox + async history', args.tasks, args.crash_at,
+                                               {'OUTBOX_ASYNC_HISTORY': 'true'})
+    mismatches += duplicates + abs(delivered - args.tasks) + abs(history - args.tasks)
+    _scenario('outbox + resend interrupted', args.tasks, args.crash_at, {'OUTBOX_RESEND_INTERRUPTED': 'true'})
+    mismatches += 0 if dup == args.overhead else 1
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+HTML パーサーバックエンド（html.parser / lxml）の比較
+
+bench/fixtures/manifest.json に登録した保存済みページに対して、ページ種別ごとの
+抽出処理を各バックエンドで実行し、抽出結果が同じであることと解析時間を確認する。
+
+使い方:
+    python bench/bench_parser_backends.py [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cases  # noqa: E402
+import html_soup  # noqa: E402
+
+
+def _run(parser, entry, html):
+    html_soup.PARSER = parser
+    return cases.normalize(cases.run_case(entry, html))
+
+
+def _median_ms(parser, entry, html, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        _run(parser, entry, html)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='HTML パーサーバックエンドの比較')
+    ap.add_argument('--repeat', type=int, default=20)
+    args = ap.parse_args()
+
+    if not html_soup._lxml_available():
+        print('lxml がインストールされていません（pip install lxml）')
+        return 1
+
+    mismatches = 0
+    totals = {}
+    print(f"{'page':<46} {'html.parser':>11} {'lxml':>8} {'speedup':>8}  result")
+    for rel_path, entry, html in cases.load_cases():
+        expected = _run('html.parser', entry, html)
+        actual = _run('lxml', entry, html)
+        same = expected == actual
+        if not same:
+            mismatches += 1
+        t_builtin = _median_ms('html.parser', entry, html, args.repeat)
+        t_lxml = _median_ms('lxml', entry, html, args.repeat)
+        t = totals.setdefault(entry['type'], [0.0, 0.0])
+        t[0] += t_builtin
+        t[1] += t_lxml
+        print(f"{rel_path:<46} {t_builtin:>11.2f} {t_lxml:>8.2f} {t_builtin / t_lxml:>7.2f}x  {'OK' if same else 'MISMATCH'}")
+        if not same:
+            print('  html.parser:', expected)
+            print('  lxml       :', actual)
+
+    print()
+    for page_type, (t_builtin, t_lxml) in totals.items():
+        print(f'{page_type:<20} html.parser {t_builtin:>8.2f}ms  lxml {t_lxml:>8.2f}ms  {t_builtin / t_lxml:>5.2f}x')
+    print('結果不一致:', mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
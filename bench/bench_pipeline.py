@@ -0,0 +1,234 @@
+"""
+段階パイプライン（src/pipeline.py）の処理量・バックプレッシャーの確認
+
+疑似の通知（アカウント数 --accounts）を、各段階の処理時間を sleep で模擬して流す。
+
+    inline   以前の構成。IMAP の監視スレッドで解析し、RPA ジョブの中でアカウント照合 → ブラウザ操作 →
+             履歴の書き込みを順に行う（ジョブはアカウントごとに直列、ブラウザ予算まで並列）
+    staged   parse / resolve / rpa / record を別々のワーカーとキューで実行する（watcher.ingest と同じ構成）
+    bounded  staged のキュー上限を --small-queue にしたもの。投入側が待たされ、処理中の件数が上限内に収まる
+
+確認すること（違えば不一致として数える）:
+    - すべての通知が1回ずつ done で終わる
+    - rpa 段階で同じアカウントのジョブが同時に動かない / 同時に動くジョブがブラウザ予算以内
+    - 同じ応募者の履歴の書き込みが投入順に行われる
+    - bounded で処理中の件数が キュー上限 + ワーカー数 の合計を超えない
+    - dropped（次の段階に渡さずに終わった件数）が 0（rpa の後ろに record をつながない）
+    - rpa 段階のアカウントごとのキュー待ち（key_waits）が全アカウント分あり、件数の合計が通知数と一致する
+
+使い方:
+    python bench/bench_pipeline.py [--notifications 80] [--accounts 8] [--browsers 4]
+                                   [--parse-ms 5] [--resolve-ms 40] [--rpa-ms 200] [--record-ms 60] [--records 2]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from pipeline import PipelineStage, StagePipeline  # noqa: E402
+
+
+def _quantile(snap, q):
+    if not snap['count']:
+        return 0.0
+    target = q * snap['count']
+    for le, acc in snap['buckets']:
+        if acc >= target:
+            return float('inf') if le == '+Inf' else float(le)
+    return 0.0
+
+
+class _Checker:
+    """同時実行数・書き込み順・終了回数を記録する"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running_keys = defaultdict(int)
+        self.running = 0
+        self.max_running = 0
+        self.key_overlap = 0
+        self.writes = defaultdict(list)
+        self.finished = defaultdict(list)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def enter(self, key):
+        with self.lock:
+            self.running_keys[key] += 1
+            if self.running_keys[key] > 1:
+                self.key_overlap += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def leave(self, key):
+        with self.lock:
+            self.running_keys[key] -= 1
+            self.running -= 1
+
+    def submitted(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, item, outcome):
+        with self.lock:
+            if 'n' in item:
+                self.finished[item['n']].append(outcome)
+                self.in_flight -= 1
+
+
+def _run(mode, args, small_queue=None):
+    chk = _Checker()
+    sleep = time.sleep
+    ms = {k: getattr(args, f'{k}_ms') / 1000 for k in ('parse', 'resolve', 'rpa', 'record')}
+
+    def parse(item):
+        sleep(ms['parse'])
+        return item
+
+    def resolve(item):
+        sleep(ms['resolve'])
+        return item
+
+    def browser(item):
+        chk.enter(item['account'])
+        try:
+            sleep(ms['rpa'])
+        finally:
+            chk.leave(item['account'])
+
+    def record(item):
+        sleep(ms['record'])
+        with chk.lock:
+            chk.writes[item['applicant']].append(item['seq'])
+
+    if mode == 'inline':
+        def rpa_job(item):
+            resolve(item)
+            browser(item)
+            for seq in range(args.records):
+                record({'applicant': item['n'], 'seq': seq})
+
+        # 以前の RPA ジョブと同じく上限なしのキュー
+        stages = [PipelineStage('rpa', rpa_job, args.browsers, capacity=10 ** 9, key=lambda it: it['account'])]
+    else:
+        cap = small_queue or 0
+        pipeline_ref = []
+
+        def rpa(item):
+            browser(item)
+            for seq in range(args.records):
+                pipeline_ref[0].submit({'applicant': item['n'], 'seq': seq}, stage='record')
+
+        stages = [
+            PipelineStage('parse', parse, 2, cap or 50),
+            PipelineStage('resolve', resolve, 4, cap or 50),
+            PipelineStage('rpa', rpa, args.browsers, cap or 100, key=lambda it: it['account']),
+            PipelineStage('record', record, 2, cap or 200, key=lambda it: it['applicant'], entry=True),
+        ]
+    pipeline = StagePipeline(f'bench-{mode}', stages, on_finish=chk.finish)
+    if mode != 'inline':
+        pipeline_ref.append(pipeline)
+
+    t0 = time.perf_counter()
+    for n in range(args.notifications):
+        item = {'n': n, 'account': f'acct{n % args.accounts}'}
+        chk.submitted()
+        if mode == 'inline':
+            parse(item)  # 監視スレッドで解析してから RPA ジョブを投入
+        pipeline.submit(item)
+    submit_sec = time.perf_counter() - t0
+    pipeline.wait_idle()
+    wall = time.perf_counter() - t0
+    stats = pipeline.stats()
+    pipeline.shutdown(wait=False)
+
+    mismatches = 0
+    bad = [n for n in range(args.notifications) if chk.finished.get(n) != ['done']]
+    if bad:
+        print(f'  {mode}: done で1回だけ終わらなかった通知 {len(bad)} 件')
+        mismatches += len(bad)
+    if chk.key_overlap:
+        print(f'  {mode}: 同じアカウントのジョブが同時に動いた回数 {chk.key_overlap}')
+        mismatches += 1
+    if chk.max_running > args.browsers:
+        print(f'  {mode}: 同時に動いたブラウザ {chk.max_running} > 予算 {args.browsers}')
+        mismatches += 1
+    order_bad = sum(1 for seqs in chk.writes.values() if seqs != list(range(args.records)))
+    if order_bad or len(chk.writes) != args.notifications:
+        print(f'  {mode}: 履歴の書き込み順が違う応募者 {order_bad} / 書き込まれた応募者 {len(chk.writes)}')
+        mismatches += 1
+    key_waits = next(st['key_waits'] for st in stats['stages'] if st['name'] == 'rpa')
+    waited = sum(w['waited'] for w in key_waits.values())
+    if len(key_waits) != min(args.accounts, args.notifications) or waited != args.notifications:
+        print(f'  {mode}: アカウントごとのキュー待ち {len(key_waits)} アカウント / {waited} 件')
+        mismatches += 1
+    dropped = {st['name']: st['dropped'] for st in stats['stages'] if st['dropped']}
+    if dropped:
+        print(f'  {mode}: 次の段階に渡さずに終わった件数 {dropped}')
+        mismatches += 1
+    bound = None
+    if small_queue:
+        # 最初の段階のキュー + 各段階のキューとワーカー + 投入中の1件
+        bound = sum(st['capacity'] + st['workers'] for st in stats['stages']) + 1
+        if chk.max_in_flight > bound:
+            print(f'  {mode}: 処理中の件数 {chk.max_in_flight} が上限 {bound} を超えました')
+            mismatches += 1
+    return {'wall': wall, 'submit': submit_sec, 'stats': stats, 'max_in_flight': chk.max_in_flight,
+            'bound': bound, 'max_browsers': chk.max_running, 'mismatches': mismatches}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--notifications', type=int, default=80)
+    ap.add_argument('--accounts', type=int, default=8)
+    ap.add_argument('--browsers', type=int, default=4)
+    ap.add_argument('--parse-ms', type=float, default=5)
+    ap.add_argument('--resolve-ms', type=float, default=40)
+    ap.add_argument('--rpa-ms', type=float, default=200)
+    ap.add_argument('--record-ms', type=float, default=60)
+    ap.add_argument('--records', type=int, default=2, help='通知1通あたりの履歴の書き込み回数')
+    ap.add_argument('--small-queue', type=int, default=4)
+    args = ap.parse_args()
+
+    print(f'通知 {args.notifications} 通 / アカウント {args.accounts} / ブラウザ予算 {args.browsers} '
+          f'(parse {args.parse_ms:g}ms, resolve {args.resolve_ms:g}ms, rpa {args.rpa_ms:g}ms, '
+          f'record {args.record_ms:g}ms × {args.records})')
+    mismatches = 0
+    results = {}
+    for mode, small in (('inline', None), ('staged', None), ('bounded', args.small_queue)):
+        results[mode] = r = _run(mode if mode != 'bounded' else 'staged', args, small)
+        mismatches += r['mismatches']
+
+    base = results['inline']['wall']
+    print(f"{'mode':<9} {'wall s':>7} {'通/分':>8} {'speedup':>8} {'投入 s':>7} {'最大処理中':>10} {'browsers':>8}")
+    for mode, r in results.items():
+        rate = args.notifications / r['wall'] * 60
+        bound = f"/{r['bound']}" if r['bound'] else ''
+        print(f"{mode:<9} {r['wall']:>7.2f} {rate:>8.0f} {base / r['wall']:>7.2f}x {r['submit']:>7.2f} "
+              f"{str(r['max_in_flight']) + bound:>10} {r['max_browsers']:>8}")
+
+    for mode in ('staged', 'bounded'):
+        print(f'\n[{mode}]')
+        print(f"{'stage':<8} {'workers':>7} {'queue':>6} {'util':>6} {'max q':>6} {'blocked':>7} {'blocked s':>9} "
+              f"{'wait p95 ms':>11} {'done':>5}")
+        for st in results[mode]['stats']['stages']:
+            print(f"{st['name']:<8} {st['workers']:>7} {st['capacity']:>6} {st['utilization']:>6.2f} "
+                  f"{st['max_queued']:>6} {st['blocked']:>7} {st['blocked_sec']:>9.2f} "
+                  f"{_quantile(st['wait'], 0.95):>11.0f} {st['completed']:>5}")
+        waits = next(st['key_waits'] for st in results[mode]['stats']['stages'] if st['name'] == 'rpa')
+        worst = sorted(waits.items(), key=lambda kv: -kv[1]['wait_max_sec'])[:3]
+        print('rpa のキュー待ち（アカウント: 平均 / 最大 秒）: ' +
+              ', '.join(f"{k} {w['wait_avg_sec']:.2f} / {w['wait_max_sec']:.2f}" for k, w in worst))
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+処理1回分のプロファイル（src/profiler.py）の確認とオーバーヘッド計測
+
+1. 予約していないとき: with profile_run(...) 1回あたりの時間（普段の運用で払うコスト）
+2. notification: logs/profiles/PROFILE_NEXT（ここでは一時ディレクトリ）を置いて予約し、
+   通知メール（bench/fixtures/eml）の解析 → bind_profile したジョブを別スレッドで実行（エンゲージの
+   応募者詳細ページ bench/fixtures/engage の抽出）を1回分として計測する。
+   .pstats / .txt ができ、両方のスレッドの関数が含まれていることを確認する
+3. scraper: arm('scraper') で予約し、@profiled の付いた EngageLogin._extract_applicant_detail 1回分
+4. scheduled + PROFILE_MODE=sample: 一定間隔のスタック採取で .folded / .txt ができることを確認する
+同じ処理を 計測なし / cProfile / sample で実行した時間も比べる。
+
+使い方:
+    python bench/bench_profiler.py [--repeat 5]
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+TMP = tempfile.mkdtemp(prefix='bench_profiler_')
+os.environ['PROFILE_DIR'] = TMP
+os.environ.pop('PROFILE', None)
+
+import profiler  # noqa: E402
+from engage_login import EngageLogin  # noqa: E402
+from notification_parser import detect_format, extract_text_body  # noqa: E402
+
+FIXTURES = os.path.join(ROOT, 'bench', 'fixtures')
+
+
+def _load():
+    emls = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'eml', '*.eml'))):
+        with open(path, 'rb') as f:
+            emls.append(f.read())
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'engage', '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+    return emls, pages
+
+
+def _parse_mails(emls, repeat):
+    import email
+    from email.header import decode_header, make_header
+    n = 0
+    for _ in range(repeat):
+        for raw in emls:
+            msg = email.message_from_bytes(raw)
+            fmt = detect_format(str(make_header(decode_header(msg.get('Subject') or ''))))
+            body = extract_text_body(raw)
+            if fmt:
+                fmt.parse_body(body)
+                n += 1
+    return n
+
+
+def _extract_pages(pages, repeat):
+    engage = EngageLogin.__new__(EngageLogin)
+    engage.driver = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            for html in pages:
+                engage._extract_applicant_detail(html)
+
+
+def _outputs(before):
+    return sorted(set(glob.glob(os.path.join(TMP, '*'))) - before)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--overhead', type=int, default=200000)
+    args = ap.parse_args()
+    emls, pages = _load()
+    mismatches = 0
+
+    t0 = time.perf_counter()
+    for _ in range(args.overhead):
+        with profiler.profile_run('scheduled'):
+            pass
+    per = (time.perf_counter() - t0) / args.overhead * 1e6
+    print(f'予約なしの profile_run: {per:.2f}µs/回')
+
+    def workload():
+        _parse_mails(emls, args.repeat)
+        _extract_pages(pages, args.repeat)
+
+    workload()  # 初回の import・正規表現のコンパイルなどを除くため1回空回しする
+    t0 = time.perf_counter()
+    workload()
+    base_s = time.perf_counter() - t0
+
+    # --- notification（トリガーファイル + 別スレッドのジョブ） ---
+    with open(os.path.join(TMP, 'PROFILE_NEXT'), 'w', encoding='utf-8') as f:
+        f.write('notification')
+    profiler._next_file_check = 0.0
+    before = set(glob.glob(os.path.join(TMP, '*')))
+    t0 = time.perf_counter()
+    run = profiler.begin_profile('notification', 'bench mailbox')
+    _parse_mails(emls, args.repeat)
+    job = profiler.bind_profile(lambda: _extract_pages(pages, args.repeat))
+    th = threading.Thread(target=job, name='rpa-job')
+    with contextlib.redirect_stdout(io.StringIO()):
+        th.start()
+        profiler.end_profile()
+        th.join()
+    cprofile_s = time.perf_counter() - t0
+    out = _outputs(before)
+    pst = [p for p in out if p.endswith('.pstats')]
+    ok = run is not None and len(pst) == 1 and any(p.endswith('.txt') for p in out)
+    funcs = set()
+    if pst:
+        funcs = {fn for (_, _, fn) in pstats.Stats(pst[0]).stats}
+    both = {'extract_text_body', '_extract_applicant_detail'} <= funcs
+    print(f"notification: {', '.join(os.path.basename(p) for p in out)}")
+    print(f'  2スレッド分の関数を含む: {both} / 関数 {len(funcs)} 個')
+    mismatches += 0 if ok and both else 1
+    mismatches += 0 if not os.path.exists(os.path.join(TMP, 'PROFILE_NEXT')) else 1
+
+    # --- scraper（@profiled） ---
+    before = set(glob.glob(os.path.join(TMP, '*')))
+    profiler.arm('scraper')
+    with contextlib.redirect_stdout(io.StringIO()):
+        _extract_pages(pages[:1], 1)
+        _extract_pages(pages[:1], 1)  # 予約は1回分なので2回目は計測しない
+    out = _outputs(before)
+    print(f"scraper: {', '.join(os.path.basename(p) for p in out)}")
+    mismatches += 0 if len([p for p in out if p.endswith('.pstats')]) == 1 else 1
+
+    # --- scheduled + sample ---
+    os.environ['PROFILE_MODE'] = 'sample'
+    os.environ['PROFILE_INTERVAL_MS'] = '2'
+    before = set(glob.glob(os.path.join(TMP, '*')))
+    profiler.arm('scheduled')
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with profiler.profile_run('scheduled', 'uid0'):
+            workload()
+    sample_s = time.perf_counter() - t0
+    out = _outputs(before)
+    samples = 0
+    for p in out:
+        if p.endswith('.txt'):
+            with open(p, encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('samples='):
+                        samples = int(line.split('=')[1])
+    print(f"scheduled (sample): {', '.join(os.path.basename(p) for p in out)} / samples={samples}")
+    mismatches += 0 if any(p.endswith('.folded') for p in out) and samples > 0 else 1
+
+    print()
+    print(f"{'mode':<12} {'time s':>8} {'ratio':>7}")
+    for name, s in (('none', base_s), ('cprofile', cprofile_s), ('sample', sample_s)):
+        print(f'{name:<12} {s:>8.3f} {s / base_s:>6.2f}x')
+    print(f'出力先: {TMP}')
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
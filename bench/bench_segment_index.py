@@ -0,0 +1,101 @@
+"""
+ターゲットセグメント判定のマイクロベンチマーク
+
+ランダムに作ったセグメント設定と応募者について、従来の順次判定
+（_match_segment_conditions を priority 順に試す）と、SegmentIndex の
+find / classify_many の結果の一致と処理時間を比較する。
+
+使い方:
+    python bench/bench_segment_index.py [--applicants 20000] [--segments 5 20 100]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from email_watcher import _match_segment_conditions  # noqa: E402
+from segment_index import SegmentIndex, name_type_of  # noqa: E402
+
+NAMES = ['山田 太郎', '佐藤花子', 'ヤマダ タロウ', 'さとう はなこ', 'John Smith', 'Li Wei',
+         '鈴木 イチロー', 'たなか 一郎', 'MARIA', '高橋 美咲']
+
+
+def make_segments(n, rnd):
+    segments = []
+    for i in range(n):
+        male_min = rnd.randint(15, 60)
+        female_min = rnd.randint(15, 60)
+        segments.append({
+            'id': f'seg{i}',
+            'title': f'セグメント{i + 1}',
+            'priority': i,
+            'conditions': {
+                'nameTypes': {t: rnd.random() < 0.6 for t in ('kanji', 'katakana', 'hiragana', 'alpha')},
+                'genders': {'male': rnd.random() < 0.7, 'female': rnd.random() < 0.7},
+                'ageRanges': {
+                    'maleMin': male_min, 'maleMax': male_min + rnd.randint(0, 30),
+                    'femaleMin': female_min, 'femaleMax': female_min + rnd.randint(0, 30),
+                },
+            },
+        })
+    return segments
+
+
+def make_applicants(n, rnd):
+    applicants = []
+    for _ in range(n):
+        applicants.append({
+            'name': rnd.choice(NAMES + ['']),
+            'gender': rnd.choice(['男性', '女性', '男性', '女性', '']),
+            'age': rnd.choice([0] + list(range(16, 80))),
+        })
+    return applicants
+
+
+def legacy_find(detail, segments):
+    for segment in segments:
+        if _match_segment_conditions(detail, segment['conditions']):
+            return segment
+    return None
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - t0) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description='ターゲットセグメント判定のマイクロベンチマーク')
+    ap.add_argument('--applicants', type=int, default=20000)
+    ap.add_argument('--segments', type=int, nargs='+', default=[5, 20, 100])
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+
+    rnd = random.Random(args.seed)
+    applicants = make_applicants(max(1, args.applicants), rnd)
+    mismatches = 0
+    print(f'applicants: {len(applicants)}')
+    print(f"{'segments':>8} {'compile':>9} {'legacy':>10} {'find':>10} {'batch':>10} {'speedup':>8}  result")
+    for n in args.segments:
+        segments = make_segments(n, rnd)
+        name_type_of.cache_clear()
+        expected, t_legacy = _timed(lambda: [legacy_find(a, segments) for a in applicants])
+        index, t_compile = _timed(lambda: SegmentIndex(segments))
+        found, t_find = _timed(lambda: [index.find(a) for a in applicants])
+        batch, t_batch = _timed(lambda: index.classify_many(applicants))
+        bad = sum(1 for e, f, b in zip(expected, found, batch) if not (e is f is b))
+        mismatches += bad
+        print(f"{n:>8} {t_compile:>7.2f}ms {t_legacy:>8.1f}ms {t_find:>8.1f}ms {t_batch:>8.1f}ms "
+              f"{t_legacy / t_batch:>7.1f}x  {'OK' if not bad else f'MISMATCH x{bad}'}")
+    print('結果不一致:', mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+SMS 送信エンジンのスループット計測（疑似 SMS PUBLISHER を使用）
+
+疑似サーバー（fake_sms_publisher）を起動し、同じ件数を
+    legacy:  メッセージごとに requests.post（接続の再利用なし）
+    engine:  sms_engine.send_sms（プロバイダごとのプール済みセッション）
+で送って、1秒あたりの送信件数・p50 / p95 と、5xx / 560 の扱い（再試行・81 形式での再送）を確認する。
+
+--rate-limit を指定すると SMS_RATE_LIMIT と同じレート制限（例: 50/s）をかけて、
+上限の速度で送られることとバケットの状態（残りトークン・待ち時間）を確認する。
+
+使い方:
+    python bench/bench_sms_engine.py [--messages 500] [--threads 4] [--latency-ms 5] [--error-rate 0.05]
+    python bench/bench_sms_engine.py --rate-limit 50/s --messages 200
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('SMS_HTTP_BACKOFF', '0.01')
+
+import rate_limit  # noqa: E402
+import sms_client  # noqa: E402
+import sms_engine  # noqa: E402
+from fake_sms_publisher import FakeSmsPublisher  # noqa: E402
+
+API_ID = 'bench'
+API_PASS = 'secret'
+
+
+def _legacy_send(cfg, number, body):
+    req = sms_engine.build_request(cfg, number, body)
+    r = requests.post(req.url, headers=req.headers, data=req.data, timeout=15)
+    return 200 <= r.status_code < 300
+
+
+def _engine_send(cfg, number, body):
+    return sms_engine.send_sms(number, body, cfg)[0]
+
+
+def _run(send, cfg, numbers, threads):
+    latencies = []
+
+    def one(number):
+        t0 = time.perf_counter()
+        ok = send(cfg, number, 'ベンチマーク & テスト')
+        latencies.append((time.perf_counter() - t0) * 1000)
+        return ok
+
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(one, numbers))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        'ok': sum(1 for r in results if r),
+        'failed': sum(1 for r in results if not r),
+        'msg_per_s': len(numbers) / elapsed if elapsed else 0,
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description='SMS 送信エンジンのスループット計測')
+    ap.add_argument('--messages', type=int, default=500)
+    ap.add_argument('--threads', type=int, default=4)
+    ap.add_argument('--latency-ms', type=float, default=5.0)
+    ap.add_argument('--error-rate', type=float, default=0.05, help='疑似サーバーが 503 を返す割合')
+    ap.add_argument('--rate-limit', help='SMS_RATE_LIMIT と同じ形式（例: 50/s）')
+    args = ap.parse_args()
+
+    if args.rate_limit:
+        os.environ['SMS_RATE_LIMIT'] = args.rate_limit
+
+    numbers = [f'0901234{i:04d}' for i in range(args.messages)]
+
+    print(f'messages: {args.messages} / threads: {args.threads} / server latency: {args.latency_ms}ms')
+    print(f"{'mode':<22} {'msg/s':>8} {'p50':>8} {'p95':>8} {'ok':>6} {'failed':>6} {'connections':>11}")
+    scenarios = [
+        ('legacy (no pool)', _legacy_send, 0.0),
+        ('engine', _engine_send, 0.0),
+        (f'engine + 503 x{args.error_rate:g}', _engine_send, args.error_rate),
+    ]
+    for name, send, error_rate in scenarios:
+        srv = FakeSmsPublisher(latency_ms=args.latency_ms, error_rate=error_rate,
+                               api_id=API_ID, api_pass=API_PASS).start()
+        cfg = {'baseUrl': srv.base_url, 'apiId': API_ID, 'apiPass': API_PASS}
+        sms_client.reset_sms_clients()
+        try:
+            res = _run(send, cfg, numbers, args.threads)
+        finally:
+            srv.stop()
+        print(f"{name:<22} {res['msg_per_s']:>8.1f} {res['p50']:>6.1f}ms {res['p95']:>6.1f}ms "
+              f"{res['ok']:>6} {res['failed']:>6} {len(srv.connections):>11}")
+
+    # 560（携帯番号不正）→ 81 形式で再送
+    srv = FakeSmsPublisher(require_81=True, api_id=API_ID, api_pass=API_PASS).start()
+    cfg = {'baseUrl': srv.base_url, 'apiId': API_ID, 'apiPass': API_PASS}
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok, info = sms_engine.send_sms('09012340000', 'test', cfg)
+    srv.stop()
+    print()
+    print(f"560 → 81 形式で再送: {'OK' if ok and srv.messages and srv.messages[0][0].startswith('81') else 'NG'} {info.get('status_code')}")
+    # 4xx は再試行しない
+    srv = FakeSmsPublisher(api_id=API_ID, api_pass='other').start()
+    cfg = {'baseUrl': srv.base_url, 'apiId': API_ID, 'apiPass': API_PASS}
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok, info = sms_engine.send_sms('09012340000', 'test', cfg)
+    srv.stop()
+    print(f"401 は再試行しない: {'OK' if not ok and srv.counters.get('requests') == 1 else 'NG'} {info.get('status_code')}")
+
+    stats = sms_engine.sms_engine_stats()
+    print('engine counters:', stats['counters'])
+    for bucket in rate_limit.rate_limit_stats():
+        print('rate limit:', bucket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
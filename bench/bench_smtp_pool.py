@@ -0,0 +1,127 @@
+"""
+SMTP 接続プールのスループット計測（疑似 SMTP サーバーを使用）
+
+疑似サーバー（fake_smtp_server）に接続時・ログイン時の遅延（TLS ハンドシェイクと認証の代わり）を入れて、
+    legacy:  メールごとに接続 → EHLO → login → 送信 → QUIT（SMTP_POOL=false）
+    pool:    smtp_pool の接続を使い回す
+で同じ件数を送り、1秒あたりの送信件数・p50 / p95・接続数を比べる。
+--fail-rate で 421 切断を混ぜたときに、接続し直して全件送れることも確認する。
+--drop-rate でメッセージを受け取った後に切断される（DATA 後の切断）場合に、送り直さずにエラーを返し、
+同じ宛先に二重に届かないことも確認する。
+
+使い方:
+    python bench/bench_smtp_pool.py [--messages 300] [--threads 2] [--connect-latency-ms 60] [--auth-latency-ms 40]
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['EMAIL_SMTP_SSL'] = 'false'
+
+import smtp_pool  # noqa: E402
+from fake_smtp_server import FakeSmtpServer  # noqa: E402
+
+SENDER = 'bench@example.com'
+PASSWORD = 'app-pass'
+
+
+def _message(i):
+    msg = EmailMessage()
+    msg['From'] = SENDER
+    msg['To'] = f'user{i}@example.com'
+    msg['Subject'] = f'ベンチマーク {i}'
+    msg.set_content('本文です。\nご応募ありがとうございます。', charset='utf-8')
+    return msg
+
+
+def _run(port, count, threads, pooled):
+    os.environ['SMTP_POOL'] = 'true' if pooled else 'false'
+    smtp_pool._pool = None
+    latencies = []
+    errors = []
+
+    def one(i):
+        msg = _message(i)
+        t0 = time.perf_counter()
+        try:
+            smtp_pool.send_message('127.0.0.1', port, SENDER, PASSWORD, msg, SENDER, [msg['To']], 'bench.local', 5)
+        except Exception as e:
+            errors.append(repr(e))
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(count)))
+    elapsed = time.perf_counter() - t0
+    stats = smtp_pool.smtp_pool_stats()
+    if smtp_pool._pool is not None:
+        smtp_pool._pool.close_all()
+    latencies.sort()
+    return {
+        'msg_per_s': count / elapsed if elapsed else 0,
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'errors': errors,
+        'pool': stats['counters'],
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description='SMTP 接続プールのスループット計測')
+    ap.add_argument('--messages', type=int, default=300)
+    ap.add_argument('--threads', type=int, default=2)
+    ap.add_argument('--connect-latency-ms', type=float, default=60.0)
+    ap.add_argument('--auth-latency-ms', type=float, default=40.0)
+    ap.add_argument('--message-latency-ms', type=float, default=2.0)
+    ap.add_argument('--fail-rate', type=float, default=0.02, help='421 で切断する割合')
+    ap.add_argument('--drop-rate', type=float, default=0.02, help='メッセージを受け取った後に切断する割合')
+    args = ap.parse_args()
+
+    print(f'messages: {args.messages} / threads: {args.threads} / '
+          f'connect {args.connect_latency_ms}ms + auth {args.auth_latency_ms}ms / message {args.message_latency_ms}ms')
+    print(f"{'mode':<20} {'msg/s':>8} {'p50':>9} {'p95':>9} {'received':>8} {'errors':>6} {'dup':>4} "
+          f"{'connections':>11}")
+    scenarios = [
+        ('legacy (no pool)', False, 0.0, 0.0),
+        ('pool', True, 0.0, 0.0),
+        (f'pool + 421 x{args.fail_rate:g}', True, args.fail_rate, 0.0),
+        (f'pool + drop x{args.drop_rate:g}', True, 0.0, args.drop_rate),
+    ]
+    mismatches = 0
+    for name, pooled, fail_rate, drop_rate in scenarios:
+        srv = FakeSmtpServer(connect_latency_ms=args.connect_latency_ms, auth_latency_ms=args.auth_latency_ms,
+                             message_latency_ms=args.message_latency_ms, fail_rate=fail_rate,
+                             password=PASSWORD, drop_after_data_rate=drop_rate).start()
+        try:
+            res = _run(srv.port, args.messages, args.threads, pooled)
+        finally:
+            srv.stop()
+        received = srv.counters.get('messages', 0)
+        dropped = srv.counters.get('dropped_after_data', 0)
+        dup = sum(n - 1 for n in Counter(r for _, rcpts, _ in srv.messages for r in rcpts).values() if n > 1)
+        # 421 を混ぜた場合、送り直しでも 421 になった分はエラーとして呼び出し元に返る（再送は1回だけ）。
+        # DATA 後に切断された分は届いているが送り直さず、エラーとして返る（二重に届かない）
+        if (received - dropped + len(res['errors']) != args.messages or dup
+                or (res['errors'] and not (fail_rate or drop_rate))):
+            mismatches += 1
+        print(f"{name:<20} {res['msg_per_s']:>8.1f} {res['p50']:>7.1f}ms {res['p95']:>7.1f}ms "
+              f"{received:>8} {len(res['errors']):>6} {dup:>4} {srv.counters.get('connections', 0):>11}")
+        if pooled:
+            print(f"{'':<20} pool: {res['pool']}")
+        for e in res['errors'][:3]:
+            print(f"{'':<20} error: {e}")
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
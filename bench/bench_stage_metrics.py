@@ -0,0 +1,151 @@
+"""
+段階ごとの所要時間（src/stage_metrics.py）の確認とオーバーヘッド計測
+
+1. オーバーヘッド: with stage(...) を N 回通したときの1回あたりの時間
+2. /metrics の確認: 疑似の通知処理（媒体 2 × UID 数 × 通知数）をパイプラインの段階と同じく別スレッドで
+   bind_context 付きで（watcher.ingest._bind_stage と同じ）実行し、ローカルのポートで公開した /metrics を取得して
+    - 段階 × 媒体 × UID ごとの _count が実行した回数と一致すること
+    - bucket が単調増加で、+Inf が _count と一致すること
+    - 別スレッドで計測した段階にも媒体 / UID のラベルが付いていること
+   を確認する。
+
+使い方:
+    python bench/bench_stage_metrics.py [--overhead 200000] [--uids 3] [--notifications 40]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import requests  # noqa: E402
+
+import stage_metrics  # noqa: E402
+from stage_metrics import StageLaps, bind_context, stage, stage_context, timed  # noqa: E402
+
+PIPELINE = ('body_fetch', 'parse', 'account_lookup', 'browser_start', 'login', 'applicant_locate',
+            'segment_match', 'sms_send', 'history_write')
+
+LINE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+
+
+@timed('sms_send')
+def _fake_send():
+    time.sleep(0.0005)
+
+
+def _rpa_job(n):
+    with stage('account_lookup'):
+        pass
+    with stage('browser_start'):
+        time.sleep(0.001)
+    laps = StageLaps()
+    time.sleep(0.001)
+    laps.lap('login')
+    laps.lap('applicant_locate')
+    with stage('segment_match'):
+        pass
+    _fake_send()
+    with stage('history_write'):
+        pass
+
+
+def _parse(text):
+    series = {}
+    for line in text.splitlines():
+        if line.startswith('#') or not line:
+            continue
+        m = LINE.match(line)
+        if not m:
+            raise ValueError(f'unparsable line: {line}')
+        labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', m.group(2)))
+        series[(m.group(1), tuple(sorted(labels.items())))] = float(m.group(3))
+    return series
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--overhead', type=int, default=200000)
+    ap.add_argument('--uids', type=int, default=3)
+    ap.add_argument('--notifications', type=int, default=40)
+    args = ap.parse_args()
+    mismatches = 0
+
+    stage_metrics._metrics.reset()
+    t0 = time.perf_counter()
+    for _ in range(args.overhead):
+        pass
+    base = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    with stage_context('jobbox', 'bench'):
+        for _ in range(args.overhead):
+            with stage('parse'):
+                pass
+    per = (time.perf_counter() - t0 - base) / args.overhead * 1e6
+    print(f'with stage(...) のオーバーヘッド: {per:.2f}µs/回（{args.overhead} 回）')
+    stage_metrics._metrics.reset()
+
+    expected = defaultdict(int)
+    jobs = []
+    for u in range(args.uids):
+        uid = f'uid{u}'
+        for platform in ('jobbox', 'engage'):
+            for i in range(args.notifications):
+                with stage_context(uid=uid):
+                    with stage('body_fetch', platform=platform):
+                        pass
+                    with stage('parse', platform=platform):
+                        pass
+                    jobs.append(bind_context(_rpa_job, platform=platform))
+                for name in PIPELINE:
+                    expected[(name, platform, uid)] += 1
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        list(ex.map(lambda job: job(0), jobs))
+
+    server = stage_metrics.start_metrics_server(port=0)
+    url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+    t0 = time.perf_counter()
+    r = requests.get(url, timeout=5)
+    scrape_ms = (time.perf_counter() - t0) * 1000
+    series = _parse(r.text)
+    print(f'GET {url}: {r.status_code} {len(r.content)} bytes / {len(series)} 系列 / {scrape_ms:.1f}ms')
+
+    counts = {}
+    buckets = defaultdict(list)
+    for (name, labels), value in series.items():
+        d = dict(labels)
+        if name == 'watcher_stage_duration_seconds_count':
+            counts[(d['stage'], d['platform'], d['uid'])] = value
+        elif name == 'watcher_stage_duration_seconds_bucket':
+            le = float('inf') if d['le'] == '+Inf' else float(d['le'])
+            buckets[(d['stage'], d['platform'], d['uid'])].append((le, value))
+    for key, n in sorted(expected.items()):
+        if counts.get(key) != n:
+            print(f'  count 不一致: {key} expected={n} got={counts.get(key)}')
+            mismatches += 1
+        bs = sorted(buckets.get(key, []))
+        if not bs or any(b[1] > c[1] for b, c in zip(bs, bs[1:])) or bs[-1][1] != counts.get(key):
+            print(f'  bucket 不一致: {key}')
+            mismatches += 1
+    unlabeled = [k for k in counts if k not in expected]
+    mismatches += len(unlabeled)
+
+    print(f"{'stage':<18} {'platform':<8} {'count':>6} {'p50 ms':>8} {'p95 ms':>8}")
+    stats = stage_metrics.stage_metrics_stats()
+    for name in PIPELINE:
+        for platform in ('jobbox', 'engage'):
+            st = stats.get(f'{name}/{platform}/uid0', {})
+            print(f"{name:<18} {platform:<8} {st.get('count', 0):>6} {st.get('p50_ms') or 0:>8.0f} {st.get('p95_ms') or 0:>8.0f}")
+    server.shutdown()
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+起動時間の計測（python -X importtime）
+
+別プロセスで次の import だけを行い、所要時間と重い依存モジュールが読み込まれていないことを確認する。
+
+    facade      import email_watcher（segment_replay などが関数を1つ2つ使うときの入口）
+    watcher     email_watcher.main() が IMAP に接続するまでに読み込むもの（watcher.ingest / watcher.schedule）
+    dispatcher  scripts/scheduled_dispatcher.py のモジュール読み込み（main は実行しない）
+
+requests / imaplib / smtplib / selenium / cProfile / pstats / http.server は、最初に使うまで
+読み込まないのが正しい（lazy_import.lazy_module）。読み込まれていたら不一致として数える。
+あわせて、watcher.EXPORTS の名前がすべて email_watcher から参照できることも確かめる。
+
+.pyc は一時ディレクトリ（PYTHONPYCACHEPREFIX）に作り、1回空回ししてから計測する
+（PYTHONDONTWRITEBYTECODE の環境でも運用時と同じ「.pyc あり」の起動時間になる。作業ツリーは汚さない）。
+--baseline-dir に以前のチェックアウト（git worktree add ../base HEAD~1 など）を渡すと同じ計測を並べる。
+
+使い方:
+    python bench/bench_startup.py [--repeat 7] [--target-watcher-ms 80] [--target-dispatcher-ms 80]
+                                  [--baseline-dir ../base] [--detail] [--strict]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ('requests', 'imaplib', 'smtplib', 'selenium', 'cProfile', 'pstats', 'http.server')
+
+# 子プロセスで実行するコード。{body} の import にかかった時間（ms）と、読み込まれた重いモジュールを出力する
+_CHILD = '''
+import json, os, sys, time
+sys.path.insert(0, os.path.join({root!r}, 'src'))
+sys.path.insert(0, {root!r})
+t0 = time.perf_counter()
+{body}
+ms = (time.perf_counter() - t0) * 1000
+print(json.dumps({{'ms': ms, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+SCENARIOS = {
+    'facade': 'import email_watcher',
+    'watcher': ('import email_watcher\n'
+                'try:\n'
+                '    import watcher.ingest, watcher.schedule\n'
+                'except ImportError:\n'
+                '    pass  # 分割前の email_watcher.py は import email_watcher で全部読み込む'),
+    'dispatcher': ("import runpy\n"
+                   "runpy.run_path(os.path.join({root!r}, 'scripts', 'scheduled_dispatcher.py'), "
+                   "run_name='scheduled_dispatcher')"),
+}
+
+
+def _run(root, name, cache_dir):
+    body = SCENARIOS[name].replace('{root!r}', repr(root))
+    code = _CHILD.format(root=root, body=body, heavy=HEAVY)
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=cache_dir)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, env=env,
+                       capture_output=True, text=True, timeout=120)
+    if p.returncode != 0:
+        raise RuntimeError(f'{name}: {p.stderr[-2000:]}')
+    out = json.loads(p.stdout.strip().splitlines()[-1])
+    # -X importtime の行: "import time: self | cumulative | name"
+    selfs = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        selfs.append((int(parts[0]), int(parts[1]), parts[2].rstrip()))
+    out['top'] = sorted(selfs, reverse=True)[:6]
+    return out
+
+
+def _measure(root, repeat):
+    cache_dir = tempfile.mkdtemp(prefix='bench_startup_pyc_')
+    results = {}
+    for name in SCENARIOS:
+        _run(root, name, cache_dir)  # .pyc を作るための空回し
+        runs = [_run(root, name, cache_dir) for _ in range(repeat)]
+        results[name] = {'median': statistics.median(r['ms'] for r in runs), 'min': min(r['ms'] for r in runs),
+                         'heavy': runs[-1]['heavy'], 'top': runs[-1]['top']}
+    return results
+
+
+def _check_exports():
+    """watcher.EXPORTS の名前がすべて email_watcher から参照できるか（別プロセスで確認）"""
+    code = ('import sys, os; sys.path.insert(0, os.path.join(%r, "src"))\n'
+            'import email_watcher, watcher\n'
+            'missing = [n for n in watcher.EXPORTS if not callable(getattr(email_watcher, n, None))]\n'
+            'print(len(watcher.EXPORTS), " ".join(missing))') % ROOT
+    p = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=120)
+    total, _, missing = p.stdout.strip().partition(' ')
+    return int(total or 0), missing.split()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--repeat', type=int, default=7)
+    ap.add_argument('--target-watcher-ms', type=float, default=80.0)
+    ap.add_argument('--target-dispatcher-ms', type=float, default=80.0)
+    ap.add_argument('--baseline-dir', help='比較する以前のチェックアウト')
+    ap.add_argument('--detail', action='store_true', help='self 時間の大きいモジュールを表示する')
+    ap.add_argument('--strict', action='store_true', help='目標の超過も不一致として数える')
+    args = ap.parse_args()
+
+    mismatches = 0
+    current = _measure(ROOT, args.repeat)
+    baseline = _measure(os.path.abspath(args.baseline_dir), args.repeat) if args.baseline_dir else None
+    targets = {'watcher': args.target_watcher_ms, 'dispatcher': args.target_dispatcher_ms}
+
+    head = f"{'scenario':<12} {'median ms':>10} {'min ms':>8}"
+    if baseline:
+        head += f" {'base ms':>8} {'ratio':>6}"
+    print(head + f" {'target':>7}  heavy modules")
+    for name, r in current.items():
+        line = f"{name:<12} {r['median']:>10.1f} {r['min']:>8.1f}"
+        if baseline:
+            b = baseline[name]['median']
+            line += f' {b:>8.1f} {r["median"] / b:>5.2f}x'
+        target = targets.get(name)
+        verdict = ''
+        if target is not None:
+            ok = r['median'] <= target
+            verdict = f'{target:>5.0f}{"" if ok else "!"}'
+            if not ok:
+                print(f'  ({name} が目標 {target:.0f}ms を超えています)')
+                mismatches += 1 if args.strict else 0
+        line += f' {verdict:>7}  {",".join(r["heavy"]) or "-"}'
+        print(line)
+        mismatches += 1 if r['heavy'] else 0
+        if args.detail:
+            for self_us, cum_us, mod in r['top']:
+                print(f'    {self_us / 1000:>7.1f}ms self {cum_us / 1000:>7.1f}ms total  {mod.strip()}')
+
+    total, missing = _check_exports()
+    print(f'email_watcher から参照できる名前: {total - len(missing)}/{total}'
+          + (f"（見つからない: {', '.join(missing)}）" if missing else ''))
+    mismatches += len(missing) + (0 if total else 1)
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
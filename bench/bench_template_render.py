@@ -0,0 +1,159 @@
+"""
+テンプレート差し込みのマイクロベンチマーク
+
+SMS 本文 / メール件名 / HTML メール本文のテンプレートについて、導入前の
+apply_template_tokens（毎回正規表現で解析）と、コンパイル済みテンプレート
+（template_render.render_template / render_many）の結果の一致と処理時間を比較する。
+
+使い方:
+    python bench/bench_template_render.py [--rows 2000]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import template_render  # noqa: E402
+
+TEMPLATES = {
+    'sms': '{{applicant_name}}様\nこの度は「{{job_title}}」にご応募いただきありがとうございます。'
+           '{{company}}採用担当です。面接日程のご案内をお送りします。',
+    'subject': '【{{会社名}}】{{氏名}}様 ご応募ありがとうございます',
+    'html': '<html><body><p>{{applicant_name}} 様</p>'
+            '<p>{{employer_name}} の「{{position}}」へのご応募ありがとうございます。</p>'
+            '<p>担当: {{アカウント名}}</p><p>{{ unknown_token }}</p></body></html>',
+    'no_token': 'ご応募ありがとうございました。担当者よりご連絡いたします。',
+}
+
+
+# ---------- 導入前の実装（email_watcher から移植、比較用） ----------
+def _legacy_apply_template_tokens(template_text: str, data_map: dict) -> str:
+    """Replace template tokens like {{applicant_name}}, {{job_title}}, {{company}}.
+
+    - data_map: dict that may contain keys 'applicant_name', 'job_title', 'company' or
+      their synonyms. Values will be stringified. If template contains HTML tags,
+      inserted values will be HTML-escaped to avoid injecting raw HTML.
+    """
+    if not template_text:
+        return template_text
+    try:
+        import html as _html
+    except Exception:
+        _html = None
+
+    text = str(template_text)
+    is_html = bool(re.search(r'<[^>]+>', text))
+
+    # normalise data_map values to strings
+    norm_map = {}
+    for k, v in (data_map or {}).items():
+        try:
+            norm_map[str(k)] = '' if v is None else str(v)
+        except Exception:
+            norm_map[str(k)] = ''
+
+    # helper to resolve synonyms
+    def resolve_key(key: str) -> str:
+        k = key.lower()
+        # applicant name
+        if k in ('applicant_name', 'applicant', 'name', '氏名'):
+            return norm_map.get('applicant_name') or norm_map.get('name') or norm_map.get('氏名') or ''
+        # employer / poster company / 掲載企業名 / 企業名 / 会社名 (publishing company)
+        if k in ('employer_name', 'employer', 'poster_company', '掲載企業名', '企業名', '会社名'):
+            return (
+                norm_map.get('employer_name')
+                or norm_map.get('employer')
+                or norm_map.get('poster_company')
+                or norm_map.get('企業名')
+                or norm_map.get('掲載企業名')
+                or norm_map.get('会社名')
+                or ''
+            )
+        # job title / position / 求人タイトル / 職種
+        if k in ('position', 'job_title', 'jobtitle', '求人タイトル', '職種'):
+            return (
+                norm_map.get('job_title')
+                or norm_map.get('position')
+                or norm_map.get('求人タイトル')
+                or norm_map.get('職種')
+                or ''
+            )
+        # company / account name / アカウント名 (account/recruiter name, distinct from 会社名)
+        if k in ('company', 'account_name', 'accountname', 'アカウント名'):
+            return norm_map.get('company') or norm_map.get('account_name') or norm_map.get('accountname') or norm_map.get('アカウント名') or ''
+        # generic fallback
+        return norm_map.get(key) or norm_map.get(key.lower()) or ''
+
+    # Support ASCII word chars plus Hiragana/Katakana/Kanji inside token keys
+    token_re = re.compile(r"{{\s*([a-zA-Z0-9_\u3040-\u30ff\u4e00-\u9fff]+)\s*}}")
+
+    def _repl(m):
+        key = m.group(1)
+        val = resolve_key(key)
+        if is_html and _html:
+            return _html.escape(val)
+        return val
+
+    try:
+        return token_re.sub(_repl, text)
+    except Exception:
+        return text
+
+
+def _make_rows(n, seed=1):
+    rnd = random.Random(seed)
+    names = ['山田 太郎', 'ヤマダ ハナコ', 'John <Smith>', '佐藤 & 鈴木', None, '']
+    titles = ['ホールスタッフ', '【未経験OK】"軽作業"', '', None]
+    rows = []
+    for i in range(n):
+        row = {
+            'name': rnd.choice(names),
+            'job_title': rnd.choice(titles),
+            'company': f'株式会社テスト{i % 7}',
+            'employer_name': rnd.choice(['', '有限会社サンプル', None]),
+            'age': rnd.randint(18, 70),
+            'gender': rnd.choice(['男性', '女性']),
+        }
+        if i % 5 == 0:
+            row['applicant_name'] = '応募 者'
+        if i % 11 == 0:
+            row['会社名'] = 'サンプル商事'
+        rows.append(row)
+    return rows
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - t0) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description='テンプレート差し込みのマイクロベンチマーク')
+    ap.add_argument('--rows', type=int, default=2000)
+    args = ap.parse_args()
+
+    rows = _make_rows(max(1, args.rows))
+    mismatches = 0
+    print(f'rows: {len(rows)}')
+    print(f"{'template':<10} {'legacy':>9} {'render':>9} {'many':>9} {'speedup':>8}  result")
+    for name, tpl in TEMPLATES.items():
+        template_render.compile_template.cache_clear()
+        expected, t_legacy = _timed(lambda: [_legacy_apply_template_tokens(tpl, r) for r in rows])
+        actual, t_render = _timed(lambda: [template_render.render_template(tpl, r) for r in rows])
+        many, t_many = _timed(lambda: template_render.render_many(tpl, rows))
+        bad = sum(1 for a, b, c in zip(expected, actual, many) if not (a == b == c))
+        mismatches += bad
+        print(f"{name:<10} {t_legacy:>7.2f}ms {t_render:>7.2f}ms {t_many:>7.2f}ms {t_legacy / t_many:>7.1f}x  {'OK' if not bad else f'MISMATCH x{bad}'}")
+    print('結果不一致:', mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+通知ごとのトレース（src/tracing.py）の確認とオーバーヘッド計測
+
+1. オーバーヘッド: with stage(...) 1回あたりの時間を、トレース外 / トレース中（スパンも記録）で比べる
+2. 疑似の通知処理: N 件の通知をトレースし、RPA ジョブは bind_trace して別スレッドのプールで実行する。
+   一部の通知は遅く（TRACE_SLOW_MS 以上）、一部は例外で終わる。小さい TRACE_MAX_BYTES でローテーションさせ、
+   書き出された JSONL を読み直して
+    - 遅い / 例外のトレースはすべて残っていること、それ以外は TRACE_SAMPLE 程度の割合であること
+    - 残ったトレースはルート + 全スパンがそろい、親スパンがすべて同じトレース内にあること
+    - ファイルの世代数が TRACE_BACKUPS + 1 を超えないこと（古い世代が消えた場合、件数の確認は行わない）
+   を確認する。
+
+使い方:
+    python bench/bench_tracing.py [--notifications 400] [--sample 0.2] [--overhead 100000]
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--notifications', type=int, default=400)
+    ap.add_argument('--sample', type=float, default=0.2)
+    ap.add_argument('--overhead', type=int, default=100000)
+    ap.add_argument('--max-bytes', type=int, default=256 * 1024)
+    ap.add_argument('--backups', type=int, default=50)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_tracing_')
+    path = os.path.join(tmp, 'traces.jsonl')
+    # tracing は読み込み時に環境変数を読むため、import より前に設定する
+    os.environ.update({'TRACING': 'true', 'TRACE_FILE': path, 'TRACE_SAMPLE': str(args.sample),
+                       'TRACE_SLOW_MS': '50', 'TRACE_MAX_BYTES': str(args.max_bytes),
+                       'TRACE_BACKUPS': str(args.backups)})
+    import tracing
+    from stage_metrics import StageLaps, bind_context, stage
+    mismatches = 0
+
+    t0 = time.perf_counter()
+    for _ in range(args.overhead):
+        with stage('parse'):
+            pass
+    outside = (time.perf_counter() - t0) / args.overhead * 1e6
+    tracing.begin_trace('overhead')
+    t0 = time.perf_counter()
+    for _ in range(min(args.overhead, 400)):
+        with stage('parse'):
+            pass
+    inside = (time.perf_counter() - t0) / min(args.overhead, 400) * 1e6
+    tracing.discard_trace()
+    print(f'with stage(...): トレース外 {outside:.2f}µs / トレース中 {inside:.2f}µs（スパン記録込み）')
+
+    def rpa_job(parsed):
+        with stage('account_lookup'):
+            pass
+        with stage('browser_start'):
+            pass
+        laps = StageLaps()
+        if parsed['slow']:
+            time.sleep(0.08)
+        laps.lap('login')
+        laps.lap('applicant_locate')
+        with stage('sms_send'):
+            if parsed['error']:
+                raise RuntimeError('provider 500')
+        with stage('history_write'):
+            pass
+
+    # キュー待ちもトレースの時間に入るため、遅い通知以外が TRACE_SLOW_MS を超えないよう十分なスレッドで実行する
+    pool = ThreadPoolExecutor(max_workers=64)
+    kinds = {}
+    t0 = time.perf_counter()
+    futures = []
+    for i in range(args.notifications):
+        slow, error = i % 23 == 0, i % 31 == 0
+        tr = tracing.begin_trace('notification', mailbox='bench', uid='uid0', n=i)
+        kinds[tr.trace_id] = (i, slow, error)
+        with stage('header_fetch'):
+            pass
+        tracing.set_trace_attrs(platform='jobbox')
+        with stage('body_fetch', platform='jobbox'):
+            pass
+        with stage('parse', platform='jobbox'):
+            pass
+        job = tracing.bind_trace(bind_context(rpa_job, platform='jobbox'))
+        futures.append(pool.submit(job, {'slow': slow, 'error': error}))
+    tracing.end_trace()
+    for f in futures:
+        try:
+            f.result()
+        except RuntimeError:
+            pass
+    pool.shutdown()
+    tracing.get_trace_writer().stop()
+    elapsed = time.perf_counter() - t0
+
+    files = sorted(glob.glob(path + '*'))
+    spans = defaultdict(list)
+    lines = 0
+    for fp in files:
+        with open(fp, encoding='utf-8') as f:
+            for line in f:
+                rec = json.loads(line)
+                spans[rec['trace']].append(rec)
+                lines += 1
+    stats = tracing.tracing_stats()['counters']
+
+    expected_names = {'notification', 'header_fetch', 'body_fetch', 'parse', 'rpa_job', 'account_lookup',
+                      'browser_start', 'login', 'applicant_locate', 'sms_send', 'history_write'}
+    kept = {'sampled': 0, 'slow': 0, 'error': 0}
+    incomplete = 0
+    for trace_id, recs in spans.items():
+        root = [r for r in recs if r['parent'] is None]
+        ids = {r['span'] for r in recs}
+        names = {r['name'] for r in recs}
+        if len(root) != 1 or any(r['parent'] not in ids for r in recs if r['parent']):
+            incomplete += 1
+            continue
+        if not (expected_names - {'history_write'}) <= names:
+            incomplete += 1
+        kept[root[0]['attrs']['kept']] += 1
+    must_keep = [t for t, (_, slow, error) in kinds.items() if slow or error]
+    missing = [t for t in must_keep if t not in spans]
+    ordinary = args.notifications - len(must_keep)
+    ratio = kept['sampled'] / ordinary if ordinary else 0.0
+
+    print(f'通知 {args.notifications} 件（遅い {sum(1 for v in kinds.values() if v[1])} / '
+          f'例外 {sum(1 for v in kinds.values() if v[2])}）を {elapsed:.2f}s で処理')
+    print(f"{'kept sampled':<16} {kept['sampled']:>5}  （通常の通知 {ordinary} 件の {ratio:.0%}、TRACE_SAMPLE={args.sample}）")
+    print(f"{'kept slow':<16} {kept['slow']:>5}")
+    print(f"{'kept error':<16} {kept['error']:>5}")
+    print(f'JSONL: {len(files)} ファイル / {lines} 行 / rotated {stats["rotated"]} / dropped {stats["dropped"]}')
+    mismatches += incomplete + stats['dropped']
+    mismatches += 0 if len(files) <= args.backups + 1 else 1
+    if stats['rotated'] <= args.backups:
+        # 古い世代が消えていなければ、書いた行・残すべきトレースはすべてファイルにある
+        mismatches += len(missing)
+        mismatches += 0 if abs(ratio - args.sample) < 0.1 else 1
+        mismatches += 0 if lines == stats['written'] else 1
+    if incomplete or missing:
+        print(f'  不完全なトレース {incomplete} / 残らなかった遅い・例外のトレース {len(missing)}')
+    print(f'結果不一致: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
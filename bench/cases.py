@@ -0,0 +1,99 @@
+"""
+ベンチマーク共通: fixture 一覧とページ種別ごとの抽出処理
+
+bench/fixtures/manifest.json に fixture のパスとページ種別（と抽出に必要な引数）を登録する。
+各抽出処理は JSON で比較できる値を返す。
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import job_site_scraper as scraper  # noqa: E402
+from engage_login import EngageLogin  # noqa: E402
+
+FIXTURE_DIR = os.path.join(ROOT, 'bench', 'fixtures')
+EXPECTED_DIR = os.path.join(FIXTURE_DIR, 'expected')
+
+
+def engage_profile(html, entry):
+    # ページ解析のキャッシュを効かせないよう毎回新しいインスタンスを使う
+    engage = EngageLogin.__new__(EngageLogin)
+    engage.driver = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        detail = engage._extract_applicant_detail(html)
+        title = engage._extract_job_title(html)
+    return {'detail': detail, 'job_title': title}
+
+
+def kyujinbox_search(html, entry):
+    records = scraper.extract_jobbox_records(html, 'test', entry['source_url'])
+    return {'records': [vars(r) for r in records], 'next_page': scraper.find_next_page_href(html)}
+
+
+def kyujinbox_detail(html, entry):
+    return {
+        'recruiter': list(scraper.parse_jobbox_detail_recruiter(html, entry.get('job_title', ''))),
+        'company': list(scraper.parse_jobbox_detail_company(html)),
+    }
+
+
+def generic_search(html, entry):
+    records = scraper.extract_records(html, 'test', entry['source_url'])
+    return {'records': [vars(r) for r in records], 'next_page': scraper.find_next_page_href(html)}
+
+
+PAGE_TYPES = {
+    'engage_profile': engage_profile,
+    'kyujinbox_search': kyujinbox_search,
+    'kyujinbox_detail': kyujinbox_detail,
+    'generic_search': generic_search,
+}
+
+
+def load_cases(page_type=None):
+    """manifest.json の順に (相対パス, entry, html) を返す。"""
+    with open(os.path.join(FIXTURE_DIR, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    cases = []
+    for rel_path, entry in manifest.items():
+        if page_type and entry['type'] != page_type:
+            continue
+        with open(os.path.join(FIXTURE_DIR, rel_path), encoding='utf-8') as f:
+            cases.append((rel_path, entry, f.read()))
+    return cases
+
+
+def run_case(entry, html):
+    return PAGE_TYPES[entry['type']](html, entry)
+
+
+def expected_path(rel_path):
+    return os.path.join(EXPECTED_DIR, os.path.splitext(rel_path)[0] + '.json')
+
+
+def load_expected(rel_path):
+    path = expected_path(rel_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_expected(rel_path, result):
+    path = expected_path(rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def normalize(result):
+    """JSON 往復させて tuple/list などの差をなくす"""
+    return json.loads(json.dumps(result, ensure_ascii=False))
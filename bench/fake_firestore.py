@@ -0,0 +1,617 @@
+"""
+Firestore REST の疑似サーバー（オフライン確認・ベンチマーク用、メモリ上）
+
+email_watcher / scheduled_dispatcher が呼ぶ REST API（v1）と同じ形のリクエストに応答する。
+FIRESTORE_EMULATOR_HOST=127.0.0.1:<port> を設定すると src/firestore_rest.py がこちらへ向ける
+（トークンは取得せず 'owner' を送る。認証は確認しない）。
+
+    - ドキュメント: GET（mask.fieldPaths）/ PATCH（updateMask.fieldPaths。アプリが送るカンマ区切りも
+      受け付ける）/ DELETE
+    - コレクション: GET（pageSize / pageToken。pageSize 未指定なら全件）/ POST（自動 ID または documentId）
+    - {parent}:runQuery: structuredQuery の from（collectionId / allDescendants）/ where（fieldFilter・
+      compositeFilter・unaryFilter）/ orderBy / offset / limit / select
+    - documents:batchGet: found / missing を要求順に返す
+    - documents:commit: update（updateMask・updateTransforms）/ delete / transform を前提条件
+      （currentDocument の exists / updateTime）込みでまとめて適用する（1件でも満たさなければ何も書かない）。
+      fieldTransforms は increment と setToServerValue: REQUEST_TIME のみ
+    - --latency-ms だけ応答を遅らせる（Firestore までの往復の代わり）
+
+10 万件規模のコレクションでも手元で回せるよう、ドキュメント ID は並べた状態で持ってページ送りを
+二分探索で行い、runQuery の EQUAL 条件はフィールドごとの索引（初回の問い合わせで作り、以降の書き込みで
+更新する）で候補を絞ってから残りの条件を確かめる。parent と collectionId の扱い（allDescendants なしなら
+parent 直下のコレクションだけ）は本物の Firestore と同じで、orderBy の direction は 'DESC' も受け付ける。
+
+put() / get() / collection() で Python の値のまま読み書きできる（ベンチマークの準備・確認用）。
+on_write に関数を入れると、書き込まれたドキュメントごとに (path, doc) で呼ばれる。
+
+使い方:
+    python bench/fake_firestore.py --port 8080 [--latency-ms 40]
+    （FIRESTORE_EMULATOR_HOST=127.0.0.1:8080 で起動する）
+"""
+
+import argparse
+import bisect
+import json
+import random
+import string
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+_PREFIX = '/v1/projects/'
+_ID_CHARS = string.ascii_letters + string.digits
+
+
+def encode_value(v):
+    """Python の値 → Firestore の Value"""
+    if v is None:
+        return {'nullValue': None}
+    if isinstance(v, bool):
+        return {'booleanValue': v}
+    if isinstance(v, int):
+        return {'integerValue': str(v)}
+    if isinstance(v, float):
+        return {'doubleValue': v}
+    if isinstance(v, dict):
+        return {'mapValue': {'fields': {k: encode_value(x) for k, x in v.items()}}}
+    if isinstance(v, (list, tuple)):
+        return {'arrayValue': {'values': [encode_value(x) for x in v]}}
+    return {'stringValue': str(v)}
+
+
+def decode_value(f):
+    """Firestore の Value → Python の値"""
+    if not isinstance(f, dict):
+        return None
+    if 'stringValue' in f:
+        return f['stringValue']
+    if 'integerValue' in f:
+        return int(f['integerValue'])
+    if 'doubleValue' in f:
+        return float(f['doubleValue'])
+    if 'booleanValue' in f:
+        return bool(f['booleanValue'])
+    if 'mapValue' in f:
+        return {k: decode_value(x) for k, x in (f['mapValue'].get('fields') or {}).items()}
+    if 'arrayValue' in f:
+        return [decode_value(x) for x in (f['arrayValue'].get('values') or [])]
+    if 'timestampValue' in f:
+        return f['timestampValue']
+    return None
+
+
+# 型の並び順（Firestore の順序: null < bool < 数値 < timestamp < 文字列 < ... < map）
+_TYPE_ORDER = {'nullValue': 0, 'booleanValue': 1, 'integerValue': 2, 'doubleValue': 2,
+               'timestampValue': 3, 'stringValue': 4, 'bytesValue': 5, 'referenceValue': 6,
+               'geoPointValue': 7, 'arrayValue': 8, 'mapValue': 9}
+
+
+def _sort_key(f):
+    if not isinstance(f, dict) or not f:
+        return (-1, 0)
+    kind = next(iter(f))
+    order = _TYPE_ORDER.get(kind, 10)
+    if kind in ('integerValue', 'doubleValue'):
+        return (order, float(f[kind]))
+    if kind in ('stringValue', 'timestampValue', 'referenceValue'):
+        return (order, f[kind])
+    if kind == 'booleanValue':
+        return (order, bool(f[kind]))
+    if kind == 'nullValue':
+        return (order, 0)
+    return (order, json.dumps(f, sort_keys=True, ensure_ascii=False))
+
+
+def _field(fields, path):
+    """a.b.c 形式のフィールドパスで値（Value）を取り出す"""
+    cur = {'mapValue': {'fields': fields}}
+    for part in path.strip('`').split('.'):
+        if not isinstance(cur, dict) or 'mapValue' not in cur:
+            return None
+        cur = (cur['mapValue'].get('fields') or {}).get(part)
+        if cur is None:
+            return None
+    return cur
+
+
+def _set_field(fields, path, value):
+    parts = path.strip('`').split('.')
+    cur = fields
+    for part in parts[:-1]:
+        nxt = cur.get(part)
+        if not isinstance(nxt, dict) or 'mapValue' not in nxt:
+            nxt = {'mapValue': {'fields': {}}}
+            cur[part] = nxt
+        cur = nxt['mapValue'].setdefault('fields', {})
+    if value is None:
+        cur.pop(parts[-1], None)
+    else:
+        cur[parts[-1]] = value
+
+
+def _match(fields, flt):
+    if not flt:
+        return True
+    if 'compositeFilter' in flt:
+        cf = flt['compositeFilter']
+        subs = cf.get('filters') or []
+        if (cf.get('op') or 'AND') == 'OR':
+            return any(_match(fields, s) for s in subs)
+        return all(_match(fields, s) for s in subs)
+    if 'unaryFilter' in flt:
+        uf = flt['unaryFilter']
+        v = _field(fields, uf['field']['fieldPath'])
+        op = uf.get('op')
+        is_nan = v is not None and 'doubleValue' in v and v['doubleValue'] != v['doubleValue']
+        is_null = v is not None and 'nullValue' in v
+        return {'IS_NULL': is_null, 'IS_NOT_NULL': v is not None and not is_null,
+                'IS_NAN': is_nan, 'IS_NOT_NAN': v is not None and not is_nan}.get(op, False)
+    ff = flt.get('fieldFilter') or {}
+    v = _field(fields, ff['field']['fieldPath'])
+    op = ff.get('op')
+    want = ff.get('value') or {}
+    if op in ('IN', 'NOT_IN'):
+        cands = [_sort_key(x) for x in (want.get('arrayValue') or {}).get('values') or []]
+        if v is None:
+            return False
+        return (_sort_key(v) in cands) == (op == 'IN')
+    if op in ('ARRAY_CONTAINS', 'ARRAY_CONTAINS_ANY'):
+        if v is None or 'arrayValue' not in v:
+            return False
+        have = {_sort_key(x) for x in v['arrayValue'].get('values') or []}
+        if op == 'ARRAY_CONTAINS':
+            return _sort_key(want) in have
+        return any(_sort_key(x) in have for x in (want.get('arrayValue') or {}).get('values') or [])
+    if v is None:
+        return False
+    a, b = _sort_key(v), _sort_key(want)
+    if op in ('LESS_THAN', 'LESS_THAN_OR_EQUAL', 'GREATER_THAN', 'GREATER_THAN_OR_EQUAL') and a[0] != b[0]:
+        # 範囲比較は同じ型どうしだけが対象
+        return False
+    return {'EQUAL': a == b, 'NOT_EQUAL': a != b, 'LESS_THAN': a < b, 'LESS_THAN_OR_EQUAL': a <= b,
+            'GREATER_THAN': a > b, 'GREATER_THAN_OR_EQUAL': a >= b}.get(op, False)
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FakeFirestore(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=0.0, project='bench-project', seed=1):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency_ms = latency_ms
+        self.project = project
+        self._rnd = random.Random(seed)
+        self._lock = threading.RLock()
+        self.counters = {}
+        # コレクションのパス（accounts/uid/sms_history など）→ {ドキュメント ID: {'fields', 'createTime', 'updateTime'}}
+        self.collections = {}
+        # コレクション → 並べ済みのドキュメント ID（一覧のページ送りを二分探索で行う）
+        self._ids = {}
+        # コレクション → {フィールドパス: {値の _sort_key: ドキュメント ID の set}}（EQUAL 条件の絞り込み用）
+        # 一度 EQUAL で使われたフィールドだけ作り、以降の書き込み・削除で更新する
+        self._indexes = {}
+        self.on_write = None
+
+    @property
+    def host(self):
+        return f'127.0.0.1:{self.server_address[1]}'
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # ---------- Python の値での読み書き ----------
+    def doc_name(self, path):
+        return f'projects/{self.project}/databases/(default)/documents/{path}'
+
+    def doc_path(self, name):
+        """projects/.../documents/accounts/uid/... → accounts/uid/..."""
+        return name.partition('/databases/(default)/documents')[2].strip('/')
+
+    def put(self, path, data: dict):
+        """ドキュメントを丸ごと書き込む（path は accounts/uid/target_segments/seg1 など）"""
+        return self.write(path, {k: encode_value(v) for k, v in data.items()})
+
+    def get(self, path):
+        doc = self.read(path)
+        if doc is None:
+            return None
+        return {k: decode_value(v) for k, v in doc['fields'].items()}
+
+    def collection(self, path):
+        """コレクションのドキュメントを {ID: Python の dict} で返す"""
+        with self._lock:
+            docs = dict(self.collections.get(path.strip('/'), {}))
+        return {doc_id: {k: decode_value(v) for k, v in d['fields'].items()} for doc_id, d in docs.items()}
+
+    # ---------- 内部の保存形式 ----------
+    def read(self, path):
+        coll, _, doc_id = path.strip('/').rpartition('/')
+        with self._lock:
+            return self.collections.get(coll, {}).get(doc_id)
+
+    def write(self, path, fields, mask=None):
+        with self._lock:
+            out = self._write(path.strip('/'), fields, mask, _now_iso())
+        if self.on_write is not None:
+            self.on_write(path.strip('/'), out)
+        return out
+
+    def _write(self, path, fields, mask, now):
+        coll, _, doc_id = path.rpartition('/')
+        docs = self.collections.setdefault(coll, {})
+        doc = docs.get(doc_id)
+        if doc is None:
+            doc = {'fields': {}, 'createTime': now}
+            docs[doc_id] = doc
+            bisect.insort(self._ids.setdefault(coll, []), doc_id)
+        indexes = self._indexes.get(coll) or {}
+        for fp, idx in indexes.items():
+            _index_discard(idx, _field(doc['fields'], fp), doc_id)
+        if mask is None:
+            doc['fields'] = dict(fields)
+        else:
+            for fp in mask:
+                _set_field(doc['fields'], fp, _field(fields, fp))
+        for fp, idx in indexes.items():
+            _index_add(idx, _field(doc['fields'], fp), doc_id)
+        doc['updateTime'] = now
+        return self.render(path, doc)
+
+    def delete(self, path):
+        with self._lock:
+            return self._delete(path.strip('/'))
+
+    def _delete(self, path):
+        coll, _, doc_id = path.rpartition('/')
+        doc = self.collections.get(coll, {}).pop(doc_id, None)
+        if doc is None:
+            return False
+        ids = self._ids[coll]
+        del ids[bisect.bisect_left(ids, doc_id)]
+        for fp, idx in (self._indexes.get(coll) or {}).items():
+            _index_discard(idx, _field(doc['fields'], fp), doc_id)
+        return True
+
+    def new_id(self):
+        with self._lock:
+            return ''.join(self._rnd.choice(_ID_CHARS) for _ in range(20))
+
+    def render(self, path, doc, mask=None):
+        fields = doc['fields']
+        if mask is not None:
+            fields = {}
+            for fp in mask:
+                _set_field(fields, fp, _field(doc['fields'], fp))
+        return {'name': self.doc_name(path.strip('/')), 'fields': fields,
+                'createTime': doc['createTime'], 'updateTime': doc.get('updateTime', doc['createTime'])}
+
+    def list(self, coll, page_size=0, page_token=None, mask=None):
+        with self._lock:
+            ids = self._ids.get(coll, [])
+            start = bisect.bisect_right(ids, page_token) if page_token else 0
+            end = start + page_size if page_size > 0 else len(ids)
+            page = ids[start:end]
+            docs = [self.render(f'{coll}/{i}', self.collections[coll][i], mask) for i in page]
+            more = end < len(ids)
+        out = {'documents': docs} if docs else {}
+        if more and page:
+            out['nextPageToken'] = page[-1]
+        return out
+
+    def batch_get(self, names, mask=None):
+        """batchGet の応答（found / missing）を names の順に返す"""
+        read_time = _now_iso()
+        out = []
+        with self._lock:
+            for name in names:
+                doc = self.read(self.doc_path(name))
+                if doc is None:
+                    out.append({'missing': name, 'readTime': read_time})
+                else:
+                    out.append({'found': self.render(self.doc_path(name), doc, mask), 'readTime': read_time})
+        return out
+
+    def commit(self, writes):
+        """commit の writes をまとめて適用する。
+
+        前提条件（currentDocument）を満たさない書き込みがあれば何も適用せず
+        (HTTP ステータス, メッセージ) を返す。成功時は (200, 応答) を返す。
+        """
+        now = _now_iso()
+        written = []
+        with self._lock:
+            for w in writes:
+                name = (w.get('update') or {}).get('name') or w.get('delete') or (w.get('transform') or {}).get('document')
+                if not name:
+                    return 400, 'write has no target document'
+                pre = w.get('currentDocument') or {}
+                doc = self.read(self.doc_path(name))
+                if 'exists' in pre and pre['exists'] and doc is None:
+                    return 404, f'No document to update: {name}'
+                if 'exists' in pre and not pre['exists'] and doc is not None:
+                    return 409, f'Document already exists: {name}'
+                if 'updateTime' in pre and (doc is None or doc.get('updateTime') != pre['updateTime']):
+                    return 400, f'FAILED_PRECONDITION: the stored version does not match: {name}'
+            results = []
+            for w in writes:
+                if 'delete' in w:
+                    self._delete(self.doc_path(w['delete']))
+                    results.append({'updateTime': now})
+                    continue
+                if 'update' in w:
+                    path = self.doc_path(w['update']['name'])
+                    mask = (w.get('updateMask') or {}).get('fieldPaths') if 'updateMask' in w else None
+                    self._write(path, w['update'].get('fields') or {}, mask, now)
+                    transforms = w.get('updateTransforms') or []
+                else:
+                    path = self.doc_path(w['transform']['document'])
+                    transforms = w['transform'].get('fieldTransforms') or []
+                result = {'updateTime': now}
+                if transforms:
+                    result['transformResults'] = self._transform(path, transforms, now)
+                results.append(result)
+                written.append(path)
+            rendered = [(p, self.render(p, self.read(p))) for p in written if self.read(p) is not None]
+        if self.on_write is not None:
+            for path, doc in rendered:
+                self.on_write(path, doc)
+        return 200, {'writeResults': results, 'commitTime': now}
+
+    def _transform(self, path, transforms, now):
+        """fieldTransforms の increment と setToServerValue: REQUEST_TIME だけに対応"""
+        doc = self.read(path)
+        fields = doc['fields'] if doc is not None else {}
+        values = {}
+        for t in transforms:
+            fp = t['fieldPath']
+            if 'increment' in t:
+                cur = decode_value(_field(fields, fp))
+                inc = decode_value(t['increment'])
+                cur = cur if isinstance(cur, (int, float)) and not isinstance(cur, bool) else 0
+                values[fp] = encode_value(cur + inc)
+            elif t.get('setToServerValue') == 'REQUEST_TIME':
+                values[fp] = {'timestampValue': now}
+        if values:
+            nested = {}
+            for fp, v in values.items():
+                _set_field(nested, fp, v)
+            self._write(path, nested, list(values), now)
+        return list(values.values())
+
+    def _candidates(self, coll, flt):
+        """where の AND 条件にある EQUAL から、索引で候補のドキュメント ID を絞る（絞れなければ None）"""
+        if not flt:
+            return None
+        if 'fieldFilter' in flt:
+            subs = [flt]
+        elif 'compositeFilter' in flt and (flt['compositeFilter'].get('op') or 'AND') == 'AND':
+            subs = flt['compositeFilter'].get('filters') or []
+        else:
+            return None
+        best = None
+        for s in subs:
+            ff = s.get('fieldFilter') or {}
+            if ff.get('op') != 'EQUAL':
+                continue
+            fp = ff['field']['fieldPath']
+            idx = self._index(coll, fp)
+            hit = idx.get(_sort_key(ff.get('value') or {}), ())
+            if best is None or len(hit) < len(best):
+                best = hit
+        return best
+
+    def _index(self, coll, fp):
+        indexes = self._indexes.setdefault(coll, {})
+        idx = indexes.get(fp)
+        if idx is None:
+            idx = {}
+            for doc_id, doc in self.collections.get(coll, {}).items():
+                _index_add(idx, _field(doc['fields'], fp), doc_id)
+            indexes[fp] = idx
+        return idx
+
+    def run_query(self, parent, q):
+        sources = q.get('from') or []
+        where = q.get('where')
+        with self._lock:
+            rows = []
+            for src in sources:
+                cid = src.get('collectionId')
+                if src.get('allDescendants'):
+                    colls = [c for c in self.collections
+                             if c.rpartition('/')[2] == cid and (not parent or c.startswith(parent + '/'))]
+                else:
+                    colls = [f'{parent}/{cid}' if parent else cid]
+                for coll in colls:
+                    docs = self.collections.get(coll, {})
+                    ids = self._candidates(coll, where)
+                    for doc_id in (docs if ids is None else ids):
+                        doc = docs[doc_id]
+                        if _match(doc['fields'], where):
+                            rows.append((f'{coll}/{doc_id}', doc))
+            order = q.get('orderBy') or []
+            rows.sort(key=lambda r: r[0])
+            for o in reversed(order):
+                fp = o['field']['fieldPath']
+                if fp == '__name__':
+                    key = (lambda r: r[0])
+                else:
+                    key = (lambda r, fp=fp: _sort_key(_field(r[1]['fields'], fp)))
+                    # orderBy のフィールドがないドキュメントは結果に含めない
+                    rows = [r for r in rows if _field(r[1]['fields'], fp) is not None]
+                rows.sort(key=key, reverse=(o.get('direction') == 'DESCENDING' or o.get('direction') == 'DESC'))
+            offset = int(q.get('offset') or 0)
+            limit = q.get('limit')
+            if isinstance(limit, dict):
+                limit = limit.get('value')
+            rows = rows[offset:offset + int(limit)] if limit is not None else rows[offset:]
+            mask = None
+            if q.get('select') is not None:
+                mask = [f['fieldPath'] for f in q['select'].get('fields') or [] if f['fieldPath'] != '__name__']
+            return [self.render(path, doc, mask) for path, doc in rows]
+
+
+def _index_add(idx, value, doc_id):
+    if value is not None:
+        idx.setdefault(_sort_key(value), set()).add(doc_id)
+
+
+def _index_discard(idx, value, doc_id):
+    if value is None:
+        return
+    key = _sort_key(value)
+    ids = idx.get(key)
+    if ids is not None:
+        ids.discard(doc_id)
+        if not ids:
+            del idx[key]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    server: FakeFirestore
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        out = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+        self.server.count(f'status_{status}')
+
+    def _error(self, status, message):
+        names = {400: 'INVALID_ARGUMENT', 404: 'NOT_FOUND', 409: 'ALREADY_EXISTS'}
+        name = names.get(status, 'UNKNOWN')
+        if message.startswith('FAILED_PRECONDITION'):
+            name = 'FAILED_PRECONDITION'
+        self._reply(status, {'error': {'code': status, 'message': message, 'status': name}})
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        return json.loads(raw.decode('utf-8')) if raw else {}
+
+    def _route(self):
+        """(相対パス, 動作 ':runQuery' など, クエリ) を返す。対象外の URL なら None"""
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        if not path.startswith(_PREFIX):
+            return None
+        rest = path[len(_PREFIX):]
+        _project, _, rest = rest.partition('/databases/(default)/documents')
+        action = ''
+        if ':' in rest:
+            rest, _, action = rest.rpartition(':')
+        return rest.strip('/'), action, parse_qs(url.query)
+
+    def _handle(self, method):
+        srv = self.server
+        srv.count('requests')
+        if srv.latency_ms:
+            time.sleep(srv.latency_ms / 1000.0)
+        route = self._route()
+        if route is None:
+            return self._error(404, f'unknown path {self.path}')
+        path, action, query = route
+        try:
+            body = self._body() if method in ('POST', 'PATCH') else {}
+        except Exception:
+            return self._error(400, 'invalid JSON')
+        segments = [s for s in path.split('/') if s]
+        is_doc = len(segments) % 2 == 0 and segments
+        srv.count(f"{method.lower()}{':' + action if action else ''}")
+
+        if action == 'runQuery' and method == 'POST':
+            docs = srv.run_query(path, body.get('structuredQuery') or {})
+            read_time = _now_iso()
+            if not docs:
+                return self._reply(200, [{'readTime': read_time}])
+            return self._reply(200, [{'document': d, 'readTime': read_time} for d in docs])
+        if action == 'batchGet' and method == 'POST':
+            mask = (body.get('mask') or {}).get('fieldPaths') if 'mask' in body else None
+            return self._reply(200, srv.batch_get(body.get('documents') or [], mask))
+        if action == 'commit' and method == 'POST':
+            status, out = srv.commit(body.get('writes') or [])
+            if status != 200:
+                return self._error(status, out)
+            return self._reply(200, out)
+        if action:
+            return self._error(400, f'unsupported action {action}')
+
+        if method == 'GET':
+            mask = query.get('mask.fieldPaths')
+            if is_doc:
+                doc = srv.read(path)
+                if doc is None:
+                    return self._error(404, f'No document to get: {path}')
+                return self._reply(200, srv.render(path, doc, mask))
+            size = int((query.get('pageSize') or ['0'])[0] or 0)
+            token = (query.get('pageToken') or [None])[0]
+            return self._reply(200, srv.list(path, size, token, mask))
+        if method == 'POST' and not is_doc:
+            doc_id = (query.get('documentId') or [None])[0] or srv.new_id()
+            if srv.read(f'{path}/{doc_id}') is not None:
+                return self._error(409, f'Document already exists: {path}/{doc_id}')
+            return self._reply(200, srv.write(f'{path}/{doc_id}', body.get('fields') or {}))
+        if method == 'PATCH' and is_doc:
+            mask = None
+            if 'updateMask.fieldPaths' in query:
+                mask = [p for v in query['updateMask.fieldPaths'] for p in v.split(',') if p]
+            return self._reply(200, srv.write(path, body.get('fields') or {}, mask))
+        if method == 'DELETE' and is_doc:
+            srv.delete(path)
+            return self._reply(200, {})
+        return self._error(400, f'unsupported request {method} {path}')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Firestore REST の疑似サーバー')
+    ap.add_argument('--port', type=int, default=8080)
+    ap.add_argument('--latency-ms', type=float, default=0.0)
+    ap.add_argument('--project', default='bench-project')
+    args = ap.parse_args()
+
+    srv = FakeFirestore(args.port, args.latency_ms, args.project)
+    print(f'疑似 Firestore: FIRESTORE_EMULATOR_HOST={srv.host}  (Ctrl+C で終了)')
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('受信件数:', json.dumps(srv.counters, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+IMAP の疑似サーバー（オフライン確認・ベンチマーク用、TLS なし）
+
+watch_mail が使うコマンドだけに応答する:
+CAPABILITY / LOGIN / SELECT / SEARCH UNSEEN / FETCH（BODY.PEEK[HEADER.FIELDS (...)] / BODY.PEEK[] / BODY[]）/
+STORE +FLAGS \\Seen / NOOP / LOGOUT。
+メールボックスはユーザーごとにメモリ上に持ち、deliver() で新着メールを追加する（EXPUNGE しないので
+シーケンス番号は追加順の連番のまま）。コマンドごとの遅延（Gmail までの往復の代わり）を指定できる。
+受信側は EMAIL_IMAP_SSL=false EMAIL_IMAP_PORT=<port> で平文接続にする。
+
+使い方:
+    python bench/fake_imap_server.py --port 1143 [--latency-ms 30] [--eml-dir bench/fixtures/eml --user recruit@example.com]
+    （EMAIL_IMAP_SSL=false EMAIL_IMAP_PORT=1143 で watch_mail を 127.0.0.1 に向ける）
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import socketserver
+import threading
+import time
+
+_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+_FETCH_ITEM = re.compile(r'BODY(\.PEEK)?\[([^\]]*)\]', re.I)
+_HEADER_FIELDS = re.compile(r'HEADER\.FIELDS\s*\(([^)]*)\)', re.I)
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency_ms=0.0, password=None):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency_ms = latency_ms
+        self.password = password
+        self._lock = threading.Lock()
+        self.counters = {}
+        # user -> [{'raw': bytes, 'flags': set, 'delivered': float}]
+        self.mailboxes = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def deliver(self, user, raw: bytes, seen=False) -> int:
+        """user の INBOX にメールを追加し、シーケンス番号を返す"""
+        with self._lock:
+            box = self.mailboxes.setdefault(user, [])
+            box.append({'raw': raw, 'flags': {'\\Seen'} if seen else set(), 'delivered': time.time()})
+            return len(box)
+
+    def mark_unseen(self, user, num: int) -> None:
+        """人が Gmail で未読に戻す操作（シーケンス番号 num の \\Seen を外す）"""
+        with self._lock:
+            self.mailboxes[user][num - 1]['flags'].discard('\\Seen')
+
+    def unseen(self, user):
+        with self._lock:
+            return sum(1 for m in self.mailboxes.get(user, []) if '\\Seen' not in m['flags'])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _header_block(raw: bytes) -> bytes:
+    if b'\r\n\r\n' in raw:
+        return raw.split(b'\r\n\r\n', 1)[0]
+    return raw.split(b'\n\n', 1)[0]
+
+
+def _header_fields(raw: bytes, names) -> bytes:
+    """ヘッダー部から指定の項目（折り返し行を含む）だけを取り出す"""
+    head = _header_block(raw)
+    wanted = {n.upper() for n in names}
+    out = []
+    keep = False
+    for line in re.split(rb'\r?\n', head):
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                out.append(line)
+            continue
+        name = line.split(b':', 1)[0].decode('ascii', errors='ignore').strip().upper()
+        keep = name in wanted
+        if keep:
+            out.append(line)
+    return b'\r\n'.join(out) + b'\r\n\r\n'
+
+
+def _seq_set(spec, total):
+    nums = []
+    for part in spec.split(','):
+        if ':' in part:
+            a, b = part.split(':', 1)
+            lo = int(a)
+            hi = total if b == '*' else int(b)
+            nums.extend(range(lo, hi + 1))
+        elif part == '*':
+            nums.append(total)
+        elif part.isdigit():
+            nums.append(int(part))
+    return [n for n in nums if 1 <= n <= total]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: FakeImapServer
+
+    def _send(self, line):
+        self.wfile.write(line.encode('utf-8') + b'\r\n')
+
+    def _readline(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def handle(self):
+        srv = self.server
+        srv.count('connections')
+        self.user = None
+        self._send('* OK [CAPABILITY IMAP4rev1 AUTH=PLAIN] fake-imap ready')
+        self.wfile.flush()
+        while True:
+            line = self._readline()
+            if line is None:
+                return
+            parts = line.split(' ', 2)
+            if len(parts) < 2:
+                self._send('* BAD missing command')
+                self.wfile.flush()
+                continue
+            tag, cmd = parts[0], parts[1].upper()
+            arg = parts[2] if len(parts) > 2 else ''
+            if cmd == 'UID':
+                self._send(f'{tag} NO UID not supported')
+                self.wfile.flush()
+                continue
+            srv.count(cmd.lower())
+            if srv.latency_ms and cmd not in ('CAPABILITY', 'LOGOUT'):
+                time.sleep(srv.latency_ms / 1000.0)
+            done = getattr(self, '_cmd_' + cmd.lower(), None)
+            if done is None:
+                self._send(f'{tag} BAD {cmd} not implemented')
+            elif done(tag, arg) is False:
+                self.wfile.flush()
+                return
+            self.wfile.flush()
+
+    def _box(self):
+        return self.server.mailboxes.setdefault(self.user, [])
+
+    def _cmd_capability(self, tag, arg):
+        self._send('* CAPABILITY IMAP4rev1 AUTH=PLAIN')
+        self._send(f'{tag} OK CAPABILITY completed')
+
+    def _cmd_noop(self, tag, arg):
+        self._send(f'{tag} OK NOOP completed')
+
+    def _cmd_logout(self, tag, arg):
+        self._send('* BYE fake-imap logging out')
+        self._send(f'{tag} OK LOGOUT completed')
+        return False
+
+    def _cmd_login(self, tag, arg):
+        toks = [m.group(1) if m.group(1) is not None else m.group(2) for m in _TOKEN.finditer(arg)]
+        toks = [re.sub(r'\\(.)', r'\1', t) for t in toks]
+        if len(toks) < 2 or (self.server.password is not None and toks[1] != self.server.password):
+            self.server.count('login_failed')
+            self._send(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials')
+            return
+        self.user = toks[0]
+        self._send(f'{tag} OK LOGIN completed')
+
+    def _cmd_select(self, tag, arg):
+        if self.user is None:
+            self._send(f'{tag} NO not authenticated')
+            return
+        with self.server._lock:
+            exists = len(self._box())
+        self._send('* FLAGS (\\Seen)')
+        self._send(f'* {exists} EXISTS')
+        self._send('* 0 RECENT')
+        self._send(f'{tag} OK [READ-WRITE] SELECT completed')
+
+    _cmd_examine = _cmd_select
+
+    def _cmd_search(self, tag, arg):
+        crit = arg.upper().split()
+        if crit[:1] == ['CHARSET']:
+            crit = crit[2:]
+        with self.server._lock:
+            box = self._box()
+            if crit == ['UNSEEN']:
+                nums = [i + 1 for i, m in enumerate(box) if '\\Seen' not in m['flags']]
+            elif crit == ['SEEN']:
+                nums = [i + 1 for i, m in enumerate(box) if '\\Seen' in m['flags']]
+            else:
+                nums = list(range(1, len(box) + 1))
+        self._send('* SEARCH' + ''.join(f' {n}' for n in nums))
+        self._send(f'{tag} OK SEARCH completed')
+
+    def _cmd_fetch(self, tag, arg):
+        spec, _, items = arg.partition(' ')
+        m = _FETCH_ITEM.search(items)
+        if not m:
+            self._send(f'{tag} BAD unsupported FETCH items')
+            return
+        peek, section = bool(m.group(1)), m.group(2)
+        fields = _HEADER_FIELDS.search(section)
+        with self.server._lock:
+            box = self._box()
+            for n in _seq_set(spec, len(box)):
+                msg = box[n - 1]
+                if fields:
+                    data = _header_fields(msg['raw'], fields.group(1).split())
+                    name = f'BODY[HEADER.FIELDS ({fields.group(1)})]'
+                elif section.upper() == 'HEADER':
+                    data = _header_block(msg['raw']) + b'\r\n\r\n'
+                    name = 'BODY[HEADER]'
+                else:
+                    data = msg['raw']
+                    name = 'BODY[]'
+                if not peek:
+                    msg['flags'].add('\\Seen')
+                self.wfile.write(f'* {n} FETCH ({name} {{{len(data)}}}\r\n'.encode('utf-8') + data + b')\r\n')
+        self._send(f'{tag} OK FETCH completed')
+
+    def _cmd_store(self, tag, arg):
+        spec, _, rest = arg.partition(' ')
+        op, _, flags = rest.partition(' ')
+        flags = set(flags.strip('()').split())
+        with self.server._lock:
+            box = self._box()
+            for n in _seq_set(spec, len(box)):
+                msg = box[n - 1]
+                if op.upper().startswith('+FLAGS'):
+                    msg['flags'] |= flags
+                elif op.upper().startswith('-FLAGS'):
+                    msg['flags'] -= flags
+                else:
+                    msg['flags'] = set(flags)
+                if '.SILENT' not in op.upper():
+                    self._send(f"* {n} FETCH (FLAGS ({' '.join(sorted(msg['flags']))}))")
+        self._send(f'{tag} OK STORE completed')
+
+    def _cmd_close(self, tag, arg):
+        self._send(f'{tag} OK CLOSE completed')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='IMAP の疑似サーバー')
+    ap.add_argument('--port', type=int, default=1143)
+    ap.add_argument('--latency-ms', type=float, default=0.0)
+    ap.add_argument('--password')
+    ap.add_argument('--eml-dir', help='起動時に未読として入れておく .eml のディレクトリ')
+    ap.add_argument('--user', default='recruit@example.com', help='--eml-dir のメールを入れるユーザー')
+    args = ap.parse_args()
+
+    srv = FakeImapServer(args.port, args.latency_ms, args.password)
+    if args.eml_dir:
+        for path in sorted(glob.glob(os.path.join(args.eml_dir, '*.eml'))):
+            with open(path, 'rb') as f:
+                srv.deliver(args.user, f.read())
+    print(f'疑似 IMAP: 127.0.0.1:{srv.port}  (Ctrl+C で終了)')
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('受信コマンド数:', json.dumps(srv.counters, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
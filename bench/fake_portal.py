@@ -0,0 +1,221 @@
+"""
+求人ボックス / エンゲージ管理画面の疑似サーバー（オフライン確認・ベンチマーク用）
+
+応募者ごとの詳細ページを静的な HTML で返し、ブラウザ操作（ログイン → 応募者一覧 → 詳細）の代わりに
+使う。ページの応答を --latency-ms だけ遅らせて、ブラウザ起動・ログインにかかる時間を模擬する。
+
+    /jobbox/applicants/<応募No>        求人ボックスの応募者詳細（dl / dt / dd）
+    /engage/message/?apply_id=<ID>     エンゲージの候補者詳細（EngageLogin._extract_applicant_detail で読む）
+    POST /jobbox/applicants/<応募No>/memo   メモ保存
+
+fail_next(platform, key) で、その応募者のページを次に開いたときだけ 503 を返す（RPA の失敗の確認用）。
+
+install(portal) で jobbox_login / engage_login を PortalJobboxLogin / PortalEngageLogin に差し替える
+（watch_mail の RPA ジョブはこれらを関数内で import するため、以降のジョブは疑似サーバーを見る）。
+ChromeDriver のない環境で watch_mail を端から端まで動かすためのもので、セレクタの確認には使えない。
+"""
+
+import html
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+_JOBBOX_LABELS = [('name', '氏名'), ('furigana', 'ふりがな'), ('gender', '性別'), ('birth', '生年月日'),
+                  ('tel', '電話番号'), ('email', 'メールアドレス'), ('addr', '住所'), ('school', '学校名'),
+                  ('oubo_no', '応募No'), ('kyujin', '求人タイトル')]
+_ENGAGE_LABELS = [('name', '氏名'), ('furigana', 'フリガナ'), ('gender', '性別'), ('birth', '生年月日'),
+                  ('addr', '現住所'), ('tel', '電話番号'), ('email', 'メールアドレス'), ('school', '最終学歴')]
+
+
+def _page(title, labels, detail):
+    rows = ''.join(f'<dt>{label}</dt><dd>{html.escape(str(detail.get(key) or ""))}</dd>'
+                   for key, label in labels if detail.get(key))
+    return (f'<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8"><title>{title}</title></head>'
+            f'<body><section class="profile"><h2>プロフィール</h2><dl>{rows}</dl></section></body></html>')
+
+
+class PortalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=0.0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency_ms = latency_ms
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.applicants = {}   # (platform, key) -> detail
+        self.memos = {}        # 応募No -> メモ
+        self.failing = set()   # 次の1回だけ 503 を返す (platform, key)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def add_applicant(self, platform, key, detail):
+        """platform: 'jobbox'（key は応募No）/ 'engage'（key は apply_id）"""
+        with self._lock:
+            self.applicants[(platform, key)] = dict(detail)
+
+    def fail_next(self, platform, key):
+        """次にその応募者のページを開いたときだけ 503 を返す（ログイン・詳細の取得の失敗の代わり）"""
+        with self._lock:
+            self.failing.add((platform, key))
+
+    def _take_failure(self, platform, key):
+        with self._lock:
+            if (platform, key) in self.failing:
+                self.failing.discard((platform, key))
+                return True
+            return False
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    server: PortalServer
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, text):
+        out = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+        self.server.count(f'status_{status}')
+
+    def do_GET(self):
+        srv = self.server
+        if srv.latency_ms:
+            time.sleep(srv.latency_ms / 1000.0)
+        url = urlparse(self.path)
+        if url.path.startswith('/jobbox/applicants/'):
+            key = url.path.rsplit('/', 1)[-1]
+            detail = srv.applicants.get(('jobbox', key))
+            srv.count('jobbox_pages')
+            if srv._take_failure('jobbox', key):
+                return self._reply(503, '<html><body>Service Unavailable</body></html>')
+            if detail is None:
+                return self._reply(404, '<html><body>該当する応募者が見つかりません</body></html>')
+            return self._reply(200, _page('応募者詳細 | 求人ボックス', _JOBBOX_LABELS, detail))
+        if url.path.startswith('/engage/message'):
+            key = (parse_qs(url.query).get('apply_id') or [''])[0]
+            detail = srv.applicants.get(('engage', key))
+            srv.count('engage_pages')
+            if srv._take_failure('engage', key):
+                return self._reply(503, '<html><body>Service Unavailable</body></html>')
+            if detail is None:
+                return self._reply(404, '<html><body>候補者が見つかりません</body></html>')
+            return self._reply(200, _page('候補者詳細 | エンゲージ', _ENGAGE_LABELS, detail))
+        return self._reply(404, '<html><body>not found</body></html>')
+
+    def do_POST(self):
+        srv = self.server
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if url.path.startswith('/jobbox/applicants/') and url.path.endswith('/memo'):
+            key = url.path.split('/')[-2]
+            with srv._lock:
+                srv.memos[key] = body
+            srv.count('memos')
+            return self._reply(200, 'OK')
+        return self._reply(404, 'not found')
+
+
+def _dl_detail(page, labels):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(page, 'html.parser')
+    by_label = {dt.get_text(strip=True): dt.find_next_sibling('dd').get_text(strip=True) for dt in soup.find_all('dt')}
+    return {key: by_label[label] for key, label in labels if label in by_label}
+
+
+class PortalJobboxLogin:
+    """JobboxLogin と同じ呼び出し方で、疑似サーバーの応募者詳細を読む"""
+
+    base_url = ''
+
+    def __init__(self, account):
+        self.account = account
+        self.driver = None
+        self._oubo_no = None
+
+    def login_and_goto(self, url, kyujin_title=None, oubo_no=None):
+        if not (kyujin_title and oubo_no):
+            return None
+        r = requests.get(f'{self.base_url}/jobbox/applicants/{oubo_no}', timeout=30)
+        if r.status_code != 200:
+            print('該当する応募者が見つかりませんでした。')
+            return None
+        self._oubo_no = oubo_no
+        detail = _dl_detail(r.text, _JOBBOX_LABELS)
+        return {'title': kyujin_title, 'detail': detail}
+
+    def set_memo_and_save(self, memo_text='送信済み'):
+        requests.post(f'{self.base_url}/jobbox/applicants/{self._oubo_no}/memo',
+                      data=memo_text.encode('utf-8'), timeout=30)
+
+    def close(self):
+        pass
+
+
+class PortalEngageLogin:
+    """EngageLogin と同じ呼び出し方で、疑似サーバーの候補者詳細を本物の抽出処理で読む"""
+
+    base_url = ''
+    reader_class = None  # 本物の EngageLogin（install で設定）
+
+    def __init__(self, account):
+        self.account = account
+        self.account_name = account.get('account_name', '')
+        self._reader = self.reader_class.__new__(self.reader_class)
+        self._reader.driver = None
+        self.driver = None
+
+    def login_and_goto(self, apply_url, email_job_title=''):
+        query = urlparse(apply_url).query
+        r = requests.get(f'{self.base_url}/engage/message/?{query}', timeout=30)
+        if r.status_code != 200:
+            return None
+        detail = self._reader._extract_applicant_detail(r.text)
+        if not detail:
+            return None
+        return {'title': email_job_title, 'detail': detail}
+
+    def close(self):
+        pass
+
+
+def install(portal: PortalServer):
+    """jobbox_login / engage_login の import 先を疑似サーバー用のクラスに差し替える"""
+    import engage_login  # 本物の抽出処理を先に読み込んでおく
+
+    PortalJobboxLogin.base_url = portal.base_url
+    PortalEngageLogin.base_url = portal.base_url
+    PortalEngageLogin.reader_class = engage_login.EngageLogin
+    jobbox = types.ModuleType('jobbox_login')
+    jobbox.JobboxLogin = PortalJobboxLogin
+    engage = types.ModuleType('engage_login')
+    engage.__dict__.update({k: v for k, v in vars(engage_login).items() if not k.startswith('__')})
+    engage.EngageLogin = PortalEngageLogin
+    sys.modules['jobbox_login'] = jobbox
+    sys.modules['engage_login'] = engage
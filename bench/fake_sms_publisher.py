@@ -0,0 +1,171 @@
+"""
+SMS PUBLISHER の疑似サーバー（オフライン確認・ベンチマーク用）
+
+実際の SMS は送らずに、送信 API と同じ形のリクエスト（フォーム / JSON / クエリ）を
+受け付けて応答を返す。遅延や 5xx を混ぜてエラー処理・再試行の確認にも使える。
+
+    - 認証: --api-id / --api-pass を指定すると Basic 認証または username / password を要求（不一致は 401）
+    - 送信先番号が空なら 400、--require-81 のとき 0 始まりの番号は 560（携帯番号不正）
+    - --error-rate の割合で 503 を返す、--latency-ms だけ応答を遅らせる
+
+使い方:
+    python bench/fake_sms_publisher.py --port 8765 [--latency-ms 20] [--error-rate 0.05]
+    （api_settings の baseUrl を http://127.0.0.1:8765 にする）
+"""
+
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeSmsPublisher(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=0.0, error_rate=0.0, api_id=None, api_pass=None,
+                 require_81=False, field_to='mobilenumber', field_message='smstext', seed=1):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.api_id = api_id
+        self.api_pass = api_pass
+        self.require_81 = require_81
+        self.field_to = field_to
+        self.field_message = field_message
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.messages = []
+        self.connections = set()
+        # 受け付けた送信ごとに (番号, 本文) で呼ばれる（ベンチマークでの到着時刻の記録用）
+        self.on_message = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def roll_error(self):
+        if self.error_rate <= 0:
+            return False
+        with self._lock:
+            return self._rnd.random() < self.error_rate
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # keep-alive でヘッダーと本文を1回で書き出す（分けると遅延 ACK で 40ms 程度待たされる）
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    server: FakeSmsPublisher
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        out = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+        self.server.count(f'status_{status}')
+
+    def _fields(self):
+        parsed = urlparse(self.path)
+        fields = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if raw:
+            ctype = self.headers.get('Content-Type') or ''
+            if 'json' in ctype:
+                try:
+                    fields.update({k: str(v) for k, v in json.loads(raw.decode('utf-8')).items()})
+                except Exception:
+                    pass
+            else:
+                fields.update({k: v[0] for k, v in parse_qs(raw.decode('utf-8')).items()})
+        return fields
+
+    def _authorized(self, fields):
+        srv = self.server
+        if not srv.api_id and not srv.api_pass:
+            return True
+        auth = self.headers.get('Authorization') or ''
+        if auth.startswith('Basic '):
+            try:
+                pair = base64.b64decode(auth[6:]).decode('utf-8')
+            except Exception:
+                return False
+            return pair == f'{srv.api_id}:{srv.api_pass}'
+        if auth.startswith('Bearer '):
+            return auth[7:] == srv.api_pass
+        return fields.get('username') == srv.api_id and fields.get('password') == srv.api_pass
+
+    def _handle(self):
+        srv = self.server
+        srv.count('requests')
+        srv.connections.add(self.client_address)
+        fields = self._fields()
+        if srv.latency_ms:
+            time.sleep(srv.latency_ms / 1000.0)
+        if srv.roll_error():
+            return self._reply(503, {'result': 'NG', 'error': 'service unavailable'})
+        if not self._authorized(fields):
+            return self._reply(401, {'result': 'NG', 'error': 'unauthorized'})
+        number = fields.get(srv.field_to, '')
+        if not number or not number.isdigit():
+            return self._reply(400, {'result': 'NG', 'error': 'invalid parameter'})
+        if srv.require_81 and number.startswith('0'):
+            return self._reply(560, {'result': 'NG', 'error': 'invalid mobile number'})
+        with srv._lock:
+            srv.messages.append((number, fields.get(srv.field_message, '')))
+            msg_id = len(srv.messages)
+        if srv.on_message is not None:
+            srv.on_message(number, fields.get(srv.field_message, ''))
+        return self._reply(200, {'result': 'OK', 'id': msg_id})
+
+    def do_POST(self):
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+
+def main():
+    ap = argparse.ArgumentParser(description='SMS PUBLISHER の疑似サーバー')
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--latency-ms', type=float, default=0.0)
+    ap.add_argument('--error-rate', type=float, default=0.0, help='503 を返す割合（0〜1）')
+    ap.add_argument('--api-id')
+    ap.add_argument('--api-pass')
+    ap.add_argument('--require-81', action='store_true', help='0 始まりの番号に 560 を返す')
+    args = ap.parse_args()
+
+    srv = FakeSmsPublisher(args.port, args.latency_ms, args.error_rate, args.api_id, args.api_pass, args.require_81)
+    print(f'疑似 SMS PUBLISHER: {srv.base_url}/send  (Ctrl+C で終了)')
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('受信件数:', json.dumps(srv.counters, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
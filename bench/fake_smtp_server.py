@@ -0,0 +1,218 @@
+"""
+SMTP の疑似サーバー（オフライン確認・ベンチマーク用、TLS なし）
+
+実際には配送せずに、EHLO / AUTH（PLAIN / LOGIN）/ MAIL / RCPT / DATA / NOOP / RSET / QUIT に応答する。
+接続時・ログイン時の遅延（TLS ハンドシェイクと認証の代わり）や 421 を混ぜて、
+接続の再利用・再接続の確認に使う。送信側は EMAIL_SMTP_SSL=false で平文接続にする。
+
+使い方:
+    python bench/fake_smtp_server.py --port 2525 [--connect-latency-ms 150] [--fail-rate 0.02]
+    （EMAIL_SMTP_HOST=127.0.0.1 EMAIL_SMTP_PORT=2525 EMAIL_SMTP_SSL=false で送る）
+"""
+
+import argparse
+import base64
+import json
+import random
+import socketserver
+import threading
+import time
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, connect_latency_ms=0.0, auth_latency_ms=0.0, message_latency_ms=0.0,
+                 fail_rate=0.0, max_messages_per_conn=0, password=None, seed=1, keep_raw=False,
+                 drop_after_data_rate=0.0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.connect_latency_ms = connect_latency_ms
+        self.auth_latency_ms = auth_latency_ms
+        self.message_latency_ms = message_latency_ms
+        self.fail_rate = fail_rate
+        # メッセージを受け取った後、250 を返さずに切断する割合（DATA 後の切断。送り直すと二重に届く）
+        self.drop_after_data_rate = drop_after_data_rate
+        self.max_messages_per_conn = max_messages_per_conn
+        self.password = password
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.messages = []
+        # keep_raw=True のとき受信したメッセージ本体（bytes）を保持する
+        self.keep_raw = keep_raw
+        self.raw_messages = []
+        # 受け付けたメッセージごとに (MAIL FROM, RCPT の一覧) で呼ばれる（ベンチマークでの到着時刻の記録用）
+        self.on_message = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def roll_fail(self, rate=None):
+        rate = self.fail_rate if rate is None else rate
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._rnd.random() < rate
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: FakeSmtpServer
+
+    def _send(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+        self.wfile.flush()
+
+    def _readline(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def _check_password(self, password):
+        return self.server.password is None or password == self.server.password
+
+    def handle(self):
+        srv = self.server
+        srv.count('connections')
+        if srv.connect_latency_ms:
+            time.sleep(srv.connect_latency_ms / 1000.0)
+        self._send('220 fake-smtp ready')
+        sent_on_conn = 0
+        mail_from = None
+        rcpts = []
+        while True:
+            line = self._readline()
+            if line is None:
+                return
+            cmd = line.split(' ', 1)[0].upper()
+            arg = line[len(cmd):].strip()
+            if cmd in ('EHLO', 'HELO'):
+                if cmd == 'EHLO':
+                    self.wfile.write(b'250-fake-smtp\r\n250-8BITMIME\r\n250-AUTH PLAIN LOGIN\r\n250 SIZE 35882577\r\n')
+                    self.wfile.flush()
+                else:
+                    self._send('250 fake-smtp')
+            elif cmd == 'AUTH':
+                if srv.auth_latency_ms:
+                    time.sleep(srv.auth_latency_ms / 1000.0)
+                parts = arg.split()
+                password = None
+                if parts and parts[0].upper() == 'PLAIN':
+                    token = parts[1] if len(parts) > 1 else None
+                    if token is None:
+                        self._send('334 ')
+                        token = self._readline() or ''
+                    try:
+                        password = base64.b64decode(token).split(b'\0')[-1].decode('utf-8')
+                    except Exception:
+                        password = None
+                elif parts and parts[0].upper() == 'LOGIN':
+                    if len(parts) == 1:
+                        self._send('334 VXNlcm5hbWU6')
+                        self._readline()
+                    self._send('334 UGFzc3dvcmQ6')
+                    try:
+                        password = base64.b64decode(self._readline() or '').decode('utf-8')
+                    except Exception:
+                        password = None
+                srv.count('auth')
+                if self._check_password(password):
+                    self._send('235 2.7.0 Accepted')
+                else:
+                    srv.count('auth_failed')
+                    self._send('535 5.7.8 Authentication failed')
+            elif cmd == 'NOOP':
+                srv.count('noop')
+                self._send('250 OK')
+            elif cmd == 'RSET':
+                mail_from, rcpts = None, []
+                self._send('250 OK')
+            elif cmd == 'MAIL':
+                if srv.max_messages_per_conn and sent_on_conn >= srv.max_messages_per_conn:
+                    srv.count('status_421')
+                    self._send('421 4.7.0 Too many messages on this connection')
+                    return
+                if srv.roll_fail():
+                    srv.count('status_421')
+                    self._send('421 4.3.2 Service not available, closing channel')
+                    return
+                mail_from = arg
+                rcpts = []
+                self._send('250 OK')
+            elif cmd == 'RCPT':
+                rcpts.append(arg)
+                self._send('250 OK')
+            elif cmd == 'DATA':
+                self._send('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line:
+                        return
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data_line)
+                    if srv.keep_raw:
+                        lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                if srv.message_latency_ms:
+                    time.sleep(srv.message_latency_ms / 1000.0)
+                sent_on_conn += 1
+                with srv._lock:
+                    srv.messages.append((mail_from, list(rcpts), size))
+                    if srv.keep_raw:
+                        srv.raw_messages.append(b''.join(lines))
+                srv.count('messages')
+                if srv.on_message is not None:
+                    srv.on_message(mail_from, list(rcpts))
+                if srv.roll_fail(srv.drop_after_data_rate):
+                    srv.count('dropped_after_data')
+                    return
+                self._send('250 OK queued')
+            elif cmd == 'QUIT':
+                self._send('221 Bye')
+                return
+            else:
+                self._send('502 Command not implemented')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='SMTP の疑似サーバー')
+    ap.add_argument('--port', type=int, default=2525)
+    ap.add_argument('--connect-latency-ms', type=float, default=0.0)
+    ap.add_argument('--auth-latency-ms', type=float, default=0.0)
+    ap.add_argument('--message-latency-ms', type=float, default=0.0)
+    ap.add_argument('--fail-rate', type=float, default=0.0, help='MAIL FROM で 421 を返して切断する割合')
+    ap.add_argument('--max-messages-per-conn', type=int, default=0)
+    ap.add_argument('--drop-after-data-rate', type=float, default=0.0,
+                    help='メッセージを受け取った後、250 を返さずに切断する割合')
+    args = ap.parse_args()
+
+    srv = FakeSmtpServer(args.port, args.connect_latency_ms, args.auth_latency_ms, args.message_latency_ms,
+                         args.fail_rate, args.max_messages_per_conn,
+                         drop_after_data_rate=args.drop_after_data_rate)
+    print(f'疑似 SMTP: 127.0.0.1:{srv.port}  (Ctrl+C で終了)')
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('受信件数:', json.dumps(srv.counters, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
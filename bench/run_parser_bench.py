@@ -0,0 +1,107 @@
+"""
+ページ解析ベンチマーク（オフライン）
+
+bench/fixtures/manifest.json に登録した保存済みページに対して抽出処理を実行し、
+ページごとの cold / warm 時間を計測し、抽出結果が期待値
+（bench/fixtures/expected/*.json）と一致するかを確認する。
+
+    cold: 正規表現キャッシュ等をクリアした直後の1回目
+    warm: 続けて --repeat 回実行したときの中央値 / p95 / 最小値
+
+使い方:
+    python bench/run_parser_bench.py                  # 計測 + 期待値チェック
+    python bench/run_parser_bench.py --type engage_profile
+    python bench/run_parser_bench.py --parser html.parser
+    python bench/run_parser_bench.py --update-expected  # 抽出結果を期待値として保存
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cases  # noqa: E402
+import html_soup  # noqa: E402
+from engage_login import _LabelIndex  # noqa: E402
+
+
+def _clear_caches():
+    re.purge()
+    _LabelIndex._pattern_cache.clear()
+
+
+def _measure(entry, html, repeat):
+    _clear_caches()
+    t0 = time.perf_counter()
+    result = cases.run_case(entry, html)
+    cold = (time.perf_counter() - t0) * 1000
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        cases.run_case(entry, html)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    warm = {
+        'median': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min': samples[0],
+    }
+    return result, cold, warm
+
+
+def main():
+    ap = argparse.ArgumentParser(description='ページ解析ベンチマーク（オフライン）')
+    ap.add_argument('--repeat', type=int, default=20, help='warm 計測の回数')
+    ap.add_argument('--type', choices=sorted(cases.PAGE_TYPES), help='ページ種別で絞り込む')
+    ap.add_argument('--parser', choices=html_soup.SUPPORTED_PARSERS, help='HTML パーサーを指定（既定は自動選択）')
+    ap.add_argument('--update-expected', action='store_true', help='抽出結果を期待値として保存する')
+    args = ap.parse_args()
+
+    if args.parser:
+        html_soup.PARSER = args.parser
+    repeat = max(1, args.repeat)
+
+    print(f'parser: {html_soup.PARSER} / repeat: {repeat}')
+    print(f"{'page':<46} {'cold':>8} {'median':>8} {'p95':>8} {'min':>8}  result")
+    failures = 0
+    totals = {}
+    for rel_path, entry, html in cases.load_cases(args.type):
+        result, cold, warm = _measure(entry, html, repeat)
+        result = cases.normalize(result)
+        if args.update_expected:
+            cases.save_expected(rel_path, result)
+            status = 'SAVED'
+        else:
+            expected = cases.load_expected(rel_path)
+            if expected is None:
+                status = 'NO EXPECTED'
+                failures += 1
+            elif expected == result:
+                status = 'OK'
+            else:
+                status = 'MISMATCH'
+                failures += 1
+        print(f"{rel_path:<46} {cold:>8.2f} {warm['median']:>8.2f} {warm['p95']:>8.2f} {warm['min']:>8.2f}  {status}")
+        if status == 'MISMATCH':
+            print('  expected:', expected)
+            print('  actual  :', result)
+        t = totals.setdefault(entry['type'], [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += cold
+        t[2] += warm['median']
+
+    print()
+    print(f"{'page type':<20} {'pages':>5} {'cold avg':>9} {'warm avg':>9}")
+    for page_type, (n, cold_sum, warm_sum) in totals.items():
+        print(f'{page_type:<20} {n:>5} {cold_sum / n:>9.2f} {warm_sum / n:>9.2f}')
+    print('(時間の単位は ms)')
+    if not args.update_expected:
+        print('不一致:', failures)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
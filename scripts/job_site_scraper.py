@@ -34,6 +34,9 @@ from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from html_soup import make_soup  # noqa: E402
+
 
 DEFAULT_TARGET_URL = "https://xn--pckua2a7gp15o89zb.com/93187E31781E495BAB"
 
@@ -487,7 +490,7 @@ def extract_jobbox_company_from_lines(lines: List[str], title: str) -> tuple[str
 
 
 def parse_jobbox_detail_company(page_html: str) -> tuple[str, str]:
-    soup = BeautifulSoup(page_html, "html.parser")
+    soup = make_soup(page_html)
     lines = [clean_text(line) for line in soup.get_text("\n").splitlines()]
     lines = [line for line in lines if line]
 
@@ -511,7 +514,7 @@ def parse_jobbox_detail_company(page_html: str) -> tuple[str, str]:
 
 
 def parse_jobbox_detail_recruiter(page_html: str, job_title: str) -> tuple[str, str]:
-    soup = BeautifulSoup(page_html, "html.parser")
+    soup = make_soup(page_html)
     lines = [clean_text(line) for line in soup.get_text("\n").splitlines()]
     lines = [line for line in lines if line]
     normalized_title = normalize_match_text(normalize_jobbox_title(job_title))
@@ -568,7 +571,7 @@ def enrich_jobbox_records_with_detail(driver: Chrome, records: List[JobRecord],
 
 
 def extract_jobbox_records(page_html: str, keyword: str, source_url: str) -> List[JobRecord]:
-    soup = BeautifulSoup(page_html, "html.parser")
+    soup = make_soup(page_html)
     records: List[JobRecord] = []
     seen_keys = set()
 
@@ -641,7 +644,7 @@ def extract_records(page_html: str, keyword: str, source_url: str) -> List[JobRe
     if is_jobbox_url(source_url):
         return extract_jobbox_records(page_html, keyword, source_url)
 
-    soup = BeautifulSoup(page_html, "html.parser")
+    soup = make_soup(page_html)
     records: List[JobRecord] = []
     seen_keys = set()
 
@@ -691,20 +694,25 @@ def record_identity(record: JobRecord) -> str:
     return record.source_url or record.title
 
 
+def find_next_page_href(page_html: str) -> Optional[str]:
+    soup = make_soup(page_html)
+    for link in soup.find_all("a", href=True):
+        text = clean_text(link.get_text(" ", strip=True))
+        href = link.get("href", "")
+        if "次のページへ" in text or "次へ" in text:
+            return href
+        if href and "pg=" in href and ("前のページ" not in text):
+            return href
+    return None
+
+
 def click_next_page(driver: Chrome) -> bool:
     try:
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        for link in soup.find_all("a", href=True):
-            text = clean_text(link.get_text(" ", strip=True))
-            href = link.get("href", "")
-            if "次のページへ" in text or "次へ" in text:
-                driver.get(urljoin(driver.current_url, href))
-                wait_ready(driver, timeout=20)
-                return True
-            if href and "pg=" in href and ("前のページ" not in text):
-                driver.get(urljoin(driver.current_url, href))
-                wait_ready(driver, timeout=20)
-                return True
+        href = find_next_page_href(driver.page_source)
+        if href is not None:
+            driver.get(urljoin(driver.current_url, href))
+            wait_ready(driver, timeout=20)
+            return True
     except Exception:
         pass
 
@@ -13,101 +13,38 @@ from datetime import datetime, timedelta
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
+# watch_mail（IMAP・RPA）側は使わないので、送信・Firestore・解釈のモジュールだけを読み込む
 try:
-    from src.email_watcher import (
-        send_mail_once, 
-        apply_template_tokens,
-        normalize_phone_number,
+    from src.watcher.firestore import (
         write_sms_history,
         _get_mail_settings,
         _find_service_account_file,
         _make_fields_for_firestore,
-        get_api_settings
+        get_api_settings,
+        _write_sms_history_now
     )
+    from src.watcher.parse import apply_template_tokens, normalize_phone_number
+    from src.watcher.send import send_mail_once, send_sms_via_api
 except ImportError:
-    from email_watcher import (
-        send_mail_once, 
-        apply_template_tokens,
-        normalize_phone_number,
+    from watcher.firestore import (
         write_sms_history,
         _get_mail_settings,
         _find_service_account_file,
         _make_fields_for_firestore,
-        get_api_settings
+        get_api_settings,
+        _write_sms_history_now
     )
+    from watcher.parse import apply_template_tokens, normalize_phone_number
+    from watcher.send import send_mail_once, send_sms_via_api
+from bulk_mail import bulk_enabled, bulk_min_tasks, send_mail_tasks_bulk
+from dispatch_policy import get_dispatch_policy
+from firestore_rest import documents_url, service_account_token
+from lazy_import import lazy_module
+from outbox import guarded_send, is_duplicate, resume_history
+from profiler import install_profile_signal, profile_run
+from stage_metrics import stage_context, start_metrics_server
 
-
-def send_sms_via_api(uid, to_number, message):
-    """通过API发送SMS
-    
-    Returns: (success, info)
-    """
-    import requests
-    
-    api_cfg = get_api_settings(uid) or {}
-    provider = api_cfg.get('provider', 'sms_publisher')
-    base = api_cfg.get('baseUrl')
-    
-    if not base:
-        return False, {'note': 'no base URL configured'}
-    
-    # Build request
-    from urllib.parse import urlparse
-    try:
-        parsed = urlparse(base)
-        if parsed.path and parsed.path != '/':
-            url = base
-        else:
-            url = base.rstrip('/') + '/send'
-    except Exception:
-        url = base
-    
-    api_id = api_cfg.get('apiId')
-    api_pass = api_cfg.get('apiPass')
-    auth_type = api_cfg.get('auth')
-    
-    headers = {'Accept': 'application/json'}
-    
-    # Build form data
-    safe_msg = str(message).replace('&', '＆')
-    data = {
-        'mobilenumber': str(to_number),
-        'smstext': safe_msg,
-    }
-    
-    if auth_type == 'params' and api_id and api_pass:
-        data['username'] = api_id
-        data['password'] = api_pass
-    
-    # Add auth headers
-    if auth_type == 'basic' and api_id and api_pass:
-        import base64
-        credentials = f'{api_id}:{api_pass}'
-        encoded = base64.b64encode(credentials.encode()).decode()
-        headers['Authorization'] = f'Basic {encoded}'
-    elif auth_type == 'bearer' and api_pass:
-        headers['Authorization'] = f'Bearer {api_pass}'
-    
-    headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=UTF-8'
-    headers.setdefault('User-Agent', 'sms-rpa/1.0')
-    
-    # Check for dry run
-    dry_run = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
-    if dry_run:
-        print(f'[DRY_RUN_SMS] would send to {to_number}: {message[:50]}...')
-        return True, {'note': 'dry_run', 'status_code': 200}
-    
-    # Send request
-    try:
-        r = requests.post(url, headers=headers, data=data, timeout=30)
-        status_code = r.status_code
-        
-        if status_code == 200:
-            return True, {'status_code': status_code, 'response': r.text[:200]}
-        else:
-            return False, {'status_code': status_code, 'error': r.text[:200]}
-    except Exception as e:
-        return False, {'note': str(e)}
+requests = lazy_module('requests')
 
 
 def get_pending_tasks(uid):
@@ -121,17 +58,10 @@ def get_pending_tasks(uid):
         return []
     
     try:
-        from google.oauth2 import service_account
-        from google.auth.transport.requests import Request
-        import requests
         
         with open(sa_file, 'r', encoding='utf-8') as f:
             sa = json.load(f)
-        creds = service_account.Credentials.from_service_account_info(
-            sa, scopes=['https://www.googleapis.com/auth/datastore']
-        )
-        creds.refresh(Request())
-        token = creds.token
+        token = service_account_token(sa)
     except Exception as e:
         print(f'Failed to get service account token: {e}')
         return []
@@ -143,7 +73,7 @@ def get_pending_tasks(uid):
     
     # Query pending tasks for this user where nextRun <= now
     now_ms = int(datetime.now().timestamp() * 1000)
-    collection_url = f'https://firestore.googleapis.com/v1/projects/{project}/databases/(default)/documents/accounts/{uid}/scheduled_tasks'
+    collection_url = f'{documents_url(project)}/accounts/{uid}/scheduled_tasks'
     headers = {'Authorization': f'Bearer {token}'}
     
     try:
@@ -173,6 +103,7 @@ def get_pending_tasks(uid):
                     'status': status,
                     'scheduledTime': fields.get('scheduledTime', {}).get('stringValue', ''),
                     'nextRun': next_run,
+                    'priority': int(fields.get('priority', {}).get('integerValue', '0')),
                     'to': fields.get('to', {}).get('stringValue', ''),
                     'template': fields.get('template', {}).get('stringValue', ''),
                     'segmentId': fields.get('segmentId', {}).get('stringValue', ''),
@@ -216,17 +147,10 @@ def update_task_status(uid, task_id, status, error_msg=None):
         return False
     
     try:
-        from google.oauth2 import service_account
-        from google.auth.transport.requests import Request
-        import requests
         
         with open(sa_file, 'r', encoding='utf-8') as f:
             sa = json.load(f)
-        creds = service_account.Credentials.from_service_account_info(
-            sa, scopes=['https://www.googleapis.com/auth/datastore']
-        )
-        creds.refresh(Request())
-        token = creds.token
+        token = service_account_token(sa)
     except Exception as e:
         print(f'Failed to get service account token: {e}')
         return False
@@ -235,7 +159,7 @@ def update_task_status(uid, task_id, status, error_msg=None):
     if not project:
         return False
     
-    doc_url = f'https://firestore.googleapis.com/v1/projects/{project}/databases/(default)/documents/accounts/{uid}/scheduled_tasks/{task_id}'
+    doc_url = f'{documents_url(project)}/accounts/{uid}/scheduled_tasks/{task_id}'
     headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
     
     # Prepare update data
@@ -290,11 +214,12 @@ def execute_sms_task(task):
     except Exception:
         message = template
     
-    # Send SMS
-    success, info = send_sms_via_api(uid, norm, message)
+    # Send SMS（outbox の冪等キーで二重送信を防ぐ。watch_mail 側の予約送信と同じキー。応募No がなければタスク ID）
+    success, info = guarded_send(uid, oubo_no, 'sms', f"scheduled:{task.get('segmentId', '')}", norm,
+                                 lambda: send_sms_via_api(uid, norm, message), ref=task.get('id') or '')
     
-    # Write to history
-    if uid:
+    # Write to history（outbox で送信済と判定された場合は前回書いているので書かない。タスクの削除は行う）
+    if uid and not is_duplicate(info):
         try:
             rec = {
                 'name': applicant_detail.get('applicant_name', ''),
@@ -323,8 +248,11 @@ def execute_sms_task(task):
         return False, error_msg
 
 
-def execute_mail_task(task):
-    """执行MAIL发送任务"""
+def execute_mail_task(task, sent=None):
+    """执行MAIL发送任务
+
+    sent: 一括送信（bulk_mail）で送信済みの場合の (success, info)
+    """
     uid = task.get('uid', '')
     to_email = task.get('to', '')
     template = task.get('template', '')
@@ -337,27 +265,32 @@ def execute_mail_task(task):
     if not to_email:
         return False, 'no recipient email'
     
-    # Get mail settings
-    mail_cfg = _get_mail_settings(uid)
-    sender = mail_cfg.get('email', '')
-    sender_pass = mail_cfg.get('appPass', '')
-    
-    if not sender or not sender_pass:
-        return False, 'mail settings not configured'
-    
-    # Apply template tokens
-    try:
-        subject = apply_template_tokens(subject_template, applicant_detail)
-        body = apply_template_tokens(template, applicant_detail)
-    except Exception:
-        subject = subject_template
-        body = template
-    
-    # Send mail
-    success, info = send_mail_once(sender, sender_pass, to_email, subject, body)
+    if sent is not None:
+        success, info = sent
+    else:
+        # Get mail settings
+        mail_cfg = _get_mail_settings(uid)
+        sender = mail_cfg.get('email', '')
+        sender_pass = mail_cfg.get('appPass', '')
+        
+        if not sender or not sender_pass:
+            return False, 'mail settings not configured'
+        
+        # Apply template tokens
+        try:
+            subject = apply_template_tokens(subject_template, applicant_detail)
+            body = apply_template_tokens(template, applicant_detail)
+        except Exception:
+            subject = subject_template
+            body = template
+        
+        # Send mail（outbox の冪等キーで二重送信を防ぐ。watch_mail 側の予約送信と同じキー）
+        success, info = guarded_send(uid, oubo_no, 'mail', f"scheduled:{task.get('segmentId', '')}", to_email,
+                                     lambda: send_mail_once(sender, sender_pass, to_email, subject, body),
+                                     ref=task.get('id') or '')
     
-    # Write to history
-    if uid:
+    # Write to history（outbox で送信済と判定された場合は前回書いているので書かない。タスクの削除は行う）
+    if uid and not is_duplicate(info):
         try:
             rec = {
                 'name': applicant_detail.get('applicant_name', ''),
@@ -391,12 +324,24 @@ def process_scheduled_tasks(uid):
     print(f'检查用户 {uid} 的定时任务...')
     
     tasks = get_pending_tasks(uid)
+    # 同じ時刻に集中したタスクは送信時刻をずらす（dispatch_policy）
+    tasks = get_dispatch_policy().select(tasks)
     if not tasks:
         print('没有待执行的任务')
         return
     
     print(f'找到 {len(tasks)} 个待执行任务')
     
+    # 同じ時刻のメールタスクが多い場合は送信元ごとにまとめて先に送る（bulk_mail）
+    bulk_sent = {}
+    mail_tasks = [t for t in tasks if t.get('taskType') == 'mail' and t.get('to')]
+    if bulk_enabled() and len(mail_tasks) >= bulk_min_tasks():
+        try:
+            bulk_sent = send_mail_tasks_bulk(mail_tasks, _get_mail_settings, prefer_reply=False)
+        except Exception as e:
+            print(f'一括メール送信エラー（タスクごとに送信します）: {e}')
+            bulk_sent = {}
+    
     for task in tasks:
         task_id = task.get('id')
         task_type = task.get('taskType')
@@ -409,7 +354,7 @@ def process_scheduled_tasks(uid):
         if task_type == 'sms':
             success, error_msg = execute_sms_task(task)
         elif task_type == 'mail':
-            success, error_msg = execute_mail_task(task)
+            success, error_msg = execute_mail_task(task, sent=bulk_sent.get(task_id))
         else:
             print(f'未知任务类型: {task_type}')
             error_msg = f'unknown task type: {task_type}'
@@ -438,21 +383,28 @@ def main():
         sys.exit(1)
     
     print(f'定时任务调度器启动 (UID: {uid})')
+    # 前回書き終わらなかった履歴（OUTBOX_ASYNC_HISTORY）があれば続きから書き込む
+    resume_history(_write_sms_history_now)
+    # METRICS_PORT が指定されていれば送信・履歴書き込みの所要時間を /metrics で公開する
+    start_metrics_server()
+    # SIGUSR1（Windows は Ctrl+Break）で次のサイクル1回をプロファイルする
+    install_profile_signal()
     print('每分钟检查一次待执行任务...')
     
     # Main loop: check every minute
     while True:
         try:
-            process_scheduled_tasks(uid)
+            with stage_context(uid=uid), profile_run('scheduled', uid):
+                process_scheduled_tasks(uid)
         except KeyboardInterrupt:
             print('\n停止定时任务调度器')
             break
         except Exception as e:
             print(f'执行任务时发生错误: {e}')
         
-        # Wait 1 minute before next check
+        # Wait 1 minute before next check（分散送信で保留中のタスクがあればその時刻まで）
         print('\n等待下一次检查...')
-        time.sleep(60)
+        time.sleep(get_dispatch_policy().wait_hint(60))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,307 @@
+"""
+セグメント設定変更の影響確認（オフライン）
+
+sms_history のエクスポート（JSONL / CSV）を読み込み、現在のセグメント設定（old）と
+変更案（new）で過去の応募者を判定し直して、どのセグメントからどのセグメントへ
+移るかの件数（遷移行列）を表示する。
+
+行ごとに dict を保持せず、性別・年齢・氏名種別を列（array）として持ち、
+(性別, 年齢, 氏名種別) の組み合わせごとの件数を数えてから組み合わせ単位で判定する。
+判定は SegmentIndex（watch_mail と同じ判定）を使う。
+
+セグメント設定の指定:
+    segments.json                 セグメントの list（id / title / priority / conditions）
+                                  または Firestore REST の {"documents": [...]} 形式
+    firestore:<uid>               accounts/{uid}/target_segments を読む
+    firestore-engage:<uid>        accounts/{uid}/engage_target_segments を読む
+
+使い方:
+    python scripts/segment_replay.py history.jsonl --old firestore:UID --new proposed.json
+    python scripts/segment_replay.py history.csv --old old.json --new new.json --source engage
+    python scripts/segment_replay.py history.jsonl --old old.json --new new.json --json result.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from functools import lru_cache
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from segment_index import NAME_TYPES, SegmentIndex, name_type_of  # noqa: E402
+
+GENDER_CODES = {'男性': 1, '女性': 2}
+GENDER_NAMES = {0: '', 1: '男性', 2: '女性'}
+NAME_TYPE_CODES = {t: i + 1 for i, t in enumerate(NAME_TYPES)}  # 0 は氏名なし
+MAX_AGE = 999
+NO_SEGMENT = '（非対象）'
+
+
+# ---------- セグメント設定 ----------
+def _load_segments_from_firestore(uid, engage=False):
+    import email_watcher
+    loader = email_watcher._get_engage_target_segments if engage else email_watcher._get_target_segments
+    segments = loader(uid)
+    if not segments:
+        print(f'[WARN] Firestore からセグメントを取得できませんでした: uid={uid}')
+    return list(segments)
+
+
+def _segments_from_documents(documents):
+    import email_watcher
+    segments = []
+    for doc in documents:
+        fields = doc.get('fields', {})
+        segments.append({
+            'id': doc.get('name', '').split('/')[-1],
+            'title': email_watcher._extract_string_value(fields.get('title', {})),
+            'enabled': email_watcher._extract_bool_value(fields.get('enabled', {})),
+            'priority': email_watcher._extract_int_value(fields.get('priority', {})),
+            'conditions': email_watcher._extract_conditions(fields.get('conditions', {})),
+        })
+    return segments
+
+
+def load_segments(spec):
+    """セグメント設定を読み込み、有効なものを priority 順に返す"""
+    if spec.startswith('firestore:'):
+        return _load_segments_from_firestore(spec.split(':', 1)[1])
+    if spec.startswith('firestore-engage:'):
+        return _load_segments_from_firestore(spec.split(':', 1)[1], engage=True)
+    with open(spec, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        if 'documents' in data:
+            data = _segments_from_documents(data['documents'])
+        else:
+            data = data.get('segments', [])
+    segments = [s for s in data if s.get('enabled', True)]
+    segments.sort(key=lambda x: x.get('priority', 0))
+    return segments
+
+
+def segment_labels(segments):
+    labels = []
+    for i, segment in enumerate(segments):
+        label = segment.get('title') or segment.get('id') or f'セグメント{i+1}'
+        if label in labels:
+            label = f"{label} ({segment.get('id') or i + 1})"
+        labels.append(label)
+    return labels
+
+
+# ---------- 履歴の読み込み（列として保持） ----------
+class HistoryColumns:
+    """履歴を列で保持する（行の dict は保持しない）"""
+
+    def __init__(self):
+        self.gender = array('b')
+        self.age = array('h')
+        self.name_type = array('b')
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.gender)
+
+    def append(self, name, gender, age):
+        name = (name or '').strip()
+        self.gender.append(GENDER_CODES.get((gender or '').strip(), 0))
+        self.age.append(age if 0 <= age <= MAX_AGE else 0)
+        self.name_type.append(NAME_TYPE_CODES[name_type_of(name)] if name else 0)
+
+    def key_counts(self):
+        """(性別, 年齢, 氏名種別) の組み合わせごとの件数"""
+        keys = map(lambda g, a, n: (g << 14) | (a << 3) | n, self.gender, self.age, self.name_type)
+        return Counter(keys)
+
+
+def _unpack_key(key):
+    return key >> 14, (key >> 3) & 0x7ff, key & 0x7
+
+
+@lru_cache(maxsize=65536)
+def _age_from_birth(birth):
+    import email_watcher
+    try:
+        return email_watcher.calc_age_from_birth_str(birth)
+    except Exception:
+        return None
+
+
+def _row_age(row):
+    age = row.get('age')
+    if isinstance(age, int) and not isinstance(age, bool):
+        return age
+    if isinstance(age, float):
+        return int(age)
+    if isinstance(age, str) and age.strip().isdigit():
+        return int(age.strip())
+    birth = row.get('birth')
+    if birth:
+        parsed = _age_from_birth(str(birth))
+        if parsed is not None:
+            return parsed
+    return 0
+
+
+def _flatten_firestore_fields(fields):
+    row = {}
+    for k, v in fields.items():
+        if not isinstance(v, dict):
+            continue
+        if 'stringValue' in v:
+            row[k] = v['stringValue']
+        elif 'integerValue' in v:
+            try:
+                row[k] = int(v['integerValue'])
+            except Exception:
+                pass
+        elif 'doubleValue' in v:
+            row[k] = v['doubleValue']
+    return row
+
+
+def _iter_rows(path):
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            yield from csv.DictReader(f)
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except Exception:
+                yield None
+                continue
+            if isinstance(row, dict) and isinstance(row.get('fields'), dict):
+                row = _flatten_firestore_fields(row['fields'])
+            yield row
+
+
+def load_history(path, source=None):
+    columns = HistoryColumns()
+    for row in _iter_rows(path):
+        if not isinstance(row, dict):
+            columns.skipped += 1
+            continue
+        if source and (row.get('source') or '') != source:
+            continue
+        try:
+            columns.append(row.get('name'), row.get('gender'), _row_age(row))
+        except Exception:
+            columns.skipped += 1
+    return columns
+
+
+# ---------- 判定・集計 ----------
+def classify_keys(index, keys):
+    """組み合わせごとに最初に該当するセグメントの位置（-1 は非対象）"""
+    result = {}
+    for key in keys:
+        g, age, nt = _unpack_key(key)
+        if not g or not age or not nt:
+            result[key] = -1
+            continue
+        result[key] = index.position(GENDER_NAMES[g], age, NAME_TYPES[nt - 1])
+    return result
+
+
+def transition_matrix(columns, old_segments, new_segments):
+    counts = columns.key_counts()
+    old_pos = classify_keys(SegmentIndex(old_segments), counts)
+    new_pos = classify_keys(SegmentIndex(new_segments), counts)
+    matrix = Counter()
+    for key, n in counts.items():
+        matrix[(old_pos[key], new_pos[key])] += n
+    return matrix
+
+
+def _width(text):
+    return sum(2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1 for c in text)
+
+
+def _ljust(text, width):
+    return text + ' ' * max(0, width - _width(text))
+
+
+def _rjust(text, width):
+    return ' ' * max(0, width - _width(text)) + text
+
+
+def print_matrix(matrix, old_labels, new_labels, total):
+    rows = list(range(len(old_labels))) + [-1]
+    cols = list(range(len(new_labels))) + [-1]
+    row_names = {i: old_labels[i] if i >= 0 else NO_SEGMENT for i in rows}
+    col_names = {j: new_labels[j] if j >= 0 else NO_SEGMENT for j in cols}
+    width = max([_width(n) for n in row_names.values()] + [8]) + 2
+    cell = max([_width(n) for n in col_names.values()] + [len(str(total)), 6]) + 2
+
+    print(_ljust('old \\ new', width) + ''.join(_rjust(col_names[j], cell) for j in cols) + _rjust('合計', cell))
+    for i in rows:
+        line = _ljust(row_names[i], width)
+        line += ''.join(str(matrix.get((i, j), 0)).rjust(cell) for j in cols)
+        line += str(sum(matrix.get((i, j), 0) for j in cols)).rjust(cell)
+        print(line)
+    print(_ljust('合計', width) + ''.join(str(sum(matrix.get((i, j), 0) for i in rows)).rjust(cell) for j in cols)
+          + str(total).rjust(cell))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='セグメント設定変更の影響確認（sms_history のリプレイ）')
+    ap.add_argument('history', help='sms_history のエクスポート（.jsonl / .csv）')
+    ap.add_argument('--old', required=True, help='現在のセグメント設定（JSON ファイル / firestore:<uid>）')
+    ap.add_argument('--new', required=True, help='変更案のセグメント設定（JSON ファイル / firestore:<uid>）')
+    ap.add_argument('--source', choices=['jobbox', 'engage'], help='source 列で絞り込む')
+    ap.add_argument('--json', dest='json_out', help='結果を JSON で保存するパス')
+    args = ap.parse_args()
+
+    old_segments = load_segments(args.old)
+    new_segments = load_segments(args.new)
+
+    t0 = time.perf_counter()
+    columns = load_history(args.history, args.source)
+    t_load = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    matrix = transition_matrix(columns, old_segments, new_segments)
+    t_eval = time.perf_counter() - t0
+
+    total = len(columns)
+    changed = sum(n for (i, j), n in matrix.items() if i != j)
+    old_labels = segment_labels(old_segments)
+    new_labels = segment_labels(new_segments)
+
+    print(f'履歴: {total}件（読み込み {t_load:.2f}s / 判定 {t_eval:.3f}s）' + (f' 読み飛ばし: {columns.skipped}件' if columns.skipped else ''))
+    print(f'セグメント: old {len(old_segments)}件 / new {len(new_segments)}件')
+    print()
+    print_matrix(matrix, old_labels, new_labels, total)
+    print()
+    print(f"判定が変わる応募者: {changed}件 ({(changed / total * 100) if total else 0:.1f}%)")
+
+    if args.json_out:
+        out = {
+            'total': total,
+            'changed': changed,
+            'old': old_labels,
+            'new': new_labels,
+            'transitions': [
+                {'old': old_labels[i] if i >= 0 else None, 'new': new_labels[j] if j >= 0 else None, 'count': n}
+                for (i, j), n in sorted(matrix.items())
+            ],
+        }
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+        print(f'結果を保存しました: {args.json_out}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
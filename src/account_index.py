@@ -0,0 +1,353 @@
+"""
+採用担当アカウント（jobbox_accounts / engage_accounts）の索引
+
+通知のアカウント名から担当アカウントを探すたびにコレクションを全件読み、全件を正規化して
+比べていたのを、UID ごとの索引で引くようにする。
+
+    (媒体, 正規化したアカウント名)              → 名前だけで探すとき（アカウントIDのない通知）
+    (媒体, 正規化したアカウント名, アカウントID) → アカウントIDも一致させるとき（求人ボックス）
+
+- 索引は UID ごとに1つで、求人ボックスとエンゲージの両方を持つ。最初の検索で両方のコレクションを読み込む
+- 同じ名前のアカウントが複数あるときは、以前の全件走査と同じくドキュメントID順で最初のものを返す
+- ACCOUNT_INDEX_TTL 秒ごと（と、見つからなかったときは ACCOUNT_INDEX_MISS_REFRESH 秒に1回まで）に
+  更新を確認する。確認は account_name だけを返す一覧（updateTime の比較）で行い、追加・変更された
+  ドキュメントだけを batchGet で読み直す。削除されたドキュメントは索引から外す
+- 中身が変わるたびに UID ごとの generation が増える
+- 見つからなかった (媒体, 正規化したアカウント名, アカウントID) は ACCOUNT_NEGATIVE_TTL 秒のあいだ覚えておき、
+  管理していないアカウントの通知が続いても Firestore を読み直さない。generation が変わったら
+  （アカウントが追加・変更・削除されたら）すべて忘れる
+
+Firestore の読み込みは呼び出し側が渡す:
+    list_documents(uid, collection, fields)  → [{'name', 'updateTime', 'fields'}, ...]（失敗したら None）
+    batch_get(names, fields)                 → 同じ形のリスト（失敗したら None）
+
+環境変数:
+    ACCOUNT_INDEX_TTL            更新を確認する間隔（秒、既定 60）
+    ACCOUNT_INDEX_MISS_REFRESH   見つからなかったときに確認し直す最短の間隔（秒、既定 10）
+    ACCOUNT_NEGATIVE_TTL         見つからなかった結果を覚えておく時間（秒、既定 60。0 で覚えない）
+"""
+
+import os
+import re
+import threading
+import time
+import unicodedata
+from bisect import insort
+from typing import Callable, Dict, List, Optional
+
+# 見つからなかった結果を UID ごとにいくつまで覚えるか（超えたら期限切れのものから捨てる）
+NEGATIVE_CACHE_MAX = 1024
+
+# 媒体 → コレクション名と、索引に持つ（ログイン処理に渡す）フィールド
+ACCOUNT_COLLECTIONS = {
+    'jobbox': ('jobbox_accounts', ('account_name', 'account_id', 'jobbox_id', 'jobbox_password')),
+    'engage': ('engage_accounts', ('account_name', 'engage_id', 'engage_password')),
+}
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_account_name(s) -> str:
+    """アカウント名の比較用の正規化（NFKC・空白除去・小文字化。会社名の接尾辞は残し、部分一致もしない）"""
+    if not s:
+        return ''
+    return _SPACES.sub('', unicodedata.normalize('NFKC', s)).lower()
+
+
+def _env_seconds(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class _Entry:
+    __slots__ = ('platform', 'update_time', 'norm', 'account_id', 'account')
+
+    def __init__(self, platform, update_time, norm, account_id, account):
+        self.platform = platform
+        self.update_time = update_time
+        self.norm = norm
+        self.account_id = account_id
+        self.account = account
+
+
+class _Tenant:
+    """1つの UID の索引"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs: Dict[str, _Entry] = {}
+        self.by_name: Dict[tuple, List[str]] = {}
+        self.by_id: Dict[tuple, List[str]] = {}
+        self.negative: Dict[tuple, float] = {}   # (媒体, 正規化した名前, アカウントID) → 期限
+        self.loaded = False
+        self.checked_at = 0.0
+        self.generation = 0
+        self.loads = 0
+        self.refreshes = 0
+        self.changed = 0
+        self.failures = 0
+        self.last_refresh_ms = 0.0
+
+    def add(self, name: str, entry: _Entry) -> None:
+        self.remove(name)
+        self.docs[name] = entry
+        if not entry.norm:
+            return
+        insort(self.by_name.setdefault((entry.platform, entry.norm), []), name)
+        if entry.account_id:
+            insort(self.by_id.setdefault((entry.platform, entry.norm, entry.account_id), []), name)
+
+    def remove(self, name: str) -> None:
+        entry = self.docs.pop(name, None)
+        if entry is None or not entry.norm:
+            return
+        keys = [(self.by_name, (entry.platform, entry.norm))]
+        if entry.account_id:
+            keys.append((self.by_id, (entry.platform, entry.norm, entry.account_id)))
+        for index, key in keys:
+            names = index.get(key)
+            if names is not None:
+                names.remove(name)
+                if not names:
+                    del index[key]
+
+    def find(self, platform: str, norm: str, account_id: str) -> Optional[dict]:
+        if not norm:
+            return None
+        if account_id:
+            names = self.by_id.get((platform, norm, account_id))
+        else:
+            names = self.by_name.get((platform, norm))
+        if not names:
+            return None
+        return dict(self.docs[names[0]].account)
+
+    def remember_miss(self, key: tuple, expires_at: float) -> None:
+        if len(self.negative) >= NEGATIVE_CACHE_MAX:
+            now = time.time()
+            self.negative = {k: exp for k, exp in self.negative.items() if exp > now}
+            if len(self.negative) >= NEGATIVE_CACHE_MAX:
+                self.negative.clear()
+        self.negative[key] = expires_at
+
+
+def _to_entry(platform: str, doc: dict) -> Optional[_Entry]:
+    fields = doc.get('fields') or {}
+    keys = ACCOUNT_COLLECTIONS[platform][1]
+    account = {k: fields.get(k, {}).get('stringValue') for k in keys}
+    if not account.get('account_name'):
+        return None
+    account_id = (account.get('account_id') or '').strip() if 'account_id' in account else ''
+    return _Entry(platform, doc.get('updateTime') or '', normalize_account_name(account['account_name']),
+                  account_id, account)
+
+
+class AccountIndex:
+    """UID ごとの採用担当アカウントの索引（スレッドセーフ。同じ UID の読み込みは1回ずつ）"""
+
+    def __init__(self, list_documents: Callable, batch_get: Optional[Callable] = None,
+                 ttl: Optional[float] = None, miss_refresh: Optional[float] = None,
+                 negative_ttl: Optional[float] = None, name: str = 'accounts'):
+        self.list_documents = list_documents
+        self.batch_get = batch_get
+        self.ttl = _env_seconds('ACCOUNT_INDEX_TTL', 60.0) if ttl is None else ttl
+        self.miss_refresh = _env_seconds('ACCOUNT_INDEX_MISS_REFRESH', 10.0) if miss_refresh is None else miss_refresh
+        self.negative_ttl = _env_seconds('ACCOUNT_NEGATIVE_TTL', 60.0) if negative_ttl is None else negative_ttl
+        self.name = name
+        self._lock = threading.Lock()
+        self._tenants: Dict[str, _Tenant] = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        with _registry_lock:
+            _registry.append(self)
+
+    def _tenant(self, uid: str) -> _Tenant:
+        with self._lock:
+            tenant = self._tenants.get(uid)
+            if tenant is None:
+                tenant = self._tenants[uid] = _Tenant()
+            return tenant
+
+    # ---------- 検索 ----------
+    def find(self, uid, platform: str, account_name, account_id='') -> Optional[dict]:
+        """アカウント名（account_id があればそれも）が一致するアカウントを返す（見つからなければ None）"""
+        if not uid or platform not in ACCOUNT_COLLECTIONS:
+            return None
+        uid = str(uid)
+        norm = normalize_account_name((account_name or '').strip())
+        account_id = (account_id or '').strip()
+        tenant = self._tenant(uid)
+        key = (platform, norm, account_id)
+        cached_miss = False
+        now = time.time()
+        with tenant.lock:
+            if not tenant.loaded or now - tenant.checked_at >= self.ttl:
+                self._refresh_locked(uid, tenant)
+            expires_at = tenant.negative.get(key)
+            if expires_at is not None and expires_at > time.time():
+                # 少し前に見つからなかった名前。索引が変わっていなければ（変わると消える）確認し直さない
+                found = None
+                cached_miss = True
+            else:
+                found = tenant.find(platform, norm, account_id)
+                if found is None and tenant.loaded and time.time() - tenant.checked_at >= self.miss_refresh:
+                    # 追加されたばかりのアカウントかもしれないので確認し直す
+                    self._refresh_locked(uid, tenant)
+                    found = tenant.find(platform, norm, account_id)
+                if found is None and tenant.loaded and self.negative_ttl > 0:
+                    tenant.remember_miss(key, time.time() + self.negative_ttl)
+                elif expires_at is not None:
+                    del tenant.negative[key]
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                if cached_miss:
+                    self.negative_hits += 1
+            else:
+                self.hits += 1
+        return found
+
+    def generation(self, uid) -> int:
+        """索引の中身が変わるたびに増える番号（まだ読み込んでいなければ 0）"""
+        with self._lock:
+            tenant = self._tenants.get(str(uid))
+        return tenant.generation if tenant is not None else 0
+
+    # ---------- 更新 ----------
+    def refresh(self, uid) -> bool:
+        """今すぐ更新を確認する。読み込めなければ False"""
+        tenant = self._tenant(str(uid))
+        with tenant.lock:
+            return self._refresh_locked(str(uid), tenant)
+
+    def invalidate(self, uid=None) -> None:
+        """次の検索で全件を読み直す（uid を省略するとすべての UID）"""
+        with self._lock:
+            tenants = list(self._tenants.values()) if uid is None else [self._tenants.get(str(uid))]
+        for tenant in tenants:
+            if tenant is not None:
+                with tenant.lock:
+                    tenant.loaded = False
+                    tenant.checked_at = 0.0
+                    tenant.negative.clear()
+
+    def _refresh_locked(self, uid: str, tenant: _Tenant) -> bool:
+        t0 = time.perf_counter()
+        full = not tenant.loaded
+        changed = 0
+        ok = True
+        for platform, (collection, keys) in ACCOUNT_COLLECTIONS.items():
+            if full:
+                docs = self.list_documents(uid, collection, keys)
+                if docs is None:
+                    ok = False
+                    continue
+                changed += self._replace(tenant, platform, docs)
+            else:
+                result = self._apply_changes(uid, tenant, platform, collection, keys)
+                if result is None:
+                    ok = False
+                    continue
+                changed += result
+        tenant.checked_at = time.time()
+        tenant.last_refresh_ms = (time.perf_counter() - t0) * 1000
+        if not ok:
+            tenant.failures += 1
+            print(f'[ACCOUNTS] uid={uid} のアカウント一覧を読み込めませんでした（前回の索引を使います）')
+            return False
+        if changed:
+            tenant.generation += 1
+            tenant.changed += changed
+            # アカウントが変わったので、見つからなかった結果は当てにならない
+            tenant.negative.clear()
+        if full:
+            tenant.loaded = True
+            tenant.loads += 1
+            counts = {p: sum(1 for e in tenant.docs.values() if e.platform == p) for p in ACCOUNT_COLLECTIONS}
+            print(f"[ACCOUNTS] uid={uid} 求人ボックス {counts['jobbox']} / エンゲージ {counts['engage']} 件を"
+                  f'読み込みました（{tenant.last_refresh_ms:.0f}ms）')
+        else:
+            tenant.refreshes += 1
+            if changed:
+                print(f'[ACCOUNTS] uid={uid} 変更されたアカウント {changed} 件を索引に反映しました')
+        return True
+
+    def _replace(self, tenant: _Tenant, platform: str, docs: list) -> int:
+        seen = set()
+        changed = 0
+        for doc in docs:
+            name = doc.get('name') or ''
+            seen.add(name)
+            old = tenant.docs.get(name)
+            if old is not None and old.update_time and old.update_time == doc.get('updateTime'):
+                continue
+            changed += self._put(tenant, platform, name, doc)
+        for name in [n for n, e in tenant.docs.items() if e.platform == platform and n not in seen]:
+            tenant.remove(name)
+            changed += 1
+        return changed
+
+    def _apply_changes(self, uid: str, tenant: _Tenant, platform: str, collection: str, keys) -> Optional[int]:
+        # account_name だけの一覧で updateTime を比べ、追加・変更分だけ読み直す
+        versions = self.list_documents(uid, collection, ('account_name',))
+        if versions is None:
+            return None
+        current = {d.get('name') or '': d.get('updateTime') or '' for d in versions}
+        stale = [n for n, ut in current.items()
+                 if n not in tenant.docs or not ut or tenant.docs[n].update_time != ut]
+        changed = 0
+        for name in [n for n, e in tenant.docs.items() if e.platform == platform and n not in current]:
+            tenant.remove(name)
+            changed += 1
+        if not stale:
+            return changed
+        docs = self.batch_get(stale, keys) if self.batch_get is not None else None
+        if docs is None:
+            # batchGet が使えなければ全件の一覧で置き換える
+            docs = self.list_documents(uid, collection, keys)
+            if docs is None:
+                return None
+            return changed + self._replace(tenant, platform, docs)
+        for doc in docs:
+            changed += self._put(tenant, platform, doc.get('name') or '', doc)
+        return changed
+
+    def _put(self, tenant: _Tenant, platform: str, name: str, doc: dict) -> int:
+        entry = _to_entry(platform, doc)
+        if entry is None:
+            # account_name のないドキュメントは以前の全件走査でも対象外。updateTime だけ覚えて次回は読み直さない
+            old = tenant.docs.get(name)
+            tenant.add(name, _Entry(platform, doc.get('updateTime') or '', '', '', {}))
+            return 1 if old is not None and old.norm else 0
+        tenant.add(name, entry)
+        return 1
+
+    # ---------- 参照 ----------
+    def stats(self) -> dict:
+        with self._lock:
+            tenants = dict(self._tenants)
+            out = {'name': self.name, 'hits': self.hits, 'misses': self.misses,
+                   'negative_hits': self.negative_hits, 'uids': []}
+        for uid, t in tenants.items():
+            with t.lock:
+                out['uids'].append({
+                    'name': uid, 'accounts': sum(1 for e in t.docs.values() if e.norm),
+                    'negative': len(t.negative), 'generation': t.generation, 'loads': t.loads, 'refreshes': t.refreshes,
+                    'changed': t.changed, 'failures': t.failures,
+                    'last_refresh_ms': round(t.last_refresh_ms, 1),
+                    'age_sec': round(time.time() - t.checked_at, 1) if t.checked_at else None,
+                })
+        return out
+
+
+_registry: List[AccountIndex] = []
+_registry_lock = threading.Lock()
+
+
+def account_index_stats() -> list:
+    with _registry_lock:
+        indexes = list(_registry)
+    return [ix.stats() for ix in indexes]
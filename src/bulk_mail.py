@@ -0,0 +1,323 @@
+"""
+予約メールの一括送信（同じ時刻に大量のメールタスクが期限になった場合）
+
+execute_scheduled_mail_task はタスクごとに送信元設定（mail_settings）を Firestore から読み、
+テンプレートを展開して send_mail_once を呼んでいた。ここでは期限になったメールタスクをまとめて
+
+    1. 送信元（uid）ごとにまとめて、mail_settings を1回だけ読む
+    2. テンプレートごとに render_many で件名・本文を先に全部展開し、メッセージを組み立てておく
+    3. 送信元ごとに少数の SMTP セッション（smtp_pool の接続）で順に流す
+
+の順で処理し、送信件数/秒とメッセージごとのレイテンシ（p50 / p95）を出力する。
+結果はタスク ID ごとの (success, info) で返し、履歴の書き込みとタスク状態の更新は呼び出し側が行う。
+タスク ID のないタスクは結果を区別できないので一括送信せず、呼び出し側がタスクごとに送る。
+
+環境変数:
+    BULK_MAIL               false で無効（タスクごとに送る従来の動作）
+    BULK_MAIL_MIN_TASKS     この件数以上のメールタスクがまとめて期限になったら一括送信する（既定 3）
+    BULK_MAIL_SESSIONS      送信元ごとの同時 SMTP セッション数（既定 SMTP_POOL_SIZE、未設定なら 2）
+    DRY_RUN_MAIL            true なら送信せずに成功扱い（send_mail_once と同じ）
+"""
+
+import html
+import os
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.header import Header
+from email.message import EmailMessage
+from email.utils import formataddr, parseaddr
+from typing import Callable, Dict, List, Optional, Tuple
+
+from outbox import guarded_send
+from rate_limit import acquire_smtp
+from smtp_pool import send_message as smtp_send_message
+from template_render import render_many
+
+_ADDR_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+_TAG_RE = re.compile(r'<[^>]+>')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except Exception:
+        return int(default)
+
+
+def bulk_enabled() -> bool:
+    return os.environ.get('BULK_MAIL', 'true').lower() not in ('0', 'false', 'no')
+
+
+def bulk_min_tasks() -> int:
+    return max(1, _env_int('BULK_MAIL_MIN_TASKS', 3))
+
+
+def bulk_sessions() -> int:
+    return max(1, _env_int('BULK_MAIL_SESSIONS', os.environ.get('SMTP_POOL_SIZE', 2)))
+
+
+def extract_addr(addr) -> Tuple[str, str]:
+    """(表示名, ASCII のアドレス) を返す。アドレスが取れなければ空文字。"""
+    a = str(addr or '')
+    name, email_addr = parseaddr(a)
+    # If parseaddr gave an ASCII addr-spec, accept it
+    if email_addr and all(ord(c) < 128 for c in email_addr):
+        return (name or '', email_addr)
+    # fallback: find ascii-like addr via regex
+    m = _ADDR_RE.search(a)
+    if m:
+        return (name or '', m.group(0))
+    return (name or '', '')
+
+
+def build_mail_message(from_addr, to_addr, subject, body):
+    """送信するメッセージを組み立てる（send_mail_once と共通）
+
+    Returns (msg, from_email, to_email)。エンベロープ用の ASCII アドレスが取れない場合は
+    msg が None で、from_email / to_email のどちらかが空になる。
+    """
+    from_name, from_email = extract_addr(from_addr)
+    to_name, to_email = extract_addr(to_addr)
+    if not from_email or not to_email:
+        return (None, from_email, to_email)
+
+    msg = EmailMessage()
+    # Header values: allow non-ASCII display names
+    msg['From'] = formataddr((str(Header(from_name or '', 'utf-8')), from_email))
+    msg['To'] = formataddr((str(Header(to_name or '', 'utf-8')), to_email))
+    # Ensure UTF-8 safe subject and body for Japanese text
+    msg['Subject'] = str(Header(subject or '', 'utf-8'))
+
+    body_content = body or ''
+    if _TAG_RE.search(body_content):
+        # Set HTML content with fallback plain text
+        plain_text = html.unescape(_TAG_RE.sub('', body_content))
+        msg.set_content(plain_text, charset='utf-8')
+        msg.add_alternative(body_content, subtype='html', charset='utf-8')
+    else:
+        msg.set_content(body_content, charset='utf-8')
+    return (msg, from_email, to_email)
+
+
+def smtp_server() -> Tuple[str, int]:
+    # Use Gmail SMTP by default
+    return (os.environ.get('EMAIL_SMTP_HOST', 'smtp.gmail.com'), int(os.environ.get('EMAIL_SMTP_PORT', '465')))
+
+
+def smtp_local_hostname() -> str:
+    """EHLO に使うホスト名（ASCII 以外を含む場合は localhost）"""
+    try:
+        lh = os.environ.get('EMAIL_SMTP_LOCALHOST') or socket.getfqdn()
+        lh.encode('ascii')
+        return lh
+    except Exception:
+        return 'localhost'
+
+
+def mail_sender(mail_cfg: dict, prefer_reply: bool = True) -> Tuple[str, str]:
+    """mail_settings から (送信元アドレス, アプリパスワード) を選ぶ"""
+    if prefer_reply:
+        return (mail_cfg.get('replyEmail') or mail_cfg.get('email', ''),
+                mail_cfg.get('replyAppPass') or mail_cfg.get('appPass', ''))
+    return (mail_cfg.get('email', ''), mail_cfg.get('appPass', ''))
+
+
+class MailJob:
+    """送信1件分（展開済みの件名・本文と組み立て済みメッセージ）"""
+
+    __slots__ = ('task_id', 'to', 'subject', 'body', 'msg', 'to_email', 'error', 'uid', 'oubo_no', 'template_key')
+
+    def __init__(self, task_id, to, subject='', body='', uid='', oubo_no='', template_key=''):
+        self.task_id = task_id
+        self.to = to
+        self.subject = subject
+        self.body = body
+        self.msg = None
+        self.to_email = ''
+        self.error = None
+        # outbox の冪等キー（execute_scheduled_mail_task と同じ uid + 応募No + mail + scheduled:セグメント）
+        self.uid = uid
+        self.oubo_no = oubo_no
+        self.template_key = template_key
+
+
+def prerender_jobs(tasks: List[dict], sender: str) -> List[MailJob]:
+    """テンプレートごとに render_many でまとめて展開し、メッセージを組み立てる（tasks と同じ順）"""
+    jobs = [MailJob(t.get('id'), t.get('to', ''), uid=t.get('uid', ''), oubo_no=t.get('ouboNo', ''),
+                    template_key=f"scheduled:{t.get('segmentId', '')}") for t in tasks]
+    for field, attr in (('subject', 'subject'), ('template', 'body')):
+        by_template: Dict[str, List[int]] = {}
+        for i, t in enumerate(tasks):
+            by_template.setdefault(t.get(field, '') or '', []).append(i)
+        for text, idxs in by_template.items():
+            rendered = render_many(text, (tasks[i].get('applicantDetail', {}) for i in idxs))
+            for i, value in zip(idxs, rendered):
+                setattr(jobs[i], attr, value)
+    for job in jobs:
+        if not job.to:
+            job.error = 'no recipient email'
+            continue
+        try:
+            job.msg, _, job.to_email = build_mail_message(sender, job.to, job.subject, job.body)
+        except Exception as e:
+            job.error = f'build failed: {e}'
+            continue
+        if job.msg is None:
+            job.error = 'invalid_envelope_address'
+    return jobs
+
+
+def _quantile(sorted_ms: List[float], q: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    return sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * q))]
+
+
+class BulkReport:
+    """送信元ごとの一括送信結果"""
+
+    def __init__(self, sender: str, total: int):
+        self.sender = sender
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.render_ms = 0.0
+        self.elapsed_s = 0.0
+        self.latencies_ms: List[float] = []
+
+    def as_dict(self) -> dict:
+        lat = sorted(self.latencies_ms)
+        return {
+            'sender': self.sender,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'render_ms': round(self.render_ms, 1),
+            'elapsed_s': round(self.elapsed_s, 3),
+            'msg_per_s': round(len(lat) / self.elapsed_s, 1) if self.elapsed_s else 0.0,
+            'p50_ms': round(_quantile(lat, 0.50), 1),
+            'p95_ms': round(_quantile(lat, 0.95), 1),
+            'max_ms': round(lat[-1], 1) if lat else 0.0,
+        }
+
+
+def send_jobs(sender: str, password: str, jobs: List[MailJob], sessions: Optional[int] = None,
+              report: Optional[BulkReport] = None) -> Dict[str, Tuple[bool, dict]]:
+    """組み立て済みのメッセージを、送信元ごとに sessions 本の SMTP セッションで送る（結果は task_id ごと）"""
+    report = report or BulkReport(sender, len(jobs))
+    results: Dict[str, Tuple[bool, dict]] = {}
+    pending = []
+    for job in jobs:
+        if not job.task_id:
+            # 結果を task_id で返すので、ID がないと他のタスクの結果を上書きしてしまう。送らずに呼び出し側に任せる
+            report.skipped += 1
+        elif job.error:
+            results[job.task_id] = (False, {'error': job.error})
+            report.skipped += 1
+        else:
+            pending.append(job)
+
+    dry = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+    host, port = smtp_server()
+    lh = smtp_local_hostname()
+    _, from_email = extract_addr(sender)
+    lock = threading.Lock()
+
+    def _send_one(job: MailJob):
+        if dry:
+            return (True, {'note': 'dry_run'})
+        try:
+            acquire_smtp(from_email)
+            smtp_send_message(host, port, from_email, password, job.msg, from_email, [job.to_email],
+                              local_hostname=lh, timeout=20)
+            return (True, {'note': 'sent'})
+        except Exception as e:
+            return (False, {'error': str(e)})
+
+    def _worker(chunk: List[MailJob]):
+        for job in chunk:
+            t0 = time.perf_counter()
+            ok, info = guarded_send(job.uid, job.oubo_no, 'mail', job.template_key, job.to,
+                                    lambda: _send_one(job), ref=job.task_id or '')
+            ms = (time.perf_counter() - t0) * 1000
+            with lock:
+                results[job.task_id] = (ok, info)
+                report.latencies_ms.append(ms)
+                if ok:
+                    report.sent += 1
+                else:
+                    report.failed += 1
+
+    n = max(1, min(sessions or bulk_sessions(), len(pending)))
+    t0 = time.perf_counter()
+    if pending:
+        # 各セッションに順番に割り振る（1セッション = 1スレッドで1本の接続を使い続ける）
+        chunks = [pending[i::n] for i in range(n)]
+        if n == 1:
+            _worker(chunks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=n) as ex:
+                list(ex.map(_worker, chunks))
+    report.elapsed_s += time.perf_counter() - t0
+    return results
+
+
+_last_reports: List[dict] = []
+_stats_lock = threading.Lock()
+
+
+def send_mail_tasks_bulk(tasks: List[dict], settings_loader: Callable[[str], dict], prefer_reply: bool = True,
+                         sessions: Optional[int] = None) -> Dict[str, Tuple[bool, dict]]:
+    """期限になったメールタスクをまとめて送る。タスク ID → (success, info) を返す。
+
+    settings_loader(uid) は mail_settings の dict を返す関数（_get_mail_settings）。
+    """
+    by_uid: Dict[str, List[dict]] = {}
+    no_id = 0
+    for t in tasks:
+        if not t.get('id'):
+            no_id += 1
+            continue
+        by_uid.setdefault(t.get('uid', ''), []).append(t)
+    if no_id:
+        print(f'[BULK_MAIL] タスク ID のないタスク {no_id}件 は一括送信しません（タスクごとに送信）')
+
+    results: Dict[str, Tuple[bool, dict]] = {}
+    reports = []
+    for uid, group in by_uid.items():
+        try:
+            mail_cfg = settings_loader(uid) or {}
+        except Exception:
+            mail_cfg = {}
+        sender, sender_pass = mail_sender(mail_cfg, prefer_reply)
+        if not sender or not sender_pass:
+            for t in group:
+                results[t.get('id')] = (False, {'note': 'mail settings not configured'})
+            continue
+
+        report = BulkReport(sender, len(group))
+        t0 = time.perf_counter()
+        jobs = prerender_jobs(group, sender)
+        report.render_ms = (time.perf_counter() - t0) * 1000
+        results.update(send_jobs(sender, sender_pass, jobs, sessions, report))
+        summary = report.as_dict()
+        reports.append(summary)
+        print(f"[BULK_MAIL] {sender}: {summary['sent']}/{summary['total']}通 送信 "
+              f"(失敗 {summary['failed']} / 対象外 {summary['skipped']}) "
+              f"{summary['elapsed_s']}s {summary['msg_per_s']}通/s "
+              f"p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms 展開・組立={summary['render_ms']}ms")
+
+    with _stats_lock:
+        _last_reports[:] = reports
+    return results
+
+
+def bulk_mail_stats() -> List[dict]:
+    """直近の一括送信のレポート（送信元ごと）"""
+    with _stats_lock:
+        return list(_last_reports)
@@ -0,0 +1,209 @@
+"""
+予約タスクの分散送信（同じ時刻に期限になったタスクを時間をずらして送る）
+
+create_scheduled_task は送信時刻を HH:MM:00 ちょうどで登録するため、「09:00」に設定した
+タスクは全部同じ 5 秒のチェックで期限になり、Firestore・SMS・SMTP に一度に集中する。
+ここでは同じ分に期限になったタスク（uid ごと）を1つのまとまり（コホート）とし、
+
+    - 応募ごと（uid + 応募No。SMS とメールは同じ応募なら一緒に送る）に送信時刻をずらす
+    - 並び順は priority（小さいほど先）→ 応募ごとに決まるジッター（ハッシュ値。再起動しても同じ）
+    - 分散幅は SCHEDULE_SPREAD_WINDOW 秒、または SCHEDULE_SPREAD_RATE の速度で送り切れる幅
+    - どのタスクも予定時刻から SCHEDULE_MAX_LATENESS 秒を超えては遅らせない
+
+の順で、各応募の送信時刻を「予定時刻 + オフセット」に割り当てる。件数の少ないコホートはずらさない。
+
+環境変数（SCHEDULE_SPREAD_WINDOW / SCHEDULE_SPREAD_RATE が未設定なら無効 = 従来どおり即時）:
+    SCHEDULE_SPREAD_WINDOW        分散幅（秒）
+    SCHEDULE_SPREAD_RATE          送信速度（例: 2/s, 60/m）。指定時は 件数 / 速度 を分散幅にする
+    SCHEDULE_SPREAD_MIN_COHORT    この件数（応募数）未満のコホートはずらさない（既定 10）
+    SCHEDULE_MAX_LATENESS         予定時刻からの最大遅延（秒、既定 600）
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from rate_limit import parse_rate
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+def _jitter(uid: str, unit: str, cohort_minute: int) -> float:
+    """応募ごとに決まる 0〜1 の値（Python の hash() と違いプロセスをまたいで同じ）"""
+    h = hashlib.blake2b(f'{uid}|{unit}|{cohort_minute}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(h, 'big') / 2.0 ** 64
+
+
+def task_priority(task: dict) -> int:
+    try:
+        return int(task.get('priority') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def unit_key(task: dict) -> str:
+    """SMS とメールを一緒に送る単位（応募No がなければタスクごと）"""
+    return task.get('ouboNo') or f"task:{task.get('id', '')}"
+
+
+class _Cohort:
+    __slots__ = ('start_ms', 'units', 'offsets', 'announced')
+
+    def __init__(self, start_ms: int):
+        self.start_ms = start_ms
+        # unit → (priority, jitter)
+        self.units: Dict[str, Tuple[int, float]] = {}
+        self.offsets: Dict[str, float] = {}
+        self.announced = 0
+
+
+class SpreadPolicy:
+    def __init__(self, window_s: float = 0.0, rate: float = 0.0, min_cohort: int = 10,
+                 max_lateness_s: float = 600.0):
+        self.window_s = max(0.0, window_s)
+        self.rate = max(0.0, rate)
+        self.min_cohort = max(1, int(min_cohort))
+        self.max_lateness_s = max(0.0, max_lateness_s)
+        self._cohorts: Dict[Tuple[str, int], _Cohort] = {}
+        self._lock = threading.Lock()
+        self._next_release: Optional[float] = None
+        self.counters = {'released': 0, 'deferred': 0, 'late_forced': 0, 'cohorts': 0}
+
+    @classmethod
+    def from_env(cls) -> 'SpreadPolicy':
+        return cls(
+            window_s=_env_float('SCHEDULE_SPREAD_WINDOW', 0),
+            rate=parse_rate(os.environ.get('SCHEDULE_SPREAD_RATE')),
+            min_cohort=int(_env_float('SCHEDULE_SPREAD_MIN_COHORT', 10)),
+            max_lateness_s=_env_float('SCHEDULE_MAX_LATENESS', 600),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_s > 0 or self.rate > 0
+
+    def spread_seconds(self, n: int) -> float:
+        """n 件（応募数）のコホートを分散する幅（秒）"""
+        if n < self.min_cohort:
+            return 0.0
+        width = n / self.rate if self.rate > 0 else self.window_s
+        # 最後の1件でも最大遅延を超えないようにする
+        return max(0.0, min(width, self.max_lateness_s))
+
+    def _assign(self, cohort: _Cohort) -> None:
+        order = sorted(cohort.units.items(), key=lambda kv: (kv[1][0], kv[1][1], kv[0]))
+        n = len(order)
+        width = self.spread_seconds(n)
+        cohort.offsets = {}
+        for i, (unit, (_, jitter)) in enumerate(order):
+            cohort.offsets[unit] = width * (i + jitter) / n if width else 0.0
+
+    def select(self, tasks: List[dict], now_ms: Optional[int] = None) -> List[dict]:
+        """期限になったタスクのうち、今送るものを返す（送信時刻順）。残りは次回以降のチェックで返す。"""
+        if not self.enabled:
+            return tasks
+        if not tasks:
+            self._next_release = None
+            return tasks
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        ready: List[Tuple[float, int, dict]] = []
+        next_release = None
+        with self._lock:
+            touched = set()
+            for t in tasks:
+                next_run = int(t.get('nextRun') or 0)
+                minute = next_run // 60000
+                key = (t.get('uid', ''), minute)
+                cohort = self._cohorts.get(key)
+                if cohort is None:
+                    cohort = _Cohort(minute * 60000)
+                    self._cohorts[key] = cohort
+                    self.counters['cohorts'] += 1
+                unit = unit_key(t)
+                prio = task_priority(t)
+                known = cohort.units.get(unit)
+                if known is None:
+                    cohort.units[unit] = (prio, _jitter(key[0], unit, minute))
+                    touched.add(key)
+                elif prio < known[0]:
+                    cohort.units[unit] = (prio, known[1])
+                    touched.add(key)
+            for key in touched:
+                cohort = self._cohorts[key]
+                self._assign(cohort)
+                n = len(cohort.units)
+                if n > cohort.announced and self.spread_seconds(n) > 0:
+                    cohort.announced = n
+                    hhmm = time.strftime('%H:%M', time.localtime(cohort.start_ms / 1000))
+                    print(f'⏳ {hhmm} のタスク {n}件を {self.spread_seconds(n):.0f}秒に分散して送信します')
+
+            for t in tasks:
+                next_run = int(t.get('nextRun') or 0)
+                cohort = self._cohorts[(t.get('uid', ''), next_run // 60000)]
+                release_ms = cohort.start_ms + cohort.offsets.get(unit_key(t), 0.0) * 1000
+                late_s = (now_ms - next_run) / 1000.0
+                if release_ms <= now_ms:
+                    ready.append((release_ms, len(ready), t))
+                    self.counters['released'] += 1
+                elif late_s >= self.max_lateness_s:
+                    ready.append((release_ms, len(ready), t))
+                    self.counters['late_forced'] += 1
+                else:
+                    self.counters['deferred'] += 1
+                    wait = (release_ms - now_ms) / 1000.0
+                    next_release = wait if next_release is None else min(next_release, wait)
+            self._next_release = next_release
+            self._prune(now_ms)
+        ready.sort(key=lambda r: (r[0], r[1]))
+        return [t for _, _, t in ready]
+
+    def _prune(self, now_ms: int) -> None:
+        horizon = (self.max_lateness_s + 3600) * 1000
+        for key in [k for k, c in self._cohorts.items() if now_ms - c.start_ms > horizon]:
+            del self._cohorts[key]
+
+    def wait_hint(self, default_s: float, min_s: float = 5.0) -> float:
+        """次のチェックまでの待ち秒数（保留中のタスクの送信時刻が近ければ短くする）
+
+        チェックのたびにタスク一覧を Firestore から読むため、min_s より短くはしない。
+        """
+        nr = self._next_release
+        if nr is None:
+            return default_s
+        return max(min_s, min(default_s, nr))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'window_s': self.window_s,
+                'rate_per_s': self.rate,
+                'max_lateness_s': self.max_lateness_s,
+                'counters': dict(self.counters),
+                'cohorts': len(self._cohorts),
+                'next_release_s': self._next_release,
+            }
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_dispatch_policy() -> SpreadPolicy:
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = SpreadPolicy.from_env()
+    return _policy
+
+
+def dispatch_policy_stats() -> dict:
+    return get_dispatch_policy().stats()
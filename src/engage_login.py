@@ -20,6 +20,144 @@ import json, time, os, re, unicodedata, datetime
 from typing import Optional, Tuple
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString, Tag
+from html_soup import make_soup
+from profiler import profiled
+from stage_metrics import StageLaps, stage, timed
+
+
+# 値として採用しない文言（セレクトボックスやタブの文字列）
+_VALUE_SKIP_WORDS = ['求人を選択', '選択してください', 'IDで検索', 'プロフィール', 'メッセージ']
+_INLINE_SKIP_WORDS = ['求人を選択', '選択してください', 'IDで検索']
+
+
+class _LabelIndex:
+    """プロフィールページのラベル→値の索引
+
+    ページを1回だけ走査して dt/dd, th/td, label/data, 「ラベル: 値」の候補を
+    文書順に集めておき、各フィールドの検索はこの索引だけを参照する。
+    検索の優先順位と採用条件は従来の get_text_bs4 と同じ:
+        1. dt → 次の dd
+        2. th → 次の td
+        3. class に label を含む label/div → 親要素内の class に data を含む div/span
+        4. div/span/p の「ラベル: 値」
+    """
+
+    _pattern_cache = {}
+
+    def __init__(self, soup):
+        self.soup = soup
+        self._dt = []
+        self._th = []
+        self._label = []
+        self._inline = []
+        self._by_class = {}
+        for tag in soup.find_all(True):
+            name = tag.name
+            classes = tag.get('class') or []
+            if isinstance(classes, str):
+                classes = [classes]
+            for c in classes:
+                self._by_class.setdefault(c, []).append(tag)
+            if name == 'dt':
+                self._dt.append([tag, tag.get_text(' ', strip=True), False, None])
+            elif name == 'th':
+                self._th.append([tag, tag.get_text(' ', strip=True), False, None])
+            if name in ('label', 'div'):
+                if any('label' in c.lower() for c in classes):
+                    self._label.append([tag, tag.get_text(' ', strip=True), False, None])
+            if name in ('div', 'span', 'p'):
+                self._inline.append(tag)
+        self._inline_texts = None
+        self._strings = None
+
+    @classmethod
+    def _pattern(cls, keywords):
+        key = tuple(keywords)
+        pat = cls._pattern_cache.get(key)
+        if pat is None:
+            pat = re.compile('|'.join(f'(?:{kw})' for kw in keywords))
+            cls._pattern_cache[key] = pat
+        return pat
+
+    @staticmethod
+    def _sibling_value(entry, sibling_name):
+        # entry: [tag, label_text, resolved, value]
+        if not entry[2]:
+            sib = entry[0].find_next_sibling(sibling_name)
+            entry[3] = sib.get_text(' ', strip=True) if sib else None
+            entry[2] = True
+        return entry[3]
+
+    @staticmethod
+    def _data_value(entry):
+        if not entry[2]:
+            value = None
+            parent = entry[0].parent
+            if parent:
+                data_elem = parent.find(['div', 'span'], class_=re.compile(r'data', re.I))
+                if data_elem:
+                    value = data_elem.get_text(' ', strip=True)
+            entry[3] = value
+            entry[2] = True
+        return entry[3]
+
+    @staticmethod
+    def _acceptable(txt):
+        return bool(txt) and len(txt) < 200 and not any(skip in txt for skip in _VALUE_SKIP_WORDS)
+
+    def by_class(self, class_name):
+        """class 名を持つ要素を文書順で返す（soup.select('.xxx') と同じ結果）"""
+        return self._by_class.get(class_name, [])
+
+    @property
+    def inline_texts(self):
+        if self._inline_texts is None:
+            self._inline_texts = [tag.get_text(' ', strip=True) for tag in self._inline]
+        return self._inline_texts
+
+    @property
+    def strings(self):
+        """ページ全体の stripped_strings（フリガナ検索用）"""
+        if self._strings is None:
+            self._strings = list(self.soup.stripped_strings)
+        return self._strings
+
+    def lookup(self, keywords) -> Optional[str]:
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        pat = self._pattern(keywords)
+
+        # Priority 1: dt/dd pairs (most reliable structure)
+        for entry in self._dt:
+            if pat.search(entry[1]):
+                txt = self._sibling_value(entry, 'dd')
+                if self._acceptable(txt):
+                    return txt
+
+        # Priority 2: th/td pairs
+        for entry in self._th:
+            if pat.search(entry[1]):
+                txt = self._sibling_value(entry, 'td')
+                if self._acceptable(txt):
+                    return txt
+
+        # Priority 3: label elements (within .list or similar containers)
+        for entry in self._label:
+            if pat.search(entry[1]):
+                txt = self._data_value(entry)
+                if self._acceptable(txt):
+                    return txt
+
+        # Priority 4: label: value in same element
+        for full_text in self.inline_texts:
+            if pat.search(full_text):
+                parts = re.split(r'[：:]', full_text, maxsplit=1)
+                if len(parts) == 2 and len(parts[1].strip()) < 100:
+                    txt = parts[1].strip()
+                    if not any(skip in txt for skip in _INLINE_SKIP_WORDS):
+                        return txt
+
+        return None
 
 
 class EngageLogin:
@@ -69,7 +207,8 @@ class EngageLogin:
             options.add_argument('--log-level=3')  # Suppress DevTools listening message
             
             # print(f'[エンゲージRPA] Chromeブラウザを起動中...')
-            self.driver = webdriver.Chrome(options=options)
+            with stage('browser_start'):
+                self.driver = webdriver.Chrome(options=options)
             self.driver.implicitly_wait(10)
             # print(f'[エンゲージRPA] ✓ ブラウザ起動成功（アカウント: {self.account_name}）')
         except Exception as e:
@@ -122,6 +261,7 @@ class EngageLogin:
         try:
             if not self.driver:
                 return None
+            laps = StageLaps()
                 
             # print(f'[エンゲージRPA] 応募ページにアクセスします: {apply_url}')
             
@@ -268,6 +408,7 @@ class EngageLogin:
             
             else:
                 pass # print('[エンゲージRPA] すでにログイン済みです')
+            laps.lap('login')
             
             # 3. ページ状態を判断して適切な処理を実行
             # print('[エンゲージRPA] ページ状態を確認中...')
@@ -343,6 +484,7 @@ class EngageLogin:
             else:
                 print('⚠️  不明なページ状態です')
             
+            laps.lap('applicant_locate')
             # 4. 応募者情報を抽出
             # print('[エンゲージRPA] 応募者情報を抽出します...')
             detail = self._extract_applicant_detail()
@@ -530,9 +672,24 @@ class EngageLogin:
             print(f'[エンゲージRPA] ボタンクリック例外: {e}')
             return False
     
-    def _extract_applicant_detail(self) -> Optional[dict]:
-        """応募者詳細情報を抽出（プロフィールページから）"""
-        if not self.driver:
+    def _parse_page(self, html: str):
+        """page_source を解析する（同じHTMLなら前回の解析結果を再利用）"""
+        cached = getattr(self, '_page_cache', None)
+        if cached and cached[0] == html:
+            return cached[1], cached[2]
+        soup = make_soup(html)
+        index = _LabelIndex(soup)
+        self._page_cache = (html, soup, index)
+        return soup, index
+
+    @timed('detail_extract')
+    @profiled('scraper')
+    def _extract_applicant_detail(self, html: Optional[str] = None) -> Optional[dict]:
+        """応募者詳細情報を抽出（プロフィールページから）
+
+        html を渡した場合はブラウザを使わずにそのHTMLから抽出する（オフライン検証用）。
+        """
+        if html is None and not self.driver:
             return None
             
         detail = {}
@@ -540,61 +697,11 @@ class EngageLogin:
         try:
             # print('[エンゲージRPA] プロフィール情報を取得中...')
             
-            # 高速化のため、BeautifulSoupで一括解析する
-            html = self.driver.page_source
-            soup = BeautifulSoup(html, 'html.parser')
+            # 高速化のため、BeautifulSoupで一括解析し、ラベル→値の索引を1回だけ作る
+            if html is None:
+                html = self.driver.page_source
+            soup, index = self._parse_page(html)
             
-            # ヘルパー関数: BS4を使ったフィールド抽出
-            def get_text_bs4(soup, keywords):
-                if isinstance(keywords, str):
-                    keywords = [keywords]
-                regexes = [re.compile(kw) for kw in keywords]
-                
-                # Priority 1: dt/dd pairs (most reliable structure)
-                for dt in soup.find_all('dt'):
-                    label_text = dt.get_text(' ', strip=True)
-                    if any(r.search(label_text) for r in regexes):
-                        dd = dt.find_next_sibling('dd')
-                        if dd:
-                            txt = dd.get_text(' ', strip=True)
-                            if txt and len(txt) < 200 and not any(skip in txt for skip in ['求人を選択', '選択してください', 'IDで検索', 'プロフィール', 'メッセージ']):
-                                return txt
-                
-                # Priority 2: th/td pairs
-                for th in soup.find_all('th'):
-                    label_text = th.get_text(' ', strip=True)
-                    if any(r.search(label_text) for r in regexes):
-                        td = th.find_next_sibling('td')
-                        if td:
-                            txt = td.get_text(' ', strip=True)
-                            if txt and len(txt) < 200 and not any(skip in txt for skip in ['求人を選択', '選択してください', 'IDで検索', 'プロフィール', 'メッセージ']):
-                                return txt
-                
-                # Priority 3: label elements (within .list or similar containers)
-                for label in soup.find_all(['label', 'div'], class_=re.compile(r'label', re.I)):
-                    label_text = label.get_text(' ', strip=True)
-                    if any(r.search(label_text) for r in regexes):
-                        # Look for adjacent .data or similar
-                        parent = label.parent
-                        if parent:
-                            data_elem = parent.find(['div', 'span'], class_=re.compile(r'data', re.I))
-                            if data_elem:
-                                txt = data_elem.get_text(' ', strip=True)
-                                if txt and len(txt) < 200 and not any(skip in txt for skip in ['求人を選択', '選択してください', 'IDで検索', 'プロフィール', 'メッセージ']):
-                                    return txt
-                
-                # Priority 4: label: value in same element
-                for tag in soup.find_all(['div', 'span', 'p']):
-                    full_text = tag.get_text(' ', strip=True)
-                    if any(r.search(full_text) for r in regexes):
-                        parts = re.split(r'[：:]', full_text, maxsplit=1)
-                        if len(parts) == 2 and len(parts[1].strip()) < 100:
-                            txt = parts[1].strip()
-                            if not any(skip in txt for skip in ['求人を選択', '選択してください', 'IDで検索']):
-                                return txt
-
-                return None
-
             def sanitize_name(text: str) -> str:
                 if not text:
                     return ''
@@ -622,15 +729,12 @@ class EngageLogin:
 
             # 1. 氏名の取得
             # まずはテーブル内の「氏名」「名前」を探す
-            name_text = get_text_bs4(
-                soup,
-                ['氏名', 'お名前', '氏名（漢字）', r'氏名\s*\(漢字\)', '氏名（カナ）']
-            )
+            name_text = index.lookup(['氏名', 'お名前', '氏名（漢字）', r'氏名\s*\(漢字\)', '氏名（カナ）'])
             
             # 見つからない場合、ヘッダー領域を探す
             header_name_info = None
             if not name_text:
-                header_name_info = self._extract_name_from_header(soup)
+                header_name_info = self._extract_name_from_header(soup, index=index)
                 if header_name_info:
                     header_node, header_name, header_kana = header_name_info
                     if header_name and not name_text:
@@ -644,10 +748,7 @@ class EngageLogin:
                 detail['name'] = sanitize_name(name_text)
             
             # 2. フリガナ
-            furigana_text = get_text_bs4(
-                soup,
-                ['フリガナ', 'ふりがな', 'カナ', 'かな', '氏名（カナ）', r'氏名\s*\(カナ\)']
-            )
+            furigana_text = index.lookup(['フリガナ', 'ふりがな', 'カナ', 'かな', '氏名（カナ）', r'氏名\s*\(カナ\)'])
             if furigana_text:
                 detail['furigana'] = furigana_text
                 print(f'[DEBUG] フリガナ取得(table): {furigana_text}')
@@ -657,18 +758,18 @@ class EngageLogin:
                     detail['furigana'] = kana_from_header
                     print(f'[DEBUG] フリガナ取得(header_node): {kana_from_header}')
             if not detail.get('furigana') and detail.get('name'):
-                kana_from_doc = self._find_furigana_in_document(soup, detail.get('name'))
+                kana_from_doc = self._find_furigana_in_document(soup, detail.get('name'), strings=index.strings)
                 if kana_from_doc:
                     detail['furigana'] = kana_from_doc
                     print(f'[DEBUG] フリガナ取得(document): {kana_from_doc}')
 
             # 3. 性別
-            gender_text = get_text_bs4(soup, ['性別'])
+            gender_text = index.lookup(['性別'])
             if gender_text:
                 detail['gender'] = self._normalize_gender(gender_text)
             
             # 4. 年齢・生年月日
-            age_text = get_text_bs4(soup, ['年齢', '生年月日'])
+            age_text = index.lookup(['年齢', '生年月日'])
             if age_text:
                 detail['birth'] = age_text
                 # 年齢を抽出（括弧内の数字）
@@ -685,24 +786,24 @@ class EngageLogin:
                     detail['birth_date'] = f"{birth_match.group(1)}/{birth_match.group(2)}/{birth_match.group(3)}"
             
             # 5. 現住所
-            addr_text = get_text_bs4(soup, ['現住所', '住所', '居住地'])
+            addr_text = index.lookup(['現住所', '住所', '居住地'])
             if addr_text:
                 detail['addr'] = addr_text
                 detail['住所'] = addr_text
             
             # 6. 電話番号
-            tel_text = get_text_bs4(soup, ['電話番号', '携帯電話', '連絡先'])
+            tel_text = index.lookup(['電話番号', '携帯電話', '連絡先'])
             if tel_text:
                 detail['tel'] = tel_text
                 detail['電話番号'] = tel_text
             
             # 7. メールアドレス
-            email_text = get_text_bs4(soup, ['メールアドレス', 'Email', 'E-mail'])
+            email_text = index.lookup(['メールアドレス', 'Email', 'E-mail'])
             if email_text:
                 detail['email'] = email_text
             
             # 8. 最終学歴
-            school_text = get_text_bs4(soup, ['最終学歴', '学歴'])
+            school_text = index.lookup(['最終学歴', '学歴'])
             if school_text:
                 detail['school'] = school_text
                 detail['最終学歴'] = school_text
@@ -728,14 +829,15 @@ class EngageLogin:
             traceback.print_exc()
             return None
     
-    def _extract_job_title(self) -> str:
+    def _extract_job_title(self, html: Optional[str] = None) -> str:
         """求人タイトルを抽出"""
-        if not self.driver:
+        if html is None and not self.driver:
             return ''
         try:
-            # BS4で高速化
-            html = self.driver.page_source
-            soup = BeautifulSoup(html, 'html.parser')
+            # BS4で高速化（応募者情報の抽出時と同じページなら解析結果を再利用）
+            if html is None:
+                html = self.driver.page_source
+            soup, _ = self._parse_page(html)
             
             # 1. Look for text pattern "【...】へ応募しました" which contains the job title
             apply_pattern = soup.find(string=re.compile(r'【[^】]+】へ応募しました'))
@@ -799,13 +901,20 @@ class EngageLogin:
             pass
         return ''
 
-    def _extract_name_from_header(self, soup) -> Optional[Tuple[Optional[Tag], Optional[str], Optional[str]]]:
+    def _extract_name_from_header(self, soup, index=None) -> Optional[Tuple[Optional[Tag], Optional[str], Optional[str]]]:
         """Attempt to pull applicant name and kana from the avatar/header region."""
         if not soup:
             return None
 
+        def select_class(selector):
+            # 索引があれば class 名で引く（セレクタごとの全体走査を避ける）
+            if index is not None:
+                return index.by_class(selector[1:])
+            return soup.select(selector)
+
         # 1. Try specific structure from screenshot: .txtSet > .name / .kana
-        txt_set = soup.select_one('.txtSet')
+        txt_sets = select_class('.txtSet')
+        txt_set = txt_sets[0] if txt_sets else None
         if txt_set:
             name_node = txt_set.select_one('.name')
             kana_node = txt_set.select_one('.kana')
@@ -831,7 +940,7 @@ class EngageLogin:
 
         checked_nodes = set()
         for selector in header_selectors:
-            headers = soup.select(selector)
+            headers = select_class(selector)
             for header in headers:
                 if not isinstance(header, Tag):
                     continue
@@ -910,14 +1019,15 @@ class EngageLogin:
 
         return None
 
-    def _find_furigana_in_document(self, soup, name_text: Optional[str]) -> Optional[str]:
+    def _find_furigana_in_document(self, soup, name_text: Optional[str], strings=None) -> Optional[str]:
         """Fallback: search entire document for kana string located immediately before the name."""
         if not soup or not name_text:
             return None
         target_norm = self._norm(re.split(r'[（(]', name_text)[0])
         if not target_norm:
             return None
-        strings = list(soup.stripped_strings)
+        if strings is None:
+            strings = list(soup.stripped_strings)
         for idx, raw in enumerate(strings):
             raw_text = str(raw).strip()
             if not raw_text:
@@ -0,0 +1,52 @@
+"""
+Firestore REST の接続先とアクセストークン
+
+email_watcher / scheduled_dispatcher は Firestore を REST（requests）で直接呼んでいる。
+ここでは URL の組み立てとサービスアカウントのトークン取得をまとめ、
+FIRESTORE_EMULATOR_HOST が設定されていれば本番の代わりにローカルの Firestore
+（公式エミュレーターや bench/fake_firestore.py）へ向ける。
+
+    - エミュレーター使用時は http://{host}/v1 を使い、トークンは取得せず固定値 'owner' を送る
+      （エミュレーターはこの値を管理者として扱う）
+    - 未設定のときは従来どおり https://firestore.googleapis.com/v1 とサービスアカウントのトークン
+
+環境変数:
+    FIRESTORE_EMULATOR_HOST    ローカルの Firestore の host:port（例: 127.0.0.1:8080）
+"""
+
+import os
+
+FIRESTORE_SCOPES = ['https://www.googleapis.com/auth/datastore']
+
+
+def emulator_host() -> str:
+    return (os.environ.get('FIRESTORE_EMULATOR_HOST') or '').strip()
+
+
+def firestore_api() -> str:
+    """Firestore REST API のベース URL（末尾の / なし）"""
+    host = emulator_host()
+    if host:
+        if '://' not in host:
+            host = 'http://' + host
+        return host.rstrip('/') + '/v1'
+    return 'https://firestore.googleapis.com/v1'
+
+
+def documents_url(project: str) -> str:
+    """projects/{project}/databases/(default)/documents までの URL"""
+    return f'{firestore_api()}/projects/{project}/databases/(default)/documents'
+
+
+def service_account_token(sa: dict) -> str:
+    """サービスアカウント情報（service-account の JSON）からアクセストークンを取得する
+
+    取得に失敗した場合は例外をそのまま投げる（呼び出し側の try/except で処理する）。
+    """
+    if emulator_host():
+        return 'owner'
+    from google.oauth2 import service_account
+    from google.auth.transport.requests import Request
+    creds = service_account.Credentials.from_service_account_info(sa, scopes=FIRESTORE_SCOPES)
+    creds.refresh(Request())
+    return creds.token
@@ -0,0 +1,43 @@
+"""
+HTML 解析バックエンドの切り替え
+
+BeautifulSoup のパーサーを1か所で選ぶ。lxml がインストールされていれば lxml を使い、
+なければ標準の html.parser にフォールバックする。
+
+環境変数:
+    HTML_PARSER    lxml / html.parser を強制する（未指定なら自動選択）
+"""
+
+import os
+from typing import Optional
+
+from bs4 import BeautifulSoup
+
+SUPPORTED_PARSERS = ('lxml', 'html.parser')
+
+
+def _lxml_available() -> bool:
+    try:
+        import lxml  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _detect_parser() -> str:
+    forced = os.environ.get('HTML_PARSER', '').strip().lower()
+    if forced == 'html.parser':
+        return 'html.parser'
+    if _lxml_available():
+        return 'lxml'
+    if forced == 'lxml':
+        print('[HTML] lxml がインストールされていないため html.parser を使用します')
+    return 'html.parser'
+
+
+PARSER = _detect_parser()
+
+
+def make_soup(html: Optional[str], parser: Optional[str] = None) -> BeautifulSoup:
+    """HTML を解析して BeautifulSoup を返す。parser 未指定なら PARSER を使う。"""
+    return BeautifulSoup(html or '', parser or PARSER)
@@ -6,6 +6,8 @@ from selenium.common.exceptions import TimeoutException
 import json, time, os, re, unicodedata, datetime
 from selenium.webdriver.common.keys import Keys
 from typing import Optional
+from profiler import profiled
+from stage_metrics import StageLaps, stage, timed
 
 CONFIG_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'config', 'accounts.json'))
 
@@ -221,11 +223,13 @@ return 'NOT_FOUND';
         chrome_options.add_argument('--window-size=1400,900')
         chrome_options.add_experimental_option('excludeSwitches', ['enable-logging','enable-automation'])
         chrome_options.add_experimental_option('useAutomationExtension', False)
-        self.driver = webdriver.Chrome(options=chrome_options)
+        with stage('browser_start'):
+            self.driver = webdriver.Chrome(options=chrome_options)
 
     def login_and_goto(self, url, kyujin_title=None, oubo_no=None):
         import random
         d = self.driver
+        laps = StageLaps()
         d.get(url)
         self._wait(lambda x: x.execute_script("return document.readyState")=="complete", 30)
         self._maybe_switch_iframe()
@@ -244,6 +248,7 @@ return 'NOT_FOUND';
         time.sleep(random.uniform(0.2,0.8)); btn.click()
         self._wait(lambda x: 'login' not in x.current_url, 30)
         d.switch_to.default_content()
+        laps.lap('login')
 
         # 关闭弹窗
         self._close_ad_popup_buttons()
@@ -256,6 +261,7 @@ return 'NOT_FOUND';
         # 若给了筛选条件，直接查找并点击
         if kyujin_title and oubo_no:
             info = self.find_and_check_applicant(kyujin_title, oubo_no)
+            laps.lap('applicant_locate')
             if info:
                 # 若 find_and_check_applicant 已返回 detail，直接打印一次；否则兼容旧行为再抓一次
                 if isinstance(info, dict) and info.get("detail"):
@@ -406,6 +412,8 @@ return 'NOT_FOUND';
                 return None
 
     # ---------- 详情页采集 ----------
+    @timed('detail_extract')
+    @profiled('scraper')
     def _collect_and_check_detail(self, oubo_no_norm: str, expected_kyujin: Optional[str] = None):
         def pick(xps):
             """
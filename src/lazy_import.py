@@ -0,0 +1,51 @@
+"""
+重い依存モジュールの遅延 import
+
+requests / imaplib / smtplib / cProfile などは import だけで数十 ms かかり、
+scheduled_dispatcher のように一部の関数しか使わないプロセスでも起動時に払うことになる。
+
+    requests = lazy_module('requests')
+
+とモジュールの先頭で書いておくと、最初に属性（requests.post / requests.RequestException など）を
+使った時点で本物を import し、以降はそのモジュールの属性をそのまま返す。呼び出し側の書き方
+（`except requests.RequestException`、isinstance の判定など）は変えなくてよい。
+
+import 自体は importlib.import_module に任せるので、複数スレッドから同時に最初の属性を使っても
+import は1回だけ行われる。型注釈で使う場合は評価時に import されるので文字列にしておくこと。
+"""
+
+import importlib
+import sys
+
+
+class _LazyModule:
+    __slots__ = ('_name', '_module')
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            self._module = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+
+def lazy_module(name: str):
+    """name のモジュールを最初の属性アクセスで import する代理を返す（すでに import 済みなら本物を返す）"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return _LazyModule(name)
@@ -0,0 +1,194 @@
+"""
+処理済み通知メールの台帳（同じ通知で RPA・SMS を2回動かさないため）
+
+watch_mail は IMAP の \\Seen フラグだけで処理済みかどうかを判断していたため、
+Gmail で人が未読に戻した・フラグの不具合・転送で同じ通知が2通届いた、などの場合に
+同じ通知でブラウザを起動して SMS をもう一度送ってしまうことがあった。
+
+ここでは処理した通知を
+    - Message-ID（本文を取得する前、ヘッダーだけで判定）
+    - 解析結果のハッシュ（媒体 + アカウント名 / ID + 求人タイトル + URL + 元の Date ヘッダー。
+      転送などで Message-ID が変わった重複用。本文の解析後に判定）
+の2つのキーで記録し、次に同じ通知が来たら1回の参照で読み飛ばす。
+参照はメモリ上の LRU → ローカルの SQLite（logs/message_ledger.db）の順に行う。
+
+環境変数:
+    MESSAGE_LEDGER                  false で無効（従来どおり \\Seen だけで判断）
+    MESSAGE_LEDGER_DB               SQLite ファイル（既定 logs/message_ledger.db）
+    MESSAGE_LEDGER_MEMORY           メモリに保持する件数（既定 4096）
+    MESSAGE_LEDGER_RETENTION_DAYS   この日数より古い記録を消す（既定 60）
+    MESSAGE_LEDGER_RETRY_FAILED     false なら RPA が失敗した通知も処理済みとしてスキップする
+                                    （既定 true: 失敗した通知は未読に戻すと処理し直す）
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'message_ledger.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    key         TEXT PRIMARY KEY,
+    platform    TEXT,
+    account     TEXT,
+    outcome     TEXT NOT NULL,
+    first_seen  REAL NOT NULL,
+    last_seen   REAL NOT NULL
+);
+"""
+
+DISPATCHED = 'dispatched'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except Exception:
+        return int(default)
+
+
+def ledger_enabled() -> bool:
+    return os.environ.get('MESSAGE_LEDGER', 'true').lower() not in ('0', 'false', 'no')
+
+
+def message_id_key(message_id) -> Optional[str]:
+    """Message-ID ヘッダーからキーを作る（<> と前後の空白を除き小文字化）。なければ None。"""
+    mid = str(message_id or '').strip().strip('<>').strip().lower()
+    return f'mid:{mid}' if mid else None
+
+
+def content_key(platform: str, parsed: dict, date_header='') -> str:
+    """解析結果（と元の Date ヘッダー）から作るキー"""
+    parsed = parsed or {}
+    fields = [platform or '', str(date_header or '').strip()]
+    for name in ('account_name', 'account_id', 'job_title', 'url'):
+        fields.append(' '.join(str(parsed.get(name) or '').split()))
+    return 'sha:' + hashlib.sha256('\x1f'.join(fields).encode('utf-8')).hexdigest()[:40]
+
+
+class MessageLedger:
+    def __init__(self, path: str = DEFAULT_DB, memory_size: int = 4096, retention_days: int = 60):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._memory: 'OrderedDict[str, dict]' = OrderedDict()
+        self.memory_size = max(0, memory_size)
+        self.retry_failed = os.environ.get('MESSAGE_LEDGER_RETRY_FAILED', 'true').lower() not in ('0', 'false', 'no')
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'recorded': 0, 'skipped': 0}
+        if retention_days > 0:
+            with self._lock:
+                self._conn.execute('DELETE FROM messages WHERE last_seen < ?', (time.time() - retention_days * 86400,))
+
+    def _remember(self, key: str, entry: dict) -> None:
+        if not self.memory_size:
+            return
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _get(self, key: str) -> Optional[dict]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            self.counters['memory_hits'] += 1
+            return entry
+        row = self._conn.execute('SELECT platform, account, outcome, first_seen FROM messages WHERE key = ?',
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        entry = {'platform': row[0], 'account': row[1], 'outcome': row[2], 'first_seen': row[3]}
+        self._remember(key, entry)
+        self.counters['disk_hits'] += 1
+        return entry
+
+    def lookup(self, *keys) -> Optional[dict]:
+        """いずれかのキーが処理済みならその記録を返す（RPA 失敗で再処理する設定なら失敗分は None）"""
+        with self._lock:
+            for key in keys:
+                if not key:
+                    continue
+                entry = self._get(key)
+                if entry is None:
+                    continue
+                if self.retry_failed and entry['outcome'] == FAILED:
+                    continue
+                self.counters['skipped'] += 1
+                return dict(entry, key=key)
+            self.counters['misses'] += 1
+            return None
+
+    def record(self, keys: Iterable[Optional[str]], outcome: str = DISPATCHED, platform: str = '',
+               account: str = '') -> None:
+        now = time.time()
+        keys = [k for k in keys if k]
+        with self._lock:
+            for key in keys:
+                self._conn.execute(
+                    'INSERT INTO messages (key, platform, account, outcome, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET outcome = excluded.outcome, last_seen = excluded.last_seen',
+                    (key, platform, account, outcome, now, now))
+                cached = self._memory.get(key)
+                first_seen = cached['first_seen'] if cached else now
+                self._remember(key, {'platform': platform, 'account': account, 'outcome': outcome,
+                                     'first_seen': first_seen})
+            self.counters['recorded'] += len(keys)
+
+    def set_outcome(self, keys: Iterable[Optional[str]], outcome: str) -> None:
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if not key:
+                    continue
+                self._conn.execute('UPDATE messages SET outcome = ?, last_seen = ? WHERE key = ?', (outcome, now, key))
+                cached = self._memory.get(key)
+                if cached is not None:
+                    cached['outcome'] = outcome
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = dict(self._conn.execute('SELECT outcome, COUNT(*) FROM messages GROUP BY outcome').fetchall())
+            return {'path': self.path, 'memory': len(self._memory), 'outcomes': rows,
+                    'counters': dict(self.counters)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_message_ledger() -> Optional[MessageLedger]:
+    """共有の台帳（MESSAGE_LEDGER=false、または開けなかった場合は None）"""
+    global _ledger
+    if not ledger_enabled():
+        return None
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                try:
+                    _ledger = MessageLedger(os.environ.get('MESSAGE_LEDGER_DB') or DEFAULT_DB,
+                                            _env_int('MESSAGE_LEDGER_MEMORY', 4096),
+                                            _env_int('MESSAGE_LEDGER_RETENTION_DAYS', 60))
+                except Exception as e:
+                    print(f'[LEDGER] 処理済み台帳を開けませんでした（\\Seen だけで判断します）: {e}')
+                    return None
+    return _ledger
+
+
+def message_ledger_stats() -> dict:
+    return _ledger.stats() if _ledger is not None else {}
@@ -0,0 +1,293 @@
+"""
+応募通知メールの解析
+
+プラットフォームごとの通知形式（件名の判定 + 本文の解析）をレジストリに登録する。
+本文は事前コンパイルしたパターンで解析する（求人ボックス: ラベル位置を探して直後だけを照合、
+エンゲージ: 行単位の1回の走査）。MIME からの本文テキスト取り出しもここで共通化する。
+
+新しいサイトを追加する場合:
+    register_format(NotificationFormat('newsite', '新サイト', match_subject, parse_body))
+"""
+
+import email
+import re
+import unicodedata
+from typing import Callable, List, Optional
+
+
+# ============ 固定URL配置 ============
+# 求人ボックスのログインページURL（メールから取得しなくなったため固定）
+JOBBOX_LOGIN_URL = 'https://secure.kyujinbox.com/login'
+
+
+class NotificationFormat:
+    """通知メールの形式
+
+    platform: 'jobbox' / 'engage' などの識別子
+    label: ログ表示用の名前
+    match_subject(subject_raw, subject): 件名（デコード済み / NFKC 正規化済み）が対象なら True
+    parse_body(body): 本文テキストから項目の dict を返す
+    """
+
+    def __init__(self, platform: str, label: str,
+                 match_subject: Callable[[str, str], bool],
+                 parse_body: Callable[[str], dict]):
+        self.platform = platform
+        self.label = label
+        self.match_subject = match_subject
+        self.parse_body = parse_body
+
+
+FORMATS: List[NotificationFormat] = []
+
+
+def register_format(fmt: NotificationFormat) -> None:
+    """形式を登録する（同じ platform は置き換え）。件名判定は登録順に行う。"""
+    for i, existing in enumerate(FORMATS):
+        if existing.platform == fmt.platform:
+            FORMATS[i] = fmt
+            return
+    FORMATS.append(fmt)
+
+
+def get_format(platform: str) -> Optional[NotificationFormat]:
+    for fmt in FORMATS:
+        if fmt.platform == platform:
+            return fmt
+    return None
+
+
+def detect_format(subject_raw: str) -> Optional[NotificationFormat]:
+    """件名から通知形式を判定する。該当しなければ None。"""
+    subject = unicodedata.normalize('NFKC', subject_raw) if subject_raw else ''
+    for fmt in FORMATS:
+        try:
+            if fmt.match_subject(subject_raw or '', subject):
+                return fmt
+        except Exception:
+            continue
+    return None
+
+
+def parse_notification(platform: str, body: str) -> dict:
+    fmt = get_format(platform)
+    if fmt is None:
+        raise KeyError(f'unknown notification platform: {platform}')
+    return fmt.parse_body(body or '')
+
+
+# ---------- MIME ----------
+def fetch_payload_bytes(fetch_data) -> Optional[bytes]:
+    """imaplib の fetch 結果から最初の bytes ペイロードを取り出す"""
+    for part in fetch_data or []:
+        if isinstance(part, tuple) and len(part) > 1 and isinstance(part[1], (bytes, bytearray)):
+            return bytes(part[1])
+        if isinstance(part, (bytes, bytearray)):
+            return bytes(part)
+    return None
+
+
+def _decode_part(part) -> str:
+    payload = part.get_payload(decode=True)
+    if isinstance(payload, (bytes, bytearray)):
+        try:
+            return payload.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+        except Exception:
+            return payload.decode('utf-8', errors='ignore')
+    if isinstance(payload, str):
+        return payload
+    return ''
+
+
+def extract_text_body(raw: bytes) -> str:
+    """メール全体（bytes）から text/plain の本文を取り出す"""
+    msg = email.message_from_bytes(raw)
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_type() == 'text/plain':
+                return _decode_part(part)
+        return ''
+    return _decode_part(msg)
+
+
+# ---------- 求人ボックス ----------
+# 各ラベルの出現位置は str.find で探し、ラベル直後だけを事前コンパイルしたパターンで照合する。
+# 結果は従来の re.search(r'【?ラベル】?[:：\s]*\s*(...)', body) と同じ（最初に照合できた出現位置を採用）。
+_JOBBOX_FIELDS = [
+    ('account_name', ('アカウント名',), re.compile(r'】?[:：\s]*\s*(.+)')),
+    # アカウントID: 严格匹配 4位数字-4位数字 格式
+    ('account_id', ('アカウントID',), re.compile(r'】?[:：\s]*\s*(\d{4}-\d{4})')),
+    ('job_title', ('求人タイトル',), re.compile(r'】?[:：\s]*\s*(.+)')),
+    # 応募No.（支持多种格式: 応募No. / 応募No: / 【応募No.】）
+    ('oubo_no', ('応募No',), re.compile(r'.?】?[:：\s]*([A-Za-z0-9\-]+)')),
+    # 掲載企業名 / 企業名 / 掲載会社 等表示发布企业名的字段
+    ('employer_name', ('掲載企業名', '企業名', '掲載会社'), re.compile(r'】?[:：\s]*\s*(.+)')),
+]
+
+
+def _find_labeled_value(body: str, labels, tail) -> str:
+    start = 0
+    while True:
+        pos = -1
+        end = -1
+        for lab in labels:
+            i = body.find(lab, start)
+            if i >= 0 and (pos < 0 or i < pos):
+                pos = i
+                end = i + len(lab)
+        if pos < 0:
+            return ''
+        m = tail.match(body, end)
+        if m:
+            return m.group(1).strip()
+        start = pos + 1
+
+
+def parse_jobbox_body(body: str) -> dict:
+    found = {field: _find_labeled_value(body, labels, tail) for field, labels, tail in _JOBBOX_FIELDS}
+    return {
+        'account_name': found['account_name'],
+        'account_id': found['account_id'],
+        'job_title': found['job_title'],
+        'url': JOBBOX_LOGIN_URL,  # 使用固定URL
+        'oubo_no': found['oubo_no'],
+        'employer_name': found['employer_name'],
+    }
+
+
+def _match_jobbox_subject(subject_raw: str, subject: str) -> bool:
+    # 特征：新着応募のお知らせ，但不含要対応标签（要対応はエンゲージ邮件的特征）
+    return '新着応募のお知らせ' in subject and not _has_engage_marker(subject_raw, subject)
+
+
+# ---------- エンゲージ ----------
+_ENGAGE_MARKER = 'エンゲージ事務局です'
+_ENGAGE_JOB_LABEL = re.compile(r'【\s*応募職種\s*】\s*$')
+_ENGAGE_URL_LABEL = re.compile(r'【\s*応募内容の閲覧用URL\s*】\s*$')
+_ENGAGE_URL_HEAD = re.compile(r'https?://[^\s]+')
+_ENGAGE_MESSAGE_URL = re.compile(r'https://en-gage\.net/company/manage/message/\?apply_id=[A-Za-z0-9=]+')
+_ENGAGE_APPLY_ID = re.compile(r'apply_id=([A-Za-z0-9=]+)')
+_COMPANY_IN_LINE = re.compile(r'(?:株式会社|有限会社|合同会社|合資会社).+')
+_HEADER_PREFIXES = ('To:', 'From:', 'Date:', 'Subject:', '----------', '<')
+_COMPANY_WORDS = ['株式会社', '会社', '有限会社', '合同会社', '本社', '支社', '事業所']
+
+
+def parse_engage_body(body: str) -> dict:
+    """
+    解析エンゲージ的应募通知邮件正文
+    主题关键词: 【要対応】新着応募のお知らせ
+
+    邮件格式示例（可能是转发消息）:
+    ---------- Forwarded message ----------
+    From: エンゲージ事務局 <system@en-gage.net>
+    ...
+    株式会社 P.P/東京本社
+    上田 真義様
+
+    エンゲージ事務局です。
+    貴社の採用ページより応募がありました。
+
+    【 応募職種 】
+    【社会人経験なしでも高収入可】ゲームテスター...
+
+    【 応募内容の閲覧用URL 】
+    https://en-gage.net/company/manage/message/?apply_id=MTg0MTI0MzI=
+
+    返回提取的信息字典
+    """
+    result = {
+        'account_name': '',
+        'job_title': '',
+        'url': '',
+        'employer_name': ''
+    }
+
+    lines = body.split('\n')
+    engage_idx = -1
+    job_title = None
+    url = None
+    fallback_url = None
+    want_job_title = False   # 【応募職種】の行を見た → 次の空でない行が職種
+    want_url = False         # 【応募内容の閲覧用URL】の行を見た → 次の空でない行がURL
+
+    # 1回の走査で、事務局の行・応募職種・URL をまとめて探す
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped:
+            if want_job_title:
+                job_title = stripped
+                want_job_title = False
+            if want_url:
+                m = _ENGAGE_URL_HEAD.match(stripped)
+                if m:
+                    url = m.group(0)
+                want_url = False
+        if engage_idx < 0 and _ENGAGE_MARKER in line:
+            engage_idx = i
+        if fallback_url is None and 'en-gage.net' in line:
+            m = _ENGAGE_MESSAGE_URL.search(line)
+            if m:
+                fallback_url = m.group(0)
+        if '【' in line:
+            if job_title is None and '応募職種' in line and _ENGAGE_JOB_LABEL.search(line):
+                want_job_title = True
+            if url is None and '閲覧用URL' in line and _ENGAGE_URL_LABEL.search(line):
+                want_url = True
+
+    # アカウント名（"エンゲージ事務局です"之前的公司名）
+    # 方法1: 向上查找最近的包含公司名特征的行
+    if engage_idx > 0:
+        for i in range(engage_idx - 1, -1, -1):
+            line = lines[i].strip()
+            # 跳过空行和邮件头信息
+            if not line or line.startswith(_HEADER_PREFIXES) or '@' in line:
+                continue
+            # 如果包含"様"，跳过（这是收件人姓名）
+            if '様' in line:
+                continue
+            if any(kw in line for kw in _COMPANY_WORDS):
+                result['account_name'] = line
+                result['employer_name'] = line
+                break
+            # 如果这是一个普通文本行（非邮件头），也可能是公司名
+            elif len(line) > 2 and not line.startswith('-') and not line.startswith('='):
+                result['account_name'] = line
+                result['employer_name'] = line
+                break
+
+    # 方法2: 如果上面没找到，在"エンゲージ事務局です"之前查找包含"株式会社"等的行
+    if not result['account_name'] and engage_idx >= 0:
+        marker_line = lines[engage_idx]
+        before = lines[:engage_idx] + [marker_line[:marker_line.find(_ENGAGE_MARKER)]]
+        if engage_idx > 0 or before[-1]:
+            for line in before:
+                m = _COMPANY_IN_LINE.search(line)
+                if m:
+                    result['account_name'] = m.group(0).strip()
+                    result['employer_name'] = result['account_name']
+                    break
+
+    if job_title is not None:
+        result['job_title'] = job_title
+    result['url'] = url or fallback_url or ''
+
+    if result['url']:
+        # 从URL中提取apply_id作为oubo_no
+        m = _ENGAGE_APPLY_ID.search(result['url'])
+        if m:
+            result['oubo_no'] = m.group(1)
+
+    return result
+
+
+def _has_engage_marker(subject_raw: str, subject: str) -> bool:
+    # Detect Engage marker (brackets may normalize to ASCII, so check broadly)
+    return '要対応' in (subject_raw or '') or '要対応' in (subject or '')
+
+
+def _match_engage_subject(subject_raw: str, subject: str) -> bool:
+    return _has_engage_marker(subject_raw, subject) and '新着応募' in subject
+
+
+register_format(NotificationFormat('jobbox', '求人ボックス', _match_jobbox_subject, parse_jobbox_body))
+register_format(NotificationFormat('engage', 'エンゲージ', _match_engage_subject, parse_engage_body))
@@ -0,0 +1,450 @@
+"""
+送信の outbox（ローカルの SQLite / WAL。二重送信の防止と履歴の非同期書き込み）
+
+SMS・メールの送信は「送ってから記録する」だけだったため、
+    - 送信後、write_sms_history の前にプロセスが落ちると履歴が残らない
+    - 送信後、update_scheduled_task_status でタスクを消す前に落ちると、再起動後にもう一度送ってしまう
+という問題があった。ここでは送信ごとに冪等キー（uid + 応募No + チャネル + テンプレート）を決め、
+プロバイダを呼ぶ前に「送信中」、呼んだ後に「送信済 / 失敗」を SQLite に記録する。
+
+応募No がない送信（エンゲージの詳細など）は、送信先では代用しない（同じ応募者が再応募したときの送信を
+止めてしまうため）。代わりにその送信のもとになった通知・タスクの識別子（ref）を使う。
+    - watch_mail: 通知の内容キー（message_ledger.content_key）。rpa 段階が notification_scope(ref) で
+      スレッドに設定し、その中の guarded_send が使う
+    - 予約送信・一括メール: scheduled_tasks のタスク ID（guarded_send の ref 引数）
+応募No も ref もなければ記録せずにそのまま送る。
+
+    - 送信済のキーは送らずに前回の結果を返す（再起動後に同じタスクを処理しても二重送信しない）。
+      info['outbox'] == 'duplicate'（is_duplicate）になるので、呼び出し側は sms_history を書かない
+      （前回の送信で書いている。予約タスクの削除だけは行う）
+    - 送信中のまま残っているキー（送信中に落ちた）は、送れたかどうか分からないので既定では送り直さない
+    - 失敗のキーは送り直す
+    - OUTBOX_ASYNC_HISTORY=true なら sms_history の書き込みも outbox に積み、
+      バックグラウンドのスレッドが書き込む（落ちても再起動後に続きから書く。書き込み中に落ちた行は、
+      一定時間たってから書き込みスレッドが queued に戻して書き直す）
+
+環境変数:
+    OUTBOX                        false で無効（従来どおり記録なしで送る）
+    OUTBOX_DB                     SQLite ファイル（既定 logs/outbox.db）
+    OUTBOX_RESEND_INTERRUPTED     true なら送信中のまま残ったキーも送り直す（二重送信の可能性あり）
+    OUTBOX_ASYNC_HISTORY          true で sms_history の書き込みを非同期にする（既定 false）
+    OUTBOX_HISTORY_MAX_ATTEMPTS   履歴の書き込みを諦めるまでの回数（既定 5）
+    OUTBOX_RETENTION_DAYS         この日数より古い送信済・書込済の行を消す（既定 30）
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'outbox.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sends (
+    key         TEXT PRIMARY KEY,
+    uid         TEXT,
+    oubo_no     TEXT,
+    channel     TEXT,
+    template    TEXT,
+    recipient   TEXT,
+    state       TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    info        TEXT,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sends_state ON sends(state, updated_at);
+CREATE TABLE IF NOT EXISTS history (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid         TEXT NOT NULL,
+    doc         TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_state ON history(state, id);
+"""
+
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+# 送信済のキーで送らなかったときの info['outbox']
+DUPLICATE = 'duplicate'
+
+
+def _env_flag(name, default='false'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except Exception:
+        return int(default)
+
+
+def outbox_enabled() -> bool:
+    return os.environ.get('OUTBOX', 'true').lower() not in ('0', 'false', 'no')
+
+
+def history_async_enabled() -> bool:
+    return outbox_enabled() and _env_flag('OUTBOX_ASYNC_HISTORY')
+
+
+def make_key(uid, oubo_no, channel, template, *, ref='') -> Optional[str]:
+    """冪等キー。応募No がない場合は通知・タスクの識別子（ref）で代用し、どちらもなければ None"""
+    if oubo_no:
+        subject = str(oubo_no)
+    elif ref:
+        subject = f'ref:{ref}'
+    else:
+        return None
+    parts = [str(uid or ''), subject, str(channel or ''), str(template or '')]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()[:40]
+
+
+_scope = threading.local()
+
+
+@contextmanager
+def notification_scope(ref):
+    """この中の guarded_send で、応募No がないときに ref（通知の内容キーなど）を冪等キーに使う"""
+    prev = getattr(_scope, 'ref', None)
+    _scope.ref = ref
+    try:
+        yield
+    finally:
+        _scope.ref = prev
+
+
+def current_ref() -> Optional[str]:
+    return getattr(_scope, 'ref', None)
+
+
+def _dumps(info) -> str:
+    try:
+        return json.dumps(info if isinstance(info, dict) else {'note': str(info)}, ensure_ascii=False, default=str)
+    except Exception:
+        return json.dumps({'note': str(info)}, ensure_ascii=False)
+
+
+def _loads(text) -> dict:
+    try:
+        v = json.loads(text) if text else {}
+        return v if isinstance(v, dict) else {'note': str(v)}
+    except Exception:
+        return {'note': str(text)}
+
+
+class Outbox:
+    def __init__(self, path: str = DEFAULT_DB):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL: プロセスが落ちてもコミット済みの行は残る（OS ごと落ちた場合は直前の数件が失われ得る）
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        # 送信・履歴のスレッドから同時に数えるので、DB の _lock とは別のロックで守る（begin は _lock の中で数える）
+        self._counters_lock = threading.Lock()
+        self.resend_interrupted = _env_flag('OUTBOX_RESEND_INTERRUPTED')
+        # この秒数以上 writing のままの履歴は、書き込み中に落ちたものとして queued に戻す
+        self.stale_after = 300.0
+        self.counters = {'sent': 0, 'failed': 0, 'duplicates': 0, 'interrupted': 0, 'retries': 0, 'unguarded': 0}
+        self._writer: Optional['HistoryWriter'] = None
+        self._prune(_env_int('OUTBOX_RETENTION_DAYS', 30))
+        self._requeue_stale()
+
+    def _count(self, key):
+        with self._counters_lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def _prune(self, days: int) -> None:
+        if days <= 0:
+            return
+        cutoff = time.time() - days * 86400
+        with self._lock:
+            self._conn.execute('DELETE FROM sends WHERE state = ? AND updated_at < ?', (SENT, cutoff))
+            self._conn.execute("DELETE FROM history WHERE state = 'written' AND updated_at < ?", (cutoff,))
+
+    def _requeue_stale(self) -> int:
+        """書き込み中のまま残った履歴（書き込み中に落ちた）を queued に戻す。戻した件数を返す"""
+        with self._lock:
+            cur = self._conn.execute("UPDATE history SET state = 'queued' WHERE state = 'writing' AND updated_at < ?",
+                                     (time.time() - self.stale_after,))
+            return cur.rowcount
+
+    # --- 送信 -----------------------------------------------------------------
+
+    def begin(self, key, uid='', oubo_no='', channel='', template='', recipient='') -> Tuple[bool, Optional[dict]]:
+        """送信前に呼ぶ。(送ってよいか, 送らない場合に返す info) を返す。"""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                row = cur.execute('SELECT state, info FROM sends WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    cur.execute('INSERT INTO sends (key, uid, oubo_no, channel, template, recipient, state, attempts, '
+                                'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?)',
+                                (key, uid, oubo_no, channel, template, recipient, SENDING, now, now))
+                    cur.execute('COMMIT')
+                    return (True, None)
+                state, info = row
+                if state == SENT:
+                    cur.execute('COMMIT')
+                    self._count('duplicates')
+                    prev = _loads(info)
+                    prev['outbox'] = DUPLICATE
+                    return (False, prev)
+                if state == SENDING and not self.resend_interrupted:
+                    cur.execute('COMMIT')
+                    self._count('interrupted')
+                    return (False, {'note': 'previous attempt was interrupted; not resent (OUTBOX_RESEND_INTERRUPTED)',
+                                    'outbox': 'interrupted'})
+                cur.execute('UPDATE sends SET state = ?, attempts = attempts + 1, updated_at = ? WHERE key = ?',
+                            (SENDING, now, key))
+                cur.execute('COMMIT')
+                self._count('retries')
+                return (True, None)
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+
+    def finish(self, key, success: bool, info=None) -> None:
+        with self._lock:
+            self._conn.execute('UPDATE sends SET state = ?, info = ?, updated_at = ? WHERE key = ?',
+                               (SENT if success else FAILED, _dumps(info), time.time(), key))
+        self._count('sent' if success else 'failed')
+
+    def run(self, key, send: Callable[[], Tuple[bool, dict]], **meta) -> Tuple[bool, dict]:
+        """begin → send() → finish。送信済・送信中断のキーは send() を呼ばずに結果を返す。"""
+        proceed, prev = self.begin(key, **meta)
+        if not proceed:
+            return (prev.get('outbox') == DUPLICATE, prev)
+        try:
+            success, info = send()
+        except Exception as e:
+            self.finish(key, False, {'error': str(e)})
+            raise
+        if isinstance(info, dict) and info.get('note') == 'dry_run':
+            # DRY_RUN は送信済として残さない（後で実際に送るときに重複扱いにしない）
+            self.forget(key)
+        else:
+            self.finish(key, bool(success), info)
+        return (success, info)
+
+    def forget(self, key) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM sends WHERE key = ?', (key,))
+
+    def state_of(self, key) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT state FROM sends WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    # --- 履歴 -----------------------------------------------------------------
+
+    def enqueue_history(self, uid: str, doc: dict) -> int:
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO history (uid, doc, state, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                (uid, json.dumps(doc, ensure_ascii=False, default=str), now, now))
+            return cur.lastrowid
+
+    def queued_history(self, limit: int = 50) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, uid, doc, attempts FROM history WHERE state = 'queued' "
+                                      'ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [(r[0], r[1], json.loads(r[2]), r[3]) for r in rows]
+
+    def claim_history(self, limit: int = 50) -> list:
+        """書き込む履歴を取り出して writing にする（watch_mail と dispatcher が同じ DB を使っても二重に書かない）"""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                rows = cur.execute("SELECT id, uid, doc, attempts FROM history WHERE state = 'queued' "
+                                   'ORDER BY id LIMIT ?', (limit,)).fetchall()
+                cur.executemany("UPDATE history SET state = 'writing', updated_at = ? WHERE id = ?",
+                                [(now, r[0]) for r in rows])
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+        return [(r[0], r[1], json.loads(r[2]), r[3]) for r in rows]
+
+    def mark_history(self, row_id: int, ok: bool, error: str = '', give_up: bool = False) -> None:
+        state = 'written' if ok else ('failed' if give_up else 'queued')
+        with self._lock:
+            self._conn.execute('UPDATE history SET state = ?, attempts = attempts + 1, error = ?, updated_at = ? '
+                               'WHERE id = ?', (state, error or None, time.time(), row_id))
+
+    def start_history_writer(self, writer: Callable[[str, dict], bool]) -> 'HistoryWriter':
+        with self._lock:
+            if self._writer is None:
+                self._writer = HistoryWriter(self, writer)
+                self._writer.start()
+            return self._writer
+
+    def stats(self) -> dict:
+        with self._lock:
+            sends = dict(self._conn.execute('SELECT state, COUNT(*) FROM sends GROUP BY state').fetchall())
+            history = dict(self._conn.execute('SELECT state, COUNT(*) FROM history GROUP BY state').fetchall())
+        with self._counters_lock:
+            counters = dict(self.counters)
+        return {'path': self.path, 'sends': sends, 'history': history, 'counters': counters}
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.stop()
+        with self._lock:
+            self._conn.close()
+
+
+class HistoryWriter(threading.Thread):
+    """outbox に積まれた履歴を順に書き込むスレッド（失敗したら間隔を空けて再試行）"""
+
+    def __init__(self, outbox: Outbox, writer: Callable[[str, dict], bool]):
+        super().__init__(name='outbox-history', daemon=True)
+        self.outbox = outbox
+        self.writer = writer
+        self.max_attempts = _env_int('OUTBOX_HISTORY_MAX_ATTEMPTS', 5)
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._idle = threading.Event()
+
+    def notify(self) -> None:
+        self._idle.clear()
+        self._wake.set()
+
+    def run(self) -> None:
+        backoff = 1.0
+        while not self._stopping.is_set():
+            rows = self.outbox.claim_history()
+            if not rows:
+                # 起動の直前に落ちたプロセスの書き込み中の行は、起動時にはまだ新しくて戻せないので、ここで戻す
+                if self.outbox._requeue_stale():
+                    continue
+                self._idle.set()
+                self._wake.wait(5)
+                self._wake.clear()
+                continue
+            failed = False
+            for row_id, uid, doc, attempts in rows:
+                try:
+                    ok = bool(self.writer(uid, doc))
+                    err = '' if ok else 'write returned False'
+                except Exception as e:
+                    ok, err = False, str(e)
+                give_up = not ok and attempts + 1 >= self.max_attempts
+                self.outbox.mark_history(row_id, ok, err, give_up)
+                if give_up:
+                    print(f'[OUTBOX] 履歴の書き込みを諦めました (id={row_id}): {err}')
+                failed = failed or not ok
+            if failed:
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            else:
+                backoff = 1.0
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """積まれている履歴を書き終えるまで待つ"""
+        self.notify()
+        return self._idle.wait(timeout)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._wake.set()
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> Optional[Outbox]:
+    """共有の outbox（OUTBOX=false、または開けなかった場合は None）"""
+    global _outbox
+    if not outbox_enabled():
+        return None
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                try:
+                    _outbox = Outbox(os.environ.get('OUTBOX_DB') or DEFAULT_DB)
+                except Exception as e:
+                    print(f'[OUTBOX] outbox を開けませんでした（記録なしで送信します）: {e}')
+                    return None
+                atexit.register(_flush_on_exit)
+    return _outbox
+
+
+def _flush_on_exit() -> None:
+    ob = _outbox
+    if ob is not None and ob._writer is not None:
+        ob._writer.flush(5.0)
+
+
+def is_duplicate(info) -> bool:
+    """guarded_send の info が「送信済なので今回は送っていない」ことを示すか"""
+    return isinstance(info, dict) and info.get('outbox') == DUPLICATE
+
+
+def guarded_send(uid, oubo_no, channel, template, recipient, send: Callable[[], Tuple[bool, dict]], ref=None):
+    """冪等キーで二重送信を防いで send() を呼ぶ（outbox が使えない・キーを決められなければそのまま送る）
+
+    ref を省略すると notification_scope で設定された通知の識別子を使う。
+    """
+    ob = get_outbox()
+    if ob is None:
+        return send()
+    key = make_key(uid, oubo_no, channel, template, ref=ref if ref is not None else current_ref())
+    if key is None:
+        # 送信先だけで判定すると同じ応募者への別の送信を止めてしまうので、記録せずに送る
+        ob._count('unguarded')
+        return send()
+    return ob.run(key, send, uid=str(uid or ''), oubo_no=str(oubo_no or ''), channel=channel,
+                  template=str(template or ''), recipient=str(recipient or ''))
+
+
+def enqueue_history(uid: str, doc: dict, writer: Callable[[str, dict], bool]) -> bool:
+    """履歴を outbox に積み、バックグラウンドで writer(uid, doc) を呼ぶ。積めなければ False。"""
+    ob = get_outbox()
+    if ob is None:
+        return False
+    try:
+        ob.enqueue_history(uid, doc)
+    except Exception as e:
+        print(f'[OUTBOX] 履歴を積めませんでした: {e}')
+        return False
+    ob.start_history_writer(writer).notify()
+    return True
+
+
+def resume_history(writer: Callable[[str, dict], bool]) -> int:
+    """前回書き終わらなかった履歴があれば書き込みスレッドを起動する。残っている件数を返す。"""
+    if not history_async_enabled():
+        return 0
+    ob = get_outbox()
+    if ob is None:
+        return 0
+    n = len(ob.queued_history(limit=1000))
+    if n:
+        print(f'[OUTBOX] 未書込の履歴 {n}件 を書き込みます')
+        ob.start_history_writer(writer).notify()
+    return n
+
+
+def outbox_stats() -> dict:
+    return _outbox.stats() if _outbox is not None else {}
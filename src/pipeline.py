@@ -0,0 +1,434 @@
+"""
+段階ごとのワーカーと上限付きキューでつないだ処理パイプライン
+
+通知1通の処理を parse → resolve → rpa → record のような段階に分け、段階ごとにワーカー数と
+キューの上限を決めて動かす。ブラウザを使う遅い段階と、解析や Firestore の読み書きのような
+速い段階を別々に増減でき、どの段階が詰まっているかを stats() の稼働率とキュー長で見られる。
+
+- 段階の関数は item を受け取り、次の段階に渡す item を返す（None を返したらそこで終わり）
+- entry=True の段階は前の段階とつながず、submit(item, stage=名前) でだけ投入する別の入口になる
+  （rpa 段階から投入する record 段階など）。dropped は次の段階がある段階で None を返した件数
+- キューが上限に達していれば put は空くまで待つ（バックプレッシャー）。前の段階のワーカー、
+  最後は投入元（IMAP の監視スレッド）が止まるので、未処理の通知がメモリに溜まり続けない
+- key を指定した段階では、同じ key の item を投入順に1つずつ処理する（別の key はワーカー数まで並列）。
+  key ごとのキュー待ち時間（直近 / 最大 / 平均）を stats() の key_waits で見られる
+  （rpa 段階ならアカウントごと。直近に使った KEY_WAIT_STATS_MAX 個の key まで）
+- workers=0 の段階はキューを使わず、投入したスレッドでそのまま実行する
+- bind(fn, 段階名, item) を渡すと、item をキューに入れるときに投入側のスレッドで関数を包む
+  （stage_metrics.bind_context / tracing.bind_trace などで文脈を引き継ぐため）
+
+使い方:
+    pipeline = StagePipeline('watch', [
+        PipelineStage('parse', parse_fn, workers=2, capacity=50),
+        PipelineStage('rpa', rpa_fn, workers=3, capacity=100, key=lambda item: item['account']),
+        PipelineStage('record', record_fn, workers=2, capacity=200, entry=True),
+    ], on_finish=lambda item, outcome: ...)
+    pipeline.submit(item)
+    pipeline.submit(record, stage='record')   # rpa_fn の中から
+
+段階のワーカー数・キューの上限は stage_setting（PIPELINE_<段階>_WORKERS / PIPELINE_<段階>_QUEUE）で、
+ブラウザを使う段階の既定のワーカー数は default_browser_budget で決める:
+    RPA_MAX_BROWSERS      同時に起動するブラウザ数の上限（未指定なら CPU/メモリから算出）
+    RPA_BROWSER_MEM_MB    ブラウザ1つあたりの想定メモリ(MB)（既定 600）
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, List, Optional
+
+from sms_client import LatencyHistogram
+
+# キュー待ち・処理時間のヒストグラムの上限（ms）。解析の数 ms からブラウザ操作の数分までを見る
+PIPELINE_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000)
+
+# key ごとのキュー待ち時間を覚えておく key の数（古いものから捨てる）
+KEY_WAIT_STATS_MAX = 256
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+def stage_setting(stage: str, kind: str, default: int) -> int:
+    """PIPELINE_<STAGE>_<KIND>（例: PIPELINE_RPA_WORKERS / PIPELINE_PARSE_QUEUE）の値を返す"""
+    raw = os.environ.get(f'PIPELINE_{stage.upper()}_{kind.upper()}')
+    if raw is None or raw.strip() == '':
+        return default
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        return default
+
+
+DEFAULT_BROWSER_MEM_MB = 600
+
+
+def _total_memory_mb() -> Optional[int]:
+    """物理メモリ量(MB)を返す。取得できなければ None。"""
+    try:
+        if hasattr(os, 'sysconf'):
+            pages = os.sysconf('SC_PHYS_PAGES')
+            page_size = os.sysconf('SC_PAGE_SIZE')
+            if pages > 0 and page_size > 0:
+                return int(pages * page_size // (1024 * 1024))
+    except Exception:
+        pass
+    # Windows: GlobalMemoryStatusEx
+    try:
+        import ctypes
+
+        class _MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('sullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+
+        stat = _MEMORYSTATUSEX()
+        stat.dwLength = ctypes.sizeof(_MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(stat)):  # type: ignore[attr-defined]
+            return int(stat.ullTotalPhys // (1024 * 1024))
+    except Exception:
+        pass
+    return None
+
+
+def default_browser_budget() -> int:
+    """同時起動できるブラウザ数を決める。
+
+    RPA_MAX_BROWSERS が指定されていればそれを使う。
+    未指定の場合は CPU コア数と（物理メモリ / ブラウザ1つあたりのメモリ）の小さい方。
+    """
+    env = os.environ.get('RPA_MAX_BROWSERS')
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            pass
+    cpu = os.cpu_count() or 1
+    try:
+        per_browser = int(os.environ.get('RPA_BROWSER_MEM_MB', str(DEFAULT_BROWSER_MEM_MB)))
+    except ValueError:
+        per_browser = DEFAULT_BROWSER_MEM_MB
+    budget = cpu
+    total_mb = _total_memory_mb()
+    if total_mb and per_browser > 0:
+        budget = min(budget, total_mb // per_browser)
+    return max(1, int(budget))
+
+
+class PipelineStage:
+    """パイプラインの1段階（上限付きキュー + ワーカー）"""
+
+    def __init__(self, name: str, fn: Callable, workers: int = 1, capacity: int = 100,
+                 key: Optional[Callable] = None, entry: bool = False):
+        self.name = name
+        self.fn = fn
+        self.workers = max(0, int(workers))
+        self.capacity = max(1, int(capacity))
+        self.key = key
+        self.entry = entry
+        self.pipeline = None
+        self.next = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pending = {}        # key → deque[(投入時刻, item, 実行する関数)]
+        self._running = set()     # 実行中の key
+        self._ready = deque()     # 待ちの item があり、実行中でない key
+        self._threads = []
+        self._queued = 0
+        self._active = 0
+        self._stopped = False
+        self._started_at = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_queued = 0
+        self.blocked = 0
+        self.blocked_sec = 0.0
+        self.busy_sec = 0.0
+        self._key_waits = OrderedDict()   # key → [件数, 合計秒, 最大秒, 直近秒]（keyed の段階だけ）
+        self.wait_hist = LatencyHistogram(PIPELINE_BUCKETS_MS)
+        self.service_hist = LatencyHistogram(PIPELINE_BUCKETS_MS)
+
+    # ---------- 投入 ----------
+    def put(self, item, timeout: Optional[float] = None) -> bool:
+        """item をキューに入れる。満杯なら空くまで待ち、timeout を過ぎたら False を返す"""
+        if self.workers == 0:
+            run = self._bind(item)
+            with self._lock:
+                self._started_at = self._started_at or time.time()
+                self.submitted += 1
+                self._active += 1
+            try:
+                self._execute(item, run, 0.0)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+            return True
+        key = self.key(item) if self.key is not None else object()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError(f'pipeline stage {self.name} is stopped')
+            if self._queued >= self.capacity:
+                self.blocked += 1
+                t0 = time.time()
+                deadline = None if timeout is None else t0 + timeout
+                while self._queued >= self.capacity and not self._stopped:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.blocked_sec += time.time() - t0
+                        return False
+                    self._cond.wait(remaining)
+                self.blocked_sec += time.time() - t0
+                if self._stopped:
+                    raise RuntimeError(f'pipeline stage {self.name} is stopped')
+            # 文脈の引き継ぎは、キューに入れると決まってから行う（入れずに終わると引き継いだ分が残るため）
+            run = self._bind(item)
+            self._started_at = self._started_at or time.time()
+            jobs = self._pending.get(key)
+            if jobs is None:
+                jobs = self._pending[key] = deque()
+            jobs.append((time.time(), item, run))
+            if key not in self._running and len(jobs) == 1:
+                self._ready.append(key)
+            self._queued += 1
+            self.submitted += 1
+            if self._queued > self.max_queued:
+                self.max_queued = self._queued
+            self._ensure_workers()
+            self._cond.notify_all()
+        return True
+
+    def _bind(self, item):
+        return self.pipeline.bind(self._step, self.name, item) if self.pipeline is not None else self._step
+
+    def _ensure_workers(self):
+        # ワーカーは必要になった分だけ起動する
+        while len(self._threads) < self.workers and len(self._threads) < self._active + len(self._ready):
+            t = threading.Thread(target=self._worker_loop, name=f'{self.name}-{len(self._threads) + 1}', daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    # ---------- 実行 ----------
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopped:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                jobs = self._pending[key]
+                queued_at, item, run = jobs.popleft()
+                self._running.add(key)
+                self._queued -= 1
+                self._active += 1
+                waited = time.time() - queued_at
+                if self.key is not None:
+                    self._record_key_wait(key, waited)
+                # 空きを待っている投入側を起こす
+                self._cond.notify_all()
+            try:
+                self._execute(item, run, waited)
+            finally:
+                with self._cond:
+                    self._running.discard(key)
+                    self._active -= 1
+                    if jobs:
+                        # 同じ key の次の item は末尾に回して他の key と公平に扱う
+                        self._ready.append(key)
+                    else:
+                        del self._pending[key]
+                    self._cond.notify_all()
+
+    def _record_key_wait(self, key, waited: float) -> None:
+        # _lock を持って呼ぶ
+        w = self._key_waits.get(key)
+        if w is None:
+            w = self._key_waits[key] = [0, 0.0, 0.0, 0.0]
+            if len(self._key_waits) > KEY_WAIT_STATS_MAX:
+                self._key_waits.popitem(last=False)
+        else:
+            self._key_waits.move_to_end(key)
+        w[0] += 1
+        w[1] += waited
+        w[2] = max(w[2], waited)
+        w[3] = waited
+
+    def _execute(self, item, run, waited: float):
+        self.wait_hist.observe(waited * 1000)
+        try:
+            run(item)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f'[PIPELINE] {self.name} で例外が発生しました: {e}')
+            if self.pipeline is not None:
+                self.pipeline.finish(item, FAILED)
+
+    def _step(self, item):
+        # bind で包まれて実行されるので、次の段階への受け渡しも同じ文脈の中で行う
+        t0 = time.perf_counter()
+        try:
+            out = self.fn(item)
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.busy_sec += elapsed
+            self.service_hist.observe(elapsed * 1000)
+        with self._lock:
+            self.completed += 1
+            if out is None and self.next is not None:
+                self.dropped += 1
+        if self.pipeline is None:
+            return
+        if out is None or self.next is None:
+            self.pipeline.finish(out if out is not None else item, DONE)
+        else:
+            # 次の段階が満杯ならここで待つ（このワーカーも止まり、上流に詰まりが伝わる）
+            self.next.put(out)
+
+    # ---------- 参照 ----------
+    def idle(self) -> bool:
+        with self._lock:
+            return not self._queued and not self._active
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queued or self._active:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            elapsed = now - self._started_at if self._started_at else 0.0
+            # 稼働率 = 処理していた時間 / (ワーカー数 × 経過時間)。workers=0 は投入スレッド1本分として見る
+            capacity_sec = max(1, self.workers) * elapsed
+            return {
+                'name': self.name,
+                'workers': self.workers,
+                'threads': len(self._threads),
+                'capacity': self.capacity,
+                'keyed': self.key is not None,
+                'entry': self.entry,
+                'queued': self._queued,
+                'max_queued': self.max_queued,
+                'active': self._active,
+                'keys': len(self._pending),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+                'blocked_sec': round(self.blocked_sec, 3),
+                'busy_sec': round(self.busy_sec, 3),
+                'utilization': round(self.busy_sec / capacity_sec, 4) if capacity_sec > 0 else 0.0,
+                'wait': self.wait_hist.snapshot(),
+                'service': self.service_hist.snapshot(),
+                'key_waits': {_format_key(k): {'waited': w[0],
+                                               'wait_last_sec': round(w[3], 3),
+                                               'wait_max_sec': round(w[2], 3),
+                                               'wait_avg_sec': round(w[1] / w[0], 3)}
+                              for k, w in self._key_waits.items()},
+            }
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+def _format_key(key) -> str:
+    if isinstance(key, tuple):
+        return ':'.join(str(k) for k in key if k not in ('', None))
+    return str(key)
+
+
+class StagePipeline:
+    """PipelineStage を順につなぐ。段階の関数が返した item を次の段階のキューに入れる（entry の段階にはつながない）"""
+
+    def __init__(self, name: str, stages: List[PipelineStage], bind: Optional[Callable] = None,
+                 on_finish: Optional[Callable] = None):
+        self.name = name
+        self.stages = list(stages)
+        self._by_name = {}
+        self._bind = bind
+        self._on_finish = on_finish
+        for i, st in enumerate(self.stages):
+            st.pipeline = self
+            nxt = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            st.next = nxt if nxt is not None and not nxt.entry else None
+            self._by_name[st.name] = st
+        with _registry_lock:
+            _registry.append(self)
+
+    def stage(self, name: str) -> PipelineStage:
+        return self._by_name[name]
+
+    def submit(self, item, stage: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        """item を最初の段階（stage を指定したらその段階）に入れる。満杯なら空くまで待つ"""
+        st = self._by_name[stage] if stage else self.stages[0]
+        return st.put(item, timeout)
+
+    def bind(self, fn: Callable, stage_name: str, item) -> Callable:
+        if self._bind is None:
+            return fn
+        return self._bind(fn, stage_name, item)
+
+    def finish(self, item, outcome: str) -> None:
+        """item がパイプラインを出たとき（最後の段階を終えた / 途中で None / 例外）に呼ばれる"""
+        if self._on_finish is None:
+            return
+        try:
+            self._on_finish(item, outcome)
+        except Exception as e:
+            print(f'[PIPELINE] {self.name} の終了処理で例外が発生しました: {e}')
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """すべての段階が空になるまで待つ。タイムアウトしたら False"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            for st in self.stages:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                if not st.wait_idle(remaining):
+                    return False
+            # 後ろの段階を待っている間に前の段階へ投入されることがあるので、全部空か確かめ直す
+            if all(st.idle() for st in self.stages):
+                return True
+
+    def stats(self) -> dict:
+        return {'name': self.name, 'stages': [st.stats() for st in self.stages]}
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None) -> None:
+        if wait:
+            self.wait_idle(timeout)
+        for st in self.stages:
+            st.stop()
+
+
+_registry: List[StagePipeline] = []
+_registry_lock = threading.Lock()
+
+
+def pipeline_stats() -> list:
+    """作成済みのパイプラインごとの段階の統計"""
+    with _registry_lock:
+        pipelines = list(_registry)
+    return [p.stats() for p in pipelines]
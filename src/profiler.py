@@ -0,0 +1,386 @@
+"""
+必要なときだけ処理1回分をプロファイルする（再起動せずに本番のホットパスを調べるため）
+
+対象（kind）:
+    notification    watch_mail の通知1通（ヘッダー取得 〜 RPA ジョブの終了まで。ジョブは別スレッドでも続けて計測）
+    scheduled       process_scheduled_tasks_once / scheduled_dispatcher の1サイクル
+    scraper         応募者詳細ページ1枚の抽出（JobboxLogin._collect_and_check_detail / EngageLogin._extract_applicant_detail）
+
+起動のしかた（どれか1つ）:
+    - 環境変数 PROFILE=notification,scheduled（all で全部）。最初の PROFILE_RUNS 回（既定 1）を計測する
+    - シグナル: Linux / macOS は SIGUSR1、Windows は Ctrl+Break（SIGBREAK）で次の1回を計測する
+    - ファイル: logs/profiles/PROFILE_NEXT を置くと次の1回を計測する（中身に kind を書けばその種類だけ）。
+      Windows のサービス実行などシグナルを送れない場合用。使ったら消す
+
+結果は logs/profiles/ に
+    <日時>_<kind>_<label>.pstats   cProfile の結果（python -m pstats で開ける / snakeviz など）
+    <日時>_<kind>_<label>.txt      上位 PROFILE_TOP 件（累積時間順・関数自体の時間順）
+    <日時>_<kind>_<label>.folded   PROFILE_MODE=sample のときのスタック（flamegraph.pl / speedscope 用）
+を書き出す。
+
+環境変数:
+    PROFILE             計測する kind（カンマ区切り / all）
+    PROFILE_RUNS        PROFILE で計測する回数（既定 1）
+    PROFILE_MODE        cprofile（既定）/ sample（一定間隔でスタックを採る。オーバーヘッドが小さく、待ち時間も見える）
+    PROFILE_INTERVAL_MS sample の間隔（既定 5）
+    PROFILE_TOP         要約に出す件数（既定 40）
+    PROFILE_DIR         出力先（既定 logs/profiles）
+    PROFILE_SIGNAL_KINDS シグナル / ファイルで計測する kind（既定 all）
+"""
+
+import functools
+import io
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from lazy_import import lazy_module
+
+# 計測を予約したときだけ使うので、起動時には import しない
+cProfile = lazy_module('cProfile')
+pstats = lazy_module('pstats')
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'profiles')
+KINDS = ('notification', 'scheduled', 'scraper')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except Exception:
+        return int(default)
+
+
+def profile_dir() -> str:
+    return os.environ.get('PROFILE_DIR') or DEFAULT_DIR
+
+
+def _parse_kinds(raw: str):
+    kinds = [k.strip().lower() for k in (raw or '').split(',') if k.strip()]
+    return ['all'] if 'all' in kinds else [k for k in kinds if k in KINDS]
+
+
+# ---------- 計測の予約（環境変数・シグナル・ファイル） ----------
+_armed: Dict[str, int] = {}
+_armed_lock = threading.Lock()
+_next_file_check = 0.0
+
+
+def arm(kinds=None, runs: int = 1) -> None:
+    """次の runs 回を計測するよう予約する（kinds は None / 'all' で全部）"""
+    with _armed_lock:
+        for k in _parse_kinds(kinds) if isinstance(kinds, str) else (kinds or ['all']):
+            _armed[k] = _armed.get(k, 0) + runs
+
+
+def _check_trigger_file() -> None:
+    global _next_file_check
+    now = time.monotonic()
+    if now < _next_file_check:
+        return
+    _next_file_check = now + 2.0
+    path = os.path.join(profile_dir(), 'PROFILE_NEXT')
+    try:
+        with open(path, encoding='utf-8') as f:
+            content = f.read().strip()
+        os.remove(path)
+    except OSError:
+        return
+    arm(content or os.environ.get('PROFILE_SIGNAL_KINDS', 'all'))
+    print(f'[PROFILE] {path} を検出しました。次の処理1回をプロファイルします')
+
+
+def _take(kind: str) -> bool:
+    if not _armed:
+        _check_trigger_file()
+        if not _armed:
+            return False
+    with _armed_lock:
+        for k in (kind, 'all'):
+            if _armed.get(k, 0) > 0:
+                _armed[k] -= 1
+                if not _armed[k]:
+                    del _armed[k]
+                return True
+    return False
+
+
+def _give_back(kind: str) -> None:
+    with _armed_lock:
+        _armed[kind] = _armed.get(kind, 0) + 1
+
+
+def _on_signal(signum, frame):
+    arm(os.environ.get('PROFILE_SIGNAL_KINDS', 'all'))
+    print('[PROFILE] シグナルを受け取りました。次の処理1回をプロファイルします')
+
+
+def install_profile_signal() -> Optional[str]:
+    """SIGUSR1（Windows は SIGBREAK）で次の1回を計測するようにする。メインスレッドから呼ぶ。"""
+    sig = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+    if sig is None:
+        return None
+    try:
+        signal.signal(sig, _on_signal)
+    except (ValueError, OSError):
+        return None
+    return signal.Signals(sig).name
+
+
+if os.environ.get('PROFILE'):
+    arm(os.environ.get('PROFILE'), _env_int('PROFILE_RUNS', 1))
+
+
+# ---------- 計測1回分 ----------
+class _Sampler(threading.Thread):
+    """一定間隔で対象スレッドのスタックを採る（PROFILE_MODE=sample）"""
+
+    def __init__(self, run: 'ProfileRun', interval_s: float):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.run_ = run
+        self.interval_s = interval_s
+        self.stopping = threading.Event()
+
+    def run(self):
+        run = self.run_
+        while not self.stopping.wait(self.interval_s):
+            frames = sys._current_frames()
+            with run.lock:
+                threads = list(run.threads)
+            for tid in threads:
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if stack:
+                    with run.lock:
+                        run.folded[';'.join(reversed(stack))] += 1
+                        run.samples += 1
+
+
+class ProfileRun:
+    def __init__(self, kind: str, label: str = ''):
+        self.kind = kind
+        self.label = label
+        self.mode = 'sample' if os.environ.get('PROFILE_MODE', 'cprofile').lower() == 'sample' else 'cprofile'
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+        self.pending = 1
+        self.profilers = []
+        self.threads = set()
+        self.folded: Counter = Counter()
+        self.samples = 0
+        self.skipped_threads = 0
+        self.sampler = None
+        if self.mode == 'sample':
+            self.sampler = _Sampler(self, max(1, _env_int('PROFILE_INTERVAL_MS', 5)) / 1000.0)
+            self.sampler.start()
+
+    def attach(self):
+        """今のスレッドの計測を始める。戻り値は detach に渡す。"""
+        if self.mode == 'sample':
+            tid = threading.get_ident()
+            with self.lock:
+                self.threads.add(tid)
+            return tid
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Python 3.12 以降は同時に1つしか有効にできない（別スレッドで計測中）
+            with self.lock:
+                self.skipped_threads += 1
+            return None
+        return prof
+
+    def detach(self, handle) -> None:
+        if handle is None:
+            return
+        if self.mode == 'sample':
+            with self.lock:
+                self.threads.discard(handle)
+            return
+        handle.disable()
+        with self.lock:
+            self.profilers.append(handle)
+
+    def hold(self) -> None:
+        with self.lock:
+            self.pending += 1
+
+    def release(self) -> None:
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            self.dump()
+
+    def dump(self) -> Optional[str]:
+        wall = time.perf_counter() - self.t0
+        if self.sampler is not None:
+            self.sampler.stopping.set()
+            self.sampler.join(1.0)
+        out_dir = profile_dir()
+        os.makedirs(out_dir, exist_ok=True)
+        label = re.sub(r'[^\w.-]+', '_', self.label or '')[:40]
+        base = os.path.join(out_dir, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start))
+                            + f'_{self.kind}' + (f'_{label}' if label else ''))
+        top = _env_int('PROFILE_TOP', 40)
+        header = (f'kind={self.kind} label={self.label} mode={self.mode} wall={wall:.3f}s '
+                  f'started={time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start))}\n')
+        try:
+            if self.mode == 'sample':
+                summary = header + _sample_summary(self.folded, self.samples, top)
+                with open(base + '.folded', 'w', encoding='utf-8') as f:
+                    for stack, n in self.folded.most_common():
+                        f.write(f'{stack} {n}\n')
+            else:
+                if not self.profilers:
+                    return None
+                stats = pstats.Stats(self.profilers[0])
+                for p in self.profilers[1:]:
+                    stats.add(p)
+                stats.dump_stats(base + '.pstats')
+                buf = io.StringIO()
+                stats.stream = buf
+                buf.write(header)
+                if self.skipped_threads:
+                    buf.write(f'（別の計測中だったため {self.skipped_threads} スレッド分は含まれていません）\n')
+                buf.write('\n==== cumulative ====\n')
+                stats.sort_stats('cumulative').print_stats(top)
+                buf.write('\n==== tottime ====\n')
+                stats.sort_stats('tottime').print_stats(top)
+                summary = buf.getvalue()
+            with open(base + '.txt', 'w', encoding='utf-8') as f:
+                f.write(summary)
+        except Exception as e:
+            print(f'[PROFILE] 結果の書き出しに失敗しました: {e}')
+            return None
+        print(f'[PROFILE] {self.kind} {self.label} ({wall:.2f}s) → {base}.txt')
+        return base
+
+
+def _sample_summary(folded: Counter, samples: int, top: int) -> str:
+    self_counts: Counter = Counter()
+    incl: Counter = Counter()
+    for stack, n in folded.items():
+        frames = stack.split(';')
+        self_counts[frames[-1]] += n
+        for fr in set(frames):
+            incl[fr] += n
+    lines = [f'samples={samples}', '', '==== inclusive ====']
+    for fr, n in incl.most_common(top):
+        lines.append(f'{n:>8} {n / max(samples, 1):>6.1%}  {fr}')
+    lines += ['', '==== self ====']
+    for fr, n in self_counts.most_common(top):
+        lines.append(f'{n:>8} {n / max(samples, 1):>6.1%}  {fr}')
+    return '\n'.join(lines) + '\n'
+
+
+# ---------- 使う側の API ----------
+_tls = threading.local()
+
+
+def current_run() -> Optional[ProfileRun]:
+    return getattr(_tls, 'run', None)
+
+
+def begin_profile(kind: str, label: str = '') -> Optional[ProfileRun]:
+    """予約されていれば今のスレッドで計測を始める（前の計測がまだ開いていれば終える）"""
+    end_profile()
+    if not _take(kind):
+        return None
+    run = ProfileRun(kind, label)
+    _tls.run = run
+    _tls.handle = run.attach()
+    return run
+
+
+def end_profile() -> None:
+    run = getattr(_tls, 'run', None)
+    if run is None:
+        return
+    run.detach(getattr(_tls, 'handle', None))
+    _tls.run = None
+    _tls.handle = None
+    run.release()
+
+
+def discard_profile() -> None:
+    """対象外のメールなど、計測する必要がなかった場合（予約は次の1回に戻す）"""
+    run = getattr(_tls, 'run', None)
+    if run is None:
+        return
+    run.detach(getattr(_tls, 'handle', None))
+    _tls.run = None
+    _tls.handle = None
+    if run.sampler is not None:
+        run.sampler.stopping.set()
+    _give_back(run.kind)
+
+
+class profile_run:
+    """with profile_run('scheduled'): ... 予約されていればブロック1回分を計測する（計測中のスレッドでは何もしない）"""
+
+    __slots__ = ('kind', 'label', 'owned')
+
+    def __init__(self, kind: str, label: str = ''):
+        self.kind = kind
+        self.label = label
+        self.owned = False
+
+    def __enter__(self):
+        if getattr(_tls, 'run', None) is None:
+            self.owned = begin_profile(self.kind, self.label) is not None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.owned:
+            end_profile()
+        return False
+
+
+def profiled(kind: str):
+    """関数1回分を計測するデコレーター（予約されていなければそのまま呼ぶ）"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def _run(*args, **kwargs):
+            with profile_run(kind, fn.__name__):
+                return fn(*args, **kwargs)
+        return _run
+    return deco
+
+
+def bind_profile(fn):
+    """計測中の処理から別スレッドに渡すジョブを、同じ計測に含める
+
+    ジョブを渡した時点で今のスレッドの計測は止める（Python 3.12 以降の cProfile は同時に1つしか動かないため）。
+    """
+    run = getattr(_tls, 'run', None)
+    if run is None:
+        return fn
+    run.hold()
+    run.detach(getattr(_tls, 'handle', None))
+    _tls.handle = None
+
+    @functools.wraps(fn)
+    def _run(*args, **kwargs):
+        prev = (getattr(_tls, 'run', None), getattr(_tls, 'handle', None))
+        _tls.run = run
+        _tls.handle = run.attach()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            run.detach(_tls.handle)
+            _tls.run, _tls.handle = prev
+            run.release()
+
+    return _run
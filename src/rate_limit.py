@@ -0,0 +1,158 @@
+"""
+送信レート制限（トークンバケット）
+
+SMS はプロバイダ + apiId ごと、メールは送信元アドレスごとにバケットを1つ持ち、
+スレッド間（watch_mail の各スレッド・予約送信ワーカー・dispatcher の送信処理）で共有する。
+上限に達したら次のトークンが貯まるまで待ってから送る（バースト時に上限の速度で送る）。
+バケットは同じプロセス内で共有される（別プロセス間では共有しない）。
+
+環境変数（未設定なら制限なし）:
+    SMS_RATE_LIMIT      例: 5/s, 120/m（apiId ごと。api_settings の rateLimit があればそちらを優先）
+    SMS_RATE_BURST      連続して送れる件数（既定: 1秒分、最低 1）
+    SMTP_RATE_LIMIT     例: 20/m, 500/h（送信元アドレスごと）
+    SMTP_RATE_BURST
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+_UNITS = {'s': 1.0, 'sec': 1.0, 'm': 60.0, 'min': 60.0, 'h': 3600.0, 'hour': 3600.0, 'd': 86400.0, 'day': 86400.0}
+
+# これ以上待ったらログに出す（秒）
+LOG_WAIT_SECONDS = 1.0
+
+
+def parse_rate(spec) -> float:
+    """'5/s' / '120/m' / '500/h' / '5' を 1秒あたりの件数にする。未設定・不正なら 0（制限なし）。"""
+    if spec is None:
+        return 0.0
+    if isinstance(spec, (int, float)):
+        return max(0.0, float(spec))
+    s = str(spec).strip().lower()
+    if not s:
+        return 0.0
+    try:
+        if '/' in s:
+            count, unit = s.split('/', 1)
+            per = _UNITS.get(unit.strip())
+            if per is None:
+                return 0.0
+            return max(0.0, float(count) / per)
+        return max(0.0, float(s))
+    except ValueError:
+        return 0.0
+
+
+class TokenBucket:
+    """トークンバケット（rate: 1秒あたりの補充数、capacity: 最大トークン数）"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, name: str = ''):
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited_total = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def reserve(self, n: float = 1.0) -> float:
+        """トークンを予約し、使えるようになるまでの待ち秒数を返す（先に予約した順に送られる）"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= n
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            self.acquired += 1
+            self.waited_total += wait
+            self.last_wait = wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+            return wait
+
+    def acquire(self, n: float = 1.0) -> float:
+        """トークンが使えるまで待つ。待った秒数を返す。"""
+        wait = self.reserve(n)
+        if wait > 0:
+            if wait >= LOG_WAIT_SECONDS:
+                print(f'[RATE] {self.name}: 送信レート上限のため {wait:.1f}s 待機します')
+            time.sleep(wait)
+        return wait
+
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def snapshot(self) -> dict:
+        tokens = self.tokens()
+        return {
+            'name': self.name,
+            'rate_per_s': self.rate,
+            'capacity': self.capacity,
+            'tokens': round(tokens, 3),
+            # 今トークンを取った場合の待ち時間
+            'wait_s': round(max(0.0, (1 - tokens) / self.rate), 3),
+            'acquired': self.acquired,
+            'waited_total_s': round(self.waited_total, 3),
+            'max_wait_s': round(self.max_wait, 3),
+            'last_wait_s': round(self.last_wait, 3),
+        }
+
+
+_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(kind: str, key: str, rate_spec=None, burst=None) -> Optional[TokenBucket]:
+    """(kind, key) のバケットを返す。制限なしなら None。
+
+    rate_spec / burst を省略すると環境変数 {KIND}_RATE_LIMIT / {KIND}_RATE_BURST を使う。
+    設定が変わった場合はバケットを作り直す。
+    """
+    prefix = kind.upper()
+    if rate_spec is None:
+        rate_spec = os.environ.get(f'{prefix}_RATE_LIMIT')
+    rate = parse_rate(rate_spec)
+    if rate <= 0:
+        return None
+    if burst is None:
+        burst = os.environ.get(f'{prefix}_RATE_BURST')
+    try:
+        capacity = float(burst) if burst else None
+    except ValueError:
+        capacity = None
+    bucket_key = (kind, key or '')
+    with _buckets_lock:
+        bucket = _buckets.get(bucket_key)
+        if bucket is None or bucket.rate != rate or (capacity and bucket.capacity != capacity):
+            bucket = TokenBucket(rate, capacity, name=f'{kind}:{key}')
+            _buckets[bucket_key] = bucket
+        return bucket
+
+
+def acquire_sms(provider: str, api_id: Optional[str], rate_spec=None) -> float:
+    """SMS 1件分のトークンを待って取る（制限なしなら即 0）"""
+    bucket = get_bucket('sms', f'{provider}/{api_id or "-"}', rate_spec)
+    return bucket.acquire() if bucket else 0.0
+
+
+def acquire_smtp(sender: str) -> float:
+    """メール1通分のトークンを待って取る（送信元アドレスごと）"""
+    bucket = get_bucket('smtp', (sender or '').strip().lower())
+    return bucket.acquire() if bucket else 0.0
+
+
+def rate_limit_stats() -> list:
+    with _buckets_lock:
+        buckets = list(_buckets.values())
+    return [b.snapshot() for b in buckets]
@@ -0,0 +1,205 @@
+"""
+ターゲットセグメントの判定（インデックス版）
+
+セグメント（priority 順）を読み込み時に次の形にコンパイルしておき、応募者ごとの
+判定をセグメント数によらずほぼ定数時間で行う:
+
+    性別（男性 / 女性） → 年齢の区間（bisect） → 氏名種別ごとの最初に該当するセグメント
+
+各セグメントの nameTypes はビットマスクにし、区間ごとに「氏名種別ビット → priority が
+最も高い該当セグメント」を事前計算する。判定結果は _match_segment_conditions を
+priority 順に試した結果（最初に該当したセグメント）と同じ。
+
+    SegmentIndex(segments).find(detail)          1件
+    SegmentIndex(segments).classify_many(rows)   複数件（リプレイや一括処理用）
+"""
+
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Iterable, List, Optional
+
+NAME_TYPES = ('kanji', 'katakana', 'hiragana', 'alpha')
+NAME_TYPE_POS = {t: i for i, t in enumerate(NAME_TYPES)}
+NAME_TYPE_BITS = {t: 1 << i for i, t in enumerate(NAME_TYPES)}
+GENDERS = {'男性': ('male', 'maleMin', 'maleMax'), '女性': ('female', 'femaleMin', 'femaleMax')}
+
+
+def _detect_name_type(name):
+    """
+    Detect the type of name (kanji, katakana, hiragana, alpha).
+    Returns the primary type found.
+    """
+    if not name:
+        return 'alpha'
+
+    # Count different character types
+    kanji_count = 0
+    katakana_count = 0
+    hiragana_count = 0
+    alpha_count = 0
+
+    for char in name:
+        if '\u4e00' <= char <= '\u9fff':  # CJK Unified Ideographs (Kanji)
+            kanji_count += 1
+        elif '\u30a0' <= char <= '\u30ff':  # Katakana
+            katakana_count += 1
+        elif '\u3040' <= char <= '\u309f':  # Hiragana
+            hiragana_count += 1
+        elif char.isalpha():  # ASCII letters
+            alpha_count += 1
+
+    # Return the most common type
+    counts = {
+        'kanji': kanji_count,
+        'katakana': katakana_count,
+        'hiragana': hiragana_count,
+        'alpha': alpha_count
+    }
+
+    # counts.get may return Optional[int], which can confuse static type checkers
+    # Provide a key function that always returns int (default 0) to be explicit.
+    return max(counts, key=lambda k: counts.get(k, 0))
+
+
+@lru_cache(maxsize=4096)
+def name_type_of(name: str) -> str:
+    """_detect_name_type のキャッシュ付き版（同じ氏名が何度も判定されるため）"""
+    return _detect_name_type(name)
+
+
+class _GenderIndex:
+    """1つの性別について、年齢区間ごとに「氏名種別 → セグメント位置」を持つ"""
+
+    __slots__ = ('breaks', 'tables')
+
+    def __init__(self, ranges):
+        # ranges: [(position, name_mask, min_age, max_age)]（priority 順）
+        points = set()
+        for _, _, lo, hi in ranges:
+            if lo <= hi:
+                points.add(lo)
+                points.add(hi + 1)
+        self.breaks = sorted(points)
+        self.tables = []
+        # 区間 [breaks[i], breaks[i+1]) ごとに、氏名種別ビットごとの最初のセグメント
+        for i in range(len(self.breaks) - 1):
+            age = self.breaks[i]
+            table = [-1] * len(NAME_TYPES)
+            for pos, mask, lo, hi in ranges:
+                if not (lo <= age <= hi):
+                    continue
+                for bit in range(len(NAME_TYPES)):
+                    if table[bit] < 0 and mask & (1 << bit):
+                        table[bit] = pos
+            self.tables.append(tuple(table))
+
+    def lookup(self, age: int, bit: int) -> int:
+        # bit: NAME_TYPES での位置
+        i = bisect_right(self.breaks, age) - 1
+        if i < 0 or i >= len(self.tables):
+            return -1
+        return self.tables[i][bit]
+
+
+class SegmentIndex:
+    """priority 順のセグメント一覧をコンパイルしたもの"""
+
+    def __init__(self, segments: List[dict]):
+        self.segments = list(segments or [])
+        self._linear = False
+        per_gender = {g: [] for g in GENDERS}
+        for pos, segment in enumerate(self.segments):
+            conditions = segment.get('conditions') or {}
+            name_conditions = conditions.get('nameTypes', {})
+            mask = 0
+            for t in NAME_TYPES:
+                if name_conditions.get(t, False):
+                    mask |= NAME_TYPE_BITS[t]
+            gender_conditions = conditions.get('genders', {})
+            age_ranges = conditions.get('ageRanges', {})
+            for g, (key, min_key, max_key) in GENDERS.items():
+                if not gender_conditions.get(key, False):
+                    continue
+                lo = age_ranges.get(min_key, 0)
+                hi = age_ranges.get(max_key, 999)
+                if type(lo) is not int or type(hi) is not int:
+                    # 整数以外の境界は区間にできないので順に判定する
+                    self._linear = True
+                per_gender[g].append((pos, mask, lo, hi))
+        self._by_gender = {} if self._linear else {g: _GenderIndex(r) for g, r in per_gender.items()}
+
+    def __len__(self):
+        return len(self.segments)
+
+    def position(self, gender: str, age, name_type: str) -> int:
+        """(性別, 年齢, 氏名種別) に最初に該当するセグメントの位置。なければ -1。"""
+        if self._linear or type(age) is not int:
+            return self._position_linear(gender, age, name_type)
+        index = self._by_gender.get(gender)
+        bit = NAME_TYPE_POS.get(name_type)
+        if index is None or bit is None or not age:
+            return -1
+        return index.lookup(age, bit)
+
+    def find_position(self, applicant_detail: dict) -> int:
+        """応募者に最初に該当するセグメントの位置（priority 順）。なければ -1。"""
+        name = (applicant_detail.get('name') or '').strip()
+        gender = (applicant_detail.get('gender') or '').strip()
+        age = applicant_detail.get('age', 0)
+
+        # All three fields must be present
+        if not name or not gender or not age:
+            return -1
+        return self.position(gender, age, name_type_of(name))
+
+    def _position_linear(self, gender, age, name_type) -> int:
+        if gender not in GENDERS or not age:
+            return -1
+        key, min_key, max_key = GENDERS[gender]
+        for pos, segment in enumerate(self.segments):
+            conditions = segment.get('conditions') or {}
+            if not conditions.get('nameTypes', {}).get(name_type, False):
+                continue
+            if not conditions.get('genders', {}).get(key, False):
+                continue
+            age_ranges = conditions.get('ageRanges', {})
+            if age_ranges.get(min_key, 0) <= age <= age_ranges.get(max_key, 999):
+                return pos
+        return -1
+
+    def find(self, applicant_detail: dict) -> Optional[dict]:
+        pos = self.find_position(applicant_detail)
+        return self.segments[pos] if pos >= 0 else None
+
+    def classify_many(self, details: Iterable[dict]) -> List[Optional[dict]]:
+        """複数の応募者をまとめて判定する（details と同じ順に、該当セグメントまたは None）"""
+        segments = self.segments
+        results = []
+        for detail in details:
+            try:
+                pos = self.find_position(detail)
+            except Exception:
+                pos = -1
+            results.append(segments[pos] if pos >= 0 else None)
+        return results
+
+
+class SegmentList(list):
+    """_get_target_segments などが返すセグメント一覧（list のまま使える）
+
+    初回の判定時に SegmentIndex を作って保持する。読み込み後に一覧を変更しない前提。
+    """
+
+    _compiled = None
+
+    @property
+    def compiled(self) -> SegmentIndex:
+        if self._compiled is None:
+            self._compiled = SegmentIndex(self)
+        return self._compiled
+
+
+def get_segment_index(segments) -> SegmentIndex:
+    if isinstance(segments, SegmentList):
+        return segments.compiled
+    return SegmentIndex(segments)
@@ -0,0 +1,230 @@
+"""
+SMS プロバイダへの HTTP 送信（接続の再利用・再試行・レイテンシ計測）
+
+プロバイダ設定（送信先 URL + apiId）ごとに SmsHttpClient を1つ作り、requests.Session の
+コネクションプールを使い回す。接続 / 読み取りのタイムアウトを分けて指定し、
+5xx（560 を除く）と接続エラー・タイムアウトはジッター付き指数バックオフで再試行する。
+4xx は再試行しない。送信ごとのレイテンシはヒストグラムに記録する。
+
+環境変数:
+    SMS_PUBLISHER_CONNECT_TIMEOUT     接続タイムアウト秒（既定 5）
+    SMS_PUBLISHER_TIMEOUT             読み取りタイムアウト秒（既定 15）
+    SMS_HTTP_RETRIES                  再試行回数（既定 2）
+    SMS_HTTP_BACKOFF                  バックオフの基準秒（既定 0.5、上限 SMS_HTTP_BACKOFF_MAX=8）
+    SMS_HTTP_RETRY_READ_TIMEOUT       読み取りタイムアウトも再試行する（既定 false。
+                                      プロバイダ側で送信済みの可能性があり二重送信になり得るため）
+    SMS_HTTP_POOL_SIZE                1プロバイダあたりの最大接続数（既定 10）
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+from lazy_import import lazy_module
+
+requests = lazy_module('requests')
+
+# 560 は SMS PUBLISHER の「携帯番号不正」。番号を 81 形式に変えて送り直す側で扱う
+NO_RETRY_STATUSES = {560}
+
+# レイテンシヒストグラムの上限（ms）
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+def _env_flag(name, default='false'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+class LatencyHistogram:
+    """累積ヒストグラム（Prometheus の histogram と同じ形: bucket ごとの件数 + 合計 + 件数）"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後は +Inf
+        self.sum_ms = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, ms: float) -> None:
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum_ms += ms
+            self.count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+            sum_ms = self.sum_ms
+        cumulative = []
+        acc = 0
+        for le, n in zip(list(self.buckets) + ['+Inf'], counts):
+            acc += n
+            cumulative.append((le, acc))
+        return {'buckets': cumulative, 'count': total, 'sum_ms': round(sum_ms, 3)}
+
+    def quantile(self, q: float) -> Optional[float]:
+        """バケット上限で近似した分位点（ms）"""
+        snap = self.snapshot()
+        if not snap['count']:
+            return None
+        target = q * snap['count']
+        for le, acc in snap['buckets']:
+            if acc >= target:
+                return float('inf') if le == '+Inf' else float(le)
+        return None
+
+
+class SmsHttpClient:
+    """1つのプロバイダ設定に対応する HTTP クライアント"""
+
+    def __init__(self, name: str = 'sms', connect_timeout: Optional[float] = None,
+                 read_timeout: Optional[float] = None, retries: Optional[int] = None,
+                 backoff: Optional[float] = None, pool_size: Optional[int] = None):
+        self.name = name
+        self.connect_timeout = connect_timeout if connect_timeout is not None else _env_float('SMS_PUBLISHER_CONNECT_TIMEOUT', 5)
+        self.read_timeout = read_timeout if read_timeout is not None else _env_float('SMS_PUBLISHER_TIMEOUT', 15)
+        self.retries = retries if retries is not None else int(_env_float('SMS_HTTP_RETRIES', 2))
+        self.backoff = backoff if backoff is not None else _env_float('SMS_HTTP_BACKOFF', 0.5)
+        self.backoff_max = _env_float('SMS_HTTP_BACKOFF_MAX', 8)
+        self.retry_read_timeout = _env_flag('SMS_HTTP_RETRY_READ_TIMEOUT')
+        pool_size = pool_size or int(_env_float('SMS_HTTP_POOL_SIZE', 10))
+
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        # 再試行はこのクラスで行う（urllib3 側の再試行は使わない）
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.latency = LatencyHistogram()
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'attempts': 0, 'retries': 0, 'ok': 0,
+                         'http_4xx': 0, 'http_5xx': 0, 'timeout': 0, 'error': 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def _sleep_backoff(self, attempt: int, reason: str) -> None:
+        delay = min(self.backoff_max, self.backoff * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        print(f'[SMS] {self.name}: {reason} → {delay:.2f}s 後に再試行 ({attempt + 1}/{self.retries})')
+        self._count('retries')
+        time.sleep(delay)
+
+    def request(self, method: str, url: str, read_timeout: Optional[float] = None, **kwargs) -> 'requests.Response':
+        """HTTP リクエストを送る。再試行しても失敗した場合は最後の応答を返すか例外を送出する。"""
+        timeout = (self.connect_timeout, read_timeout if read_timeout is not None else self.read_timeout)
+        self._count('requests')
+        attempt = 0
+        while True:
+            self._count('attempts')
+            t0 = time.perf_counter()
+            try:
+                r = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectTimeout as e:
+                self._observe(t0, 'timeout')
+                if attempt < self.retries:
+                    self._sleep_backoff(attempt, f'接続タイムアウト ({e.__class__.__name__})')
+                    attempt += 1
+                    continue
+                raise
+            except requests.exceptions.Timeout as e:
+                # 読み取りタイムアウト: 送信済みの可能性があるので既定では再試行しない
+                self._observe(t0, 'timeout')
+                if self.retry_read_timeout and attempt < self.retries:
+                    self._sleep_backoff(attempt, f'読み取りタイムアウト ({e.__class__.__name__})')
+                    attempt += 1
+                    continue
+                raise
+            except requests.exceptions.ConnectionError as e:
+                self._observe(t0, 'error')
+                if attempt < self.retries:
+                    self._sleep_backoff(attempt, f'接続エラー ({e.__class__.__name__})')
+                    attempt += 1
+                    continue
+                raise
+            except requests.RequestException:
+                self._observe(t0, 'error')
+                raise
+
+            status = r.status_code
+            if 500 <= status < 600 and status not in NO_RETRY_STATUSES:
+                self._observe(t0, 'http_5xx')
+                if attempt < self.retries:
+                    self._sleep_backoff(attempt, f'HTTP {status}')
+                    attempt += 1
+                    continue
+                return r
+            self._observe(t0, 'ok' if status < 400 else ('http_4xx' if status < 500 else 'http_5xx'))
+            return r
+
+    def _observe(self, t0, outcome):
+        self.latency.observe((time.perf_counter() - t0) * 1000)
+        self._count(outcome)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        latency = self.latency.snapshot()
+        return {
+            'name': self.name,
+            'counters': counters,
+            'latency_ms': latency,
+            'p50_ms': self.latency.quantile(0.5),
+            'p95_ms': self.latency.quantile(0.95),
+        }
+
+    def close(self):
+        try:
+            self.session.close()
+        except Exception:
+            pass
+
+
+_clients: Dict[tuple, SmsHttpClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_sms_client(url: str, api_id: Optional[str] = None) -> SmsHttpClient:
+    """送信先 URL + apiId ごとのクライアントを返す（スレッド間で共有）"""
+    key = (url or '', api_id or '')
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            name = url or 'sms'
+            if api_id:
+                name = f'{name} ({api_id})'
+            client = SmsHttpClient(name=name)
+            _clients[key] = client
+    return client
+
+
+def sms_client_stats() -> list:
+    with _clients_lock:
+        clients = list(_clients.values())
+    return [c.stats() for c in clients]
+
+
+def reset_sms_clients() -> None:
+    with _clients_lock:
+        for c in _clients.values():
+            c.close()
+        _clients.clear()
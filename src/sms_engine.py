@@ -0,0 +1,359 @@
+"""
+SMS 送信エンジン（全送信経路で共通）
+
+即時送信（send_via_sms_publisher）・予約送信（send_sms_via_api）・dispatcher・
+送信テスト（send_sms_once）で別々に組み立てていたリクエストをここで1つにまとめる。
+
+    build_request(api_cfg, to_number, body)   プロバイダ設定から SmsRequest を組み立てる
+    send_sms(to_number, body, api_cfg)        組み立て → 送信 → 560 の場合は 81 形式で再送
+                                              戻り値は (success, info)
+
+SMS PUBLISHER のリクエスト:
+    - 送信先 URL: baseUrl にパスがあればそのまま、なければ baseUrl + path（既定 /send）
+    - 項目名: fieldTo / fieldMessage（既定 mobilenumber / smstext）
+    - 本文の & は ＆ に置き換える（プロバイダのサンプルに合わせる）
+    - 認証: auth=basic / bearer / params（params は username / password をフォームに含める）
+      auth 未指定なら apiId + apiPass → Basic、apiPass のみ → Bearer
+    - 本文: Bearer はJSON、それ以外はフォーム（method=GET ならクエリ）
+
+実際の送信はトランスポートが行う（http: sms_client のプール済みセッション + rate_limit /
+dry_run: 送信せずログのみ / log: sms_outbox.log に追記）。
+環境変数 SMS_TRANSPORT で選び、DRY_RUN_SMS=true なら dry_run になる。
+"""
+
+import base64
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+
+from lazy_import import lazy_module
+from rate_limit import acquire_sms
+from sms_client import LatencyHistogram, get_sms_client
+
+requests = lazy_module('requests')
+
+DEFAULT_FIELD_TO = 'mobilenumber'
+DEFAULT_FIELD_MESSAGE = 'smstext'
+INVALID_MOBILE_STATUS = 560
+
+
+class SmsRequest:
+    """組み立て済みの送信リクエスト"""
+
+    def __init__(self, provider, url, method='POST', headers=None, params=None, data=None,
+                 json_payload=None, field_to=DEFAULT_FIELD_TO, api_id=None, read_timeout=None,
+                 rate_limit=None):
+        self.provider = provider
+        self.url = url
+        self.method = method
+        self.headers = headers or {}
+        self.params = params or {}
+        self.data = data
+        self.json_payload = json_payload
+        self.field_to = field_to
+        self.api_id = api_id
+        self.read_timeout = read_timeout
+        self.rate_limit = rate_limit
+
+    def with_number(self, number: str) -> 'SmsRequest':
+        """送信先番号だけを差し替えたリクエスト（560 の再送用）"""
+        def _swap(d):
+            if not d or self.field_to not in d:
+                return d
+            d = dict(d)
+            d[self.field_to] = number
+            return d
+        return SmsRequest(self.provider, self.url, self.method, self.headers, _swap(self.params),
+                          _swap(self.data), _swap(self.json_payload), self.field_to, self.api_id,
+                          self.read_timeout, self.rate_limit)
+
+    def describe(self) -> dict:
+        return {
+            'url': self.url,
+            'method': self.method + (' (json)' if self.json_payload is not None else ' (form)'),
+            'headers': self.headers,
+            'params': self.params,
+            'data': self.json_payload if self.json_payload is not None else self.data,
+        }
+
+
+class SmsResponse:
+    def __init__(self, status_code: int, text: str = '', json_body=None):
+        self.status_code = status_code
+        self.text = text
+        self.json_body = json_body
+
+    def info(self) -> dict:
+        info = {'status_code': self.status_code, 'text': (self.text or '')[:2000]}
+        if self.json_body is not None:
+            info['json'] = self.json_body
+        return info
+
+
+# ---------- リクエストの組み立て ----------
+def to81FromLocal(number):
+    """Convert local Japanese number starting with 0 to international 81 format.
+
+    Examples:
+      09012345678 -> 819012345678
+      0312345678 -> 81312345678
+    Returns converted string or None if conversion not applicable.
+    """
+    if not number:
+        return None
+    s = re.sub(r"\D+", '', str(number))
+    if not s:
+        return None
+    # Already international with 81
+    if s.startswith('81'):
+        return s
+    # Local national format starting with 0
+    if s.startswith('0') and len(s) >= 9:
+        return '81' + s[1:]
+    # fallback: if starts with +81
+    if s.startswith('+81'):
+        return s.replace('+', '')
+    return None
+
+
+def resolve_url(base: str, path: Optional[str]) -> str:
+    # If base contains a non-root path, respect it as the full endpoint.
+    # Only append `path` when base is host/root only.
+    path = path or '/send'
+    try:
+        parsed = urlparse(base)
+        if parsed.path and parsed.path not in ('', '/'):
+            return base
+    except Exception:
+        pass
+    return base.rstrip('/') + (path if path.startswith('/') else '/' + path)
+
+
+def _basic_header(api_id, api_pass) -> str:
+    pair = f'{api_id}:{api_pass}'
+    return 'Basic ' + base64.b64encode(pair.encode('utf-8')).decode('ascii')
+
+
+def build_sms_publisher_request(api_cfg: dict, to_number, body) -> SmsRequest:
+    base = api_cfg.get('baseUrl') or os.environ.get('SMS_PUBLISHER_BASEURL')
+    if not base:
+        raise ValueError('no baseUrl')
+    api_id = api_cfg.get('apiId') or os.environ.get('SMS_PUBLISHER_APIID')
+    api_pass = api_cfg.get('apiPass') or os.environ.get('SMS_PUBLISHER_APIPASS')
+    method = (api_cfg.get('method') or os.environ.get('SMS_PUBLISHER_METHOD') or 'POST').upper()
+    path = api_cfg.get('path') or os.environ.get('SMS_PUBLISHER_PATH') or '/send'
+    auth_type = api_cfg.get('auth')
+    field_to = api_cfg.get('fieldTo') or os.environ.get('SMS_PUBLISHER_FIELD_TO') or DEFAULT_FIELD_TO
+    field_message = api_cfg.get('fieldMessage') or os.environ.get('SMS_PUBLISHER_FIELD_MESSAGE') or DEFAULT_FIELD_MESSAGE
+
+    headers = {
+        'Accept': 'application/json',
+        'User-Agent': 'sms-rpa/1.0',
+    }
+    # Replace ampersand in message to avoid form parsing issues (match example)
+    payload = {field_to: str(to_number), field_message: str(body).replace('&', '＆')}
+    use_json = False
+
+    if auth_type == 'basic' and api_id and api_pass:
+        headers['Authorization'] = _basic_header(api_id, api_pass)
+    elif auth_type == 'bearer' and api_pass:
+        headers['Authorization'] = f'Bearer {api_pass}'
+        use_json = True
+    elif auth_type == 'params' and api_id and api_pass:
+        payload['username'] = api_id
+        payload['password'] = api_pass
+    elif api_id and api_pass:
+        # prefer Basic auth when username+password available
+        headers['Authorization'] = _basic_header(api_id, api_pass)
+    elif api_pass:
+        headers['Authorization'] = f'Bearer {api_pass}'
+        use_json = True
+
+    req = SmsRequest('sms_publisher', resolve_url(base, path), method, headers,
+                     field_to=field_to, api_id=api_id, rate_limit=api_cfg.get('rateLimit'))
+    if method == 'GET':
+        req.params = payload
+    elif use_json:
+        req.json_payload = payload
+    else:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=UTF-8'
+        req.data = payload
+    return req
+
+
+# provider 名 → リクエストの組み立て関数
+PROVIDERS: Dict[str, Callable[[dict, str, str], SmsRequest]] = {
+    'sms_publisher': build_sms_publisher_request,
+}
+
+
+def build_request(api_cfg: dict, to_number, body, provider: Optional[str] = None) -> SmsRequest:
+    provider = provider or (api_cfg or {}).get('provider') or 'sms_publisher'
+    builder = PROVIDERS.get(provider)
+    if builder is None:
+        raise KeyError(f'unsupported provider: {provider}')
+    return builder(api_cfg or {}, to_number, body)
+
+
+# ---------- トランスポート ----------
+class HttpTransport:
+    """sms_client のプール済みセッションで送る（プロバイダ + apiId ごとのレート制限つき）"""
+
+    name = 'http'
+
+    def send(self, req: SmsRequest) -> SmsResponse:
+        acquire_sms(req.provider, req.api_id, req.rate_limit)
+        client = get_sms_client(req.url, req.api_id)
+        kwargs = {'headers': req.headers, 'params': req.params or None}
+        if req.json_payload is not None:
+            kwargs['json'] = req.json_payload
+        elif req.data is not None:
+            kwargs['data'] = req.data
+        r = client.request(req.method, req.url, read_timeout=req.read_timeout, **kwargs)
+        json_body = None
+        try:
+            json_body = r.json()
+        except Exception:
+            pass
+        return SmsResponse(r.status_code, r.text, json_body)
+
+
+class DryRunTransport:
+    """送信せずに成功として扱う"""
+
+    name = 'dry_run'
+
+    def send(self, req: SmsRequest) -> SmsResponse:
+        payload = req.json_payload if req.json_payload is not None else (req.data or req.params)
+        print(f"DRY_RUN_SMS enabled — would send to {payload.get(req.field_to)}: {payload}")
+        return SmsResponse(200, '', {'note': 'dry_run'})
+
+
+class LogTransport:
+    """sms_outbox.log に追記するだけ"""
+
+    name = 'log'
+
+    def __init__(self, path='sms_outbox.log'):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, req: SmsRequest) -> SmsResponse:
+        payload = req.json_payload if req.json_payload is not None else (req.data or req.params)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(f"{time.time()}\t{req.provider}\t{payload.get(req.field_to)}\t{payload}\n")
+        return SmsResponse(200, '', {'note': 'logged'})
+
+
+TRANSPORTS = {
+    'http': HttpTransport,
+    'dry_run': DryRunTransport,
+    'log': LogTransport,
+}
+
+_transport_override = None
+
+
+def set_transport(transport) -> None:
+    """トランスポートを差し替える（ベンチマーク・オフライン確認用）。None で環境変数に戻す。"""
+    global _transport_override
+    _transport_override = transport
+
+
+def get_transport():
+    if _transport_override is not None:
+        return _transport_override
+    if os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes'):
+        return TRANSPORTS['dry_run']()
+    name = (os.environ.get('SMS_TRANSPORT') or 'http').strip().lower()
+    return TRANSPORTS.get(name, HttpTransport)()
+
+
+# ---------- 送信 ----------
+class _EngineStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.latency = LatencyHistogram()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            'counters': counters,
+            'latency_ms': self.latency.snapshot(),
+            'p50_ms': self.latency.quantile(0.5),
+            'p95_ms': self.latency.quantile(0.95),
+        }
+
+
+_stats = _EngineStats()
+
+
+def sms_engine_stats() -> dict:
+    return _stats.snapshot()
+
+
+def send_request(req: SmsRequest, transport=None):
+    """組み立て済みリクエストを送る。戻り値は (success, info)"""
+    transport = transport or get_transport()
+    t0 = time.perf_counter()
+    try:
+        res = transport.send(req)
+        # If provider returns 560 (invalid mobile), try converting to 81-prefixed and retry once
+        if res.status_code == INVALID_MOBILE_STATUS:
+            payload = req.json_payload if req.json_payload is not None else (req.data or req.params)
+            try:
+                alt = to81FromLocal(str(payload.get(req.field_to)))
+            except Exception:
+                alt = None
+            if alt:
+                print('Retrying with 81 prefixed number:', alt)
+                _stats.count(f'{req.provider}.retry_81')
+                res = transport.send(req.with_number(alt))
+    except requests.RequestException as e:
+        _stats.latency.observe((time.perf_counter() - t0) * 1000)
+        _stats.count(f'{req.provider}.error')
+        print(f"Network error sending SMS via {req.provider}: {e}")
+        return (False, {'error': str(e)})
+    except Exception as e:
+        _stats.latency.observe((time.perf_counter() - t0) * 1000)
+        _stats.count(f'{req.provider}.error')
+        print(f"SMS send error ({req.provider}): {e}")
+        return (False, {'error': str(e)})
+
+    _stats.latency.observe((time.perf_counter() - t0) * 1000)
+    info = res.info()
+    if getattr(transport, 'name', '') == 'dry_run':
+        info['note'] = 'dry_run'
+    if 200 <= res.status_code < 300:
+        _stats.count(f'{req.provider}.sent')
+        return (True, info)
+    _stats.count(f'{req.provider}.failed')
+    return (False, info)
+
+
+def send_sms(to_number, body, api_cfg: dict, provider: Optional[str] = None, transport=None,
+             read_timeout: Optional[float] = None):
+    """プロバイダ設定に従って SMS を送る。戻り値は (success, info)"""
+    transport = transport or get_transport()
+    try:
+        req = build_request(api_cfg, to_number, body, provider)
+    except ValueError as e:
+        if getattr(transport, 'name', '') == 'dry_run':
+            print(f"DRY_RUN_SMS enabled — would send to {to_number}: {body}")
+            return (True, {'note': 'dry_run'})
+        print(f'SMS 設定エラー: {e}')
+        return (False, {'error': str(e)})
+    except KeyError as e:
+        return (False, {'error': str(e.args[0] if e.args else e)})
+    req.read_timeout = read_timeout
+    return send_request(req, transport=transport)
@@ -0,0 +1,231 @@
+"""
+SMTP 接続プール（送信元アドレスごとにログイン済みの接続を使い回す）
+
+send_mail_once はメール1通ごとに SMTP_SSL 接続 → EHLO → login をしていた。
+ここでは (ホスト, ポート, 送信元アドレス) ごとにログイン済みの接続を保持し、次の送信で再利用する。
+
+    - しばらく使っていない接続は NOOP で生存確認してから使う
+    - メッセージを渡す前（EHLO / MAIL FROM / RCPT TO）の 421（サービス停止）・切断・タイムアウトの場合は
+      接続し直して1回だけ送り直す。DATA を送り始めた後の失敗は、サーバーが受け取った可能性があるので
+      送り直さずに呼び出し元へ返す（二重送信を防ぐ。送り直すかどうかは outbox の記録で決まる）
+    - 1接続あたりの送信数が上限に達したら QUIT して新しい接続にする
+
+環境変数:
+    SMTP_POOL                     false で無効（毎回接続する従来の動作）
+    SMTP_POOL_SIZE                送信元ごとに保持する接続数（既定 2）
+    SMTP_MAX_MESSAGES_PER_CONN    1接続あたりの最大送信数（既定 50）
+    SMTP_POOL_IDLE_CHECK          この秒数以上使っていない接続は NOOP で確認する（既定 30）
+    SMTP_POOL_MAX_IDLE            この秒数以上使っていない接続は捨てる（既定 240）
+    EMAIL_SMTP_SSL                false で平文の SMTP（ローカルの疑似サーバー用。既定は SMTP_SSL）
+"""
+
+import atexit
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from lazy_import import lazy_module
+
+smtplib = lazy_module('smtplib')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except Exception:
+        return int(default)
+
+
+def pool_enabled() -> bool:
+    return os.environ.get('SMTP_POOL', 'true').lower() not in ('0', 'false', 'no')
+
+
+def _smtp_class():
+    if os.environ.get('EMAIL_SMTP_SSL', 'true').lower() in ('0', 'false', 'no'):
+        return smtplib.SMTP
+    return smtplib.SMTP_SSL
+
+
+class _Session:
+    __slots__ = ('smtp', 'created', 'last_used', 'messages')
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.messages = 0
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+def _is_reconnectable(e: Exception) -> bool:
+    """メッセージを渡す前の失敗のうち、接続し直せば送れるもの"""
+    if isinstance(e, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError)):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        # sendmail は全員が拒否されたときだけ投げる。全員 421 なら接続の問題
+        return bool(e.recipients) and all(code == 421 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421:
+        return True  # EHLO / MAIL FROM（SMTPSenderRefused）の 421
+    return False
+
+
+def _send_tracked(smtp, msg, from_addr, to_addrs, state: dict) -> None:
+    """send_message を呼び、DATA を送り始めたら state['data'] = True にする"""
+    send_data = smtp.data
+
+    def data(m):
+        state['data'] = True
+        return send_data(m)
+
+    smtp.data = data
+    try:
+        smtp.send_message(msg, from_addr=from_addr, to_addrs=to_addrs)
+    finally:
+        del smtp.data
+
+
+class SmtpPool:
+    def __init__(self, timeout: float = 20):
+        self.timeout = timeout
+        self.size = _env_int('SMTP_POOL_SIZE', 2)
+        self.max_messages = _env_int('SMTP_MAX_MESSAGES_PER_CONN', 50)
+        self.idle_check = _env_int('SMTP_POOL_IDLE_CHECK', 30)
+        self.max_idle = _env_int('SMTP_POOL_MAX_IDLE', 240)
+        self._idle: Dict[Tuple[str, int, str], List[_Session]] = {}
+        self._lock = threading.Lock()
+        self.counters = {'connects': 0, 'reuses': 0, 'noop_failed': 0, 'reconnects': 0,
+                         'rotated': 0, 'messages': 0, 'failed_after_data': 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def _connect(self, host, port, user, password, local_hostname) -> _Session:
+        smtp = _smtp_class()(host, port, timeout=self.timeout, local_hostname=local_hostname)
+        try:
+            smtp.login(user, password)
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+            raise
+        self._count('connects')
+        return _Session(smtp)
+
+    def _checkout(self, key, password, local_hostname) -> _Session:
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                session = idle.pop() if idle else None
+            if session is None:
+                return self._connect(key[0], key[1], key[2], password, local_hostname)
+            age = now - session.last_used
+            if age > self.max_idle:
+                session.close()
+                continue
+            if age > self.idle_check:
+                try:
+                    code = session.smtp.noop()[0]
+                except Exception:
+                    code = None
+                if code != 250:
+                    self._count('noop_failed')
+                    session.close()
+                    continue
+            self._count('reuses')
+            return session
+
+    def _checkin(self, key, session: _Session) -> None:
+        session.last_used = time.monotonic()
+        if session.messages >= self.max_messages:
+            self._count('rotated')
+            session.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(session)
+                return
+        session.close()
+
+    def send_message(self, host, port, user, password, msg, from_addr, to_addrs, local_hostname=None):
+        """プールの接続で1通送る。
+
+        DATA の前に 421 / 切断 / タイムアウトになったら接続し直して1回だけ送り直す。DATA を送り始めた後の
+        失敗は送り直さない（届いている可能性がある）。
+        """
+        key = (host, int(port), user)
+        session = self._checkout(key, password, local_hostname)
+        state = {'data': False}
+        try:
+            _send_tracked(session.smtp, msg, from_addr, to_addrs, state)
+        except Exception as e:
+            session.close()
+            if state['data']:
+                self._count('failed_after_data')
+                raise
+            if not _is_reconnectable(e):
+                raise
+            self._count('reconnects')
+            session = self._connect(host, port, user, password, local_hostname)
+            try:
+                session.smtp.send_message(msg, from_addr=from_addr, to_addrs=to_addrs)
+            except Exception:
+                session.close()
+                raise
+        session.messages += 1
+        self._count('messages')
+        self._checkin(key, session)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            idle = {f'{k[2]}@{k[0]}:{k[1]}': len(v) for k, v in self._idle.items()}
+        return {'counters': counters, 'idle': idle}
+
+    def close_all(self) -> None:
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for s in sessions:
+            s.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_smtp_pool() -> SmtpPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SmtpPool()
+                atexit.register(_pool.close_all)
+    return _pool
+
+
+def send_message(host, port, user, password, msg, from_addr, to_addrs, local_hostname=None, timeout=20):
+    """メールを送る（SMTP_POOL が有効なら接続を再利用する）"""
+    if pool_enabled():
+        get_smtp_pool().send_message(host, port, user, password, msg, from_addr, to_addrs, local_hostname)
+        return
+    with _smtp_class()(host, port, timeout=timeout, local_hostname=local_hostname) as s:
+        s.login(user, password)
+        s.send_message(msg, from_addr=from_addr, to_addrs=to_addrs)
+
+
+def smtp_pool_stats() -> dict:
+    return get_smtp_pool().stats() if _pool is not None else {'counters': {}, 'idle': {}}
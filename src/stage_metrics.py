@@ -0,0 +1,365 @@
+"""
+ウォッチャーの処理段階ごとの所要時間（Prometheus のテキスト形式で公開）
+
+通知が届いてから SMS が送られるまでのどこで時間がかかっているかを見るため、各段階を
+
+    imap_search / header_fetch / body_fetch / parse / account_lookup / browser_start / login /
+    applicant_locate（detail_extract を含む）/ detail_extract / segment_match / sms_send /
+    mail_send / memo_save / history_write
+
+の名前で計測し、段階 × 媒体（jobbox / engage）× UID ごとのヒストグラムにする。
+媒体と UID はスレッドごとの文脈（stage_context / bind_context）から付けるので、
+RPA ジョブの奥で呼ばれる送信・履歴書き込みにも引数を通さずにラベルが付く。
+
+METRICS_PORT を指定すると http://127.0.0.1:<port>/metrics で段階ごとのヒストグラムと、
+各モジュールの統計（sms_client / sms_engine / smtp_pool / rate_limit / outbox / message_ledger /
+pipeline / account_index / dispatch_policy / bulk_mail）を返す。
+
+環境変数:
+    METRICS_PORT        公開するポート（未設定なら HTTP サーバーは起動しない）
+    METRICS_HOST        待ち受けるアドレス（既定 127.0.0.1）
+    METRICS_UID_LABEL   false で UID ラベルを付けない（UID が多い場合）
+    STAGE_METRICS       false で計測しない
+
+使い方:
+    from stage_metrics import stage, timed, StageLaps, bind_context
+
+    with stage('body_fetch'):
+        ...
+    @timed('mail_send')
+    def send_mail_once(...): ...
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from sms_client import LatencyHistogram
+from tracing import begin_span, end_span, record_span
+
+STAGES = (
+    'imap_search', 'header_fetch', 'body_fetch', 'parse', 'account_lookup', 'browser_start', 'login',
+    'applicant_locate', 'detail_extract', 'segment_match', 'sms_send', 'mail_send', 'memo_save',
+    'history_write',
+)
+
+# ヒストグラムの上限（ms）。IMAP の数 ms からブラウザ操作の数分までを見る
+STAGE_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000)
+
+# /metrics に載せる各モジュールの統計（読み込み済みのモジュールだけ見る）
+COMPONENTS = (
+    ('sms_client', 'sms_client', 'sms_client_stats'),
+    ('sms_engine', 'sms_engine', 'sms_engine_stats'),
+    ('smtp_pool', 'smtp_pool', 'smtp_pool_stats'),
+    ('rate_limit', 'rate_limit', 'rate_limit_stats'),
+    ('outbox', 'outbox', 'outbox_stats'),
+    ('message_ledger', 'message_ledger', 'message_ledger_stats'),
+    ('pipeline', 'pipeline', 'pipeline_stats'),
+    ('account_index', 'account_index', 'account_index_stats'),
+    ('dispatch_policy', 'dispatch_policy', 'dispatch_policy_stats'),
+    ('bulk_mail', 'bulk_mail', 'bulk_mail_stats'),
+    ('tracing', 'tracing', 'tracing_stats'),
+)
+
+
+# 計測のたびに環境変数を読まないよう、読み込み時に決める
+_ENABLED = os.environ.get('STAGE_METRICS', 'true').lower() not in ('0', 'false', 'no')
+_UID_LABEL = os.environ.get('METRICS_UID_LABEL', 'true').lower() not in ('0', 'false', 'no')
+
+
+def metrics_enabled() -> bool:
+    return _ENABLED
+
+
+# ---------- 文脈（媒体 / UID） ----------
+_ctx = threading.local()
+
+
+def current_labels() -> Tuple[str, str]:
+    return getattr(_ctx, 'platform', ''), getattr(_ctx, 'uid', '')
+
+
+@contextmanager
+def stage_context(platform: Optional[str] = None, uid: Optional[str] = None):
+    """このスレッドで計測する段階に媒体 / UID を付ける（None は外側の値を引き継ぐ）"""
+    prev = current_labels()
+    _ctx.platform = prev[0] if platform is None else str(platform)
+    _ctx.uid = prev[1] if uid is None else str(uid)
+    try:
+        yield
+    finally:
+        _ctx.platform, _ctx.uid = prev
+
+
+def bind_context(fn, platform: Optional[str] = None, uid: Optional[str] = None):
+    """別スレッド（パイプラインの段階のワーカーなど）で実行される関数に、投入時の媒体 / UID を引き継ぐ
+
+    watcher.ingest._bind_stage が、通知をパイプラインの段階のキューに入れるときに使う。
+    """
+    cur_platform, cur_uid = current_labels()
+    platform = cur_platform if platform is None else platform
+    uid = cur_uid if uid is None else uid
+
+    @functools.wraps(fn)
+    def _run(*args, **kwargs):
+        with stage_context(platform, uid):
+            return fn(*args, **kwargs)
+
+    return _run
+
+
+# ---------- 計測 ----------
+class StageMetrics:
+    def __init__(self):
+        self._hist: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+        self._errors: Dict[Tuple[str, str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, platform, uid):
+        cur_platform, cur_uid = current_labels()
+        platform = cur_platform if platform is None else platform
+        uid = cur_uid if uid is None else uid
+        return (name, platform or '', (uid or '') if _UID_LABEL else '')
+
+    def observe(self, name: str, seconds: float, platform: Optional[str] = None, uid: Optional[str] = None,
+                error: bool = False) -> None:
+        key = self._key(name, platform, uid)
+        hist = self._hist.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._hist.setdefault(key, LatencyHistogram(STAGE_BUCKETS_MS))
+        hist.observe(seconds * 1000)
+        if error:
+            with self._lock:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            items = list(self._hist.items())
+            errors = dict(self._errors)
+        out = {}
+        for (name, platform, uid), hist in items:
+            snap = hist.snapshot()
+            snap['errors'] = errors.get((name, platform, uid), 0)
+            out[(name, platform, uid)] = snap
+        return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._hist.clear()
+            self._errors.clear()
+
+
+_metrics = StageMetrics()
+
+
+def observe(name: str, seconds: float, platform: Optional[str] = None, uid: Optional[str] = None,
+            error: bool = False) -> None:
+    if _ENABLED:
+        _metrics.observe(name, seconds, platform, uid, error)
+
+
+class stage:
+    """with ブロックの所要時間を段階 name として記録する（例外なら errors も数える）
+
+    トレース中のスレッドでは同じ名前のスパンも記録する（tracing.py）。
+    """
+
+    __slots__ = ('name', 'platform', 'uid', 't0', 'span')
+
+    def __init__(self, name: str, platform: Optional[str] = None, uid: Optional[str] = None):
+        self.name = name
+        self.platform = platform
+        self.uid = uid
+
+    def __enter__(self):
+        self.span = begin_span(self.name, {'platform': self.platform} if self.platform else None)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.t0, self.platform, self.uid, exc_type is not None)
+        end_span(self.span, exc)
+        return False
+
+
+def timed(name: str):
+    """関数の所要時間を段階 name として記録するデコレーター"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def _run(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return _run
+    return deco
+
+
+class StageLaps:
+    """順に進む処理を区切って計測する（lap を呼ぶたびに前回からの時間をその段階として記録）"""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+
+    def lap(self, name: str) -> float:
+        now = time.perf_counter()
+        seconds = now - self.t0
+        self.t0 = now
+        observe(name, seconds)
+        record_span(name, seconds)
+        return seconds
+
+
+def stage_metrics_stats() -> dict:
+    """段階ごとの件数・p50・p95（ms）。キーは 'stage/platform/uid'"""
+    out = {}
+    for (name, platform, uid), snap in _metrics.snapshot().items():
+        out[f'{name}/{platform or "-"}/{uid or "-"}'] = {
+            'count': snap['count'], 'sum_ms': snap['sum_ms'], 'errors': snap['errors'],
+            'p50_ms': _quantile(snap, 0.5), 'p95_ms': _quantile(snap, 0.95),
+        }
+    return out
+
+
+def _quantile(snap: dict, q: float) -> Optional[float]:
+    if not snap['count']:
+        return None
+    target = q * snap['count']
+    for le, acc in snap['buckets']:
+        if acc >= target:
+            return float('inf') if le == '+Inf' else float(le)
+    return None
+
+
+# ---------- Prometheus テキスト形式 ----------
+def _esc(v) -> str:
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**kw) -> str:
+    return '{' + ','.join(f'{k}="{_esc(v)}"' for k, v in kw.items()) + '}'
+
+
+def _le(le) -> str:
+    return '+Inf' if le == '+Inf' else repr(le / 1000.0)
+
+
+def _histogram_lines(name: str, snap: dict, labels: dict) -> list:
+    lines = []
+    for le, acc in snap['buckets']:
+        lines.append(f'{name}_bucket{_labels(**labels, le=_le(le))} {acc}')
+    lines.append(f'{name}_sum{_labels(**labels)} {snap["sum_ms"] / 1000.0}')
+    lines.append(f'{name}_count{_labels(**labels)} {snap["count"]}')
+    return lines
+
+
+def _is_histogram(v) -> bool:
+    return isinstance(v, dict) and 'buckets' in v and 'count' in v and 'sum_ms' in v
+
+
+def _flatten(component: str, item: str, path: str, value, gauges: list, hists: list) -> None:
+    if _is_histogram(value):
+        hists.append((component, item, path, value))
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(component, item, f'{path}.{k}' if path else str(k), v, gauges, hists)
+    elif isinstance(value, (list, tuple)):
+        for i, v in enumerate(value):
+            name = str(v.get('name') or v.get('key') or v.get('sender') or i) if isinstance(v, dict) else str(i)
+            _flatten(component, name if not item else f'{item}/{name}', path, v, gauges, hists)
+    elif isinstance(value, bool):
+        gauges.append((component, item, path, int(value)))
+    elif isinstance(value, (int, float)) and value == value and value not in (float('inf'), float('-inf')):
+        gauges.append((component, item, path, value))
+
+
+def render_metrics() -> str:
+    lines = [
+        '# HELP watcher_stage_duration_seconds ウォッチャーの処理段階ごとの所要時間',
+        '# TYPE watcher_stage_duration_seconds histogram',
+    ]
+    snaps = sorted(_metrics.snapshot().items())
+    for (name, platform, uid), snap in snaps:
+        lines += _histogram_lines('watcher_stage_duration_seconds', snap,
+                                  {'stage': name, 'platform': platform, 'uid': uid})
+    lines += ['# HELP watcher_stage_errors_total 例外で終わった段階の回数',
+              '# TYPE watcher_stage_errors_total counter']
+    for (name, platform, uid), snap in snaps:
+        lines.append(f'watcher_stage_errors_total{_labels(stage=name, platform=platform, uid=uid)} {snap["errors"]}')
+
+    gauges, hists = [], []
+    for component, module, func in COMPONENTS:
+        mod = sys.modules.get(module)
+        if mod is None or not hasattr(mod, func):
+            continue
+        try:
+            _flatten(component, '', '', getattr(mod, func)(), gauges, hists)
+        except Exception as e:
+            print(f'[METRICS] {component} の統計を取得できませんでした: {e}')
+    lines += ['# HELP watcher_component 各モジュールの統計値（カウンター・キュー長など）',
+              '# TYPE watcher_component gauge']
+    for component, item, key, value in gauges:
+        lines.append(f'watcher_component{_labels(component=component, item=item, key=key)} {value}')
+    lines += ['# HELP watcher_component_latency_seconds 各モジュールが計測したレイテンシ',
+              '# TYPE watcher_component_latency_seconds histogram']
+    for component, item, key, snap in hists:
+        lines += _histogram_lines('watcher_component_latency_seconds', snap,
+                                  {'component': component, 'item': item, 'key': key})
+    return '\n'.join(lines) + '\n'
+
+
+def _handler_class():
+    # http.server は METRICS_PORT を指定したときだけ使うので、ここで import する
+    from http.server import BaseHTTPRequestHandler
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = render_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Handler
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None):
+    """METRICS_PORT（または port）が指定されていれば /metrics を公開する。起動しなければ None。"""
+    global _server
+    if port is None:
+        raw = os.environ.get('METRICS_PORT', '').strip()
+        if not raw:
+            return None
+        try:
+            port = int(raw)
+        except ValueError:
+            print(f'[METRICS] METRICS_PORT が不正です: {raw}')
+            return None
+    host = host or os.environ.get('METRICS_HOST', '127.0.0.1')
+    with _server_lock:
+        if _server is not None:
+            return _server
+        try:
+            from http.server import ThreadingHTTPServer
+            _server = ThreadingHTTPServer((host, port), _handler_class())
+        except OSError as e:
+            print(f'[METRICS] http://{host}:{port}/metrics を開けませんでした: {e}')
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+        print(f'[METRICS] http://{host}:{_server.server_address[1]}/metrics で段階ごとの所要時間を公開しています')
+        return _server
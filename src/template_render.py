@@ -0,0 +1,143 @@
+"""
+テンプレートの差し込み（{{applicant_name}} などのトークン置換）
+
+テンプレート文字列ごとに1回だけ解析して「固定文字列 / トークン」の列にコンパイルし、
+テンプレート文字列をキーにキャッシュする。HTML かどうか（差し込む値をエスケープするか）
+もコンパイル時に決める。各トークンの同義語（applicant_name / name / 氏名 など）も
+参照するキーの並びとして事前に解決しておくので、差し込み時は dict を引くだけになる。
+
+    render_template(template, data)      1件分
+    render_many(template, rows)          同じテンプレートで複数件（予約送信の一括処理など）
+"""
+
+import html
+import re
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+# Support ASCII word chars plus Hiragana/Katakana/Kanji inside token keys
+TOKEN_RE = re.compile(r"{{\s*([a-zA-Z0-9_\u3040-\u30ff\u4e00-\u9fff]+)\s*}}")
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# (トークン名（小文字）の集合, 値を探すキーの順番)
+_SYNONYMS = [
+    # applicant name
+    (('applicant_name', 'applicant', 'name', '氏名'),
+     ('applicant_name', 'name', '氏名')),
+    # employer / poster company / 掲載企業名 / 企業名 / 会社名 (publishing company)
+    (('employer_name', 'employer', 'poster_company', '掲載企業名', '企業名', '会社名'),
+     ('employer_name', 'employer', 'poster_company', '企業名', '掲載企業名', '会社名')),
+    # job title / position / 求人タイトル / 職種
+    (('position', 'job_title', 'jobtitle', '求人タイトル', '職種'),
+     ('job_title', 'position', '求人タイトル', '職種')),
+    # company / account name / アカウント名 (account/recruiter name, distinct from 会社名)
+    (('company', 'account_name', 'accountname', 'アカウント名'),
+     ('company', 'account_name', 'accountname', 'アカウント名')),
+]
+_SYNONYM_KEYS = {name: keys for names, keys in _SYNONYMS for name in names}
+
+TEMPLATE_CACHE_SIZE = 256
+
+
+def _lookup_keys(token: str) -> Tuple[str, ...]:
+    keys = _SYNONYM_KEYS.get(token.lower())
+    if keys is not None:
+        return keys
+    # generic fallback
+    lower = token.lower()
+    return (token,) if lower == token else (token, lower)
+
+
+def _value(data: dict, keys: Tuple[str, ...]) -> str:
+    # 最初に空でない値を使う（None は空文字扱い）
+    for key in keys:
+        v = data.get(key)
+        if v is None:
+            continue
+        try:
+            s = v if isinstance(v, str) else str(v)
+        except Exception:
+            continue
+        if s:
+            return s
+    return ''
+
+
+class CompiledTemplate:
+    """コンパイル済みテンプレート
+
+    parts: 固定文字列（str）とトークン（参照キーの tuple）が交互に並んだリスト
+    is_html: テンプレートに HTML タグが含まれる（差し込む値を HTML エスケープする）
+    """
+
+    __slots__ = ('text', 'parts', 'is_html', 'tokens')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.is_html = bool(_HTML_TAG_RE.search(text))
+        parts: List[object] = []
+        tokens = []
+        pos = 0
+        for m in TOKEN_RE.finditer(text):
+            if m.start() > pos:
+                parts.append(text[pos:m.start()])
+            parts.append(_lookup_keys(m.group(1)))
+            tokens.append(m.group(1))
+            pos = m.end()
+        if pos < len(text):
+            parts.append(text[pos:])
+        self.parts = parts
+        self.tokens = tokens
+
+    def render(self, data: Optional[dict]) -> str:
+        if not self.tokens:
+            return self.text
+        data = data or {}
+        escape = self.is_html
+        out = []
+        for part in self.parts:
+            if part.__class__ is str:
+                out.append(part)
+            else:
+                val = _value(data, part)
+                out.append(html.escape(val) if escape and val else val)
+        return ''.join(out)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(template_text: str) -> CompiledTemplate:
+    """テンプレート文字列をコンパイルする（テンプレート文字列ごとにキャッシュ）"""
+    return CompiledTemplate(template_text)
+
+
+def render_template(template_text, data_map: Optional[dict]):
+    """Replace template tokens like {{applicant_name}}, {{job_title}}, {{company}}.
+
+    空のテンプレートはそのまま返す。テンプレートに HTML タグが含まれる場合、
+    差し込む値は HTML エスケープする。
+    """
+    if not template_text:
+        return template_text
+    text = str(template_text)
+    try:
+        return compile_template(text).render(data_map)
+    except Exception:
+        return text
+
+
+def render_many(template_text, rows: Iterable[Optional[dict]]) -> list:
+    """同じテンプレートを複数件の差し込みデータで展開する（rows と同じ順のリストを返す）"""
+    if not template_text:
+        return [template_text for _ in rows]
+    text = str(template_text)
+    try:
+        compiled = compile_template(text)
+    except Exception:
+        return [text for _ in rows]
+    results = []
+    for row in rows:
+        try:
+            results.append(compiled.render(row))
+        except Exception:
+            results.append(text)
+    return results
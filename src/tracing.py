@@ -0,0 +1,387 @@
+"""
+通知ごとのトレース（処理段階のスパンを JSONL で logs/ に書き出す）
+
+コンソールの print では遅い通知の原因を後から追えないため、通知1通 = 1トレースとして
+IMAP 取得・解析・RPA（アカウント検索・ブラウザ起動・ログイン・詳細抽出）・SMS / メール送信・
+履歴書き込みなどの各段階をスパン（親子関係・開始時刻・所要時間・属性）として記録する。
+
+    - スパンは stage_metrics.stage() / timed() / StageLaps が自動で作る（トレース中のスレッドだけ）
+    - パイプラインの各段階（parse / resolve / rpa / record）のワーカーで後から実行される処理は、
+      watcher.ingest._bind_stage がキューに入れるときに bind_trace で包み、同じトレースに続けて記録する
+      （スパン名は rpa_job / parse_job など。キューで待った時間は queue_wait_ms）
+    - トレースが終わった時点で残すかを決める: TRACE_SAMPLE の割合 + 遅い（TRACE_SLOW_MS 以上）/
+      例外があったトレースは必ず残す
+    - 書き込みは専用スレッドでまとめて行い（キューが一杯なら捨てて数える）、
+      TRACE_MAX_BYTES を超えたら traces.jsonl.1 … にローテーションする
+
+1行 = 1スパン:
+    {"ts": "...", "trace": "...", "span": "...", "parent": "...", "name": "login", "ms": 8123.4,
+     "thread": "...", "attrs": {...}, "error": "..."}
+
+環境変数:
+    TRACING             true で有効（既定 false）
+    TRACE_FILE          出力先（既定 logs/traces.jsonl）
+    TRACE_SAMPLE        残すトレースの割合 0〜1（既定 1.0）
+    TRACE_SLOW_MS       この時間以上かかったトレースは割合に関係なく残す（既定 60000）
+    TRACE_MAX_BYTES     ローテーションするサイズ（既定 20MB）
+    TRACE_BACKUPS       残す世代数（既定 5）
+    TRACE_MAX_SPANS     1トレースに記録するスパンの上限（既定 500）
+"""
+
+import atexit
+import datetime
+import functools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Optional
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'traces.jsonl')
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+# span を開くたびに環境変数を読まないよう、読み込み時に決める
+_ENABLED = os.environ.get('TRACING', 'false').lower() in ('1', 'true', 'yes')
+_SAMPLE = _env_float('TRACE_SAMPLE', 1.0)
+_SLOW_MS = _env_float('TRACE_SLOW_MS', 60000)
+_MAX_SPANS = int(_env_float('TRACE_MAX_SPANS', 500))
+
+_tls = threading.local()
+_counters = {'started': 0, 'kept': 0, 'kept_slow': 0, 'kept_error': 0, 'sampled_out': 0, 'discarded': 0,
+             'spans_truncated': 0, 'dropped': 0, 'written': 0, 'rotated': 0}
+_counters_lock = threading.Lock()
+
+
+def tracing_enabled() -> bool:
+    return _ENABLED
+
+
+def _count(key, n=1):
+    with _counters_lock:
+        _counters[key] += n
+
+
+def _new_id() -> str:
+    return os.urandom(8).hex()
+
+
+def _iso(ts: float) -> str:
+    return datetime.datetime.fromtimestamp(ts).isoformat(timespec='milliseconds')
+
+
+class Trace:
+    __slots__ = ('trace_id', 'root_id', 'name', 'attrs', 'spans', 'pending', 'error', 'discard',
+                 'start', 't0', 'lock')
+
+    def __init__(self, name: str, attrs: dict):
+        self.trace_id = _new_id()
+        self.root_id = _new_id()
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.pending = 1
+        self.error = False
+        self.discard = False
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, record: dict) -> None:
+        with self.lock:
+            if len(self.spans) < _MAX_SPANS:
+                self.spans.append(record)
+            else:
+                _count('spans_truncated')
+            if record.get('error'):
+                self.error = True
+
+    def release(self) -> None:
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            _finish(self)
+
+
+def _span_record(tr: Trace, span_id, parent_id, name, start, ms, attrs=None, error=None) -> dict:
+    rec = {'ts': _iso(start), 'trace': tr.trace_id, 'span': span_id, 'parent': parent_id, 'name': name,
+           'ms': round(ms, 3), 'thread': threading.current_thread().name}
+    if attrs:
+        rec['attrs'] = attrs
+    if error:
+        rec['error'] = error
+    return rec
+
+
+def _finish(tr: Trace) -> None:
+    total_ms = (time.perf_counter() - tr.t0) * 1000
+    if tr.discard:
+        _count('discarded')
+        return
+    if tr.error:
+        reason = 'error'
+    elif total_ms >= _SLOW_MS:
+        reason = 'slow'
+    elif random.random() < _SAMPLE:
+        reason = 'sampled'
+    else:
+        _count('sampled_out')
+        return
+    _count('kept')
+    if reason != 'sampled':
+        _count(f'kept_{reason}')
+    root = _span_record(tr, tr.root_id, None, tr.name, tr.start, total_ms, dict(tr.attrs, kept=reason))
+    get_trace_writer().put([root] + tr.spans)
+
+
+# ---------- トレースの開始・終了（スレッドごと） ----------
+def current_trace() -> Optional[Trace]:
+    return getattr(_tls, 'trace', None)
+
+
+def begin_trace(name: str, **attrs) -> Optional[Trace]:
+    """このスレッドで新しいトレースを始める（前のトレースがまだ開いていれば終える）"""
+    if not _ENABLED:
+        return None
+    end_trace()
+    tr = Trace(name, attrs)
+    _tls.trace = tr
+    _tls.stack = [tr.root_id]
+    _count('started')
+    return tr
+
+
+def end_trace() -> None:
+    """このスレッドのトレースを終える（bind_trace したジョブが残っていればその終了時に書き出す）"""
+    tr = getattr(_tls, 'trace', None)
+    if tr is None:
+        return
+    _tls.trace = None
+    _tls.stack = []
+    tr.release()
+
+
+def set_trace_attrs(**attrs) -> None:
+    tr = getattr(_tls, 'trace', None)
+    if tr is not None:
+        with tr.lock:
+            tr.attrs.update({k: v for k, v in attrs.items() if v is not None})
+
+
+def discard_trace() -> None:
+    """対象外のメールなど、書き出す必要のないトレースにする"""
+    tr = getattr(_tls, 'trace', None)
+    if tr is not None:
+        tr.discard = True
+        end_trace()
+
+
+# ---------- スパン ----------
+def begin_span(name: str, attrs: Optional[dict] = None):
+    """トレース中ならスパンを開いてトークンを返す（トレース外なら None。呼び出し側は end_span に渡すだけ）"""
+    tr = getattr(_tls, 'trace', None)
+    if tr is None:
+        return None
+    span_id = _new_id()
+    stack = _tls.stack
+    parent = stack[-1] if stack else tr.root_id
+    stack.append(span_id)
+    return (tr, span_id, parent, name, time.time(), time.perf_counter(), attrs)
+
+
+def end_span(token, error: Optional[BaseException] = None) -> None:
+    if token is None:
+        return
+    tr, span_id, parent, name, start, t0, attrs = token
+    stack = getattr(_tls, 'stack', None)
+    if stack and stack[-1] == span_id:
+        stack.pop()
+    err = f'{type(error).__name__}: {error}'[:300] if error is not None else None
+    tr.add(_span_record(tr, span_id, parent, name, start, (time.perf_counter() - t0) * 1000, attrs, err))
+
+
+def record_span(name: str, seconds: float, attrs: Optional[dict] = None) -> None:
+    """今終わった区間（StageLaps の lap など）を子スパンとして記録する"""
+    tr = getattr(_tls, 'trace', None)
+    if tr is None:
+        return
+    stack = getattr(_tls, 'stack', None)
+    parent = stack[-1] if stack else tr.root_id
+    tr.add(_span_record(tr, _new_id(), parent, name, time.time() - seconds, seconds * 1000, attrs))
+
+
+class span:
+    """with span('firestore_get', collection='jobbox_accounts'): ... （トレース外なら何もしない）"""
+
+    __slots__ = ('name', 'attrs', 'token')
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs or None
+
+    def __enter__(self):
+        self.token = begin_span(self.name, self.attrs)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end_span(self.token, exc)
+        return False
+
+
+def traced(name: str):
+    """関数の呼び出しをスパン name として記録するデコレーター（Firestore の読み込みなど、外部呼び出し用）"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def _run(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return _run
+    return deco
+
+
+def bind_trace(fn, name: str = 'rpa_job'):
+    """別スレッドで後から実行される関数を、今のトレースの子スパン name として記録する"""
+    tr = getattr(_tls, 'trace', None)
+    if tr is None:
+        return fn
+    stack = getattr(_tls, 'stack', None)
+    parent = stack[-1] if stack else tr.root_id
+    with tr.lock:
+        tr.pending += 1
+    bound_at = time.perf_counter()
+
+    @functools.wraps(fn)
+    def _run(*args, **kwargs):
+        prev = (getattr(_tls, 'trace', None), getattr(_tls, 'stack', None))
+        span_id = _new_id()
+        _tls.trace = tr
+        _tls.stack = [parent, span_id]
+        start, t0 = time.time(), time.perf_counter()
+        error = None
+        try:
+            return fn(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            err = f'{type(error).__name__}: {error}'[:300] if error is not None else None
+            tr.add(_span_record(tr, span_id, parent, name, start, (time.perf_counter() - t0) * 1000,
+                                {'queue_wait_ms': round((t0 - bound_at) * 1000, 1)}, err))
+            _tls.trace, _tls.stack = prev
+            tr.release()
+
+    return _run
+
+
+# ---------- 書き込み（専用スレッド + ローテーション） ----------
+class TraceWriter(threading.Thread):
+    def __init__(self, path: str, max_bytes: int, backups: int, max_queue: int = 10000):
+        super().__init__(name='trace-writer', daemon=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+
+    def put(self, records) -> None:
+        try:
+            self.queue.put_nowait(records)
+        except queue.Full:
+            _count('dropped', len(records))
+
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        _count('rotated')
+        self._open()
+
+    def _write(self, batch) -> None:
+        if self._file is None:
+            self._open()
+        n = 0
+        for records in batch:
+            for rec in records:
+                self._file.write(json.dumps(rec, ensure_ascii=False, default=str) + '\n')
+                n += 1
+        self._file.flush()
+        _count('written', n)
+        if self.max_bytes > 0 and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            batch = []
+            stop = item is None
+            if not stop:
+                batch.append(item)
+            # 溜まっている分はまとめて書く
+            while not stop:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    print(f'[TRACE] トレースの書き込みに失敗しました: {e}')
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def stop(self, timeout: float = 5.0) -> None:
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_trace_writer() -> TraceWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = TraceWriter(os.environ.get('TRACE_FILE') or DEFAULT_FILE,
+                                      int(_env_float('TRACE_MAX_BYTES', 20 * 1024 * 1024)),
+                                      int(_env_float('TRACE_BACKUPS', 5)))
+                _writer.start()
+                atexit.register(_writer.stop)
+    return _writer
+
+
+def tracing_stats() -> dict:
+    with _counters_lock:
+        counters = dict(_counters)
+    return {'enabled': _ENABLED, 'sample': _SAMPLE, 'slow_ms': _SLOW_MS, 'counters': counters,
+            'queue': _writer.queue.qsize() if _writer is not None else 0}
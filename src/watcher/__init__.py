@@ -0,0 +1,56 @@
+"""
+メール監視（email_watcher）の本体
+
+src/email_watcher.py は起動スクリプト（main）と互換用の窓口だけを持ち、処理は次のモジュールに分けている。
+
+    watcher.parse      通知・応募者情報の解釈（件名デコード、電話番号の正規化、年齢計算、
+                       テンプレート差し込み、セグメント条件の判定）。ネットワークは使わない
+    watcher.firestore  Firestore REST の読み書き（各種設定、セグメント、sms_history、scheduled_tasks）
+    watcher.send       SMS / メールの送信と、セグメントに応じた自動返信（即時・予約の振り分け）
+    watcher.rpa        求人ボックス / エンゲージの管理画面操作（selenium は最初の RPA ジョブで読み込む）
+    watcher.schedule   予約タスクの実行（scheduled_task_worker）
+    watcher.ingest     IMAP の監視と通知ごとの処理（watch_mail）
+
+どのモジュールも import 時には requests / imaplib / selenium を読み込まない（lazy_import.lazy_module で
+最初の使用時に読み込む）。scheduled_dispatcher のように一部の関数だけ使うプロセスは、必要なモジュール
+だけを import すればよい。
+
+`import email_watcher` 経由の `email_watcher.write_sms_history` などの参照は、EXPORTS に従って
+初めて使われたときに該当モジュールを import する。
+"""
+
+import os
+
+# src ディレクトリ（service-account の探索や logs の場所の基準。以前の email_watcher.py の場所）
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_MODULES = {
+    'parse': ('decode_subject', 'normalize_phone_number', 'calc_age_from_birth_str', 'apply_template_tokens',
+              '_match_segment_conditions', '_find_matching_segment', '_oubo_no_of', '_norm_account_key'),
+    'firestore': ('_find_service_account_file', 'get_api_settings', 'pick_and_rotate_template', '_get_mail_settings',
+                  '_extract_string_value', '_extract_bool_value', '_extract_int_value', '_extract_conditions',
+                  '_extract_name_types', '_get_target_segments', '_get_engage_target_segments',
+                  '_get_engage_mail_settings', '_extract_genders', '_extract_age_ranges', '_extract_actions',
+                  '_extract_sms_action', '_extract_mail_action', '_make_fields_for_firestore',
+                  'create_scheduled_task', 'create_delayed_task', 'write_sms_history', '_write_sms_history_now',
+                  'get_pending_scheduled_tasks', 'update_scheduled_task_status'),
+    'send': ('send_mail_once', '_send_html_mail', 'send_via_sms_publisher', 'send_sms_router',
+             'send_auto_reply_if_configured', 'send_sms_via_api', 'send_sms_once', 'send_sms', 'to81FromLocal'),
+    'rpa': ('safe_set_memo_and_save', 'jobbox_login_class', 'engage_login_class'),
+    'schedule': ('execute_scheduled_sms_task', 'execute_scheduled_mail_task', 'process_scheduled_tasks_once',
+                 'scheduled_task_worker'),
+    'ingest': ('_imap_connect', 'watch_mail'),
+}
+
+# 公開名 → モジュール名
+EXPORTS = {name: module for module, names in _MODULES.items() for name in names}
+
+
+def load(name):
+    """EXPORTS の名前を該当モジュールから取り出す（必要ならそのモジュールを import する）"""
+    import importlib
+
+    module = EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(name)
+    return getattr(importlib.import_module(f'{__name__}.{module}'), name)
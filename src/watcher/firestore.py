@@ -0,0 +1,1271 @@
+"""
+Firestore REST の読み書き（サービスアカウントのトークンで requests から直接呼ぶ）
+
+各種設定（api_settings / mail_settings / engage_mail_settings / target_settings）とセグメントの読み込み、
+jobbox_accounts / engage_accounts の索引（account_index）、
+sms_history の書き込み（直近の送信への統合を含む）、scheduled_tasks の登録・取得・更新。
+接続先とトークンは firestore_rest（FIRESTORE_EMULATOR_HOST でローカルに向けられる）。
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from account_index import AccountIndex
+from firestore_rest import documents_url, firestore_api, service_account_token
+from lazy_import import lazy_module
+from outbox import enqueue_history, history_async_enabled
+from segment_index import SegmentList
+from stage_metrics import timed
+from tracing import traced
+
+from . import SRC_DIR
+
+requests = lazy_module('requests')
+
+
+def _find_service_account_file():
+    sa_candidates = [
+        os.path.join(os.getcwd(), 'service-account'),
+        os.path.join(SRC_DIR, '..', 'service-account'),
+        os.path.join(os.path.dirname(SRC_DIR), '..', 'service-account'),
+        os.path.join(os.getcwd(), 'src', 'service-account'),
+    ]
+    for c in sa_candidates:
+        if os.path.isfile(c):
+            return c
+    return None
+
+
+@traced('firestore.api_settings')
+def get_api_settings(uid):
+    """
+    从 Firestore 读取 accounts/{uid}/api_settings/settings
+    返回 dict: { provider, baseUrl, apiId, apiPass }
+    """
+    if not uid:
+        return {}
+    sa_candidates = [
+        os.path.join(os.getcwd(), 'service-account'),
+        os.path.join(SRC_DIR, '..', 'service-account'),
+        os.path.join(os.path.dirname(SRC_DIR), '..', 'service-account'),
+        os.path.join(os.getcwd(), 'src', 'service-account'),
+    ]
+    sa_file = None
+    for c in sa_candidates:
+        if os.path.isfile(c):
+            sa_file = c
+            break
+    if not sa_file:
+        # fallback to envs only
+        return {
+            'provider': os.environ.get('SMS_PROVIDER') or os.environ.get('API_PROVIDER'),
+            'baseUrl': os.environ.get('SMS_PUBLISHER_BASEURL') or os.environ.get('API_BASEURL'),
+            'apiId': os.environ.get('SMS_PUBLISHER_APIID') or os.environ.get('API_ID'),
+            'apiPass': os.environ.get('SMS_PUBLISHER_APIPASS') or os.environ.get('SMS_PUBLISHER_TOKEN') or os.environ.get('API_PASS')
+        }
+    try:
+        import json
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        # can't read service account -> fallback to envs
+        return {
+            'provider': os.environ.get('SMS_PROVIDER') or os.environ.get('API_PROVIDER'),
+            'baseUrl': os.environ.get('SMS_PUBLISHER_BASEURL') or os.environ.get('API_BASEURL'),
+            'apiId': os.environ.get('SMS_PUBLISHER_APIID') or os.environ.get('API_ID'),
+            'apiPass': os.environ.get('SMS_PUBLISHER_APIPASS') or os.environ.get('SMS_PUBLISHER_TOKEN') or os.environ.get('API_PASS')
+        }
+    project = sa.get('project_id')
+    if not project:
+        return {}
+    url = f'{documents_url(project)}/accounts/{uid}/api_settings/settings'
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        r = requests.get(url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            return {}
+        data = r.json()
+        fields = data.get('fields', {})
+        res = {}
+        res['provider'] = fields.get('provider', {}).get('stringValue') if fields.get('provider') else None
+        res['baseUrl'] = fields.get('baseUrl', {}).get('stringValue') if fields.get('baseUrl') else None
+        res['apiId'] = fields.get('apiId', {}).get('stringValue') if fields.get('apiId') else None
+        res['apiPass'] = fields.get('apiPass', {}).get('stringValue') if fields.get('apiPass') else None
+        res['rateLimit'] = fields.get('rateLimit', {}).get('stringValue') if fields.get('rateLimit') else None
+        # Fallback to environment variables for any missing values
+        if not res.get('provider'):
+            res['provider'] = os.environ.get('SMS_PROVIDER') or os.environ.get('API_PROVIDER')
+        if not res.get('baseUrl'):
+            res['baseUrl'] = os.environ.get('SMS_PUBLISHER_BASEURL') or os.environ.get('API_BASEURL')
+        if not res.get('apiId'):
+            res['apiId'] = os.environ.get('SMS_PUBLISHER_APIID') or os.environ.get('API_ID')
+        if not res.get('apiPass'):
+            res['apiPass'] = os.environ.get('SMS_PUBLISHER_APIPASS') or os.environ.get('SMS_PUBLISHER_TOKEN') or os.environ.get('API_PASS')
+        return res
+    except Exception:
+        # If Firestore read fails at runtime, still try environment variables
+        fallback = {
+            'provider': os.environ.get('SMS_PROVIDER') or os.environ.get('API_PROVIDER'),
+            'baseUrl': os.environ.get('SMS_PUBLISHER_BASEURL') or os.environ.get('API_BASEURL'),
+            'apiId': os.environ.get('SMS_PUBLISHER_APIID') or os.environ.get('API_ID'),
+            'apiPass': os.environ.get('SMS_PUBLISHER_APIPASS') or os.environ.get('SMS_PUBLISHER_TOKEN') or os.environ.get('API_PASS')
+        }
+        return fallback
+
+
+def pick_and_rotate_template(uid):
+    """Module-level helper: decide A/B and best-effort update nextSmsTemplate in Firestore.
+
+    Returns chosen 'A' or 'B'.
+    """
+    sa_candidates = [
+        os.path.join(os.getcwd(), 'service-account'),
+        os.path.join(SRC_DIR, '..', 'service-account'),
+        os.path.join(os.path.dirname(SRC_DIR), '..', 'service-account'),
+        os.path.join(os.getcwd(), 'src', 'service-account'),
+    ]
+    sa_file = None
+    for c in sa_candidates:
+        if os.path.isfile(c):
+            sa_file = c; break
+    if not sa_file:
+        return 'A'  # fallback
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return 'A'
+    project = sa.get('project_id')
+    if not project:
+        return 'A'
+
+    doc_url = f'{documents_url(project)}/accounts/{uid}/target_settings/settings'
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        r = requests.get(doc_url, headers=headers, timeout=8)
+        if r.status_code != 200:
+            return 'A'
+        data = r.json()
+        fields = data.get('fields', {})
+        useA = True if (not fields.get('smsUseA')) else (fields.get('smsUseA', {}).get('booleanValue') is True)
+        useB = True if (not fields.get('smsUseB')) else (fields.get('smsUseB', {}).get('booleanValue') is True)
+        next_t = 'A'
+        if fields.get('nextSmsTemplate') and fields.get('nextSmsTemplate').get('stringValue'):
+            next_t = fields.get('nextSmsTemplate').get('stringValue')
+
+        # Decide chosen and next
+        if next_t == 'A' and useA:
+            chosen = 'A'
+            new_next = 'B' if useB else 'A'
+        elif next_t == 'B' and useB:
+            chosen = 'B'
+            new_next = 'A' if useA else 'B'
+        else:
+            # fallback: pick A if available else B
+            if useA:
+                chosen = 'A'
+                new_next = 'B' if useB else 'A'
+            elif useB:
+                chosen = 'B'
+                new_next = 'A'
+            else:
+                # none enabled -> default A
+                return 'A'
+
+        # write back new_next (best-effort)
+        patch_body = {'fields': {'nextSmsTemplate': {'stringValue': new_next}}}
+        # PATCH to the document path
+        try:
+            # Use updateMask to update only the nextSmsTemplate field to avoid
+            # replacing the whole document (which would clear other fields).
+            r2 = requests.patch(
+                doc_url,
+                params={'updateMask.fieldPaths': 'nextSmsTemplate'},
+                headers={**headers, 'Content-Type': 'application/json'},
+                json=patch_body,
+                timeout=8,
+            )
+            # ignore result; best-effort
+        except Exception:
+            pass
+        return chosen
+    except Exception:
+        return 'A'
+
+
+@traced('firestore.mail_settings')
+def _get_mail_settings(uid: str) -> dict:
+    """Read accounts/{uid}/mail_settings/settings from Firestore using service account file.
+
+    Returns dict with possible keys 'email', 'appPass', 'replyEmail', 'replyAppPass'.
+    Empty dict on failure.
+    """
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        return {}
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return {}
+
+    project = sa.get('project_id') if isinstance(sa, dict) else None
+    if not project:
+        return {}
+    url = f'{documents_url(project)}/accounts/{uid}/mail_settings/settings'
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        r = requests.get(url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            return {}
+        data = r.json()
+        fields = data.get('fields', {})
+        res = {}
+        if 'email' in fields:
+            res['email'] = fields.get('email', {}).get('stringValue')
+        if 'appPass' in fields:
+            res['appPass'] = fields.get('appPass', {}).get('stringValue')
+        if 'replyEmail' in fields:
+            res['replyEmail'] = fields.get('replyEmail', {}).get('stringValue')
+        if 'replyAppPass' in fields:
+            res['replyAppPass'] = fields.get('replyAppPass', {}).get('stringValue')
+        return res
+    except Exception:
+        return {}
+
+
+def _extract_string_value(field):
+    """Extract string value from Firestore field."""   
+    return field.get('stringValue', '')
+
+
+def _extract_bool_value(field):
+    """Extract boolean value from Firestore field."""
+    return field.get('booleanValue', False)
+
+
+def _extract_int_value(field):
+    """Extract integer value from Firestore field."""
+    return int(field.get('integerValue', 0))
+
+
+def _extract_conditions(conditions_field):
+    """Extract conditions from Firestore mapValue."""
+    if conditions_field.get('mapValue'):
+        fields = conditions_field['mapValue'].get('fields', {})
+        return {
+            'nameTypes': _extract_name_types(fields.get('nameTypes', {})),
+            'genders': _extract_genders(fields.get('genders', {})),
+            'ageRanges': _extract_age_ranges(fields.get('ageRanges', {}))
+        }
+    return {}
+
+
+def _extract_name_types(name_types_field):
+    """Extract nameTypes from Firestore mapValue."""
+    if name_types_field.get('mapValue'):
+        fields = name_types_field['mapValue'].get('fields', {})
+        return {
+            'kanji': _extract_bool_value(fields.get('kanji', {})),
+            'katakana': _extract_bool_value(fields.get('katakana', {})),
+            'hiragana': _extract_bool_value(fields.get('hiragana', {})),
+            'alpha': _extract_bool_value(fields.get('alpha', {}))
+        }
+    return {}
+
+
+@traced('firestore.target_segments')
+def _get_target_segments(uid: Optional[str]) -> list:
+    """Read enabled segments from accounts/{uid}/target_segments.
+
+    Returns list of segment dicts sorted by priority. Each segment contains
+    id, title, enabled, priority, conditions, actions.
+    """
+    sa_file = _find_service_account_file()
+    if not sa_file or not uid:
+        return []
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return []
+
+    project = sa.get('project_id') if isinstance(sa, dict) else None
+    if not project:
+        return []
+
+    collection_url = f'{documents_url(project)}/accounts/{uid}/target_segments'
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        r = requests.get(collection_url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            return []
+        data = r.json()
+        documents = data.get('documents', [])
+        segments = []
+        for doc in documents:
+            fields = doc.get('fields', {})
+            seg = {
+                'id': doc.get('name', '').split('/')[-1],
+                'title': _extract_string_value(fields.get('title', {})),
+                'enabled': _extract_bool_value(fields.get('enabled', {})),
+                'priority': _extract_int_value(fields.get('priority', {})),
+                'conditions': _extract_conditions(fields.get('conditions', {})),
+                'actions': _extract_actions(fields.get('actions', {})),
+            }
+            if seg['enabled']:
+                segments.append(seg)
+        segments.sort(key=lambda x: x.get('priority', 0))
+        return SegmentList(segments)
+    except Exception as e:
+        print(f'Error reading target_segments: {e}')
+        return []
+
+
+@traced('firestore.engage_target_segments')
+def _get_engage_target_segments(uid: Optional[str]) -> list:
+    """Read enabled segments from accounts/{uid}/engage_target_segments for エンゲージ.
+
+    Returns list of segment dicts sorted by priority. Each segment contains
+    id, title, enabled, priority, conditions, actions.
+    """
+    sa_file = _find_service_account_file()
+    if not sa_file or not uid:
+        return []
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return []
+
+    project = sa.get('project_id') if isinstance(sa, dict) else None
+    if not project:
+        return []
+
+    collection_url = f'{documents_url(project)}/accounts/{uid}/engage_target_segments'
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        r = requests.get(collection_url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            return []
+        data = r.json()
+        documents = data.get('documents', [])
+        segments = []
+        for doc in documents:
+            fields = doc.get('fields', {})
+            seg = {
+                'id': doc.get('name', '').split('/')[-1],
+                'title': _extract_string_value(fields.get('title', {})),
+                'enabled': _extract_bool_value(fields.get('enabled', {})),
+                'priority': _extract_int_value(fields.get('priority', {})),
+                'conditions': _extract_conditions(fields.get('conditions', {})),
+                'actions': _extract_actions(fields.get('actions', {})),
+            }
+            if seg['enabled']:
+                segments.append(seg)
+        segments.sort(key=lambda x: x.get('priority', 0))
+        return SegmentList(segments)
+    except Exception as e:
+        print(f'Error reading engage_target_segments: {e}')
+        return []
+
+
+def _project_and_token():
+    """(project_id, アクセストークン)。サービスアカウントがない・トークンを取得できなければ (None, None)"""
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        return None, None
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return None, None
+    return sa.get('project_id'), token
+
+
+@traced('firestore.list_accounts')
+def list_account_documents(uid, collection: str, fields=None) -> Optional[list]:
+    """accounts/{uid}/{collection} の全ドキュメント（fields を指定したらそのフィールドだけ）。失敗したら None"""
+    project, token = _project_and_token()
+    if not project or not uid:
+        return None
+    base_url = f'{documents_url(project)}/accounts/{uid}/{collection}'
+    headers = {'Authorization': f'Bearer {token}'}
+    docs = []
+    page_token = None
+    try:
+        while True:
+            params = {'pageSize': 300}
+            if fields:
+                params['mask.fieldPaths'] = list(fields)
+            if page_token:
+                params['pageToken'] = page_token
+            r = requests.get(base_url, headers=headers, params=params, timeout=10)
+            if r.status_code != 200:
+                print(f'{collection} の一覧を取得できませんでした: {r.status_code}')
+                return None
+            data = r.json()
+            docs.extend(data.get('documents', []))
+            page_token = data.get('nextPageToken')
+            if not page_token:
+                return docs
+    except Exception as e:
+        print(f'{collection} の一覧の取得で例外が発生しました: {e}')
+        return None
+
+
+@traced('firestore.batch_get')
+def batch_get_documents(names, fields=None) -> Optional[list]:
+    """ドキュメント名（projects/.../documents/...）のリストをまとめて読む。存在しないものは含めない。失敗したら None"""
+    project, token = _project_and_token()
+    if not project:
+        return None
+    body = {'documents': list(names)}
+    if fields:
+        body['mask'] = {'fieldPaths': list(fields)}
+    try:
+        r = requests.post(f'{documents_url(project)}:batchGet', headers={'Authorization': f'Bearer {token}'},
+                          json=body, timeout=10)
+        if r.status_code != 200:
+            print(f'batchGet に失敗しました: {r.status_code}')
+            return None
+        return [row['found'] for row in r.json() if row.get('found')]
+    except Exception as e:
+        print(f'batchGet で例外が発生しました: {e}')
+        return None
+
+
+_account_index = None
+_account_index_lock = threading.Lock()
+
+
+def get_account_index() -> AccountIndex:
+    """プロセス共通の jobbox_accounts / engage_accounts の索引"""
+    global _account_index
+    with _account_index_lock:
+        if _account_index is None:
+            _account_index = AccountIndex(list_account_documents, batch_get_documents)
+        return _account_index
+
+
+def _get_engage_mail_settings(uid: str) -> dict:
+    """Read accounts/{uid}/engage_mail_settings/settings from Firestore.
+
+    Returns dict with possible keys 'email', 'appPass', 'replyEmail', 'replyAppPass'.
+    Empty dict on failure.
+    """
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        return {}
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return {}
+
+    project = sa.get('project_id') if isinstance(sa, dict) else None
+    if not project:
+        return {}
+    url = f'{documents_url(project)}/accounts/{uid}/engage_mail_settings/settings'
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        r = requests.get(url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            return {}
+        data = r.json()
+        fields = data.get('fields', {})
+        res = {}
+        if 'email' in fields:
+            res['email'] = fields['email'].get('stringValue')
+        if 'appPass' in fields:
+            res['appPass'] = fields['appPass'].get('stringValue')
+        if 'replyEmail' in fields:
+            res['replyEmail'] = fields['replyEmail'].get('stringValue')
+        if 'replyAppPass' in fields:
+            res['replyAppPass'] = fields['replyAppPass'].get('stringValue')
+        return res
+    except Exception:
+        return {}
+
+
+def _extract_genders(genders_field):
+    """Extract genders from Firestore mapValue."""
+    if genders_field.get('mapValue'):
+        fields = genders_field['mapValue'].get('fields', {})
+        return {
+            'male': _extract_bool_value(fields.get('male', {})),
+            'female': _extract_bool_value(fields.get('female', {}))
+        }
+    return {}
+
+
+def _extract_age_ranges(age_ranges_field):
+    """Extract ageRanges from Firestore mapValue."""
+    if age_ranges_field.get('mapValue'):
+        fields = age_ranges_field['mapValue'].get('fields', {})
+        return {
+            'maleMin': _extract_int_value(fields.get('maleMin', {})),
+            'maleMax': _extract_int_value(fields.get('maleMax', {})),
+            'femaleMin': _extract_int_value(fields.get('femaleMin', {})),
+            'femaleMax': _extract_int_value(fields.get('femaleMax', {}))
+        }
+    return {}
+
+
+def _extract_actions(actions_field):
+    """Extract actions from Firestore mapValue."""
+    if actions_field.get('mapValue'):
+        fields = actions_field['mapValue'].get('fields', {})
+        return {
+            'sms': _extract_sms_action(fields.get('sms', {})),
+            'mail': _extract_mail_action(fields.get('mail', {}))
+        }
+    return {}
+
+
+def _extract_sms_action(sms_field):
+    """Extract SMS action from Firestore mapValue."""
+    if sms_field.get('mapValue'):
+        fields = sms_field['mapValue'].get('fields', {})
+        return {
+            'enabled': _extract_bool_value(fields.get('enabled', {})),
+            'text': _extract_string_value(fields.get('text', {})),
+            'sendMode': _extract_string_value(fields.get('sendMode', {})) or 'immediate',
+            'scheduledTime': _extract_string_value(fields.get('scheduledTime', {})) or '09:00',
+            'delayMinutes': _extract_int_value(fields.get('delayMinutes', {})) or 30
+        }
+    return {}
+
+
+def _extract_mail_action(mail_field):
+    """Extract mail action from Firestore mapValue."""
+    if mail_field.get('mapValue'):
+        fields = mail_field['mapValue'].get('fields', {})
+        return {
+            'enabled': _extract_bool_value(fields.get('enabled', {})),
+            'subject': _extract_string_value(fields.get('subject', {})),
+            'body': _extract_string_value(fields.get('body', {})),
+            'sendMode': _extract_string_value(fields.get('sendMode', {})) or 'immediate',
+            'scheduledTime': _extract_string_value(fields.get('scheduledTime', {})) or '09:00',
+            'delayMinutes': _extract_int_value(fields.get('delayMinutes', {})) or 30
+        }
+    return {}
+
+
+def _make_fields_for_firestore(doc: dict) -> dict:
+    fields = {}
+    for k, v in doc.items():
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            fields[k] = {'booleanValue': v}
+        elif isinstance(v, int):
+            fields[k] = {'integerValue': str(v)}
+        elif isinstance(v, dict):
+            # nested map
+            fields[k] = {'mapValue': {'fields': _make_fields_for_firestore(v)}}
+        else:
+            fields[k] = {'stringValue': str(v)}
+    return fields
+
+
+def create_scheduled_task(uid: str, task_type: str, task_data: dict) -> bool:
+    """Create a scheduled task in Firestore under accounts/{uid}/scheduled_tasks.
+    
+    Args:
+        uid: User ID
+        task_type: 'sms' or 'mail'
+        task_data: dict containing:
+            - scheduledTime: 'HH:mm' format
+            - to: recipient (phone number for SMS, email for mail)
+            - template: message template with tokens
+            - applicant_detail: dict with applicant info for token replacement
+            - subject: (for mail only) email subject
+            - segment_id: ID of the segment that triggered this task
+            - oubo_no: 応募No
+            
+    Returns True on success.
+    """
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        print('service-account file not found; cannot create scheduled task')
+        return False
+    
+    try:
+        import json
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception as e:
+        print(f'Failed to get service account token: {e}')
+        return False
+    
+    project = sa.get('project_id')
+    if not project:
+        print('No project_id in service account')
+        return False
+    
+    # Calculate next execution datetime based on scheduledTime
+    from datetime import datetime, timedelta
+    import re
+    
+    scheduled_time = task_data.get('scheduledTime', '09:00')
+    match = re.match(r'(\d{1,2}):(\d{2})', scheduled_time)
+    if not match:
+        print(f'Invalid scheduledTime format: {scheduled_time}')
+        return False
+    
+    hour, minute = int(match.group(1)), int(match.group(2))
+    now = datetime.now()
+    next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    
+    # If the time has passed today, schedule for tomorrow
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    
+    print(f'時刻送信登録: {next_run.strftime("%m/%d %H:%M")}')
+    
+    # Create task document
+    task_doc = {
+        'uid': uid,
+        'taskType': task_type,
+        'status': 'pending',
+        'scheduledTime': scheduled_time,
+        'nextRun': int(next_run.timestamp() * 1000),  # milliseconds
+        'createdAt': int(datetime.now().timestamp() * 1000),
+        'to': task_data.get('to', ''),
+        'template': task_data.get('template', ''),
+        'applicantDetail': task_data.get('applicant_detail', {}),
+        'segmentId': task_data.get('segment_id', ''),
+        'ouboNo': task_data.get('oubo_no', ''),
+    }
+    if task_data.get('priority') is not None:
+        # 分散送信（dispatch_policy）での順番。小さいほど先に送る
+        task_doc['priority'] = int(task_data['priority'])
+    
+    if task_type == 'mail':
+        task_doc['subject'] = task_data.get('subject', '')
+    
+    fields = _make_fields_for_firestore(task_doc)
+    
+    collection_url = f'{documents_url(project)}/accounts/{uid}/scheduled_tasks'
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    
+    try:
+        r = requests.post(collection_url, headers=headers, json={'fields': fields}, timeout=10)
+        if r.status_code not in (200, 201):
+            print(f'タスク登録失敗: {r.status_code}')
+            return False
+        return True
+    except Exception as e:
+        print(f'エラー: {e}')
+        return False
+
+
+def create_delayed_task(uid: str, task_type: str, next_run: int, task_data: dict) -> bool:
+    """Create a delayed task in Firestore under accounts/{uid}/scheduled_tasks.
+    
+    Args:
+        uid: User ID
+        task_type: 'sms' or 'mail'
+        next_run: Unix timestamp (seconds) when the task should execute
+        task_data: dict containing:
+            - delayMinutes: number of minutes to delay
+            - to: recipient (phone number for SMS, email for mail)
+            - template: message template with tokens
+            - applicant_detail: dict with applicant info for token replacement
+            - subject: (for mail only) email subject
+            - segment_id: ID of the segment that triggered this task
+            - oubo_no: 応募No
+            
+    Returns True on success.
+    """
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        print('service-account file not found; cannot create delayed task')
+        return False
+    
+    try:
+        import json
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception as e:
+        print(f'Failed to get service account token: {e}')
+        return False
+    
+    project = sa.get('project_id')
+    if not project:
+        print('No project_id in service account')
+        return False
+    
+    from datetime import datetime
+    delay_minutes = task_data.get('delayMinutes', 30)
+    print(f'予約送信登録: {delay_minutes}分後')
+    
+    # Create task document
+    task_doc = {
+        'uid': uid,
+        'taskType': task_type,
+        'status': 'pending',
+        'sendMode': 'delayed',
+        'delayMinutes': delay_minutes,
+        'nextRun': int(next_run * 1000),  # convert seconds to milliseconds
+        'createdAt': int(datetime.now().timestamp() * 1000),
+        'to': task_data.get('to', ''),
+        'template': task_data.get('template', ''),
+        'applicantDetail': task_data.get('applicant_detail', {}),
+        'segmentId': task_data.get('segment_id', ''),
+        'ouboNo': task_data.get('oubo_no', ''),
+    }
+    if task_data.get('priority') is not None:
+        # 分散送信（dispatch_policy）での順番。小さいほど先に送る
+        task_doc['priority'] = int(task_data['priority'])
+    
+    if task_type == 'mail':
+        task_doc['subject'] = task_data.get('subject', '')
+    
+    fields = _make_fields_for_firestore(task_doc)
+    
+    collection_url = f'{documents_url(project)}/accounts/{uid}/scheduled_tasks'
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    
+    try:
+        r = requests.post(collection_url, headers=headers, json={'fields': fields}, timeout=10)
+        if r.status_code not in (200, 201):
+            print(f'予約タスク登録失敗: {r.status_code}')
+            return False
+        return True
+    except Exception as e:
+        print(f'エラー: {e}')
+        return False
+
+
+def write_sms_history(uid: str, doc: dict) -> bool:
+    """Write a minimal sms_history document under accounts/{uid}/sms_history using service account.
+
+    OUTBOX_ASYNC_HISTORY=true の場合は outbox に積んで True を返し、バックグラウンドで書き込む。
+    Returns True on success.
+    """
+    if history_async_enabled() and enqueue_history(uid, doc, _write_sms_history_now):
+        return True
+    return _write_sms_history_now(uid, doc)
+
+
+@timed('history_write')
+def _write_sms_history_now(uid: str, doc: dict) -> bool:
+    """sms_history を今すぐ書き込む（write_sms_history の本体）"""
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        print('service-account file not found; cannot write history')
+        return False
+
+    # Helper: load service account and obtain access token
+    sa = None
+    token = None
+    project = None
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+        project = sa.get('project_id')
+    except Exception:
+        sa = None
+        token = None
+        project = None
+
+    # Try multiple matching strategies to find an existing history doc to merge into.
+    # Strategies (priority order):
+    # 1) oubo_no + tel (recent window)
+    # 2) oubo_no + email (recent)
+    # 3) tel + email (recent)
+    # 4) email only (within short time window)
+    try:
+        if token and project and uid and doc:
+            oubo = (doc.get('oubo_no') or doc.get('oubo') or '').strip()
+            tel = (doc.get('tel') or doc.get('電話番号') or '').strip()
+            email_addr = (doc.get('email') or doc.get('メール') or '').strip()
+            now_ts = int(time.time())
+            recent_threshold = 300
+            short_threshold = 120
+            run_url = f'{documents_url(project)}:runQuery'
+            headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+
+            # helper to run a structuredQuery and return first document (or None)
+            def _run_query(filters, limit=1, order_by_sentAt=False):
+                body = {"structuredQuery": {"from": [{"collectionId": "sms_history"}], "limit": limit}}
+                if filters:
+                    if len(filters) == 1:
+                        body['structuredQuery']['where'] = filters[0]
+                    else:
+                        body['structuredQuery']['where'] = {"compositeFilter": {"op": "AND", "filters": filters}}
+                if order_by_sentAt:
+                    body['structuredQuery']['orderBy'] = [{"field": {"fieldPath": "sentAt"}, "direction": "DESC"}]
+                try:
+                    r = requests.post(run_url, headers=headers, json=body, timeout=8)
+                    if r.status_code != 200:
+                        return None
+                    results = r.json()
+                    for item in results:
+                        if item.get('document'):
+                            return item.get('document')
+                except Exception:
+                    return None
+                return None
+
+            # build simple fieldFilter helper
+            def ff(fieldPath, op, value, valueType='stringValue'):
+                return {"fieldFilter": {"field": {"fieldPath": fieldPath}, "op": op, "value": {valueType: str(value)}}}
+
+            # Strategy 1: oubo + tel (recent)
+            existing_doc = None
+            if oubo and tel:
+                filters = [ff('oubo_no', 'EQUAL', oubo), ff('tel', 'EQUAL', tel), ff('sentAt', 'GREATER_THAN', now_ts - recent_threshold, valueType='integerValue')]
+                existing_doc = _run_query(filters, limit=1, order_by_sentAt=True)
+
+            # Strategy 2: oubo + email
+            if not existing_doc and oubo and email_addr:
+                filters = [ff('oubo_no', 'EQUAL', oubo), ff('email', 'EQUAL', email_addr), ff('sentAt', 'GREATER_THAN', now_ts - recent_threshold, valueType='integerValue')]
+                existing_doc = _run_query(filters, limit=1, order_by_sentAt=True)
+
+            # Strategy 3: tel + email
+            if not existing_doc and tel and email_addr:
+                filters = [ff('tel', 'EQUAL', tel), ff('email', 'EQUAL', email_addr), ff('sentAt', 'GREATER_THAN', now_ts - recent_threshold, valueType='integerValue')]
+                existing_doc = _run_query(filters, limit=1, order_by_sentAt=True)
+
+            # Strategy 4: email only within short window
+            if not existing_doc and email_addr:
+                filters = [ff('email', 'EQUAL', email_addr), ff('sentAt', 'GREATER_THAN', now_ts - short_threshold, valueType='integerValue')]
+                existing_doc = _run_query(filters, limit=1, order_by_sentAt=True)
+
+            # Helper: read Firestore field value
+            def _read_field(f):
+                if not f:
+                    return None
+                if 'stringValue' in f:
+                    return f.get('stringValue')
+                if 'integerValue' in f:
+                    try:
+                        return int(f.get('integerValue'))
+                    except Exception:
+                        return f.get('integerValue')
+                if 'booleanValue' in f:
+                    return f.get('booleanValue')
+                if 'mapValue' in f:
+                    mv = f.get('mapValue', {}).get('fields', {})
+                    return {k: _read_field(v) for k, v in mv.items()}
+                return None
+
+            if existing_doc:
+                existing_name = existing_doc.get('name')
+                existing_fields = existing_doc.get('fields', {})
+
+                # extract existing channel states/responses
+                existing_sms_state = _read_field(existing_fields.get('sms_status'))
+                existing_mail_state = _read_field(existing_fields.get('mail_status'))
+                existing_resp = _read_field(existing_fields.get('response')) or {}
+                existing_sentAt = _read_field(existing_fields.get('sentAt'))
+
+                # infer incoming states from doc
+                inc_sms_state = None
+                inc_mail_state = None
+                inc_sms_resp = None
+                inc_mail_resp = None
+                # If caller provided explicit sms_status/mail_status use them
+                if doc.get('sms_status'):
+                    inc_sms_state = doc.get('sms_status')
+                if doc.get('mail_status'):
+                    inc_mail_state = doc.get('mail_status')
+                # else infer from status text
+                sraw = (doc.get('status') or '').lower()
+                if not inc_sms_state and ('送信済' in (doc.get('status') or '') or '済' in (doc.get('status') or '')) and '（m）' not in sraw and '（s）' in sraw:
+                    inc_sms_state = 'sent'
+                if not inc_mail_state and ('（m）' in (doc.get('status') or '') or '（M）' in (doc.get('status') or '') or 'mail' in sraw):
+                    # treat as mail attempt
+                    if '失敗' in (doc.get('status') or '') or 'fail' in sraw:
+                        inc_mail_state = 'failed'
+                    else:
+                        inc_mail_state = 'sent'
+                # responses
+                # read response into a local variable once so type-checkers can
+                # reason about its type (and to avoid calling .get on None)
+                resp = doc.get('response')
+                if isinstance(resp, dict):
+                    # try to separate sms vs mail keys if present
+                    if 'sms' in resp:
+                        inc_sms_resp = resp.get('sms')
+                    if 'mail' in resp:
+                        inc_mail_resp = resp.get('mail')
+                    # otherwise put as mail if email present
+                    if not inc_sms_resp and not inc_mail_resp:
+                        if email_addr:
+                            inc_mail_resp = resp
+                        else:
+                            inc_sms_resp = resp
+                else:
+                    # primitive response -> assign based on presence of tel/email
+                    if email_addr:
+                        inc_mail_resp = resp
+                    else:
+                        inc_sms_resp = resp
+
+                # merge states: incoming overrides existing for the channel
+                final_sms_state = existing_sms_state or None
+                final_mail_state = existing_mail_state or None
+                if inc_sms_state:
+                    final_sms_state = inc_sms_state
+                if inc_mail_state:
+                    final_mail_state = inc_mail_state
+
+                # normalize helper
+                def _norm(s):
+                    if not s:
+                        return None
+                    s2 = str(s).lower()
+                    if 'fail' in s2 or '失敗' in s2:
+                        return 'failed'
+                    if 'sent' in s2 or '送信' in s2 or '済' in s2:
+                        return 'sent'
+                    return s
+
+                final_sms_state = _norm(final_sms_state)
+                final_mail_state = _norm(final_mail_state)
+
+                # merge responses
+                final_resp = {}
+                if existing_resp and isinstance(existing_resp, dict):
+                    if 'sms' in existing_resp:
+                        final_resp['sms'] = existing_resp.get('sms')
+                    if 'mail' in existing_resp:
+                        final_resp['mail'] = existing_resp.get('mail')
+                if inc_sms_resp is not None:
+                    final_resp['sms'] = inc_sms_resp
+                if inc_mail_resp is not None:
+                    final_resp['mail'] = inc_mail_resp
+
+                # decide status string per user's rules
+                status_str = ''
+                if not final_sms_state and not final_mail_state:
+                    status_str = '対象外'
+                else:
+                    # failures reported as failed channels
+                    failed_parts = []
+                    sent_parts = []
+                    if final_mail_state == 'failed':
+                        failed_parts.append('M')
+                    if final_sms_state == 'failed':
+                        failed_parts.append('S')
+                    if final_mail_state == 'sent':
+                        sent_parts.append('M')
+                    if final_sms_state == 'sent':
+                        sent_parts.append('S')
+
+                    if failed_parts:
+                        status_str = '送信失敗（' + '+'.join(failed_parts) + '）'
+                    else:
+                        if sent_parts:
+                            order = []
+                            if 'M' in sent_parts:
+                                order.append('M')
+                            if 'S' in sent_parts:
+                                order.append('S')
+                            status_str = '送信済（' + '+'.join(order) + '）'
+                        else:
+                            status_str = '対象外'
+
+                # prepare write_doc fields
+                write_doc = {}
+                if oubo:
+                    write_doc['oubo_no'] = oubo
+                if tel:
+                    write_doc['tel'] = tel
+                if email_addr:
+                    write_doc['email'] = email_addr
+                # Ensure sentAt is an integer. If existing_sentAt is numeric-string, coerce it.
+                try:
+                    if existing_sentAt is not None and not isinstance(existing_sentAt, dict):
+                        write_doc['sentAt'] = int(existing_sentAt)
+                    else:
+                        write_doc['sentAt'] = now_ts
+                except (ValueError, TypeError):
+                    write_doc['sentAt'] = now_ts
+                write_doc['sms_status'] = final_sms_state
+                write_doc['mail_status'] = final_mail_state
+                if final_resp:
+                    write_doc['response'] = final_resp
+                write_doc['status'] = status_str
+
+                # Preserve/append additional fields from incoming doc.
+                # IMPORTANT: This merge path previously patched only a minimal set of fields,
+                # which caused other fields (and newly-added ones like work_prefecture/work_address)
+                # to be missing in Firestore, resulting in blank CSV columns.
+                def _nonempty(v):
+                    if v is None:
+                        return False
+                    if isinstance(v, (int, bool)):
+                        return True
+                    return str(v).strip() != ''
+
+                def _pick_from_doc(*keys):
+                    for kk in keys:
+                        try:
+                            if kk in doc and _nonempty(doc.get(kk)):
+                                return doc.get(kk)
+                        except Exception:
+                            continue
+                    return None
+
+                # Common passthrough fields
+                name_val = _pick_from_doc('name', '氏名')
+                if _nonempty(name_val):
+                    write_doc['name'] = name_val
+                gender_val = _pick_from_doc('gender', '性別')
+                if _nonempty(gender_val):
+                    write_doc['gender'] = gender_val
+                birth_val = _pick_from_doc('birth', '生年月日')
+                if _nonempty(birth_val):
+                    write_doc['birth'] = birth_val
+                age_val = _pick_from_doc('age')
+                if _nonempty(age_val):
+                    write_doc['age'] = age_val
+
+                addr_val = _pick_from_doc('addr', '住所')
+                if _nonempty(addr_val):
+                    write_doc['addr'] = addr_val
+                school_val = _pick_from_doc('school', '学校名')
+                if _nonempty(school_val):
+                    write_doc['school'] = school_val
+
+                # Job title can appear under multiple keys
+                job_title_val = _pick_from_doc('job_title', 'jobTitle', '求人タイトル', 'kyujin', 'title')
+                if _nonempty(job_title_val):
+                    write_doc['job_title'] = job_title_val
+
+                # New: job posting public URL (求人URL)
+                job_url_val = _pick_from_doc('job_url', 'jobUrl', '求人URL')
+                if _nonempty(job_url_val):
+                    write_doc['job_url'] = job_url_val
+
+                template_val = _pick_from_doc('template')
+                if _nonempty(template_val):
+                    write_doc['template'] = template_val
+
+                # Employer/company
+                employer_val = _pick_from_doc('employer_name', 'employer', '会社名', '企業名', '掲載企業名')
+                if _nonempty(employer_val):
+                    write_doc['employer_name'] = employer_val
+
+                # New: work location (prefecture + address)
+                wp = _pick_from_doc('work_prefecture', 'workPrefecture')
+                wa = _pick_from_doc('work_address', 'workAddress')
+                if _nonempty(wp):
+                    write_doc['work_prefecture'] = wp
+                if _nonempty(wa):
+                    write_doc['work_address'] = wa
+
+                # PATCH existing document
+                try:
+                    patch_url = f'{firestore_api()}/{existing_name}'
+                    # Use updateMask to avoid deleting other existing fields.
+                    params = {'updateMask.fieldPaths': ','.join(write_doc.keys())}
+                    r = requests.patch(
+                        patch_url,
+                        headers={**headers, 'Content-Type': 'application/json'},
+                        params=params,
+                        json={'fields': _make_fields_for_firestore(write_doc)},
+                        timeout=12,
+                    )
+                    if r.status_code in (200, 201):
+                        try:
+                            print(f'Merged sms_history into {existing_name} status={write_doc.get("status")}')
+                        except Exception:
+                            pass
+                        return True
+                    else:
+                        print('Failed to patch existing sms_history:', r.status_code, r.text[:500])
+                except Exception as e:
+                    print('Exception patching existing sms_history:', e)
+
+    except Exception as e:
+        print('Error during matching existing sms_history (non-fatal):', e)
+
+    # Fallback: create a new sms_history document
+    try:
+        if not sa:
+            with open(sa_file, 'r', encoding='utf-8') as f:
+                sa = json.load(f)
+        token = service_account_token(sa)
+        project = sa.get('project_id')
+        if not project:
+            print('service account missing project_id')
+            return False
+        url = f'{documents_url(project)}/accounts/{uid}/sms_history'
+        headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+        body = {'fields': _make_fields_for_firestore(doc)}
+        r = requests.post(url, headers=headers, json=body, timeout=15)
+        if r.status_code in (200, 201):
+            return True
+        else:
+            print(f'Firestore書き込み失敗: {r.status_code}, {r.text[:500]}')
+            return False
+    except Exception as e:
+        print('Exception writing sms_history:', e)
+        return False
+
+
+def get_pending_scheduled_tasks(uid):
+    """获取待执行的定时任务"""
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        return []
+    
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception as e:
+        print(f'[定時タスク] Failed to get token: {e}')
+        return []
+    
+    project = sa.get('project_id')
+    if not project:
+        return []
+    
+    # Query pending tasks within execution window
+    # 使用更精确的时间窗口：只执行在当前时间之前且在未来2分钟内的任务
+    now = datetime.now()
+    now_ms = int(now.timestamp() * 1000)
+    # 允许2分钟的执行窗口（防止错过任务）
+    future_window_ms = int((now.timestamp() + 120) * 1000)
+    
+    collection_url = f'{documents_url(project)}/accounts/{uid}/scheduled_tasks'
+    headers = {'Authorization': f'Bearer {token}'}
+    
+    try:
+        r = requests.get(collection_url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            return []
+        
+        data = r.json()
+        documents = data.get('documents', [])
+        
+        tasks = []
+        for doc in documents:
+            doc_id = doc['name'].split('/')[-1]
+            fields = doc.get('fields', {})
+            
+            status = fields.get('status', {}).get('stringValue', '')
+            next_run = int(fields.get('nextRun', {}).get('integerValue', '0'))
+            task_type = fields.get('taskType', {}).get('stringValue', '')
+            scheduled_time = fields.get('scheduledTime', {}).get('stringValue', '')
+            
+            # Only process pending tasks that are due (within execution window)
+            # 任务必须：1) 状态为pending 2) nextRun已经到达 3) 不超过未来2分钟
+            if status == 'pending' and next_run <= now_ms:
+                # 计算任务与当前时间的差距
+                time_diff_seconds = (now_ms - next_run) / 1000
+                
+                # 如果任务超过10分钟还未执行，可能是系统故障导致，记录警告
+                if time_diff_seconds > 600:
+                    print(f'[定時任務] 警告: タスク {doc_id} は予定時刻から {int(time_diff_seconds/60)} 分遅延しています (scheduled: {scheduled_time})')
+                
+                # 提取任务时间信息用于日志
+                next_run_dt = datetime.fromtimestamp(next_run / 1000)
+                time_diff_min = int(time_diff_seconds / 60)
+                
+                # 简化日志：只在延迟超过2分钟时显示警告
+                if time_diff_seconds > 120:
+                    print(f'⚠️ タスク遅延 {time_diff_min}分 - {task_type} ({scheduled_time})')
+
+                task_data = {
+                    'id': doc_id,
+                    'uid': fields.get('uid', {}).get('stringValue', ''),
+                    'taskType': task_type,
+                    'to': fields.get('to', {}).get('stringValue', ''),
+                    'template': fields.get('template', {}).get('stringValue', ''),
+                    'segmentId': fields.get('segmentId', {}).get('stringValue', ''),
+                    'ouboNo': fields.get('ouboNo', {}).get('stringValue', ''),
+                    'nextRun': next_run,
+                    'priority': _extract_int_value(fields.get('priority', {})),
+                }
+                
+                # Extract applicantDetail
+                applicant_detail_field = fields.get('applicantDetail', {})
+                if applicant_detail_field.get('mapValue'):
+                    detail_fields = applicant_detail_field['mapValue'].get('fields', {})
+                    applicant_detail = {}
+                    for k, v in detail_fields.items():
+                        if v.get('stringValue') is not None:
+                            applicant_detail[k] = v['stringValue']
+                    task_data['applicantDetail'] = applicant_detail
+                else:
+                    task_data['applicantDetail'] = {}
+                
+                if task_type == 'mail':
+                    task_data['subject'] = fields.get('subject', {}).get('stringValue', '')
+                
+                tasks.append(task_data)
+        
+        return tasks
+    except Exception as e:
+        print(f'タスク取得エラー: {e}')
+        return []
+
+
+def update_scheduled_task_status(uid, task_id, status, error_msg=None):
+    """更新定时任务状态（失败时）或删除任务（成功时）"""
+    sa_file = _find_service_account_file()
+    if not sa_file:
+        return False
+    
+    try:
+        with open(sa_file, 'r', encoding='utf-8') as f:
+            sa = json.load(f)
+        token = service_account_token(sa)
+    except Exception:
+        return False
+    
+    project = sa.get('project_id')
+    if not project:
+        return False
+    
+    doc_url = f'{documents_url(project)}/accounts/{uid}/scheduled_tasks/{task_id}'
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    
+    try:
+        if status == 'completed':
+            # 成功时：删除任务文档（防止重复执行）
+            r = requests.delete(doc_url, headers=headers, timeout=10)
+            return r.status_code in (200, 204)
+        else:
+            # 失败时：更新状态为failed
+            update_data = {
+                'status': {'stringValue': status},
+                'updatedAt': {'integerValue': str(int(datetime.now().timestamp() * 1000))}
+            }
+            
+            if error_msg:
+                update_data['errorMsg'] = {'stringValue': str(error_msg)}
+            
+            params = {'updateMask.fieldPaths': ','.join(update_data.keys())}
+            r = requests.patch(
+                doc_url,
+                headers=headers,
+                params=params,
+                json={'fields': update_data},
+                timeout=10
+            )
+            return r.status_code in (200, 204)
+    except Exception:
+        return False
@@ -0,0 +1,2168 @@
+"""
+IMAP の監視と通知メールごとの処理（watch_mail）
+
+通知1通の処理は次の段階に分け、pipeline.StagePipeline の上限付きキューでつないでいる。
+
+    ingest   IMAP の監視スレッド。件名で求人ボックス / エンゲージを判定し、本文を取得して既読にする
+    parse    本文の解析と、処理済みの内容（message_ledger）の読み飛ばし
+    resolve  jobbox_accounts / engage_accounts から担当アカウントを決める
+    rpa      管理画面で応募者詳細を取得し、セグメント判定 → 送信 → メモ保存（ブラウザを開いている間に
+             行う必要があるので1段階。同じアカウントは直列、ワーカー数はブラウザ予算）
+    record   sms_history の書き込み（同じ応募者の書き込みは順番どおり）。rpa の後ろにはつながず、
+             RPA の中の write_sms_history から投入する別の入口
+
+段階ごとのワーカー数とキューの上限は PIPELINE_<段階>_WORKERS / PIPELINE_<段階>_QUEUE で変えられる
+（workers=0 の段階はキューを使わず、前の段階のスレッドで実行する）。キューが満杯になると前の段階が待ち、
+最後は IMAP の監視スレッドが次の通知を取りに行かなくなる。
+"""
+
+import email
+import os
+import socket
+import threading
+import time
+import unicodedata
+
+from firestore_rest import documents_url, service_account_token
+from lazy_import import lazy_module
+from message_ledger import DONE, FAILED, content_key, get_message_ledger, message_id_key
+from notification_parser import detect_format, extract_text_body, fetch_payload_bytes
+from outbox import guarded_send, is_duplicate, notification_scope
+from pipeline import PipelineStage, StagePipeline, default_browser_budget, stage_setting
+from profiler import begin_profile, bind_profile, discard_profile, end_profile
+from stage_metrics import bind_context, stage
+from tracing import begin_trace, bind_trace, discard_trace, end_trace, set_trace_attrs
+
+from . import SRC_DIR, firestore
+from .firestore import (
+    _get_engage_mail_settings,
+    _get_engage_target_segments,
+    _get_mail_settings,
+    _get_target_segments,
+    create_delayed_task,
+    create_scheduled_task,
+    get_account_index,
+    get_api_settings,
+)
+from .parse import (
+    _find_matching_segment,
+    _norm_account_key,
+    _oubo_no_of,
+    apply_template_tokens,
+    calc_age_from_birth_str,
+    decode_subject,
+    normalize_phone_number,
+)
+from .rpa import engage_login_class, jobbox_login_class, safe_set_memo_and_save
+from .send import _send_html_mail, send_auto_reply_if_configured, send_mail_once, send_sms_router
+
+imaplib = lazy_module('imaplib')
+requests = lazy_module('requests')
+
+
+def _imap_connect(imap_host):
+    """IMAP に接続する（EMAIL_IMAP_SSL=false で平文、EMAIL_IMAP_PORT でポート指定。ローカルの疑似サーバー用）"""
+    port = os.environ.get('EMAIL_IMAP_PORT')
+    if os.environ.get('EMAIL_IMAP_SSL', 'true').lower() in ('0', 'false', 'no'):
+        return imaplib.IMAP4(imap_host, int(port or 143))
+    return imaplib.IMAP4_SSL(imap_host, int(port or 993))
+
+
+def _resolve_jobbox_account(uid, parsed, label):
+    """通知のアカウント名（とアカウントID）に一致する jobbox_accounts を返す（見つからなければ None）
+
+    名前は正規化（NFKC・空白除去・小文字化）して完全一致で比べる。メールにアカウントIDがあればそれも一致させる。
+    """
+    parsed_name = (parsed.get('account_name') or '').strip()
+    parsed_id = (parsed.get('account_id') or '').strip()
+    with stage('account_lookup'):
+        match_account = get_account_index().find(uid, 'jobbox', parsed_name, parsed_id)
+    if match_account:
+        if parsed_id:
+            print(f"[{label}] アカウントが見つかりました: {match_account.get('account_name')} (ID: {parsed_id})")
+        else:
+            print(f"[{label}] アカウントが見つかりました: {match_account.get('account_name')} (アカウントIDなし)")
+        return match_account
+    if parsed_id:
+        print(f"[{label}] メール内のアカウント名 '{parsed_name}' & アカウントID '{parsed_id}' は jobbox_accounts に見つかりませんでした。自動ログインをスキップします。")
+    else:
+        print(f"[{label}] メール内のアカウント名 '{parsed_name}' は jobbox_accounts に見つかりませんでした。自動ログインをスキップします。")
+    return None
+
+
+def _run_jobbox_rpa(parsed, match_account, uid, label):
+    """求人ボックスの管理画面で応募者詳細を取得し、セグメント判定 → 送信 → メモ保存を行う
+
+    最後まで処理できたら True。ログイン・応募者詳細の取得に失敗したり、判定中に例外が起きたら False
+    （通知は台帳に failed として残り、未読に戻せば処理し直せる）。
+    """
+    ok = False
+    try:
+        JobboxLogin = jobbox_login_class()
+    except Exception:
+        print(f'[{label}] 自動ログイン機能は無効です：`src/jobbox_login.py` を確認してください。')
+    else:
+        try:
+            jb = JobboxLogin(match_account)
+        except Exception as e:
+            print(f'[{label}] アカウントの初期化に失敗しました: {e}')
+        else:
+            try:
+                info = jb.login_and_goto(parsed.get('url'), parsed.get('job_title'), parsed.get('oubo_no'))
+            except Exception as e:
+                print(f'[{label}] 自動ログイン中に例外が発生しました: {e}')
+                info = None
+            ok = bool(info and isinstance(info, dict) and info.get('detail'))
+            if not ok:
+                print(f'[{label}] 応募者の詳細を取得できませんでした。')
+            # 不在此处关闭 jb；保留会话以便在发送成功时写入メモ。
+            # 如果 login_and_goto 返回了 detail，则调用云端的 target_settings 做匹配判定
+            try:
+                if info and isinstance(info, dict) and info.get('detail'):
+                    detail = info.get('detail') or {}
+
+                    def get_target_settings(uid):
+                        if not uid:
+                            return {}
+                        sa_candidates = [
+                            os.path.join(os.getcwd(), 'service-account'),
+                            os.path.join(SRC_DIR, '..', 'service-account'),
+                            os.path.join(os.path.dirname(SRC_DIR), '..', 'service-account'),
+                            os.path.join(os.getcwd(), 'src', 'service-account'),
+                        ]
+                        sa_file = None
+                        for c in sa_candidates:
+                            if os.path.isfile(c):
+                                sa_file = c
+                                break
+                        if not sa_file:
+                            return {}
+                        try:
+                            import json
+                            with open(sa_file, 'r', encoding='utf-8') as f:
+                                sa = json.load(f)
+                            token = service_account_token(sa)
+                        except Exception:
+                            return {}
+                        project = sa.get('project_id')
+                        if not project:
+                            return {}
+                        url = f'{documents_url(project)}/accounts/{uid}/target_settings/settings'
+                        headers = {'Authorization': f'Bearer {token}'}
+                        try:
+                            r = requests.get(url, headers=headers, timeout=10)
+                            if r.status_code != 200:
+                                return {}
+                            data = r.json()
+                            fields = data.get('fields', {})
+                            res = {}
+                            nt = fields.get('nameTypes', {}).get('mapValue', {}).get('fields', {})
+                            if nt:
+                                res['nameTypes'] = {
+                                    'kanji': nt.get('kanji', {}).get('booleanValue', True),
+                                    'katakana': nt.get('katakana', {}).get('booleanValue', True),
+                                    'hiragana': nt.get('hiragana', {}).get('booleanValue', True),
+                                    'alpha': nt.get('alpha', {}).get('booleanValue', True),
+                                }
+                            gd = fields.get('genders', {}).get('mapValue', {}).get('fields', {})
+                            if gd:
+                                res['genders'] = {
+                                    'male': gd.get('male', {}).get('booleanValue', True),
+                                    'female': gd.get('female', {}).get('booleanValue', True),
+                                }
+                            ar = fields.get('ageRanges', {}).get('mapValue', {}).get('fields', {})
+                            if ar:
+                                def iv(k, default):
+                                    v = ar.get(k, {}).get('integerValue')
+                                    try:
+                                        return int(v)
+                                    except:
+                                        return default
+                                res['ageRanges'] = {
+                                    'maleMin': iv('maleMin', 18), 'maleMax': iv('maleMax', 99),
+                                    'femaleMin': iv('femaleMin', 18), 'femaleMax': iv('femaleMax', 99)
+                                }
+                            res['smsTemplateA'] = fields.get('smsTemplateA', {}).get('stringValue')
+                            res['smsTemplateB'] = fields.get('smsTemplateB', {}).get('stringValue')
+                            # mail related fields
+                            res['autoReply'] = fields.get('autoReply', {}).get('booleanValue') if fields.get('autoReply') is not None else False
+                            res['mailUseTarget'] = fields.get('mailUseTarget', {}).get('booleanValue') if fields.get('mailUseTarget') is not None else True
+                            res['mailUseNonTarget'] = fields.get('mailUseNonTarget', {}).get('booleanValue') if fields.get('mailUseNonTarget') is not None else False
+                            res['mailTemplateA'] = fields.get('mailTemplateA', {}).get('stringValue') if fields.get('mailTemplateA') else None
+                            res['mailTemplateB'] = fields.get('mailTemplateB', {}).get('stringValue') if fields.get('mailTemplateB') else None
+                            res['mailSubjectA'] = fields.get('mailSubjectA', {}).get('stringValue') if fields.get('mailSubjectA') else None
+                            res['mailSubjectB'] = fields.get('mailSubjectB', {}).get('stringValue') if fields.get('mailSubjectB') else None
+                            return res
+                        except Exception:
+                            return {}
+
+                    def evaluate_target(detail, settings):
+                        try:
+                            name = detail.get('name','') or ''
+                            gender = detail.get('gender','') or ''
+                            birth = detail.get('birth','') or ''
+
+                            def detect_name_types(s):
+                                types = set()
+                                if re.search(r'[\u4E00-\u9FFF]', s): types.add('kanji')
+                                if re.search(r'[\u30A0-\u30FF]', s): types.add('katakana')
+                                if re.search(r'[\u3040-\u309F]', s): types.add('hiragana')
+                                if re.search(r'[A-Za-z]', s): types.add('alpha')
+                                return types
+
+                            name_ok = True
+                            nts = settings.get('nameTypes', {})
+                            if nts:
+                                detected = detect_name_types(name)
+                                if detected:
+                                    allowed = set(k for k,v in nts.items() if v)
+                                    if not (detected & allowed):
+                                        name_ok = False
+
+                            gender_ok = True
+                            gsets = settings.get('genders', {})
+                            if gsets:
+                                g = None
+                                if '男' in gender: g = 'male'
+                                elif '女' in gender: g = 'female'
+                                if g and not gsets.get(g, True):
+                                    gender_ok = False
+
+                            age_ok = True
+                            ar = settings.get('ageRanges', {})
+                            if ar:
+                                # 尝试根据完整出生日期精确计算年龄（如果可行）
+                                parsed_age = None
+                                try:
+                                    parsed_age = calc_age_from_birth_str(birth)
+                                except Exception:
+                                    parsed_age = None
+
+                                if parsed_age is not None:
+                                    age = parsed_age
+                                    if '男' in gender:
+                                        if age < ar.get('maleMin', 0) or age > ar.get('maleMax', 999):
+                                            age_ok = False
+                                    elif '女' in gender:
+                                        if age < ar.get('femaleMin', 0) or age > ar.get('femaleMax', 999):
+                                            age_ok = False
+                                    else:
+                                        if not (ar.get('maleMin',0) <= age <= ar.get('maleMax',999) or ar.get('femaleMin',0) <= age <= ar.get('femaleMax',999)):
+                                            age_ok = False
+                                else:
+                                    # 无法解析出生日期 -> 保持兼容旧逻辑：不把无法解析视为不符合年龄条件
+                                    age_ok = True
+
+                            return bool(name_ok and gender_ok and age_ok)
+                        except Exception:
+                            return False
+
+                    # Calculate age from birth date if not present
+                    if 'age' not in detail or not detail.get('age'):
+                        birth_str = detail.get('birth', '') or ''
+                        parsed_age = None
+                        if birth_str:
+                            try:
+                                parsed_age = calc_age_from_birth_str(birth_str)
+                            except Exception:
+                                parsed_age = None
+
+                        # 仅在成功解析出年龄时写入 detail['age']，解析失败则不修改 age 字段
+                        if parsed_age is not None:
+                            detail['age'] = parsed_age
+
+                    # Load all target segments and check if applicant matches any
+                    segments = _get_target_segments(uid)
+
+                    matching_segment = _find_matching_segment(detail, segments)
+
+                    # Determine if applicant is a target (using new segment system)
+                    # Check separately for SMS and mail targets
+                    sms_target_segment = None
+                    mail_target_segment = None
+
+                    if matching_segment:
+                        # Check if this segment has SMS enabled
+                        if matching_segment['actions']['sms']['enabled']:
+                            sms_target_segment = matching_segment
+                        # Check if this segment has mail enabled  
+                        if matching_segment['actions']['mail']['enabled']:
+                            mail_target_segment = matching_segment
+
+                    # Initialize flags for SMS and Mail (ensure availability in all branches)
+                    sms_attempted = False
+                    sms_ok = False
+                    sms_info = {}
+                    mail_attempted = False
+                    mail_ok = False
+                    mail_info = {}
+                    needs_combined_status = False
+
+                    # For backward compatibility, keep is_target for SMS logic
+                    is_target = sms_target_segment is not None
+
+                    if sms_target_segment:
+                        print(f'[{label}] この応募者はSMSの送信対象です。（「{sms_target_segment["title"]}」セグメントに該当）')
+                    else:
+                        print(f'[{label}] この応募者はSMSの送信対象ではありません。')
+
+                    if mail_target_segment:
+                        print(f'[{label}] この応募者はメールの送信対象です。（「{mail_target_segment["title"]}」セグメントに該当）')
+                    else:
+                        print(f'[{label}] この応募者はメールの送信対象ではありません。')
+
+                    # Determine if we need combined status logic
+                    if sms_target_segment and mail_target_segment:
+                        # Check if both SMS and Mail will actually be attempted
+                        tel = detail.get('tel') or detail.get('電話番号') or ''
+                        try:
+                            sms_action = sms_target_segment['actions']['sms']
+                            tpl = sms_action['text'] if sms_action.get('enabled') else None
+                            will_attempt_sms = bool(tel and tpl and sms_action.get('enabled'))
+                        except Exception:
+                            will_attempt_sms = False
+
+                        try:
+                            mail_action = mail_target_segment['actions']['mail']
+                            to_email = detail.get('email', '').strip()
+                            will_attempt_mail = bool(mail_action.get('enabled') and mail_action.get('subject') and mail_action.get('body') and to_email)
+                        except Exception:
+                            will_attempt_mail = False
+
+                        needs_combined_status = will_attempt_sms and will_attempt_mail
+
+                    # Handle SMS sending
+                    if sms_target_segment:
+                        # 读取 api settings，按 provider 路由
+                        api_settings = get_api_settings(uid)
+                        provider = (api_settings.get('provider') or 'sms_publisher')
+
+
+                        tel = detail.get('tel') or detail.get('電話番号') or ''
+
+                        # Use segment's SMS content
+                        sms_action = sms_target_segment['actions']['sms']
+                        tpl = sms_action['text'] if sms_action['enabled'] else None
+                        sms_send_mode = sms_action.get('sendMode', 'immediate')
+                        sms_scheduled_time = sms_action.get('scheduledTime', '09:00')
+                        sms_delay_minutes = sms_action.get('delayMinutes', 30)
+
+                        # Debug: print SMS action settings
+                        print(f'[{label}] [DEBUG] SMS Action Settings:')
+                        print(f'[{label}]   sendMode: {sms_send_mode}')
+                        print(f'[{label}]   scheduledTime: {sms_scheduled_time}')
+                        print(f'[{label}]   delayMinutes: {sms_delay_minutes}')
+                        print(f'[{label}]   sms_action keys: {list(sms_action.keys())}')
+
+                        if tel and tpl and sms_target_segment and sms_action['enabled']:
+                            norm, ok, reason = normalize_phone_number(tel)
+                            dry_run_env = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
+                            if not ok:
+                                print(f'[{label}] 電話番号の検証に失敗しました: {tel} -> {norm} 理由: {reason}。SMSは送信されません。')
+                                # write target-out / invalid-phone history when not dry-run
+                                if not dry_run_env and uid:
+                                    try:
+                                        rec = {
+                                            'name': detail.get('name'),
+                                            'gender': detail.get('gender'),
+                                            'birth': detail.get('birth'),
+                                            'email': detail.get('email'),
+                                            'tel': norm,
+                                            'addr': detail.get('addr'),
+                                            'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                            'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                            'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                            'school': detail.get('school'),
+                                            'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                            'job_title': detail.get('kyujin') or '',
+                                            'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                            'status': '送信失敗',
+                                            'response': {'note': f'invalid phone: {reason}'},
+                                            'sentAt': int(time.time())
+                                        }
+                                        ok_write = write_sms_history(str(uid), rec)
+                                        if not ok_write:
+                                            print(f'[{label}] Failed to write sms_history for invalid phone')
+                                    except Exception as e:
+                                        print(f'[{label}] Exception when writing sms_history for invalid phone:', e)
+                            elif sms_send_mode == 'scheduled':
+                                # 定时发送: 创建定时任务
+                                print(f'[{label}] SMS時刻送信を設定します: {sms_scheduled_time}')
+                                # Prepare COMPLETE applicant data (for both template substitution AND history writing)
+                                try:
+                                    company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                    employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                    jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+                                    try:
+                                        if not jt and 'info' in locals() and isinstance(info, dict):
+                                            jt = info.get('title') or jt
+                                    except Exception:
+                                        pass
+                                    try:
+                                        if not jt and 'parsed' in locals() and isinstance(parsed, dict):
+                                            jt = parsed.get('job_title') or jt
+                                    except Exception:
+                                        pass
+
+                                    # Include ALL fields needed for template substitution AND history writing
+                                    applicant_detail_for_task = {
+                                        # Template substitution fields
+                                        'name': detail.get('name'),
+                                        'applicant_name': detail.get('name'),
+                                        'job_title': jt,
+                                        'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                        'company': company_val,
+                                        'account_name': company_val,
+                                        'employer_name': employer_val,
+                                        'employer': employer_val,
+                                        '会社名': employer_val,
+                                        # History writing fields
+                                        'gender': detail.get('gender'),
+                                        'birth': detail.get('birth'),
+                                        'age': detail.get('age'),
+                                        'email': detail.get('email') or detail.get('メール') or detail.get('メールアドレス'),
+                                        'tel': detail.get('tel') or detail.get('電話番号'),
+                                        'addr': detail.get('addr') or detail.get('住所'),
+                                        'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                        'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                        'school': detail.get('school') or detail.get('学校名'),
+                                    }
+                                except Exception as e:
+                                    print(f'[{label}] [SMS時刻] applicant_detail構築エラー: {e}')
+                                    applicant_detail_for_task = {}
+
+                                task_ok = create_scheduled_task(
+                                    uid=str(uid),
+                                    task_type='sms',
+                                    task_data={
+                                        'scheduledTime': sms_scheduled_time,
+                                        'to': norm,
+                                        'template': tpl,
+                                        'applicant_detail': applicant_detail_for_task,
+                                        'segment_id': sms_target_segment.get('id', ''),
+                                        'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted') or '',
+                                    }
+                                )
+                                if task_ok:
+                                    # DON'T set sms_attempted=True here - scheduled tasks should not write history until execution
+                                    print(f'SMS時刻送信タスク作成成功: {sms_scheduled_time}')
+                                else:
+                                    print('SMS時刻送信タスク作成失敗')
+                            elif sms_send_mode == 'delayed':
+                                # 延迟发送: 在指定分钟数后发送
+                                print(f'SMS予約送信を設定します: {sms_delay_minutes}分後')
+                                # Calculate nextRun timestamp (current time + delay minutes)
+                                from datetime import datetime, timedelta
+                                next_run_dt = datetime.now() + timedelta(minutes=sms_delay_minutes)
+                                next_run_timestamp = int(next_run_dt.timestamp())
+
+                                # Prepare COMPLETE applicant data
+                                try:
+                                    company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                    employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                    jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+                                    try:
+                                        if not jt and 'info' in locals() and isinstance(info, dict):
+                                            jt = info.get('title') or jt
+                                    except Exception:
+                                        pass
+                                    try:
+                                        if not jt and 'parsed' in locals() and isinstance(parsed, dict):
+                                            jt = parsed.get('job_title') or jt
+                                    except Exception:
+                                        pass
+
+                                    applicant_detail_for_task = {
+                                        'name': detail.get('name'),
+                                        'applicant_name': detail.get('name'),
+                                        'job_title': jt,
+                                        'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                        'company': company_val,
+                                        'account_name': company_val,
+                                        'employer_name': employer_val,
+                                        'employer': employer_val,
+                                        '会社名': employer_val,
+                                        'gender': detail.get('gender'),
+                                        'birth': detail.get('birth'),
+                                        'age': detail.get('age'),
+                                        'email': detail.get('email') or detail.get('メール') or detail.get('メールアドレス'),
+                                        'tel': detail.get('tel') or detail.get('電話番号'),
+                                        'addr': detail.get('addr') or detail.get('住所'),
+                                        'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                        'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                        'school': detail.get('school') or detail.get('学校名'),
+                                    }
+                                except Exception as e:
+                                    print(f'[SMS予約] applicant_detail構築エラー: {e}')
+                                    applicant_detail_for_task = {}
+
+                                task_ok = create_delayed_task(
+                                    uid=str(uid),
+                                    task_type='sms',
+                                    next_run=next_run_timestamp,
+                                    task_data={
+                                        'delayMinutes': sms_delay_minutes,
+                                        'to': norm,
+                                        'template': tpl,
+                                        'applicant_detail': applicant_detail_for_task,
+                                        'segment_id': sms_target_segment.get('id', ''),
+                                        'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted') or '',
+                                    }
+                                )
+                                if task_ok:
+                                    print(f'SMS予約送信タスク作成成功: {sms_delay_minutes}分後 ({next_run_dt.strftime("%Y-%m-%d %H:%M:%S")})')
+                                else:
+                                    print('SMS予約送信タスク作成失敗')
+                            else:
+                                # Prepare data map for token substitution in SMS
+                                try:
+                                    # Provide canonical SMS data keys that match mail template tokens
+                                    # so both SMS and Mail use the same set: applicant_name, job_title, employer_name
+                                    company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                    # employer_name may be present from parsed email body; prefer that for publishing-company name
+                                    employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                    # job_title fallback: prefer detail, but also fallback to info.title or parsed.job_title when available
+                                    jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+                                    try:
+                                        if not jt and 'info' in locals() and isinstance(info, dict):
+                                            jt = info.get('title') or jt
+                                    except Exception:
+                                        pass
+                                    try:
+                                        if not jt and 'parsed' in locals() and isinstance(parsed, dict):
+                                            jt = parsed.get('job_title') or jt
+                                    except Exception:
+                                        pass
+                                    sms_data = {
+                                        'applicant_name': detail.get('name'),
+                                        'job_title': jt,
+                                        # include both company/account and employer aliases for backward compatibility
+                                        'company': company_val,
+                                        'account_name': company_val,
+                                        'employer_name': employer_val,
+                                        'employer': employer_val,
+                                        '会社名': employer_val,
+                                    }
+                                except Exception:
+                                    sms_data = {}
+                                try:
+                                    tpl_to_send = apply_template_tokens(tpl, sms_data)
+                                except Exception:
+                                    tpl_to_send = tpl
+
+                                success, info = guarded_send(
+                                    uid, _oubo_no_of(detail), 'sms', (sms_target_segment or {}).get('id', ''), norm,
+                                    lambda: send_sms_router(norm, tpl_to_send, provider, api_settings))
+                                sms_attempted = True
+                                sms_ok = success
+                                sms_info = info
+
+                                # If not combined status needed, write SMS history immediately
+                                # （outbox で送信済と判定された場合は今回送っていないので書かない）
+                                if not needs_combined_status and not dry_run_env and uid and not is_duplicate(info):
+                                    try:
+                                        # determine status_code if available
+                                        status_code = None
+                                        if isinstance(info, dict) and 'status_code' in info:
+                                            try:
+                                                sc = info.get('status_code')
+                                                if sc is not None:
+                                                    status_code = int(str(sc))
+                                            except Exception:
+                                                status_code = None
+                                        if success:
+                                            rec_status = '送信済（S）'
+                                        else:
+                                            rec_status = '送信失敗（S）'
+                                        rec = {
+                                            'name': detail.get('name'),
+                                            'gender': detail.get('gender'),
+                                            'birth': detail.get('birth'),
+                                            'email': detail.get('email'),
+                                            'tel': norm,
+                                            'addr': detail.get('addr'),
+                                            'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                            'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                            'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                            'school': detail.get('school'),
+                                            'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                            'job_title': detail.get('kyujin') or detail.get('title') or '',
+                                            'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                            'status': rec_status,
+                                            'template': sms_target_segment.get('title') if sms_target_segment else 'unknown',
+                                            'response': info if isinstance(info, dict) else {'note': str(info)},
+                                            'sentAt': int(time.time())
+                                        }
+                                        try:
+                                            ok_write = write_sms_history(str(uid), rec)
+                                        except Exception:
+                                            ok_write = False
+                                        if not ok_write:
+                                            print('Failed to write sms_history after send/failure')
+                                    except Exception as e:
+                                        print('Exception when writing sms_history (result record):', e)
+                                # Only write Jobbox memo when candidate is target, send succeeded, exact HTTP 200, and not dry-run
+                                if success and not dry_run_env:
+                                    try:
+                                        if isinstance(info, dict) and 'status_code' in info:
+                                            try:
+                                                sc = info.get('status_code')
+                                                if sc is not None:
+                                                    status_code = int(str(sc))
+                                            except Exception:
+                                                status_code = None
+                                    except Exception:
+                                        status_code = None
+                                # Previously: only wrote history on success; now we've recorded both cases
+                                    try:
+                                        status_code = None
+                                        if isinstance(info, dict) and 'status_code' in info:
+                                            try:
+                                                sc = info.get('status_code')
+                                                if sc is not None:
+                                                    status_code = int(str(sc))
+                                            except Exception:
+                                                status_code = None
+                                    except Exception:
+                                        status_code = None
+
+
+                                # Collect memo lines and write a single combined memo for this applicant
+                                try:
+                                    memo_lines = []
+                                    # Determine label/title to use: prefer sms_target_segment title, else mail_target_segment title, else use ID
+                                    label = None
+                                    try:
+                                        if sms_target_segment:
+                                            label = sms_target_segment.get('title') or sms_target_segment.get('id') or 'SMS対象'
+                                        elif mail_target_segment:
+                                            label = mail_target_segment.get('title') or mail_target_segment.get('id') or 'MAIL対象'
+                                    except Exception as e:
+                                        print(f'label取得エラー: {e}')
+                                        label = None
+
+                                    # SMS result
+                                    try:
+                                        if is_target:
+                                            if success:
+                                                # Check if this is a scheduled send
+                                                if sms_send_mode == 'scheduled' and isinstance(info, dict) and 'scheduled' in info.get('note', ''):
+                                                    # Get next run date for scheduled task
+                                                    from datetime import datetime, timedelta
+                                                    import re
+                                                    scheduled_time = sms_scheduled_time
+                                                    match = re.match(r'(\d{1,2}):(\d{2})', scheduled_time)
+                                                    if match:
+                                                        hour, minute = int(match.group(1)), int(match.group(2))
+                                                        now = datetime.now()
+                                                        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                                                        if next_run <= now:
+                                                            next_run += timedelta(days=1)
+                                                        scheduled_date = next_run.strftime('%Y/%m/%d')
+                                                        sms_result = f'SMS（時刻送信{scheduled_date}）'
+                                                    else:
+                                                        sms_result = f'SMS（時刻送信）'
+                                                else:
+                                                    sms_result = 'sms送信済'
+                                            else:
+                                                # try to include status code if available
+                                                sc = None
+                                                if isinstance(info, dict):
+                                                    try:
+                                                        raw_sc = info.get('status_code')
+                                                        if raw_sc is not None:
+                                                            sc = int(str(raw_sc))
+                                                    except Exception:
+                                                        sc = None
+                                                sms_result = f'sms送信失敗{sc}' if sc is not None else 'sms送信失敗'
+                                        else:
+                                            sms_result = 'sms未送信'
+                                    except Exception:
+                                        sms_result = 'sms未送信'
+
+                                    # Mail result
+                                    try:
+                                        if mail_attempted:
+                                            if mail_ok:
+                                                # Check if this is a scheduled send
+                                                if mail_send_mode == 'scheduled' and isinstance(mail_info, dict) and 'scheduled' in mail_info.get('note', ''):
+                                                    # Get next run date for scheduled task
+                                                    from datetime import datetime, timedelta
+                                                    import re
+                                                    scheduled_time = mail_scheduled_time
+                                                    match = re.match(r'(\d{1,2}):(\d{2})', scheduled_time)
+                                                    if match:
+                                                        hour, minute = int(match.group(1)), int(match.group(2))
+                                                        now = datetime.now()
+                                                        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                                                        if next_run <= now:
+                                                            next_run += timedelta(days=1)
+                                                        scheduled_date = next_run.strftime('%Y/%m/%d')
+                                                        mail_result = f'MAIL（時刻送信{scheduled_date}）'
+                                                    else:
+                                                        mail_result = f'MAIL（時刻送信）'
+                                                else:
+                                                    mail_result = 'mail送信済'
+                                            else:
+                                                # try to include code or error
+                                                mail_code = None
+                                                if isinstance(mail_info, dict):
+                                                    mail_code = mail_info.get('status_code') or mail_info.get('code') or mail_info.get('error')
+                                                elif mail_info is not None:
+                                                    mail_code = str(mail_info)
+                                                mail_result = f'mail送信失敗{mail_code}' if mail_code else 'mail送信失敗'
+                                        else:
+                                            mail_result = 'mail未送信'
+                                    except Exception:
+                                        mail_result = 'mail未送信'
+
+                                    # If no label matched, write '対象外'
+                                    # Only write comprehensive memo if label exists (matched a segment)
+                                    # If no label (target-out), memo will be written at Line 3811 instead
+                                    if label:
+                                        # Don't add timestamp here - set_memo_and_save will auto-append it
+                                        memo_text = f"【{label}】：{sms_result}/{mail_result}"
+                                        try:
+                                            if 'jb' in locals() and jb:
+                                                safe_set_memo_and_save(jb, memo_text, '(まとめ)')
+                                        except Exception as e:
+                                            print('メモ保存(まとめ)時に例外が発生しました:', e)
+                                except Exception as e:
+                                    print('合并メモ処理で例外:', e)
+                        # If tel or template was missing, record that fact (do not run this when we successfully sent above)
+                        if not (tel and tpl):
+                            print('電話番号またはテンプレートが不足しているため、SMSは送信されませんでした。')
+                            dry_run_env = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
+                            if not dry_run_env and uid:
+                                try:
+                                    rec = {
+                                        'name': detail.get('name'),
+                                        'gender': detail.get('gender'),
+                                        'birth': detail.get('birth'),
+                                        'email': detail.get('email'),
+                                        'tel': detail.get('tel') or detail.get('電話番号') or '',
+                                        'addr': detail.get('addr'),
+                                        'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                        'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                        'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                        'school': detail.get('school'),
+                                        'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                        'job_title': detail.get('kyujin') or '',
+                                        'status': '送信失敗',
+                                        'response': {'note': 'missing tel or template'},
+                                        'sentAt': int(time.time())
+                                    }
+                                    ok_write = write_sms_history(str(uid), rec)
+                                    if not ok_write:
+                                        print('Failed to write sms_history for missing tel/template')
+                                except Exception as e:
+                                    print('Exception when writing sms_history for missing tel/template:', e)
+
+                    # Handle Mail sending (independent of SMS)
+                    mail_attempted = False
+                    mail_ok = False
+                    mail_info = {}
+                    mail_send_mode = 'immediate'
+                    mail_scheduled_time = '09:00'
+
+                    if mail_target_segment:
+                        try:
+                            mail_action = mail_target_segment['actions']['mail']
+                            mail_send_mode = mail_action.get('sendMode', 'immediate')
+                            mail_scheduled_time = mail_action.get('scheduledTime', '09:00')
+                            mail_delay_minutes = mail_action.get('delayMinutes', 30)
+
+                            # Debug: print MAIL action settings
+                            print(f'[DEBUG] MAIL Action Settings:')
+                            print(f'  sendMode: {mail_send_mode}')
+                            print(f'  scheduledTime: {mail_scheduled_time}')
+                            print(f'  delayMinutes: {mail_delay_minutes}')
+                            print(f'  mail_action keys: {list(mail_action.keys())}')
+
+                            if mail_action['enabled'] and mail_action['subject'] and mail_action['body']:
+                                to_email = detail.get('email', '').strip()
+                                if to_email:
+                                    # Get mail settings (sender credentials)
+                                    mail_cfg = _get_mail_settings(str(uid) if uid is not None else "")
+                                    sender = mail_cfg.get('replyEmail') or mail_cfg.get('email', '')
+                                    sender_pass = mail_cfg.get('replyAppPass') or mail_cfg.get('appPass', '')
+
+                                    if sender and sender_pass:
+                                        subject = mail_action['subject']
+                                        body = mail_action['body']
+
+                                        # Apply template tokens before sending (subject + body)
+                                        try:
+                                            # Build a data map for template replacement with multiple fallbacks.
+                                            applicant_name = ''
+                                            job_title_val = ''
+                                            company_val = ''
+                                            employer_name_val = ''  # 追加：勤務先名
+                                            if isinstance(detail, dict):
+                                                applicant_name = detail.get('name') or detail.get('氏名') or detail.get('\u6c0f\u540d') or ''
+                                                job_title_val = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+                                                company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company') or ''
+                                                employer_name_val = detail.get('employer_name') or detail.get('掲載企業名') or detail.get('企業名') or ''  # 追加
+
+                                            # fallback to info.title returned by find_and_check_applicant
+                                            try:
+                                                if not job_title_val and 'info' in locals() and isinstance(info, dict):
+                                                    job_title_val = info.get('title') or job_title_val
+                                            except Exception:
+                                                pass
+
+                                            # fallback to parsed values (from the initial Jobbox notice email)
+                                            try:
+                                                if not job_title_val and 'parsed' in locals() and isinstance(parsed, dict):
+                                                    job_title_val = parsed.get('job_title') or job_title_val
+                                            except Exception:
+                                                pass
+                                            try:
+                                                if not company_val and 'parsed' in locals() and isinstance(parsed, dict):
+                                                    company_val = parsed.get('account_name') or company_val
+                                            except Exception:
+                                                pass
+                                            # fallback for employer_name from parsed values
+                                            try:
+                                                if not employer_name_val and 'parsed' in locals() and isinstance(parsed, dict):
+                                                    employer_name_val = parsed.get('employer_name') or employer_name_val
+                                            except Exception:
+                                                pass
+
+                                            # fallback to jb.account if available
+                                            try:
+                                                if not company_val and 'jb' in locals() and getattr(jb, 'account', None):
+                                                    company_val = (jb.account.get('account_name') if isinstance(jb.account, dict) else None) or company_val
+                                            except Exception:
+                                                pass
+
+                                            data_for_mail = {
+                                                # Template substitution fields
+                                                'applicant_name': applicant_name,
+                                                'name': applicant_name,
+                                                '氏名': applicant_name,
+                                                'job_title': job_title_val,
+                                                'job_url': (detail.get('job_url') or detail.get('jobUrl') or '') if isinstance(detail, dict) else '',
+                                                'position': job_title_val,
+                                                '求人タイトル': job_title_val,
+                                                '職種': job_title_val,
+                                                'company': company_val,
+                                                'account_name': company_val,
+                                                'アカウント名': company_val,
+                                                'employer_name': employer_name_val,
+                                                'employer': employer_name_val,
+                                                '会社名': employer_name_val,
+                                                '掲載企業名': employer_name_val,
+                                                '企業名': employer_name_val,
+                                                # History writing fields (for scheduled tasks)
+                                                'gender': detail.get('gender') if isinstance(detail, dict) else '',
+                                                'birth': detail.get('birth') if isinstance(detail, dict) else '',
+                                                'age': detail.get('age') if isinstance(detail, dict) else '',
+                                                'email': to_email,
+                                                'tel': detail.get('tel') or detail.get('電話番号') if isinstance(detail, dict) else '',
+                                                'addr': detail.get('addr') or detail.get('住所') if isinstance(detail, dict) else '',
+                                                'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') if isinstance(detail, dict) else '',
+                                                'work_address': detail.get('work_address') or detail.get('workAddress') if isinstance(detail, dict) else '',
+                                                'school': detail.get('school') or detail.get('学校名') if isinstance(detail, dict) else '',
+                                            }
+                                        except Exception:
+                                            data_for_mail = {}
+
+                                        # Check send mode
+                                        if mail_send_mode == 'scheduled':
+                                            # 定时发送MAIL: 创建定时任务
+                                            print(f'MAIL時刻送信を設定します: {mail_scheduled_time}')
+                                            task_ok = create_scheduled_task(
+                                                uid=str(uid),
+                                                task_type='mail',
+                                                task_data={
+                                                    'scheduledTime': mail_scheduled_time,
+                                                    'to': to_email,
+                                                    'template': body,
+                                                    'subject': subject,
+                                                    'applicant_detail': data_for_mail,
+                                                    'segment_id': mail_target_segment.get('id', ''),
+                                                    'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted') or '',
+                                                }
+                                            )
+                                            if task_ok:
+                                                # DON'T set mail_attempted=True here - scheduled tasks should not write history until execution
+                                                print(f'MAIL時刻送信タスク作成成功: {mail_scheduled_time}')
+                                            else:
+                                                print('MAIL時刻送信タスク作成失敗')
+                                        elif mail_send_mode == 'delayed':
+                                            # 延迟发送MAIL: 在指定分钟数后发送
+                                            print(f'MAIL予約送信を設定します: {mail_delay_minutes}分後')
+                                            # Calculate nextRun timestamp
+                                            from datetime import datetime, timedelta
+                                            next_run_dt = datetime.now() + timedelta(minutes=mail_delay_minutes)
+                                            next_run_timestamp = int(next_run_dt.timestamp())
+
+                                            task_ok = create_delayed_task(
+                                                uid=str(uid),
+                                                task_type='mail',
+                                                next_run=next_run_timestamp,
+                                                task_data={
+                                                    'delayMinutes': mail_delay_minutes,
+                                                    'to': to_email,
+                                                    'template': body,
+                                                    'subject': subject,
+                                                    'applicant_detail': data_for_mail,
+                                                    'segment_id': mail_target_segment.get('id', ''),
+                                                    'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted') or '',
+                                                }
+                                            )
+                                            if task_ok:
+                                                print(f'MAIL予約送信タスク作成成功: {mail_delay_minutes}分後 ({next_run_dt.strftime("%Y-%m-%d %H:%M:%S")})')
+                                            else:
+                                                print('MAIL予約送信タスク作成失敗')
+                                        else:
+                                            # 即时发送
+                                            mail_attempted = True
+                                            try:
+                                                subject_to_send = apply_template_tokens(subject or '', data_for_mail)
+                                                body_to_send = apply_template_tokens(body or '', data_for_mail)
+                                            except Exception:
+                                                subject_to_send = subject or ''
+                                                body_to_send = body or ''
+
+                                            # Debug: show data_for_mail and substituted values
+                                            debug_mail = os.environ.get('DEBUG_MAIL', 'false').lower() in ('1','true','yes')
+                                            if debug_mail:
+                                                try:
+                                                    print('[DEBUG_MAIL] data_for_mail keys:', list(data_for_mail.keys()))
+                                                    print('[DEBUG_MAIL] employer_name:', data_for_mail.get('employer_name', 'None'))
+                                                    print('[DEBUG_MAIL] 会社名:', data_for_mail.get('会社名', 'None'))
+                                                    print('[DEBUG_MAIL] substituted subject:', (subject_to_send or '')[:120])
+                                                    print('[DEBUG_MAIL] substituted body   :', re.sub(r'\s+', ' ', (body_to_send or ''))[:180])
+                                                except Exception:
+                                                    pass
+
+                                            # Check if DRY_RUN_MAIL is enabled
+                                            mail_dry = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+                                            if mail_dry:
+                                                print(f'[DRY_RUN_MAIL] would send mail from={sender} to={to_email} subj={subject_to_send}')
+                                                mail_ok, mail_info = True, {'note': 'dry_run'}
+                                            else:
+                                                # Send HTML email (body may be HTML; apply_template_tokens already HTML-escapes values if needed)
+                                                mail_ok, mail_info = _send_html_mail(sender, sender_pass, to_email, subject_to_send, body_to_send)
+
+                                            if mail_ok:
+                                                print(f'メール送信成功: {to_email} (件名: {subject_to_send})')
+                                            else:
+                                                print(f'メール送信失敗: {to_email} - {mail_info}')
+
+                                            # If not combined status needed, write mail history immediately
+                                            mail_dry_env = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+
+                                            if not needs_combined_status and not mail_dry_env and uid:
+                                                try:
+                                                    rec = {
+                                                        'name': detail.get('name'),
+                                                        'gender': detail.get('gender'),
+                                                        'birth': detail.get('birth'),
+                                                        'email': detail.get('email'),
+                                                        'tel': detail.get('tel') or detail.get('電話番号') or '',
+                                                        'addr': detail.get('addr'),
+                                                        'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                                        'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                                        'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                                        'school': detail.get('school'),
+                                                        'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                                        'job_title': detail.get('kyujin') or detail.get('title') or '',
+                                                        'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                                        'status': '送信済（M）' if mail_ok else '送信失敗（M）',  # M for Mail
+                                                        'response': mail_info if isinstance(mail_info, dict) else {'note': str(mail_info)},
+                                                        'sentAt': int(time.time())
+                                                    }
+                                                    ok_write_history = write_sms_history(str(uid), rec)  # Use same table as SMS
+                                                    if not ok_write_history:
+                                                        print('履歴の書き込みに失敗しました（メール）')
+                                                except Exception as e:
+                                                    print(f'履歴書き込み例外（メール）: {e}')
+                                    else:
+                                        print('メール設定が不完全です（送信者またはパスワードが不足）')
+                                        mail_info = {'error': 'incomplete mail settings'}
+                                else:
+                                    print('応募者のメールアドレスが見つかりません')
+                                    mail_info = {'error': 'no email address'}
+                            else:
+                                print('メール機能が無効か、件名/本文が設定されていません')
+                                mail_info = {'error': 'mail action disabled or incomplete'}
+                        except Exception as e:
+                            print(f'メール送信処理中に例外が発生しました: {e}')
+                            mail_info = {'error': str(e)}
+
+                    # Add mail memo if mail was attempted and not in dry-run mode
+                    if mail_attempted and (not os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')):
+                        try:
+                            mail_note = 'RPA:メール:送信済み' if mail_ok else 'RPA:メール:送信失敗'
+                            # Try to extract a concise note from mail_info
+                            info_snip = ''
+                            try:
+                                if isinstance(mail_info, dict):
+                                    info_snip = mail_info.get('note') or mail_info.get('error') or str(mail_info.get('status_code', ''))
+                                    if info_snip and isinstance(info_snip, dict):
+                                        info_snip = ''
+                                else:
+                                    info_snip = str(mail_info)
+                            except Exception:
+                                info_snip = ''
+                            if info_snip:
+                                mail_note = f"{mail_note} ({info_snip})"
+                            try:
+                                if 'jb' in locals() and jb:
+                                    safe_set_memo_and_save(jb, mail_note, '(MAIL)')
+                            except Exception as e:
+                                print('メモ保存(MAIL)時に例外が発生しました:', e)
+                        except Exception as e:
+                            print('メール memo 処理で例外:', e)
+
+                    # Handle combined status history writing if both SMS and Mail were attempted
+                    if needs_combined_status and uid:
+                        dry_run_sms = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
+                        dry_run_mail = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+
+                        # outbox で送信済と判定された（今回は送っていない）チャネルは記録に含めない
+                        sms_part = sms_attempted and not is_duplicate(sms_info)
+                        mail_part = mail_attempted and not is_duplicate(mail_info)
+                        all_dup = (sms_attempted or mail_attempted) and not (sms_part or mail_part)
+
+                        if not (dry_run_sms and dry_run_mail) and not all_dup:  # Write history unless both are dry-run
+                            try:
+                                # Determine combined status
+                                if sms_part and mail_part:
+                                    # both channels attempted
+                                    if sms_ok and mail_ok:
+                                        combined_status = '送信済（M+S）'
+                                    elif sms_ok and not mail_ok:
+                                        combined_status = '送信済（S）+送信失敗（M）'
+                                    elif not sms_ok and mail_ok:
+                                        combined_status = '送信失敗（S）+送信済（M）'
+                                    else:
+                                        combined_status = '送信失敗（M+S）'
+                                elif sms_part and not mail_part:
+                                    combined_status = '送信済（S）' if sms_ok else '送信失敗（S）'
+                                elif not sms_part and mail_part:
+                                    combined_status = '送信済（M）' if mail_ok else '送信失敗（M）'
+                                else:
+                                    combined_status = '送信失敗（S）'
+
+                                # Create combined response info
+                                combined_response = {}
+                                if sms_part and isinstance(sms_info, dict):
+                                    combined_response['sms'] = sms_info
+                                if mail_part and isinstance(mail_info, dict):
+                                    combined_response['mail'] = mail_info
+
+                                # Create combined history record
+                                rec = {
+                                    'name': detail.get('name'),
+                                    'gender': detail.get('gender'),
+                                    'birth': detail.get('birth'),
+                                    'email': detail.get('email'),
+                                    'tel': detail.get('tel') or detail.get('電話番号') or '',
+                                    'addr': detail.get('addr'),
+                                    'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                    'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                    'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                    'school': detail.get('school'),
+                                    'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                    'job_title': detail.get('kyujin') or detail.get('title') or '',
+                                    'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                    'status': combined_status,
+                                    'response': combined_response if combined_response else {'note': 'combined attempt'},
+                                    'sentAt': int(time.time())
+                                }
+
+                                ok_write_combined = write_sms_history(str(uid), rec)
+                                if not ok_write_combined:
+                                    print('組み合わせ履歴の書き込みに失敗しました')
+                            except Exception as e:
+                                print(f'組み合わせ履歴書き込み例外: {e}')
+
+                    else:
+                        # For non-target applicants, use the old mail system (if configured)
+                        dry_run_env = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
+                        # Mail auto-reply for non-target (if configured)
+                        try:
+                            # Create timestamp for non-target users (if needed) but
+                            # pass actual mail/target settings dict to send_auto_reply_if_configured
+                            now_ts = int(time.time())
+                            try:
+                                mail_cfg = get_target_settings(uid)
+                            except Exception:
+                                mail_cfg = {}
+                            # Call auto-reply helper and capture result so we can write mail_history
+                            try:
+                                mail_sent_ok, mail_sent_flag, mail_sent_info = send_auto_reply_if_configured(uid, mail_cfg, False, detail, jb)
+                            except Exception as e:
+                                mail_sent_ok, mail_sent_flag, mail_sent_info = (False, False, {'error': str(e)})
+
+                            # Write sms_history if not dry-run (same table as SMS, with M suffix)
+                            try:
+                                mail_dry_env2 = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+
+                                # Only write if mail was actually attempted（outbox で送信済と判定された場合は書かない）
+                                if not mail_dry_env2 and uid and mail_sent_flag and not is_duplicate(mail_sent_info):
+                                    # Add (M) suffix to status to distinguish mail from SMS
+                                    base_status = '送信済' if (mail_sent_ok and mail_sent_flag) else ('送信失敗' if mail_sent_ok and not mail_sent_flag else '送信抑制')
+                                    mail_status = f'{base_status}（M）'
+                                    rec = {
+                                        'name': detail.get('name'),
+                                        'gender': detail.get('gender'),
+                                        'birth': detail.get('birth'),
+                                        'email': detail.get('email'),
+                                        'tel': detail.get('tel') or detail.get('電話番号') or '',
+                                        'addr': detail.get('addr'),
+                                        'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                        'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                        'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                        'school': detail.get('school'),
+                                        'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                        'job_title': detail.get('kyujin') or '',
+                                        'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                        'status': mail_status,
+                                        'response': mail_sent_info if isinstance(mail_sent_info, dict) else {'note': str(mail_sent_info)},
+                                        'sentAt': int(time.time())
+                                    }
+                                    ok_write_mail2 = write_sms_history(str(uid), rec)  # Use same table as SMS
+                                    if not ok_write_mail2:
+                                        print('Failed to write mail_history (non-target)')
+                            except Exception as e:
+                                print('Exception when writing mail_history (non-target):', e)
+                        except Exception as e:
+                            print('メール送信処理中に例外が発生しました(対象外):', e)
+                        if not dry_run_env and uid:
+                            try:
+                                # If any channel was attempted (SMS or Mail), do not write a
+                                # separate "対象外" record. This avoids duplicate rows when
+                                # one channel is intentionally disabled/off and the other
+                                # was sent or when an auto-reply mail was attempted.
+                                any_attempted = bool(locals().get('mail_sent_flag') or locals().get('mail_attempted') or locals().get('sms_attempted'))
+                                if any_attempted:
+                                    print('Skipping target-out history write: a channel was attempted for this applicant')
+                                else:
+                                    rec = {
+                                        'name': detail.get('name'),
+                                        'gender': detail.get('gender'),
+                                        'birth': detail.get('birth'),
+                                        'email': detail.get('email'),
+                                        'tel': detail.get('tel') or detail.get('電話番号') or '',
+                                        'addr': detail.get('addr'),
+                                        'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                        'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                        'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                        'school': detail.get('school'),
+                                        'oubo_no': detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted'),
+                                        'job_title': detail.get('kyujin') or '',
+                                        'job_url': detail.get('job_url') or detail.get('jobUrl') or '',
+                                        'status': '対象外',
+                                        'response': {'note': 'evaluated as not target'},
+                                        'sentAt': int(time.time())
+                                    }
+                                    ok_write = write_sms_history(str(uid), rec)
+                                    if not ok_write:
+                                        print('Failed to write sms_history for target-out')
+                            except Exception as e:
+                                print('Exception when writing sms_history for target-out:', e)
+                            # 写入 Jobbox メモ为「RPA:対象外」，如果我们仍然持有 jb 会话且不是 dry-run
+                            try:
+                                if (not dry_run_env) and 'jb' in locals() and jb:
+                                    safe_set_memo_and_save(jb, 'RPA:対象外', '(対象外)')
+                            except Exception:
+                                pass
+            except Exception as e:
+                print(f'対象判定中に例外が発生しました: {e}')
+                ok = False
+
+            # Ensure jb is closed after all memo operations are completed
+            try:
+                if 'jb' in locals() and jb:
+                    jb.close()
+            except Exception:
+                pass
+    return ok
+
+
+def _resolve_engage_account(uid, parsed, label):
+    """通知のアカウント名に一致する engage_accounts を返す（見つからなければ None）"""
+    parsed_name = (parsed.get('account_name') or '').strip()
+    with stage('account_lookup'):
+        match_account = get_account_index().find(uid, 'engage', parsed_name)
+    if match_account:
+        return match_account
+    print(f"メール内のアカウント名 '{parsed_name}' は engage_accounts に見つかりませんでした。自動ログインをスキップします。")
+    print('=' * 50)
+    return None
+
+
+def _run_engage_rpa(parsed, match_account, uid, label):
+    """エンゲージの管理画面で応募者詳細を取得し、セグメント判定 → 送信 → メモ保存を行う
+
+    最後まで処理できたら True。ブラウザの初期化・ログイン・応募者詳細の取得に失敗したり、
+    処理中に例外が起きたら False（_run_jobbox_rpa と同じ）。
+    """
+
+    # エンゲージ自動ログイン処理（完全な異常捕获，不会闪退）
+    engage = None
+    ok = False
+    try:
+        # print('[エンゲージ] ===== RPA処理を開始します =====')
+        try:
+            EngageLogin = engage_login_class()
+            # print('[エンゲージ] ✓ EngageLoginモジュールを読み込みました')
+        except Exception as import_err:
+            print(f'[エンゲージ] ❌ EngageLogin読み込みエラー: {import_err}')
+            print('  `src/engage_login.py` を確認してください。')
+            print('  処理をスキップして次のメールに進みます。')
+            print('=' * 50)
+            return False
+
+        try:
+            # print(f'[エンゲージ] EngageLoginを初期化します...')
+            # print(f'  アカウント名: {match_account.get("account_name")}')
+            # print(f'  ID: {match_account.get("engage_id")}')
+            # print(f'  URL: {parsed.get("url")}')
+
+            try:
+                engage = EngageLogin(match_account)
+                # print('[エンゲージ] ✓ ブラウザ初期化成功')
+            except Exception as init_err:
+                print(f'[エンゲージ] ❌ ブラウザ初期化エラー: {init_err}')
+                print('  ChromeDriverが正しくインストールされているか確認してください。')
+                import traceback
+                traceback.print_exc()
+                print('  処理をスキップして次のメールに進みます。')
+                print('=' * 50)
+                return False
+
+            # print('[エンゲージ] login_and_goto()を呼び出します...')
+            try:
+                # メールから取得した職種名を渡す
+                info = engage.login_and_goto(parsed.get('url'), parsed.get('job_title', ''))
+                # print(f'[エンゲージ] ✓ login_and_goto()完了: {type(info)}')
+            except Exception as login_err:
+                print(f'[エンゲージ] ❌ ログイン処理エラー: {login_err}')
+                import traceback
+                traceback.print_exc()
+                print('  処理をスキップして次のメールに進みます。')
+                try:
+                    if engage:
+                        engage.close()
+                        # print('[エンゲージ] ブラウザを閉じました')
+                except:
+                    pass
+                print('=' * 50)
+                return False
+
+            ok = bool(info and isinstance(info, dict) and info.get('detail'))
+            if not ok:
+                print('[エンゲージ] 応募者の詳細を取得できませんでした。')
+            if info and isinstance(info, dict) and info.get('detail'):
+                detail = info.get('detail') or {}
+
+                # 応募Noを追加（URLから取得）
+                if not detail.get('oubo_no') and parsed.get('oubo_no'):
+                    detail['oubo_no'] = parsed.get('oubo_no')
+                    detail['応募No'] = parsed.get('oubo_no')
+
+                # アカウント名と求人タイトルを追加
+                detail['account_name'] = parsed.get('account_name')
+                # 職種名はlogin_and_goto()で既に設定済み（メールから取得）
+                detail['job_title'] = info.get('title', '') or parsed.get('job_title', '')
+                detail['employer_name'] = parsed.get('employer_name')
+                detail['company'] = parsed.get('account_name')
+
+                # 年齢を計算（まだ取得できていない場合）
+                if 'age' not in detail or not detail.get('age'):
+                    birth_str = detail.get('birth', '') or ''
+                    if birth_str:
+                        try:
+                            parsed_age = calc_age_from_birth_str(birth_str)
+                            if parsed_age is not None:
+                                detail['age'] = parsed_age
+                        except Exception:
+                            pass
+
+                # エンゲージのsegment配置を読取
+                segments = _get_engage_target_segments(uid)
+                if not segments:
+                    print('エンゲージのセグメント設定が見つかりません')
+                    # 履歴に記録（対象外として）
+                    try:
+                        rec = {
+                            'name': detail.get('name'),
+                            'furigana': detail.get('furigana', ''),
+                            'gender': detail.get('gender'),
+                            'birth': detail.get('birth'),
+                            'age': detail.get('age'),
+                            'email': detail.get('email'),
+                            'tel': detail.get('tel'),
+                            'addr': detail.get('addr'),
+                            'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                            'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                            'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                            'oubo_no': detail.get('oubo_no'),
+                            'job_title': detail.get('title') or '',
+                            'source': 'engage',
+                            'platform': 'エンゲージ',
+                            'status': '対象外',
+                            'response': {'note': 'セグメント設定なし'},
+                            'sentAt': int(time.time())
+                        }
+                        write_sms_history(str(uid), rec)
+                    except Exception:
+                        pass
+                else:
+                    # セグメントマッチング
+                    matching_segment = _find_matching_segment(detail, segments)
+
+                    if matching_segment:
+                        print(f'✓ セグメント「{matching_segment["title"]}」に該当します（エンゲージ）')
+
+                        # ===== SMS/Mail送信処理（求人ボックスと同じロジックを使用）=====
+                        # エンゲージ専用のmail_settingsを読み込む
+                        engage_mail_settings = _get_engage_mail_settings(uid)
+
+                        # SMS/Mail送信フラグ
+                        sms_attempted = False
+                        sms_ok = False
+                        sms_info = {}
+                        mail_attempted = False
+                        mail_ok = False
+                        mail_info = {}
+
+                        # SMS/Mailが両方有効かチェック
+                        needs_combined_status = False
+                        try:
+                            tel = detail.get('tel') or detail.get('電話番号') or ''
+                            sms_action = matching_segment['actions']['sms']
+                            tpl = sms_action['text'] if sms_action.get('enabled') else None
+                            will_attempt_sms = bool(tel and tpl and sms_action.get('enabled'))
+                        except Exception:
+                            will_attempt_sms = False
+
+                        try:
+                            mail_action = matching_segment['actions']['mail']
+                            to_email = detail.get('email', '').strip()
+                            will_attempt_mail = bool(mail_action.get('enabled') and mail_action.get('subject') and mail_action.get('body') and to_email)
+                        except Exception:
+                            will_attempt_mail = False
+
+                        needs_combined_status = will_attempt_sms and will_attempt_mail
+
+                        # ===== SMS送信処理 =====
+                        if matching_segment:
+                            # API設定を取得（求人ボックスと同じAPIを使用）
+                            api_settings = get_api_settings(uid)
+                            provider = (api_settings.get('provider') or 'sms_publisher')
+
+                            # エンゲージ流程中使用模块级别的SMS发送函数
+                            tel = detail.get('tel') or detail.get('電話番号') or ''
+
+                            # セグメントのSMS設定を使用
+                            sms_action = matching_segment['actions']['sms']
+                            tpl = sms_action['text'] if sms_action['enabled'] else None
+                            sms_send_mode = sms_action.get('sendMode', 'immediate')
+                            sms_scheduled_time = sms_action.get('scheduledTime', '09:00')
+                            sms_delay_minutes = sms_action.get('delayMinutes', 30)
+
+                            if tel and tpl and matching_segment and sms_action['enabled']:
+                                norm, ok, reason = normalize_phone_number(tel)
+                                dry_run_env = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
+
+                                if not ok:
+                                    print(f'電話番号の検証に失敗: {tel} -> {norm} 理由: {reason}')
+                                    if not dry_run_env and uid:
+                                        try:
+                                            rec = {
+                                                'name': detail.get('name'),
+                                                'furigana': detail.get('furigana', ''),
+                                                'gender': detail.get('gender'),
+                                                'birth': detail.get('birth'),
+                                                'age': detail.get('age'),
+                                                'email': detail.get('email'),
+                                                'tel': norm,
+                                                'addr': detail.get('addr'),
+                                                'school': detail.get('school'),
+                                                'oubo_no': detail.get('oubo_no'),
+                                                'job_title': detail.get('title') or '',
+                                                'source': 'engage',
+                                                'platform': 'エンゲージ',
+                                                'status': '送信失敗',
+                                                'response': {'note': f'invalid phone: {reason}'},
+                                                'sentAt': int(time.time())
+                                            }
+                                            write_sms_history(str(uid), rec)
+                                        except Exception as e:
+                                            print(f'履歴記録エラー: {e}')
+
+                                elif sms_send_mode == 'scheduled':
+                                    # 定時送信
+                                    print(f'SMS時刻送信を設定します: {sms_scheduled_time}')
+                                    try:
+                                        company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                        employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                        jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+
+                                        applicant_detail_for_task = {
+                                            'name': detail.get('name'),
+                                            'applicant_name': detail.get('name'),
+                                            'job_title': jt,
+                                            'company': company_val,
+                                            'account_name': company_val,
+                                            'employer_name': employer_val,
+                                            'employer': employer_val,
+                                            '会社名': employer_val,
+                                            'gender': detail.get('gender'),
+                                            'birth': detail.get('birth'),
+                                            'age': detail.get('age'),
+                                            'email': detail.get('email'),
+                                            'tel': detail.get('tel'),
+                                            'addr': detail.get('addr'),
+                                            'school': detail.get('school'),
+                                        }
+                                    except Exception as e:
+                                        print(f'[SMS時刻] applicant_detail構築エラー: {e}')
+                                        applicant_detail_for_task = {}
+
+                                    task_ok = create_scheduled_task(
+                                        uid=str(uid),
+                                        task_type='sms',
+                                        task_data={
+                                            'scheduledTime': sms_scheduled_time,
+                                            'to': norm,
+                                            'template': tpl,
+                                            'applicant_detail': applicant_detail_for_task,
+                                            'segment_id': matching_segment.get('id', ''),
+                                            'oubo_no': detail.get('oubo_no') or '',
+                                        }
+                                    )
+                                    if task_ok:
+                                        print(f'SMS時刻送信タスク作成成功: {sms_scheduled_time}')
+                                    else:
+                                        print('SMS時刻送信タスク作成失敗')
+
+                                elif sms_send_mode == 'delayed':
+                                    # 延迟送信
+                                    print(f'SMS予約送信を設定します: {sms_delay_minutes}分後')
+                                    from datetime import datetime, timedelta
+                                    next_run_dt = datetime.now() + timedelta(minutes=sms_delay_minutes)
+                                    next_run_timestamp = int(next_run_dt.timestamp())
+
+                                    try:
+                                        company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                        employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                        jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+
+                                        applicant_detail_for_task = {
+                                            'name': detail.get('name'),
+                                            'applicant_name': detail.get('name'),
+                                            'job_title': jt,
+                                            'company': company_val,
+                                            'account_name': company_val,
+                                            'employer_name': employer_val,
+                                            'employer': employer_val,
+                                            '会社名': employer_val,
+                                            'gender': detail.get('gender'),
+                                            'birth': detail.get('birth'),
+                                            'age': detail.get('age'),
+                                            'email': detail.get('email'),
+                                            'tel': detail.get('tel'),
+                                            'addr': detail.get('addr'),
+                                            'school': detail.get('school'),
+                                        }
+                                    except Exception as e:
+                                        print(f'[SMS予約] applicant_detail構築エラー: {e}')
+                                        applicant_detail_for_task = {}
+
+                                    task_ok = create_delayed_task(
+                                        uid=str(uid),
+                                        task_type='sms',
+                                        next_run=next_run_timestamp,
+                                        task_data={
+                                            'delayMinutes': sms_delay_minutes,
+                                            'to': norm,
+                                            'template': tpl,
+                                            'applicant_detail': applicant_detail_for_task,
+                                            'segment_id': matching_segment.get('id', ''),
+                                            'oubo_no': detail.get('oubo_no') or '',
+                                        }
+                                    )
+                                    if task_ok:
+                                        print(f'SMS予約送信タスク作成成功: {sms_delay_minutes}分後 ({next_run_dt.strftime("%Y-%m-%d %H:%M:%S")})')
+                                    else:
+                                        print('SMS予約送信タスク作成失敗')
+
+                                else:
+                                    # 即時送信
+                                    try:
+                                        company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                        employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                        jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+
+                                        sms_data = {
+                                            'applicant_name': detail.get('name'),
+                                            'job_title': jt,
+                                            'company': company_val,
+                                            'account_name': company_val,
+                                            'employer_name': employer_val,
+                                            'employer': employer_val,
+                                            '会社名': employer_val,
+                                        }
+                                    except Exception:
+                                        sms_data = {}
+
+                                    try:
+                                        tpl_to_send = apply_template_tokens(tpl, sms_data)
+                                    except Exception:
+                                        tpl_to_send = tpl
+
+                                    success, info = guarded_send(
+                                        uid, _oubo_no_of(detail), 'sms', (matching_segment or {}).get('id', ''), norm,
+                                        lambda: send_sms_router(norm, tpl_to_send, provider, api_settings))
+                                    sms_attempted = True
+                                    sms_ok = success
+                                    sms_info = info
+
+                                    # 显示SMS发送结果
+                                    if success:
+                                        print(f'✅ SMS送信完了')
+                                    else:
+                                        print(f'❌ SMS送信失敗')
+
+                                    # 単独SMS送信の場合は即座に履歴記録（outbox で送信済と判定された場合は書かない）
+                                    if not needs_combined_status and not dry_run_env and uid and not is_duplicate(info):
+                                        try:
+                                            rec_status = '送信済（S）' if success else '送信失敗（S）'
+                                            rec = {
+                                                'name': detail.get('name'),
+                                                'furigana': detail.get('furigana', ''),
+                                                'gender': detail.get('gender'),
+                                                'birth': detail.get('birth'),
+                                                'age': detail.get('age'),
+                                                'email': detail.get('email'),
+                                                'tel': norm,
+                                                'addr': detail.get('addr'),
+                                                'school': detail.get('school'),
+                                                'oubo_no': detail.get('oubo_no'),
+                                                'job_title': detail.get('title') or '',
+                                                'source': 'engage',
+                                                'platform': 'エンゲージ',
+                                                'segment_title': matching_segment.get('title'),
+                                                'status': rec_status,
+                                                'response': info if isinstance(info, dict) else {'note': str(info)},
+                                                'sentAt': int(time.time())
+                                            }
+                                            write_sms_history(str(uid), rec)
+                                        except Exception as e:
+                                            print(f'SMS履歴記録エラー: {e}')
+
+                        # ===== Mail送信処理 =====
+                        if matching_segment:
+                            try:
+                                mail_action = matching_segment['actions']['mail']
+                                to_email = detail.get('email', '').strip()
+
+                                if mail_action.get('enabled') and mail_action.get('subject') and mail_action.get('body') and to_email:
+                                    mail_send_mode = mail_action.get('sendMode', 'immediate')
+                                    mail_scheduled_time = mail_action.get('scheduledTime', '09:00')
+                                    mail_delay_minutes = mail_action.get('delayMinutes', 30)
+
+                                    # エンゲージ専用のmail_settings取得
+                                    sender = engage_mail_settings.get('replyEmail') or engage_mail_settings.get('email')
+                                    sender_pass = engage_mail_settings.get('replyAppPass') or engage_mail_settings.get('appPass')
+
+                                    if not sender or not sender_pass:
+                                        print('メール送信元の設定が見つかりません（engage_mail_settings）')
+                                    else:
+                                        if mail_send_mode == 'scheduled':
+                                            # 定時送信
+                                            print(f'メール時刻送信を設定します: {mail_scheduled_time}')
+                                            try:
+                                                company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                                employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                                jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+
+                                                applicant_detail_for_task = {
+                                                    'name': detail.get('name'),
+                                                    'applicant_name': detail.get('name'),
+                                                    'job_title': jt,
+                                                    'company': company_val,
+                                                    'account_name': company_val,
+                                                    'employer_name': employer_val,
+                                                    'employer': employer_val,
+                                                    '会社名': employer_val,
+                                                    'gender': detail.get('gender'),
+                                                    'birth': detail.get('birth'),
+                                                    'age': detail.get('age'),
+                                                    'email': detail.get('email'),
+                                                    'tel': detail.get('tel'),
+                                                    'addr': detail.get('addr'),
+                                                    'school': detail.get('school'),
+                                                }
+                                            except Exception as e:
+                                                print(f'[メール時刻] applicant_detail構築エラー: {e}')
+                                                applicant_detail_for_task = {}
+
+                                            task_ok = create_scheduled_task(
+                                                uid=str(uid),
+                                                task_type='mail',
+                                                task_data={
+                                                    'scheduledTime': mail_scheduled_time,
+                                                    'to': to_email,
+                                                    'template': mail_action.get('body'),
+                                                    'subject': mail_action.get('subject'),
+                                                    'applicant_detail': applicant_detail_for_task,
+                                                    'segment_id': matching_segment.get('id', ''),
+                                                    'oubo_no': detail.get('oubo_no') or '',
+                                                }
+                                            )
+                                            if task_ok:
+                                                print(f'メール時刻送信タスク作成成功: {mail_scheduled_time}')
+                                            else:
+                                                print('メール時刻送信タスク作成失敗')
+
+                                        elif mail_send_mode == 'delayed':
+                                            # 延迟送信
+                                            print(f'メール予約送信を設定します: {mail_delay_minutes}分後')
+                                            from datetime import datetime, timedelta
+                                            next_run_dt = datetime.now() + timedelta(minutes=mail_delay_minutes)
+                                            next_run_timestamp = int(next_run_dt.timestamp())
+
+                                            try:
+                                                company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                                employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                                jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+
+                                                applicant_detail_for_task = {
+                                                    'name': detail.get('name'),
+                                                    'applicant_name': detail.get('name'),
+                                                    'job_title': jt,
+                                                    'company': company_val,
+                                                    'account_name': company_val,
+                                                    'employer_name': employer_val,
+                                                    'employer': employer_val,
+                                                    '会社名': employer_val,
+                                                    'gender': detail.get('gender'),
+                                                    'birth': detail.get('birth'),
+                                                    'age': detail.get('age'),
+                                                    'email': detail.get('email'),
+                                                    'tel': detail.get('tel'),
+                                                    'addr': detail.get('addr'),
+                                                    'school': detail.get('school'),
+                                                }
+                                            except Exception as e:
+                                                print(f'[メール予約] applicant_detail構築エラー: {e}')
+                                                applicant_detail_for_task = {}
+
+                                            task_ok = create_delayed_task(
+                                                uid=str(uid),
+                                                task_type='mail',
+                                                next_run=next_run_timestamp,
+                                                task_data={
+                                                    'delayMinutes': mail_delay_minutes,
+                                                    'to': to_email,
+                                                    'template': mail_action.get('body'),
+                                                    'subject': mail_action.get('subject'),
+                                                    'applicant_detail': applicant_detail_for_task,
+                                                    'segment_id': matching_segment.get('id', ''),
+                                                    'oubo_no': detail.get('oubo_no') or '',
+                                                }
+                                            )
+                                            if task_ok:
+                                                print(f'メール予約送信タスク作成成功: {mail_delay_minutes}分後 ({next_run_dt.strftime("%Y-%m-%d %H:%M:%S")})')
+                                            else:
+                                                print('メール予約送信タスク作成失敗')
+
+                                        else:
+                                            # 即時送信
+                                            try:
+                                                company_val = detail.get('account_name') or detail.get('アカウント名') or detail.get('company')
+                                                employer_val = detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or company_val
+                                                jt = detail.get('job_title') or detail.get('求人タイトル') or detail.get('jobTitle') or ''
+
+                                                mail_data = {
+                                                    'applicant_name': detail.get('name'),
+                                                    'job_title': jt,
+                                                    'company': company_val,
+                                                    'account_name': company_val,
+                                                    'employer_name': employer_val,
+                                                    'employer': employer_val,
+                                                    '会社名': employer_val,
+                                                }
+                                            except Exception:
+                                                mail_data = {}
+
+                                            try:
+                                                subj_to_send = apply_template_tokens(mail_action.get('subject'), mail_data)
+                                                body_to_send = apply_template_tokens(mail_action.get('body'), mail_data)
+                                            except Exception:
+                                                subj_to_send = mail_action.get('subject')
+                                                body_to_send = mail_action.get('body')
+
+                                            dry_run_mail = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+                                            if dry_run_mail:
+                                                print(f"[DRY_RUN_MAIL] would send to {to_email}: {subj_to_send}")
+                                                mail_attempted = True
+                                                mail_ok = True
+                                                mail_info = {'note': 'dry_run'}
+                                            else:
+                                                ok_mail, info_mail = guarded_send(
+                                                    uid, _oubo_no_of(detail), 'mail', (matching_segment or {}).get('id', ''), to_email,
+                                                    lambda: send_mail_once(sender, sender_pass, to_email, subj_to_send, body_to_send))
+                                                mail_attempted = True
+                                                mail_ok = ok_mail
+                                                mail_info = info_mail
+
+                                                # 显示Mail发送结果
+                                                if ok_mail:
+                                                    print(f'✅ MAIL送信完了')
+                                                else:
+                                                    print(f'❌ MAIL送信失敗')
+
+                                            # 単独メール送信の場合は即座に履歴記録（outbox で送信済と判定された場合は書かない）
+                                            if not needs_combined_status and not dry_run_mail and uid and not is_duplicate(mail_info):
+                                                try:
+                                                    rec_status = '送信済（M）' if mail_ok else '送信失敗（M）'
+                                                    rec = {
+                                                        'name': detail.get('name'),
+                                                        'furigana': detail.get('furigana', ''),
+                                                        'gender': detail.get('gender'),
+                                                        'birth': detail.get('birth'),
+                                                        'age': detail.get('age'),
+                                                        'email': to_email,
+                                                        'tel': detail.get('tel'),
+                                                        'addr': detail.get('addr'),
+                                                        'school': detail.get('school'),
+                                                        'oubo_no': detail.get('oubo_no'),
+                                                        'job_title': detail.get('title') or '',
+                                                        'source': 'engage',
+                                                        'platform': 'エンゲージ',
+                                                        'segment_title': matching_segment.get('title'),
+                                                        'status': rec_status,
+                                                        'response': mail_info if isinstance(mail_info, dict) else {'note': str(mail_info)},
+                                                        'sentAt': int(time.time())
+                                                    }
+                                                    write_sms_history(str(uid), rec)
+                                                except Exception as e:
+                                                    print(f'メール履歴記録エラー: {e}')
+
+                            except Exception as e:
+                                print(f'メール送信エラー: {e}')
+
+                        # SMS+Mail両方試行した場合の統合履歴記録（outbox で送信済と判定されたチャネルは含めない）
+                        sms_dup = sms_attempted and is_duplicate(sms_info)
+                        mail_dup = mail_attempted and is_duplicate(mail_info)
+                        if needs_combined_status and ((sms_attempted and not sms_dup) or (mail_attempted and not mail_dup)):
+                            dry_run_env = os.environ.get('DRY_RUN_SMS', 'false').lower() in ('1', 'true', 'yes')
+                            dry_run_mail = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+
+                            if not (dry_run_env and dry_run_mail) and uid:
+                                try:
+                                    # 統合ステータス決定
+                                    if mail_dup:
+                                        combined_status = '送信済（S）' if sms_ok else '送信失敗（S）'
+                                    elif sms_dup:
+                                        combined_status = '送信済（M）' if mail_ok else '送信失敗（M）'
+                                    elif sms_ok and mail_ok:
+                                        combined_status = '送信済（M+S）'
+                                    elif sms_ok and not mail_ok:
+                                        combined_status = '送信済（S）'
+                                    elif not sms_ok and mail_ok:
+                                        combined_status = '送信済（M）'
+                                    else:
+                                        combined_status = '送信失敗（M+S）'
+
+                                    combined_response = {}
+                                    if not sms_dup:
+                                        combined_response['sms'] = sms_info if isinstance(sms_info, dict) else {'note': str(sms_info)}
+                                    if not mail_dup:
+                                        combined_response['mail'] = mail_info if isinstance(mail_info, dict) else {'note': str(mail_info)}
+
+                                    rec = {
+                                        'name': detail.get('name'),
+                                        'furigana': detail.get('furigana', ''),
+                                        'gender': detail.get('gender'),
+                                        'birth': detail.get('birth'),
+                                        'age': detail.get('age'),
+                                        'email': detail.get('email'),
+                                        'tel': detail.get('tel'),
+                                        'addr': detail.get('addr'),
+                                        'school': detail.get('school'),
+                                        'oubo_no': detail.get('oubo_no'),
+                                        'job_title': detail.get('kyujin') or detail.get('title') or '',
+                                        'source': 'engage',
+                                        'platform': 'エンゲージ',
+                                        'segment_title': matching_segment.get('title'),
+                                        'status': combined_status,
+                                        'response': combined_response,
+                                        'sentAt': int(time.time())
+                                    }
+                                    write_sms_history(str(uid), rec)
+                                    print(f'✓ 統合履歴記録: {combined_status}')
+                                except Exception as e:
+                                    print(f'統合履歴記録エラー: {e}')
+
+                    else:
+                        print('× セグメント条件に該当しません（エンゲージ）')
+                        # 対象外として記録
+                        try:
+                            rec = {
+                                'name': detail.get('name'),
+                                'furigana': detail.get('furigana', ''),
+                                'gender': detail.get('gender'),
+                                'birth': detail.get('birth'),
+                                'age': detail.get('age'),
+                                'email': detail.get('email'),
+                                'tel': detail.get('tel'),
+                                'addr': detail.get('addr'),
+                                'employer_name': detail.get('employer_name') or detail.get('会社名') or detail.get('企業名') or '',
+                                'work_prefecture': detail.get('work_prefecture') or detail.get('workPrefecture') or '',
+                                'work_address': detail.get('work_address') or detail.get('workAddress') or '',
+                                'oubo_no': detail.get('oubo_no'),
+                                'job_title': detail.get('title') or '',
+                                'source': 'engage',
+                                'platform': 'エンゲージ',
+                                'status': '対象外',
+                                'response': {'note': 'セグメント条件不一致'},
+                                'sentAt': int(time.time())
+                            }
+                            write_sms_history(str(uid), rec)
+                        except Exception:
+                            pass
+
+            print('[エンゲージ] ブラウザを閉じます...')
+            try:
+                engage.close()
+                print('[エンゲージ] ✓ ブラウザ終了完了')
+            except Exception as close_err:
+                print(f'[エンゲージ] ⚠️  ブラウザ終了エラー: {close_err}')
+
+            print('[エンゲージ] ===== RPA処理完了 =====')
+
+        except Exception as e:
+            print('=' * 60)
+            print('[エンゲージ] ❌ 処理中に例外が発生しました')
+            print('=' * 60)
+            print(f'エラータイプ: {type(e).__name__}')
+            print(f'エラー内容: {e}')
+            print('-' * 60)
+            import traceback
+            traceback.print_exc()
+            print('=' * 60)
+            print('⚠️  エラーが発生しましたが、プログラムは継続します。')
+            print('次のメール処理に進みます...')
+            ok = False
+            # 确保浏览器关闭
+            try:
+                if engage:
+                    engage.close()
+                    print('[エンゲージ] ブラウザを閉じました')
+            except Exception:
+                pass
+
+    except Exception as outer_err:
+        print('=' * 60)
+        print('[エンゲージ] ❌ 予期しないエラーが発生しました')
+        print('=' * 60)
+        print(f'エラータイプ: {type(outer_err).__name__}')
+        print(f'エラー内容: {outer_err}')
+        import traceback
+        traceback.print_exc()
+        print('=' * 60)
+        print('⚠️  プログラムは継続します。')
+        ok = False
+        # 最后的保险措施
+        try:
+            if engage:
+                engage.close()
+        except:
+            pass
+    return ok
+
+
+# ---------- パイプラインの段階 ----------
+def _parse_stage(item):
+    """本文を解析し、処理済みの内容やアカウント名のない通知はここで終える"""
+    platform, label, ledger = item['platform'], item['label'], item['ledger']
+    with stage('parse', platform=platform):
+        body = extract_text_body(item.pop('full_bytes'))
+        parsed = item['format'].parse_body(body)
+    subject = item['subject']
+    if platform == 'jobbox':
+        print(f'[{label}] ---- 求人ボックスの未読メールを検出 ----')
+        print(f'[{label}] 件名:', subject)
+        print(f'[{label}] アカウント名:', parsed['account_name'])
+        print(f'[{label}] アカウントID:', parsed['account_id'])
+        print(f'[{label}] 求人タイトル:', parsed['job_title'])
+        print(f'[{label}] ログインURL（固定）:', parsed['url'])
+    else:
+        print('---- エンゲージの未読メールを検出 ----')
+        print('件名:', subject)
+        print('アカウント名:', parsed['account_name'])
+        print('応募職種:', parsed['job_title'])
+        print('URL:', parsed['url'])
+    # 転送などで Message-ID が違っても、解析結果と元の Date が同じなら処理済みとして扱う
+    ckey = content_key(platform, parsed, item['date_hdr'])
+    set_trace_attrs(account=parsed.get('account_name'))
+    if ledger is not None:
+        hit = ledger.lookup(ckey)
+        if hit:
+            prefix = f'[{label}] ' if platform == 'jobbox' else ''
+            print(f"{prefix}同じ内容の通知を処理済みのためスキップします（{hit['outcome']}）")
+            ledger.record([item['mid_key']], hit['outcome'], platform, parsed.get('account_name') or '')
+            return None
+    # アカウント名が見つかったら自動でログイン処理を実行（求人ボックスのURLは固定値を使用）
+    if platform == 'jobbox':
+        if not parsed.get('account_name'):
+            return None
+        print(f'[{label}] アカウント情報を検出しました。固定URLを使用して自動ログイン処理を実行します。')
+    else:
+        if not (parsed.get('account_name') and parsed.get('url')):
+            print('=' * 50)
+            return None
+        print('エンゲージのアカウント情報を検出しました。自動ログイン処理を実行します。')
+    if ledger is not None:
+        # パイプラインに渡した時点で記録し、結果（done / failed）は最後の段階を出たときに更新する
+        item['ledger_keys'] = [item['mid_key'], ckey]
+        ledger.record(item['ledger_keys'], 'dispatched', platform, parsed.get('account_name') or '')
+    item['parsed'] = parsed
+    item['content_key'] = ckey
+    return item
+
+
+def _resolve_stage(item):
+    """担当アカウントを決める（見つからなければここで終える）"""
+    resolve = _resolve_jobbox_account if item['platform'] == 'jobbox' else _resolve_engage_account
+    account = resolve(item['uid'], item['parsed'], item['label'])
+    if not account:
+        return None
+    item['account'] = account
+    return item
+
+
+def _rpa_stage(item):
+    run = _run_jobbox_rpa if item['platform'] == 'jobbox' else _run_engage_rpa
+    # 応募No のない応募者への送信は、通知の内容キーで二重送信を判定する（送信先だけでは判定しない）
+    with notification_scope(item.get('content_key')):
+        item['rpa_ok'] = run(dict(item['parsed']), item['account'], item['uid'], item['label'])
+    return None
+
+
+def _record_stage(item):
+    if not firestore.write_sms_history(item['uid'], item['doc']):
+        print(f"sms_history の書き込みに失敗しました（応募No: {item['doc'].get('oubo_no') or '-'}）")
+
+
+def _rpa_key(item):
+    # 同じアカウントのジョブは直列、別アカウントはブラウザ予算まで並列に実行
+    parsed = item['parsed']
+    if item['platform'] == 'jobbox':
+        return ('jobbox', _norm_account_key(parsed.get('account_name')), (parsed.get('account_id') or '').strip())
+    return ('engage', _norm_account_key(parsed.get('account_name')))
+
+
+def _record_key(item):
+    # 同じ応募者の履歴（送信結果 → まとめなど）は書き込む順番を保つ
+    return (item['uid'], str(item['doc'].get('oubo_no') or ''))
+
+
+def _bind_stage(fn, stage_name, item):
+    # 計測する段階に媒体 / UID、トレース、プロファイルを付けたまま各段階のスレッドで実行する
+    span = 'rpa_job' if stage_name == 'rpa' else f'{stage_name}_job'
+    return bind_profile(bind_trace(bind_context(fn, platform=item.get('platform')), name=span))
+
+
+def _finish_notification(item, outcome):
+    keys = item.get('ledger_keys')
+    ledger = item.get('ledger')
+    if keys and ledger is not None:
+        # RPA 関数は例外を外に出さないので、戻り値（False = ログイン・詳細の取得などに失敗）も failed にする
+        failed = outcome == FAILED or item.get('rpa_ok') is False
+        ledger.set_outcome(keys, FAILED if failed else DONE)
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_watch_pipeline() -> StagePipeline:
+    """プロセス共通のパイプラインを返す（メールボックスのスレッド間でワーカーとブラウザ予算を共有する）"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            stages = [
+                PipelineStage('parse', _parse_stage, stage_setting('parse', 'workers', 2),
+                              stage_setting('parse', 'queue', 50)),
+                PipelineStage('resolve', _resolve_stage, stage_setting('resolve', 'workers', 4),
+                              stage_setting('resolve', 'queue', 50)),
+                PipelineStage('rpa', _rpa_stage, stage_setting('rpa', 'workers', default_browser_budget()),
+                              stage_setting('rpa', 'queue', 100), key=_rpa_key),
+                PipelineStage('record', _record_stage, stage_setting('record', 'workers', 2),
+                              stage_setting('record', 'queue', 200), key=_record_key, entry=True),
+            ]
+            _pipeline = StagePipeline('watch', stages, bind=_bind_stage, on_finish=_finish_notification)
+            print('[PIPELINE] ' + ' / '.join(f'{st.name} {st.workers}' for st in stages))
+        return _pipeline
+
+
+def write_sms_history(uid, doc):
+    """RPA 段階からの sms_history の書き込みは record 段階に渡す（キューに入れた時点で True）"""
+    return get_watch_pipeline().submit({'uid': uid, 'doc': doc}, stage='record')
+
+
+def watch_mail(imap_host, email_user, email_pass, uid=None, folder='INBOX', poll_seconds=30, label='Mailbox', category='auto'):  # type: ignore
+    import re
+    print(f'[{label}] IMAPサーバー({imap_host})に接続中... User: {email_user}')
+    mailbox_type = (category or 'auto').lower()
+    handle_jobbox = mailbox_type in ('auto', 'jobbox')
+    handle_engage = mailbox_type in ('auto', 'engage')
+    max_unseen_scan = int(os.environ.get('RPA_MAX_UNREAD_SCAN', '50'))
+    try:
+        conn = _imap_connect(imap_host)
+        conn.login(email_user, email_pass)
+        print(f'[{label}] ログインしました。未読メールを監視します')
+    except Exception as e:
+        print(f'[{label}] ❌ ログイン失敗: {e}')
+        return
+
+    try:
+        while True:
+            try:
+                conn.select(folder)
+                # 查找所有未读邮件
+                with stage('imap_search'):
+                    status, data = conn.search(None, 'UNSEEN')
+            except (imaplib.IMAP4.abort, socket.error, ConnectionResetError) as e:
+                print(f'[{label}] ⚠️  IMAP接続が切断されました: {e}')
+                print(f'[{label}] 再接続を試みます...')
+                try:
+                    conn = _imap_connect(imap_host)
+                    conn.login(email_user, email_pass)
+                    conn.select(folder)
+                    print(f'[{label}] ✓ 再接続成功')
+                    status, data = conn.search(None, 'UNSEEN')
+                except Exception as reconnect_err:
+                    print(f'[{label}] ❌ 再接続失敗: {reconnect_err}')
+                    time.sleep(poll_seconds)
+                    continue
+
+            if status != 'OK':
+                time.sleep(poll_seconds)
+                continue
+            ids = data[0].split()
+            total_unseen = len(ids)
+            if total_unseen > max_unseen_scan > 0:
+                ids = ids[-max_unseen_scan:]
+            # print(f"[{label}] [DEBUG] Found {total_unseen} unread emails in {folder}")
+            if not ids:
+                # 没有未读
+                time.sleep(poll_seconds)
+                continue
+            for num in ids:
+                # 通知1通 = 1トレース（TRACING=true のとき。次の通知に進むと前のトレースは閉じる）
+                begin_trace('notification', mailbox=label, uid=uid or '')
+                # PROFILE / シグナル / logs/profiles/PROFILE_NEXT で予約されていればこの通知1通をプロファイルする
+                begin_profile('notification', label)
+                # 先只抓头部，避免把非目标邮件标记为已读
+                try:
+                    with stage('header_fetch'):
+                        status, msg_data = conn.fetch(num, '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM MESSAGE-ID DATE)])')
+                except (imaplib.IMAP4.abort, socket.error, ConnectionResetError) as e:
+                    print(f'[{label}] ⚠️  IMAP接続が切断されました(fetch中): {e}')
+                    print(f'[{label}] 再接続を試みます...')
+                    try:
+                        conn = _imap_connect(imap_host)
+                        conn.login(email_user, email_pass)
+                        conn.select(folder)
+                        print(f'[{label}] ✓ 再接続成功')
+                        # 再次尝试fetch
+                        status, msg_data = conn.fetch(num, '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM MESSAGE-ID DATE)])')
+                    except Exception as reconnect_err:
+                        print(f'[{label}] ❌ 再接続失敗: {reconnect_err}')
+                        break  # 退出当前循环，等待下次监视周期
+                        
+                if status != 'OK' or not msg_data:
+                    continue
+                # msg_data can contain tuples; find the first bytes payload
+                hdr_bytes = None
+                for part in msg_data:
+                    if isinstance(part, tuple) and len(part) > 1 and isinstance(part[1], (bytes, bytearray)):
+                        hdr_bytes = bytes(part[1])
+                        break
+                    if isinstance(part, (bytes, bytearray)):
+                        hdr_bytes = bytes(part)
+                        break
+                subject_raw = ''
+                message_id = ''
+                date_hdr = ''
+                if hdr_bytes:
+                    try:
+                        hdr_msg = email.message_from_bytes(hdr_bytes)
+                        subject_raw = decode_subject(hdr_msg.get('Subject') or '')
+                        message_id = hdr_msg.get('Message-ID') or ''
+                        date_hdr = hdr_msg.get('Date') or ''
+                    except Exception:
+                        try:
+                            raw = hdr_bytes.decode('utf-8', errors='ignore')
+                            subj_match = re.search(r'Subject:\s*(.*)', raw)
+                            subject_raw = decode_subject(subj_match.group(1).strip()) if subj_match else ''
+                        except Exception:
+                            subject_raw = ''
+                
+                # Normalize subject to handle full-width/half-width chars consistently
+                subject = unicodedata.normalize('NFKC', subject_raw) if subject_raw else ''
+                
+                # 件名から通知形式を判定（求人ボックス: 新着応募のお知らせ / エンゲージ: 要対応 + 新着応募）
+                notification_format = detect_format(subject_raw)
+                platform = notification_format.platform if notification_format else ''
+
+                # 処理済み台帳に同じ Message-ID があれば、本文を取得せず既読にして読み飛ばす
+                handled = (handle_jobbox and platform == 'jobbox') or (handle_engage and platform == 'engage')
+                if handled:
+                    set_trace_attrs(platform=platform)
+                else:
+                    discard_trace()
+                    discard_profile()
+                ledger = get_message_ledger() if handled else None
+                mid_key = message_id_key(message_id)
+                if ledger is not None and mid_key:
+                    hit = ledger.lookup(mid_key)
+                    if hit:
+                        print(f"[{label}] 処理済みの通知のためスキップします（{hit['outcome']}）: {subject}")
+                        set_trace_attrs(skipped='ledger')
+                        conn.store(num, '+FLAGS', '\\Seen')
+                        continue
+                
+                # 非求人ボックス・非エンゲージ邮件，保持未读（不 fetch full body），不标记
+                if not handled:
+                    continue
+                # 获取整封邮件正文（不影响已读标记，使用 PEEK）
+                with stage('body_fetch', platform=platform):
+                    status, full = conn.fetch(num, '(BODY.PEEK[])')
+                if status != 'OK' or not full:
+                    continue
+                full_bytes = fetch_payload_bytes(full)
+                if not full_bytes:
+                    continue
+                # 标记为已读（解析以降はパイプラインの各段階で行う）
+                conn.store(num, '+FLAGS', '\\Seen')
+                # キューが満杯なら空くまで待つ（その間は次の通知を取りに行かない）
+                get_watch_pipeline().submit({
+                    'platform': platform, 'label': label, 'uid': uid, 'subject': subject,
+                    'format': notification_format, 'full_bytes': full_bytes, 'date_hdr': date_hdr,
+                    'ledger': ledger, 'mid_key': mid_key,
+                })
+            end_trace()
+            end_profile()
+            time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print('\nRPAを停止しました。終了します')
+    finally:
+        try:
+            conn.close()
+            conn.logout()
+        except Exception:
+            pass
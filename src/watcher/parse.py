@@ -0,0 +1,234 @@
+"""
+通知メール・応募者情報の解釈（ネットワークを使わない処理）
+
+件名のデコード、電話番号の正規化、生年月日からの年齢計算、テンプレートの差し込み、
+セグメント条件（性別・年齢・氏名の種類）の判定。watch_mail / 予約タスク / scheduled_dispatcher の共通部品。
+"""
+
+import os
+import re
+import unicodedata
+from email.header import decode_header
+
+from segment_index import _detect_name_type, get_segment_index
+from stage_metrics import timed
+from template_render import render_template
+
+
+def decode_subject(raw):
+    if not raw:
+        return ''
+    parts = decode_header(raw)
+    subject = ''
+    for part, enc in parts:
+        if isinstance(part, bytes):
+            try:
+                subject += part.decode(enc or 'utf-8')
+            except Exception:
+                subject += part.decode('utf-8', errors='ignore')
+        else:
+            subject += part
+    return subject
+
+
+def normalize_phone_number(number):
+    """Normalize and validate phone number for SMS PUBLISHER.
+
+    Returns (normalized_number, is_valid, reason).
+    - Removes non-digit chars.
+    - If starts with '0' and env SMS_DEFAULT_COUNTRY is set (e.g. '81'),
+      it will convert leading 0 to that country code.
+    - Acceptable lengths: 6..20 digits (provider accepts various lengths);
+      for numbers starting with '0' prefer 10 or 11 (JP style).
+    """
+    if not number:
+        return ('', False, '空の番号')
+    s = re.sub(r"\D+", '', str(number))
+    if not s:
+        return ('', False, '数字が含まれていません')
+
+    # If starts with 0 (national format), optionally add country code
+    if s.startswith('0'):
+        # common Japan handling: 10 or 11 digits
+        if len(s) not in (10, 11):
+            # still allow but mark as suspicious
+            reason = f'国内番号だが長さが期待値外({len(s)})'
+        else:
+            reason = ''
+        default_cc = os.environ.get('SMS_DEFAULT_COUNTRY')
+        if default_cc:
+            # convert to international by replacing leading 0
+            normalized = default_cc + s[1:]
+            return (normalized, True if 6 <= len(normalized) <= 20 else False, reason or '国内->国際変換実施')
+        else:
+            # keep as-is (provider may accept), but validate length
+            valid = len(s) >= 6 and len(s) <= 20
+            return (s, valid, reason or ('長さ不正' if not valid else ''))
+
+    # If already in international format (e.g., starts with country code)
+    if 6 <= len(s) <= 20:
+        return (s, True, '')
+    return (s, False, f'長さが不正({len(s)})')
+
+
+def calc_age_from_birth_str(birth_str):
+    """尝试从各种常见出生日期字符串解析出精确年龄。
+
+    支持格式示例：
+      - "1990年10月30日"
+      - "1990-10-30" / "1990/10/30"
+      - "1990年10月"
+      - 仅年份 "1990"
+
+    返回整数年龄（精确到月日），解析失败返回 None。
+    """
+    if not birth_str:
+        return None
+    try:
+        import re
+        from datetime import datetime
+
+        s = str(birth_str).strip()
+
+        # 1) YYYY年M月D日
+        m = re.search(r"(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日", s)
+        if m:
+            y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+            b = datetime(y, mo, d)
+            today = datetime.now()
+            age = today.year - b.year - ((today.month, today.day) < (b.month, b.day))
+            return age
+
+        # 2) YYYY-M-D or YYYY/M/D
+        m2 = re.search(r"(\d{4})[\-/](\d{1,2})[\-/](\d{1,2})", s)
+        if m2:
+            y, mo, d = int(m2.group(1)), int(m2.group(2)), int(m2.group(3))
+            b = datetime(y, mo, d)
+            today = datetime.now()
+            age = today.year - b.year - ((today.month, today.day) < (b.month, b.day))
+            return age
+
+        # 3) YYYY年M月 (no day) -> assume day=1 for conservative calc
+        m3 = re.search(r"(\d{4})\s*年\s*(\d{1,2})\s*月", s)
+        if m3:
+            y, mo = int(m3.group(1)), int(m3.group(2))
+            b = datetime(y, mo, 1)
+            today = datetime.now()
+            age = today.year - b.year - ((today.month, today.day) < (b.month, b.day))
+            return age
+
+        # 4) Only year
+        m4 = re.search(r"(\d{4})", s)
+        if m4:
+            y = int(m4.group(1))
+            # Fallback to year-only: still return approximate age but indicate it's approximate by returning int
+            from datetime import datetime as _dt
+            return _dt.now().year - y
+
+        return None
+    except Exception:
+        return None
+
+
+def apply_template_tokens(template_text: str, data_map: dict) -> str:
+    """Replace template tokens like {{applicant_name}}, {{job_title}}, {{company}}.
+
+    - data_map: dict that may contain keys 'applicant_name', 'job_title', 'company' or
+      their synonyms. Values will be stringified. If template contains HTML tags,
+      inserted values will be HTML-escaped to avoid injecting raw HTML.
+    - テンプレートはコンパイル済みのものをキャッシュして使う（template_render 参照）。
+      同じテンプレートで複数件を展開する場合は render_many を使う。
+    """
+    return render_template(template_text, data_map)
+
+
+def _match_segment_conditions(applicant_detail, segment_conditions):
+    """
+    Check if applicant matches segment conditions.
+    Returns True ONLY if ALL THREE conditions match: name, gender, and age.
+    
+    applicant_detail: dict with keys like name, age, gender, etc.
+    segment_conditions: dict with nameTypes, genders, ageRanges
+    """
+    # Get applicant data - ALL THREE are required
+    name = applicant_detail.get('name', '').strip()
+    gender = applicant_detail.get('gender', '').strip()  # '男性' or '女性'
+    age = applicant_detail.get('age', 0)
+    
+    # All three fields must be present
+    if not name or not gender or not age:
+        return False
+    
+    # 1. Check name type condition
+    name_type = _detect_name_type(name)
+    name_conditions = segment_conditions.get('nameTypes', {})
+    
+    # Name type condition must be set and match
+    if not name_conditions.get(name_type, False):
+        return False
+    
+    # 2. Check gender condition
+    gender_conditions = segment_conditions.get('genders', {})
+    
+    if gender == '男性':
+        if not gender_conditions.get('male', False):
+            return False
+    elif gender == '女性':
+        if not gender_conditions.get('female', False):
+            return False
+    else:
+        return False  # Unknown gender
+    
+    # 3. Check age range condition
+    age_ranges = segment_conditions.get('ageRanges', {})
+    
+    if gender == '男性':
+        min_age = age_ranges.get('maleMin', 0)
+        max_age = age_ranges.get('maleMax', 999)
+        if not (min_age <= age <= max_age):
+            return False
+    elif gender == '女性':
+        min_age = age_ranges.get('femaleMin', 0)
+        max_age = age_ranges.get('femaleMax', 999)
+        if not (min_age <= age <= max_age):
+            return False
+    
+    # All three conditions passed
+    return True
+
+
+@timed('segment_match')
+def _find_matching_segment(applicant_detail, segments):
+    """
+    Find the first segment that matches the applicant.
+    Returns the matching segment or None.
+    Segments are already sorted by priority.
+
+    判定は priority 順にコンパイルしたインデックス（segment_index）で行う。
+    """
+    index = get_segment_index(segments)
+    pos = index.find_position(applicant_detail)
+    if pos < 0:
+        print(f"セグメント非対象（{len(index)}件中該当なし）")
+        return None
+    segment = index.segments[pos]
+    segment_title = segment.get('title', f'セグメント{pos+1}')
+    print(f"【{segment_title}】対象。")
+    return segment
+
+
+def _oubo_no_of(detail) -> str:
+    """応募No（outbox の冪等キー用）"""
+    try:
+        return str(detail.get('oubo_no') or detail.get('応募No') or detail.get('oubo_no_extracted') or '')
+    except Exception:
+        return ''
+
+
+def _norm_account_key(name):
+    """RPA ジョブのアカウントキー用に名前を正規化（NFKC・空白除去・小文字化）"""
+    if not name:
+        return ''
+    t = unicodedata.normalize('NFKC', name)
+    t = re.sub(r"\s+", '', t)
+    return t.lower()
@@ -0,0 +1,38 @@
+"""
+求人ボックス / エンゲージの管理画面操作（selenium）
+
+JobboxLogin / EngageLogin は selenium を読み込むため、起動時には import せず最初の RPA ジョブで
+jobbox_login_class() / engage_login_class() から取り出す（毎回 import 文を通すので、
+bench/fake_portal.py の install のように sys.modules を差し替えた場合もそちらが使われる）。
+"""
+
+from stage_metrics import timed
+
+
+def jobbox_login_class():
+    """求人ボックスの JobboxLogin（初回呼び出しで jobbox_login と selenium を import する）"""
+    from jobbox_login import JobboxLogin
+    return JobboxLogin
+
+
+def engage_login_class():
+    """エンゲージの EngageLogin（初回呼び出しで engage_login と selenium を import する）"""
+    from engage_login import EngageLogin
+    return EngageLogin
+
+
+@timed('memo_save')
+def safe_set_memo_and_save(jb, memo_text, context=""):
+    """安全地保存memo，处理WebDriverセッション错误"""
+    try:
+        jb.set_memo_and_save(memo_text)
+        return True
+    except Exception as e:
+        error_msg = str(e)
+        if 'HTTPConnectionPool' in error_msg and 'Max retries exceeded' in error_msg:
+            print(f'メモ保存{context}時にWebDriverセッションエラーが発生しました: ブラウザが閉じられた可能性があります')
+        elif 'WebDriver セッションが無効です' in error_msg:
+            print(f'メモ保存{context}時にWebDriverセッションが無効になりました: ブラウザが閉じられた可能性があります')
+        else:
+            print(f'メモ保存{context}時に例外が発生しました: {e}')
+        return False
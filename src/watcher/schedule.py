@@ -0,0 +1,327 @@
+"""
+予約タスク（accounts/{uid}/scheduled_tasks）の実行
+
+scheduled_task_worker が一定間隔で期限の来たタスクを取り出し、dispatch_policy の順番・上限に従って
+SMS / メールを送る。メールは件数が多ければ bulk_mail でまとめて送る。
+"""
+
+import os
+import time
+
+from bulk_mail import bulk_enabled, bulk_min_tasks, send_mail_tasks_bulk
+from dispatch_policy import get_dispatch_policy
+from outbox import DUPLICATE, guarded_send, is_duplicate
+from profiler import profile_run
+
+from . import SRC_DIR
+from .firestore import (
+    _get_mail_settings,
+    get_pending_scheduled_tasks,
+    update_scheduled_task_status,
+    write_sms_history,
+)
+from .parse import apply_template_tokens, normalize_phone_number
+from .send import send_mail_once, send_sms_via_api
+
+
+def execute_scheduled_sms_task(task, write_history=True):
+    """执行SMS定时任务"""
+    uid = task.get('uid', '')
+    to_number = task.get('to', '')
+    template = task.get('template', '')
+    applicant_detail = task.get('applicantDetail', {})
+    oubo_no = task.get('ouboNo', '')
+    
+    print(f'📱 SMS送信: {to_number[:3]}****{to_number[-4:]}')
+    
+    # Normalize phone number
+    norm, ok, reason = normalize_phone_number(to_number)
+    if not ok:
+        print(f'❌ 電話番号エラー: {reason}')
+        return False, f'invalid phone: {reason}'
+    
+    # Apply template tokens
+    try:
+        message = apply_template_tokens(template, applicant_detail)
+    except Exception as e:
+        message = template
+    
+    # Send SMS（outbox: 送信済のタスクを再起動後にもう一度処理しても二重送信しない）
+    success, info = guarded_send(uid, oubo_no, 'sms', f"scheduled:{task.get('segmentId', '')}", norm,
+                                 lambda: send_sms_via_api(uid, norm, message), ref=task.get('id') or '')
+    
+    # Write to history (only if write_history=True)。outbox で送信済と判定された場合は前回書いているので書かない
+    if write_history and uid and not is_duplicate(info):
+        try:
+            rec = {
+                'name': applicant_detail.get('applicant_name', ''),
+                'gender': applicant_detail.get('gender', ''),
+                'birth': applicant_detail.get('birth', ''),
+                'email': applicant_detail.get('email', ''),
+                'tel': norm,
+                'addr': applicant_detail.get('addr', ''),
+                'employer_name': applicant_detail.get('employer_name', '') or applicant_detail.get('会社名', '') or applicant_detail.get('企業名', ''),
+                'work_prefecture': applicant_detail.get('work_prefecture', '') or applicant_detail.get('workPrefecture', ''),
+                'work_address': applicant_detail.get('work_address', '') or applicant_detail.get('workAddress', ''),
+                'school': applicant_detail.get('school', ''),
+                'oubo_no': oubo_no,
+                'job_title': applicant_detail.get('kyujin') or applicant_detail.get('title') or '',
+                'job_url': applicant_detail.get('job_url') or applicant_detail.get('jobUrl') or '',
+                'status': '送信済（S）' if success else '送信失敗（S）',
+                'template': 'scheduled',
+                'response': info if isinstance(info, dict) else {'note': str(info)},
+                'sentAt': int(time.time())
+            }
+            write_sms_history(uid, rec)
+        except Exception as e:
+            print(f'履歴書込エラー: {e}')
+    
+    if success:
+        print(f'✅ SMS送信完了')
+        # 送信済で送らなかった場合は DUPLICATE を返す（まとめて履歴を書く側が記録から外す）
+        return True, (DUPLICATE if is_duplicate(info) else None)
+    else:
+        print(f'❌ SMS送信失敗')
+        return False, str(info) if info else 'unknown error'
+
+
+def execute_scheduled_mail_task(task, write_history=True, sent=None):
+    """执行MAIL定时任务
+
+    sent: 一括送信（bulk_mail）で送信済みの場合の (success, info)。指定時は設定の読込・送信をしない
+    """
+    uid = task.get('uid', '')
+    to_email = task.get('to', '')
+    template = task.get('template', '')
+    subject_template = task.get('subject', '')
+    applicant_detail = task.get('applicantDetail', {})
+    oubo_no = task.get('ouboNo', '')
+    
+    print(f'📧 MAIL送信: {to_email}')
+    
+    if not to_email:
+        print(f'❌ メールアドレスなし')
+        return False, 'no recipient email'
+    
+    if sent is not None:
+        success, info = sent
+    else:
+        # Get mail settings
+        mail_cfg = _get_mail_settings(uid)
+        sender = mail_cfg.get('replyEmail') or mail_cfg.get('email', '')
+        sender_pass = mail_cfg.get('replyAppPass') or mail_cfg.get('appPass', '')
+        
+        if not sender or not sender_pass:
+            print(f'❌ メール設定未完了')
+            return False, 'mail settings not configured'
+        
+        # Apply template tokens
+        try:
+            subject = apply_template_tokens(subject_template, applicant_detail)
+            body = apply_template_tokens(template, applicant_detail)
+        except Exception:
+            subject = subject_template
+            body = template
+        
+        # Send mail（outbox の冪等キーで二重送信を防ぐ）
+        success, info = guarded_send(uid, oubo_no, 'mail', f"scheduled:{task.get('segmentId', '')}", to_email,
+                                     lambda: send_mail_once(sender, sender_pass, to_email, subject, body),
+                                     ref=task.get('id') or '')
+    
+    # Write to history (only if write_history=True)。outbox で送信済と判定された場合は前回書いているので書かない
+    if write_history and uid and not is_duplicate(info):
+        try:
+            rec = {
+                'name': applicant_detail.get('applicant_name', ''),
+                'gender': applicant_detail.get('gender', ''),
+                'birth': applicant_detail.get('birth', ''),
+                'email': to_email,
+                'tel': applicant_detail.get('tel', ''),
+                'addr': applicant_detail.get('addr', ''),
+                'employer_name': applicant_detail.get('employer_name', '') or applicant_detail.get('会社名', '') or applicant_detail.get('企業名', ''),
+                'work_prefecture': applicant_detail.get('work_prefecture', '') or applicant_detail.get('workPrefecture', ''),
+                'work_address': applicant_detail.get('work_address', '') or applicant_detail.get('workAddress', ''),
+                'school': applicant_detail.get('school', ''),
+                'oubo_no': oubo_no,
+                'job_title': applicant_detail.get('kyujin') or applicant_detail.get('title') or '',
+                'job_url': applicant_detail.get('job_url') or applicant_detail.get('jobUrl') or '',
+                'status': '送信済（M）' if success else '送信失敗（M）',
+                'template': 'scheduled',
+                'response': info if isinstance(info, dict) else {'note': str(info)},
+                'sentAt': int(time.time())
+            }
+            write_sms_history(uid, rec)
+        except Exception as e:
+            print(f'履歴書込エラー: {e}')
+    
+    if success:
+        print(f'✅ MAIL送信完了')
+        return True, (DUPLICATE if is_duplicate(info) else None)
+    else:
+        print(f'❌ MAIL送信失敗')
+        return False, str(info) if info else 'unknown error'
+
+
+def process_scheduled_tasks_once(uid):
+    """处理一次待执行的定时任务"""
+    tasks = get_pending_scheduled_tasks(uid)
+    # 同じ時刻に集中したタスクは送信時刻をずらす（SCHEDULE_SPREAD_WINDOW / SCHEDULE_SPREAD_RATE）
+    tasks = get_dispatch_policy().select(tasks)
+    if not tasks:
+        return
+    
+    print(f'⏰ 実行タスク {len(tasks)}件')
+    
+    # 同じ時刻に期限になったメールタスクが多い場合は、送信元ごとにまとめて先に送る（bulk_mail）
+    bulk_sent = {}
+    mail_tasks = [t for t in tasks if t.get('taskType') == 'mail' and t.get('to')]
+    if bulk_enabled() and len(mail_tasks) >= bulk_min_tasks():
+        try:
+            bulk_sent = send_mail_tasks_bulk(mail_tasks, _get_mail_settings)
+        except Exception as e:
+            print(f'一括メール送信エラー（タスクごとに送信します）: {e}')
+            bulk_sent = {}
+    
+    # Group tasks by (uid, oubo_no, scheduledTime) to combine SMS+MAIL into one history record
+    from collections import defaultdict
+    task_groups = defaultdict(list)
+    
+    for task in tasks:
+        oubo_no = task.get('ouboNo', '')
+        scheduled_time = task.get('scheduledTime', '')
+        group_key = (uid, oubo_no, scheduled_time)
+        task_groups[group_key].append(task)
+    
+    # Process each group
+    for group_key, group_tasks in task_groups.items():
+        sms_task = None
+        mail_task = None
+        
+        # Separate SMS and MAIL tasks
+        for task in group_tasks:
+            if task.get('taskType') == 'sms':
+                sms_task = task
+            elif task.get('taskType') == 'mail':
+                mail_task = task
+        
+        # Execute tasks
+        sms_success = False
+        sms_info = {}
+        sms_dup = False
+        mail_success = False
+        mail_info = {}
+        mail_dup = False
+        
+        if sms_task:
+            try:
+                # Execute SMS but DON'T write history in execute_scheduled_sms_task
+                sms_success, sms_error = execute_scheduled_sms_task(sms_task, write_history=False)
+                sms_dup = sms_error == DUPLICATE
+                sms_info = {'note': sms_error} if sms_error else {'status': 'sent'}
+                update_scheduled_task_status(uid, sms_task.get('id'), 'completed' if sms_success else 'failed', sms_error)
+            except Exception as e:
+                sms_info = {'error': str(e)}
+                update_scheduled_task_status(uid, sms_task.get('id'), 'failed', str(e))
+        
+        if mail_task:
+            try:
+                # Execute MAIL but DON'T write history in execute_scheduled_mail_task
+                mail_success, mail_error = execute_scheduled_mail_task(
+                    mail_task, write_history=False, sent=bulk_sent.get(mail_task.get('id')))
+                mail_dup = mail_error == DUPLICATE
+                mail_info = {'note': mail_error} if mail_error else {'status': 'sent'}
+                update_scheduled_task_status(uid, mail_task.get('id'), 'completed' if mail_success else 'failed', mail_error)
+            except Exception as e:
+                mail_info = {'error': str(e)}
+                update_scheduled_task_status(uid, mail_task.get('id'), 'failed', str(e))
+        
+        # outbox で送信済と判定された（今回は送っていない）タスクは前回の履歴があるので記録に含めない
+        sms_part = bool(sms_task) and not sms_dup
+        mail_part = bool(mail_task) and not mail_dup
+
+        # Write COMBINED history record if any task was executed
+        if sms_part or mail_part:
+            try:
+                # Get applicant details from either task (prefer sms_task first)
+                task_with_data = sms_task if sms_task else mail_task
+                if not task_with_data:
+                    continue
+                    
+                applicant_detail = task_with_data.get('applicantDetail', {})
+                oubo_no = task_with_data.get('ouboNo', '')
+                
+                # Determine combined status
+                if sms_part and mail_part:
+                    if sms_success and mail_success:
+                        status = '送信済（M+S）'
+                    elif sms_success and not mail_success:
+                        status = '送信済（S）+送信失敗（M）'
+                    elif not sms_success and mail_success:
+                        status = '送信失敗（S）+送信済（M）'
+                    else:
+                        status = '送信失敗（M+S）'
+                elif sms_part:
+                    status = '送信済（S）' if sms_success else '送信失敗（S）'
+                elif mail_part:
+                    status = '送信済（M）' if mail_success else '送信失敗（M）'
+                else:
+                    status = '送信失敗（S）'
+                
+                # Create combined response
+                combined_response = {}
+                if sms_part and sms_info:
+                    combined_response['sms'] = sms_info
+                if mail_part and mail_info:
+                    combined_response['mail'] = mail_info
+                
+                # Write combined history
+                rec = {
+                    'name': applicant_detail.get('applicant_name', ''),
+                    'gender': applicant_detail.get('gender', ''),
+                    'birth': applicant_detail.get('birth', ''),
+                    'email': applicant_detail.get('email', ''),
+                    'tel': applicant_detail.get('tel', ''),
+                    'addr': applicant_detail.get('addr', ''),
+                    'employer_name': applicant_detail.get('employer_name', '') or applicant_detail.get('会社名', '') or applicant_detail.get('企業名', ''),
+                    'work_prefecture': applicant_detail.get('work_prefecture', '') or applicant_detail.get('workPrefecture', ''),
+                    'work_address': applicant_detail.get('work_address', '') or applicant_detail.get('workAddress', ''),
+                    'school': applicant_detail.get('school', ''),
+                    'oubo_no': oubo_no,
+                    'job_title': applicant_detail.get('kyujin') or applicant_detail.get('title') or '',
+                    'job_url': applicant_detail.get('job_url') or applicant_detail.get('jobUrl') or '',
+                    'status': status,
+                    'template': 'scheduled',
+                    'response': combined_response,
+                    'sentAt': int(time.time())
+                }
+                write_sms_history(uid, rec)
+                print(f'✅ 履歴書込: {status}')
+            except Exception as e:
+                print(f'❌ 履歴書込エラー: {e}')
+
+
+def scheduled_task_worker(uid, stop_event):
+    """后台线程：每5秒检查并执行定时任务（提高时间精确度）"""
+    print('🔄 scheduled_tasks監視開始 ')
+    
+    while not stop_event.is_set():
+        try:
+            with profile_run('scheduled', uid):
+                process_scheduled_tasks_once(uid)
+        except Exception as e:
+            print(f'エラー: {e}')
+            try:
+                import traceback
+                tb = traceback.format_exc()
+                log_dir = os.path.join(os.path.dirname(SRC_DIR), 'logs')
+                if not os.path.exists(log_dir):
+                    os.makedirs(log_dir)
+                with open(os.path.join(log_dir, 'scheduled_errors.log'), 'a', encoding='utf-8') as f:
+                    f.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] UID={uid}\n{tb}\n")
+            except Exception:
+                pass
+        
+        # Wait 5 seconds (improved accuracy for faster response)
+        stop_event.wait(5)
+    
+    print('時刻送信監視停止')
@@ -0,0 +1,475 @@
+"""
+SMS / メールの送信
+
+Gmail SMTP でのメール送信、SMS PUBLISHER への送信（sms_engine）、セグメントに応じた自動返信
+（send_auto_reply_if_configured: 即時送信・時刻指定・遅延送信の振り分けと sms_history の記録）。
+"""
+
+import os
+import re
+import time
+
+from bulk_mail import build_mail_message, smtp_local_hostname, smtp_server
+from firestore_rest import documents_url, service_account_token
+from lazy_import import lazy_module
+from outbox import guarded_send
+from rate_limit import acquire_smtp
+from sms_engine import build_request as build_sms_request
+from sms_engine import send_request as send_sms_request
+from sms_engine import send_sms, to81FromLocal  # noqa: F401
+from smtp_pool import send_message as smtp_send_message
+from stage_metrics import timed
+
+from . import SRC_DIR
+from .firestore import _get_mail_settings, get_api_settings, pick_and_rotate_template, write_sms_history
+from .parse import _oubo_no_of, apply_template_tokens, normalize_phone_number
+
+requests = lazy_module('requests')
+
+
+@timed('mail_send')
+def send_mail_once(from_addr, app_pass, to_addr, subject, body):
+    """Send a single email using SMTP SSL (Gmail compatible).
+
+    from_addr: full email address used as sender
+    app_pass: 16-char app password
+    to_addr: recipient email
+    subject/body: strings
+    Returns (success, info_dict)
+    """
+    if not to_addr:
+        return (False, {'note': 'no recipient'})
+    if not from_addr or not app_pass:
+        return (False, {'note': 'missing sender credentials'})
+    dry = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+    if dry:
+        print(f"[DRY_RUN_MAIL] would send mail from={from_addr} to={to_addr} subj={subject}")
+        return (True, {'note': 'dry_run'})
+    try:
+        # メッセージの組み立ては bulk_mail と共通（UTF-8 の表示名・件名、HTML なら text/plain 付き）
+        msg, from_email, to_email = build_mail_message(from_addr, to_addr, subject, body)
+
+        debug = os.environ.get('DEBUG_MAIL', 'false').lower() in ('1', 'true', 'yes')
+        if debug:
+            print(f"[DEBUG_MAIL] parsed from_email={repr(from_email)} to_email={repr(to_email)}")
+
+        # If we couldn't extract a pure ascii addr-spec for envelope, fail clearly
+        if msg is None:
+            return (False, {'error': 'invalid_envelope_address', 'from_raw': str(from_addr), 'to_raw': str(to_addr), 'note': 'failed to extract ASCII addr-spec for SMTP envelope'})
+
+        smtp_host, smtp_port = smtp_server()
+        if debug:
+            print(f"[DEBUG_MAIL] connecting SMTP_SSL host={smtp_host} port={smtp_port}")
+        # Ensure local_hostname used for EHLO/HELO is ASCII-only to avoid
+        # smtplib attempting to encode a non-ASCII hostname with ascii codec.
+        lh = smtp_local_hostname()
+
+        # 送信元アドレスごとのレート制限（SMTP_RATE_LIMIT）
+        acquire_smtp(from_email)
+        # 送信元ごとにログイン済みの接続を再利用する（smtp_pool、SMTP_POOL=false で毎回接続）
+        if debug:
+            print(f"[DEBUG_MAIL] login as {from_email}")
+            print(f"[DEBUG_MAIL] send_message envelope from={from_email} to={to_email}")
+        # Envelope addresses must be ASCII addr-specs; use parsed emails
+        smtp_send_message(smtp_host, smtp_port, from_email, app_pass, msg, from_email, [to_email],
+                          local_hostname=lh, timeout=20)
+        return (True, {'note': 'sent'})
+    except Exception as e:
+        import traceback
+        tb = traceback.format_exc()
+        return (False, {'error': str(e), 'traceback': tb})
+
+
+def _send_html_mail(from_addr, app_pass, to_addr, subject, html_body):
+    """Send HTML email with automatic fallback to plain text.
+    
+    This function specifically handles HTML content from the rich text editor.
+    """
+    return send_mail_once(from_addr, app_pass, to_addr, subject, html_body)
+
+
+def send_via_sms_publisher(to_number, body, api_cfg):
+    """Send SMS via SMS PUBLISHER (module-level function shared by both jobbox and engage).
+
+    リクエストの組み立て・送信・560 時の 81 形式での再送は sms_engine で共通化している
+    （予約送信の send_sms_via_api と同じ処理）。
+
+    api_cfg keys: baseUrl, apiId, apiPass, auth (optional 'basic'|'bearer'|'params'),
+                  method (optional 'GET'|'POST'), path (optional), fieldTo, fieldMessage
+    Returns: (success, info)
+    """
+    timeout = int(os.environ.get("SMS_PUBLISHER_TIMEOUT", "15"))
+    success, info = send_sms(to_number, body, api_cfg or {}, provider='sms_publisher', read_timeout=timeout)
+    if success and info.get('status_code'):
+        print(f"SMS PUBLISHER returned 2xx for {to_number}: {info.get('status_code')}")
+    elif info.get('status_code'):
+        print(f"SMS PUBLISHER HTTP {info.get('status_code')}: {info.get('text', '')[:1000]}")
+    return (success, info)
+
+
+@timed('sms_send')
+def send_sms_router(to_number, body, provider, api_settings):
+    """Route SMS sending to appropriate provider (module-level function shared by both jobbox and engage).
+    
+    Args:
+        to_number: Phone number to send to
+        body: Message body
+        provider: Provider name (e.g., 'sms_publisher')
+        api_settings: API configuration dict
+    
+    Returns: (success, info)
+    """
+    if provider == 'sms_publisher':
+        return send_via_sms_publisher(to_number, body, api_settings)
+    # fallback: dry run / log
+    dry = os.environ.get('DRY_RUN_SMS') in ('1','true','True')
+    if dry:
+        print(f"[DRY_RUN] SMS ({provider}) => to={to_number} body={body}")
+        return (True, {'note': 'dry_run'})
+    print(f"未対応のプロバイダ: {provider} - ログに記録します。")
+    with open('sms_outbox.log', 'a', encoding='utf-8') as f:
+        f.write(f"{time.time()}\t{provider}\t{to_number}\t{body}\n")
+    return (True, {'note': 'logged'})
+
+
+def send_auto_reply_if_configured(uid, mail_cfg, is_target, detail, jb=None):
+    """If target settings request auto-reply, send mail to candidate.
+
+    This helper can be called for both target and non-target candidates.
+    """
+    try:
+        mail_cfg = mail_cfg or {}
+    except Exception:
+        mail_cfg = {}
+    # Ensure auto is defined regardless of whether exception occurred above
+    auto = bool(mail_cfg.get('autoReply', False))
+    debug = os.environ.get('DEBUG_MAIL', 'false').lower() in ('1', 'true', 'yes')
+    if not auto:
+        if debug:
+            print('[DEBUG_MAIL] autoReply is disabled -> skip sending')
+        return (False, False, {'note': 'autoReply disabled'})
+
+    # Accept multiple possible keys for email address
+    to_email = (
+        detail.get('email')
+        or detail.get('メール')
+        or detail.get('メールアドレス')
+        or detail.get('mail')
+        or detail.get('Mail')
+        or detail.get('emailAddress')
+        or detail.get('Email')
+        or ''
+    )
+    should_send = False
+    if is_target and mail_cfg.get('mailUseTarget', True):
+        should_send = True
+    if (not is_target) and mail_cfg.get('mailUseNonTarget', False):
+        should_send = True
+    if not should_send:
+        if debug:
+            print(f"[DEBUG_MAIL] should_send=false (is_target={is_target}, mailUseTarget={mail_cfg.get('mailUseTarget', True)}, mailUseNonTarget={mail_cfg.get('mailUseNonTarget', False)}) -> skip")
+        return (False, False, {'note': 'send suppressed by mailUseTarget/mailUseNonTarget'})
+    if not to_email:
+        msg = 'メール送信を要求されていますが、送信先メールアドレスがありません。スキップします。'
+        if debug:
+            print('[DEBUG_MAIL]', msg)
+        else:
+            print(msg)
+        return (False, False, {'error': 'missing recipient'})
+
+    subj = mail_cfg.get('mailSubjectA') if is_target else mail_cfg.get('mailSubjectB')
+    body = mail_cfg.get('mailTemplateA') if is_target else mail_cfg.get('mailTemplateB')
+
+    # get sender creds from env or cloud
+    mail_settings = _get_mail_settings(uid) if uid else {}
+    sender = mail_settings.get('replyEmail') or os.environ.get('EMAIL_WATCHER_ADDR') or mail_settings.get('email')
+    sender_pass = mail_settings.get('replyAppPass') or os.environ.get('EMAIL_WATCHER_PASS') or mail_settings.get('appPass')
+    if not sender:
+        msg = '送信元メールアドレスが見つかりません。メール送信をスキップします。'
+        if debug:
+            print('[DEBUG_MAIL]', msg)
+        else:
+            print(msg)
+        return (False, False, {'error': 'missing sender'})
+
+    mail_dry = os.environ.get('DRY_RUN_MAIL', 'false').lower() in ('1', 'true', 'yes')
+    if mail_dry:
+        print(f"[DRY_RUN_MAIL] would send mail from={sender} to={to_email} subj={subj}")
+        if debug:
+            print('[DEBUG_MAIL] DRY_RUN_MAIL is enabled -> no real send')
+        # Treat dry-run as not actually attempted so callers don't treat it as a real send
+        return (False, False, {'note': 'dry_run'})
+
+    # Apply template tokens using detail map if available (detail keys expected by caller)
+    try:
+        data_for_mail = {}
+        # Debug: print detail input to check if employer_name is present
+        if debug:
+            print(f"[DEBUG_MAIL] detail keys: {list(detail.keys()) if isinstance(detail, dict) else 'not dict'}")
+            if isinstance(detail, dict) and 'employer_name' in detail:
+                print(f"[DEBUG_MAIL] detail.employer_name: '{detail.get('employer_name')}'")
+        
+        # Build a rich data map with multiple synonym keys (English + Japanese)
+        if isinstance(detail, dict):
+            # Applicant name
+            name_val = detail.get('name') or detail.get('\u6c0f\u540d') or detail.get('氏名')
+            data_for_mail['applicant_name'] = name_val
+            data_for_mail['name'] = name_val
+            data_for_mail['氏名'] = name_val
+
+            # Job title / position (several possible source keys)
+            jt = (
+                detail.get('job_title')
+                or detail.get('\u6c42\u4eba\u30bf\u30a4\u30c8\u30eb')
+                or detail.get('jobTitle')
+                or detail.get('求人タイトル')
+                or detail.get('職種')
+            )
+            data_for_mail['job_title'] = jt
+            data_for_mail['position'] = jt
+            data_for_mail['jobtitle'] = jt
+            data_for_mail['求人タイトル'] = jt
+            data_for_mail['職種'] = jt
+
+            # Company / account name (several possible source keys)
+            comp = (
+                detail.get('account_name')
+                or detail.get('\u30a2\u30ab\u30a6\u30f3\u30c8\u540d')
+                or detail.get('company')
+                or detail.get('会社名')
+                or detail.get('アカウント名')
+            )
+            data_for_mail['company'] = comp
+            data_for_mail['account_name'] = comp
+            data_for_mail['accountname'] = comp
+            data_for_mail['会社名'] = comp
+            data_for_mail['アカウント名'] = comp
+            # Employer / poster company (distinct from account_name)
+            emp = (
+                detail.get('employer_name')
+                or detail.get('\u6392\u8868\u4f1a\u793e\u540d')
+                or detail.get('掲載企業名')
+                or detail.get('企業名')
+                or detail.get('poster_company')
+            )
+            data_for_mail['employer_name'] = emp
+            data_for_mail['employer'] = emp
+            data_for_mail['掲載企業名'] = emp
+            data_for_mail['企業名'] = emp
+            data_for_mail['会社名'] = emp  # 追加：会社名トークン用
+    except Exception:
+        data_for_mail = {}
+
+    try:
+        # Debug print of the data map and raw templates to help diagnose missing fields
+        if debug:
+            try:
+                printable = {}
+                for k, v in (data_for_mail or {}).items():
+                    try:
+                        printable[k] = (v[:120] + '...') if isinstance(v, str) and len(v) > 120 else v
+                    except Exception:
+                        printable[k] = v
+                print('[DEBUG_MAIL] data_for_mail:', printable)
+                print('[DEBUG_MAIL] raw subj:', (subj or '')[:200])
+                print('[DEBUG_MAIL] raw body :', re.sub(r'\s+', ' ', (body or ''))[:300])
+            except Exception:
+                pass
+        subj_to_send = apply_template_tokens(subj or '', data_for_mail)
+        body_to_send = apply_template_tokens(body or '', data_for_mail)
+
+        # Diagnostic: if template contains tokens whose values are empty, log details
+        try:
+            token_re = re.compile(r"{{\s*([a-zA-Z0-9_\u3040-\u30ff\u4e00-\u9fff]+)\s*}}")
+            raw_tokens = set(token_re.findall((subj or '') + ' ' + (body or '')))
+            missing = []
+            if raw_tokens:
+                for tk in raw_tokens:
+                    k = tk.lower()
+                    val = ''
+                    # resolve similarly to apply_template_tokens
+                    if k in ('applicant_name', 'applicant', 'name', '氏名'):
+                        val = (data_for_mail.get('applicant_name') or data_for_mail.get('name') or data_for_mail.get('氏名') or '')
+                    elif k in ('position', 'job_title', 'jobtitle', '求人タイトル', '職種'):
+                        val = (data_for_mail.get('job_title') or data_for_mail.get('position') or data_for_mail.get('求人タイトル') or data_for_mail.get('職種') or '')
+                    elif k in ('employer_name', 'employer', 'poster_company', '掲載企業名', '企業名', '会社名'):
+                        val = (data_for_mail.get('employer_name') or data_for_mail.get('employer') or data_for_mail.get('poster_company') or data_for_mail.get('企業名') or data_for_mail.get('掲載企業名') or data_for_mail.get('会社名') or '')
+                    elif k in ('company', 'account_name', 'accountname', 'アカウント名'):
+                        val = (data_for_mail.get('company') or data_for_mail.get('account_name') or data_for_mail.get('accountname') or data_for_mail.get('アカウント名') or '')
+                    else:
+                        val = data_for_mail.get(tk) or data_for_mail.get(k) or ''
+                    if not val:
+                        missing.append(tk)
+            if missing:
+                try:
+                    import datetime
+                    ts = datetime.datetime.utcnow().isoformat() + 'Z'
+                    logline = {
+                        'ts': ts,
+                        'uid': uid,
+                        'to': to_email,
+                        'missing_tokens': missing,
+                        'raw_subj': (subj or '')[:300],
+                        'raw_body_excerpt': re.sub(r'\s+', ' ', (body or ''))[:400],
+                    }
+                    # Trim data_for_mail for logging
+                    printable = {}
+                    for k, v in (data_for_mail or {}).items():
+                        try:
+                            s = v if v is not None else ''
+                            s = str(s)
+                            printable[k] = s[:200] + '...' if len(s) > 200 else s
+                        except Exception:
+                            printable[k] = ''
+                    logline['data_for_mail'] = printable
+                    try:
+                        os.makedirs(os.path.join(os.getcwd(), 'logs'), exist_ok=True)
+                        with open(os.path.join(os.getcwd(), 'logs', 'watcher.log'), 'a', encoding='utf-8') as lf:
+                            lf.write(str(logline) + '\n')
+                    except Exception:
+                        pass
+                    if debug:
+                        print('[DEBUG_MAIL] missing token values detected:', logline)
+                except Exception:
+                    pass
+        except Exception:
+            pass
+    except Exception:
+        subj_to_send = subj or ''
+        body_to_send = body or ''
+
+    # 同じ応募への自動返信は1回だけ（outbox の冪等キー: uid + 応募No（なければ通知の内容キー）+ mail + autoReply）
+    ok_mail, info_mail = guarded_send(uid, _oubo_no_of(detail), 'mail', 'autoReply', to_email,
+                                      lambda: send_mail_once(sender, sender_pass, to_email, subj_to_send, body_to_send))
+    if ok_mail:
+        print(f"メール送信成功: to={to_email}")
+        try:
+            # NOTE: remove direct memo write here to avoid duplicate memo lines.
+            # The caller will construct a mail_note and call jb.set_memo_and_save once.
+            pass
+        except Exception:
+            pass
+        return (True, True, info_mail if isinstance(info_mail, dict) else {'note': str(info_mail)})
+    else:
+        print(f"メール送信失敗: to={to_email} info={info_mail}")
+        return (True, False, info_mail if isinstance(info_mail, dict) else {'note': str(info_mail)})
+
+
+def send_sms_via_api(uid, to_number, message):
+    """通过API发送SMS (用于定时任务执行) - 与即时送信使用相同的逻辑（sms_engine）
+    
+    Returns: (success, info)
+    """
+    api_cfg = get_api_settings(uid) or {}
+    if not api_cfg.get('baseUrl'):
+        return False, {'note': 'no base URL configured'}
+    timeout = int(os.environ.get('SMS_PUBLISHER_TIMEOUT', '30'))
+    return send_sms(to_number, message, api_cfg, provider='sms_publisher', read_timeout=timeout)
+
+
+def send_sms_once(uid, to_number, template_type=None, live=False):
+    """Send a single SMS using account uid. Returns (success, info).
+
+    template_type: 'A' or 'B'
+    live: if True, actually perform HTTP request; if False, just print constructed request.
+    """
+    # Read API settings
+    api_cfg = get_api_settings(uid) or {}
+    provider = (api_cfg.get('provider') or 'sms_publisher')
+    base = api_cfg.get('baseUrl')
+    if not base:
+        return (False, 'no baseUrl configured for uid')
+
+    # Read templates from target_settings
+    def _get_target_settings_top(uid):
+        sa_candidates = [
+            os.path.join(os.getcwd(), 'service-account'),
+            os.path.join(SRC_DIR, '..', 'service-account'),
+            os.path.join(os.path.dirname(SRC_DIR), '..', 'service-account'),
+            os.path.join(os.getcwd(), 'src', 'service-account'),
+        ]
+        sa_file = None
+        for c in sa_candidates:
+            if os.path.isfile(c):
+                sa_file = c; break
+        if not sa_file:
+            return {}
+        try:
+            import json
+            with open(sa_file, 'r', encoding='utf-8') as f:
+                sa = json.load(f)
+            token = service_account_token(sa)
+        except Exception:
+            return {}
+        project = sa.get('project_id')
+        if not project:
+            return {}
+        url = f'{documents_url(project)}/accounts/{uid}/target_settings/settings'
+        headers = {'Authorization': f'Bearer {token}'}
+        try:
+            r = requests.get(url, headers=headers, timeout=10)
+            if r.status_code != 200:
+                return {}
+            data = r.json()
+            fields = data.get('fields', {})
+            res = {}
+            res['smsTemplateA'] = fields.get('smsTemplateA', {}).get('stringValue')
+            res['smsTemplateB'] = fields.get('smsTemplateB', {}).get('stringValue')
+            return res
+        except Exception:
+            return {}
+
+    # Pick template based on target_settings and rotate nextSmsTemplate.
+    # NOTE: This uses the module-level pick_and_rotate_template (best-effort GET then PATCH).
+
+    ts = _get_target_settings_top(uid)
+    tpl = None
+    # If caller explicitly passed 'A' or 'B', use it; otherwise consult cloud settings via rotation helper
+    if template_type in ('A', 'B'):
+        chosen_type = template_type
+    else:
+        chosen_type = pick_and_rotate_template(uid)
+    if chosen_type == 'A':
+        tpl = ts.get('smsTemplateA')
+    else:
+        tpl = ts.get('smsTemplateB')
+    if not tpl:
+        return (False, 'no template found')
+
+    # Normalize number
+    norm, ok, reason = normalize_phone_number(to_number)
+    if not ok:
+        return (False, f'phone invalid: {reason}')
+
+    # Build request per provider (only sms_publisher currently supported)
+    if provider != 'sms_publisher':
+        return (False, f'unsupported provider: {provider}')
+    try:
+        req = build_sms_request(api_cfg, norm, tpl, provider)
+    except Exception as e:
+        return (False, {'error': str(e)})
+    req.read_timeout = 15
+
+    # Show constructed request
+    desc = req.describe()
+    print('--- SMS送信（構築内容）---')
+    print('URL:', desc['url'])
+    print('Method:', desc['method'])
+    print('Headers:', desc['headers'])
+    print('Params:', desc['params'])
+    print('Form data:', desc['data'])
+
+    if not live:
+        return (True, 'dry run, no request sent')
+
+    success, info = send_sms_request(req)
+    print('送信成功' if success else '送信失敗', info)
+    try:
+        # record the actual chosen_type used for this send
+        status_code = info.get('status_code') if isinstance(info, dict) else None
+        status = '送信済（S）' if success else (f'送信失敗（S）{status_code}' if status_code else '送信失敗（S）')
+        rec = {'tel': norm, 'status': status, 'response': info, 'sentAt': int(time.time()), 'template': chosen_type}
+        write_sms_history(uid, rec)
+    except Exception:
+        pass
+    return (success, info)